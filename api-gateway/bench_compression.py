@@ -0,0 +1,108 @@
+"""Benchmark of response compression: CPU cost against bytes saved, per algorithm and level.
+
+Payloads mimic appointment-service responses: one appointment, list pages of
+50 and 200 appointments, and a 10k-row NDJSON export. The export is encoded
+the way the gateway streams it, in 64 KiB chunks flushed one by one; the
+other payloads in a single call. Each case runs through the same encoders
+CompressionMiddleware uses.
+
+    python bench_compression.py --repeat 20
+"""
+import argparse
+import json
+import time
+from typing import Any, Dict, List, Tuple
+
+from compression import ENCODERS
+
+LEVELS: Dict[str, Tuple[int, ...]] = {
+    "gzip": (1, 6, 9),
+    "br": (1, 4, 6, 11),
+    "zstd": (1, 3, 9),
+}
+EXPORT_CHUNK = 65536
+
+
+def appointment(i: int) -> Dict[str, Any]:
+    return {
+        "patient_name": f"Paciente {i} Gómez",
+        "patient_email": f"paciente{i}@example.com",
+        "doctor_name": f"Dra. Ana Torres {i % 40}",
+        "doctor_specialty": ("Cardiología", "Pediatría", "Medicina General", "Dermatología")[i % 4],
+        "appointment_time": f"2030-{1 + i % 12:02d}-{1 + i % 28:02d}T{8 + i % 10:02d}:{(i % 2) * 30:02d}:00",
+        "status": ("scheduled", "completed", "cancelled")[i % 3],
+        "notes": "Primera consulta de chequeo." if i % 3 == 0 else None,
+        "id": 100000 + i,
+        "created_at": f"2030-01-{1 + i % 28:02d}T10:{i % 60:02d}:{(i * 7) % 60:02d}",
+        "updated_at": f"2030-01-{1 + i % 28:02d}T11:{i % 60:02d}:{(i * 7) % 60:02d}",
+    }
+
+
+def payloads() -> Dict[str, List[bytes]]:
+    """name -> chunks, as the gateway would receive them"""
+    export = b"".join(json.dumps(appointment(i)).encode() + b"\n" for i in range(10000))
+    return {
+        "single": [json.dumps(appointment(1)).encode()],
+        "page_50": [json.dumps([appointment(i) for i in range(50)]).encode()],
+        "page_200": [json.dumps([appointment(i) for i in range(200)]).encode()],
+        "export_10k": [export[i:i + EXPORT_CHUNK] for i in range(0, len(export), EXPORT_CHUNK)],
+    }
+
+
+def encode(encoding: str, level: int, chunks: List[bytes]) -> int:
+    encoder = ENCODERS[encoding](level)
+    size = 0
+    for chunk in chunks[:-1]:
+        size += len(encoder.compress(chunk))
+    return size + len(encoder.finish(chunks[-1]))
+
+
+def run(repeat: int) -> List[Dict[str, Any]]:
+    results = []
+    for name, chunks in payloads().items():
+        original = sum(len(chunk) for chunk in chunks)
+        for encoding, levels in LEVELS.items():
+            if encoding not in ENCODERS:
+                continue
+            for level in levels:
+                size = encode(encoding, level, chunks)
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    encode(encoding, level, chunks)
+                elapsed = (time.perf_counter() - start) / repeat
+                results.append({
+                    "payload": name,
+                    "encoding": encoding,
+                    "level": level,
+                    "original_bytes": original,
+                    "compressed_bytes": size,
+                    "ratio": round(original / size, 2),
+                    "saved_pct": round(100 * (1 - size / original), 1),
+                    "cpu_us": round(elapsed * 1e6, 1),
+                    "mb_per_s": round(original / elapsed / 1e6, 1),
+                    # CPU spent per KiB the client does not have to download
+                    "us_per_kib_saved": round(elapsed * 1e6 / max(original - size, 1) * 1024, 2),
+                })
+    return results
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20, help="encodings per case")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'payload':<11} {'encoding':<5} {'lvl':>3} {'bytes':>9} {'->':>9} {'saved':>7} "
+          f"{'cpu us':>10} {'MB/s':>8} {'us/KiB saved':>13}")
+    for r in results:
+        print(f"{r['payload']:<11} {r['encoding']:<5} {r['level']:>3} {r['original_bytes']:>9} "
+              f"{r['compressed_bytes']:>9} {r['saved_pct']:>6}% {r['cpu_us']:>10} {r['mb_per_s']:>8} "
+              f"{r['us_per_kib_saved']:>13}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,175 @@
+"""Benchmark of the appointments proxy against a local stub upstream.
+
+Compares the shared, pooled upstream client (current behavior) with a new
+httpx.AsyncClient per request (previous behavior). The gateway app is driven
+in-process through httpx.ASGITransport; only the gateway -> upstream hop
+goes over TCP, to a stub server started on localhost.
+
+    python bench_proxy.py --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import socket
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List
+
+import httpx
+import uvicorn
+from jose import jwt
+
+import main
+from rate_limit import Limit
+
+
+def stub_payload(rows: int) -> bytes:
+    appointment = {
+        "id": 1,
+        "patient_name": "Juan Perez",
+        "patient_email": "juan.perez@example.com",
+        "doctor_name": "Dra. Ana Torres",
+        "doctor_specialty": "Cardiología",
+        "appointment_time": "2024-07-01T09:00:00",
+        "status": "scheduled",
+        "notes": "Primera consulta de chequeo.",
+        "created_at": "2024-06-13T10:00:00",
+        "updated_at": "2024-06-13T10:00:00",
+    }
+    return json.dumps([dict(appointment, id=i) for i in range(rows)]).encode()
+
+
+def make_stub_app(body: bytes):
+    """Minimal ASGI upstream that always answers with the same JSON body"""
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    return app
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_stub_upstream(body: bytes) -> uvicorn.Server:
+    port = free_port()
+    config = uvicorn.Config(
+        make_stub_app(body), host="127.0.0.1", port=port, log_level="warning", access_log=False
+    )
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    main.APPOINTMENT_SERVICE_URL = f"http://127.0.0.1:{port}"
+    main.balancer = main.create_balancer([main.APPOINTMENT_SERVICE_URL])
+    return server
+
+
+class PerRequestClient:
+    """Previous behavior: a new AsyncClient (and TCP connection) for every request"""
+
+    def build_request(self, method: str, url: str, **kwargs: Any) -> httpx.Request:
+        return httpx.Request(method, url, **kwargs)
+
+    async def send(self, request: httpx.Request, stream: bool = False) -> httpx.Response:
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            resp = await client.send(request)
+
+        async def body():
+            yield resp.content
+
+        return httpx.Response(resp.status_code, headers=resp.headers, content=body(), request=request)
+
+    async def aclose(self) -> None:
+        pass
+
+
+async def run_scenario(name: str, upstream_client: Any, requests: int, concurrency: int) -> Dict[str, Any]:
+    token = jwt.encode(
+        {"sub": "bench", "exp": datetime.now(timezone.utc) + timedelta(minutes=30)},
+        main.SECRET_KEY,
+        algorithm=main.ALGORITHM,
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    main.http_client = upstream_client
+    # A subject limit the bench never reaches, so the per-request check is part of the measurement
+    main.RATE_LIMIT_SUBJECT = Limit(rate=1e9, burst=10**9)
+    latencies: List[float] = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://gateway") as gateway:
+
+        async def worker() -> None:
+            nonlocal errors
+            for _ in remaining:
+                start = time.perf_counter()
+                resp = await gateway.get("/appointments/appointments/", headers=headers)
+                latencies.append(time.perf_counter() - start)
+                if resp.status_code != 200:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    await upstream_client.aclose()
+    latencies.sort()
+    return {
+        "scenario": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        "errors": errors,
+    }
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    server = start_stub_upstream(stub_payload(args.rows))
+    try:
+        results = [
+            await run_scenario("per_request_client", PerRequestClient(), args.requests, args.concurrency),
+            await run_scenario("shared_client", main.create_http_client(), args.requests, args.concurrency),
+        ]
+    finally:
+        server.should_exit = True
+    return results
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=20, help="appointments in the stub response")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'scenario':<20} {'rps':>10} {'p50 ms':>10} {'p99 ms':>10} {'errors':>8}")
+    for r in results:
+        print(f"{r['scenario']:<20} {r['rps']:>10} {r['p50_ms']:>10} {r['p99_ms']:>10} {r['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main_cli()
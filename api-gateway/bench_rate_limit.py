@@ -0,0 +1,73 @@
+"""Microbenchmark of the per-request cost of rate limiting and load shedding.
+
+Times the decisions the proxy makes on every request, in the in-memory
+backend: one subject bucket, subject + route buckets, rejected requests, and
+the adaptive concurrency limit's try_acquire/release pair. Subjects are drawn
+from --subjects distinct keys so the LRU holds a realistic number of buckets.
+
+    python bench_rate_limit.py --decisions 200000
+"""
+import argparse
+import json
+import time
+from typing import Any, Callable, Dict, List
+
+from rate_limit import AdaptiveConcurrencyLimit, InMemoryRateLimiter, Limit
+
+SUBJECT_LIMIT = Limit(rate=1e9, burst=10**9)
+ROUTE_LIMIT = Limit(rate=1e9, burst=10**9)
+EXHAUSTED = Limit(rate=1e-9, burst=1)
+
+
+def measure(decisions: int, decide: Callable[[int], Any]) -> float:
+    """Microseconds per decision"""
+    start = time.perf_counter()
+    for i in range(decisions):
+        decide(i)
+    return (time.perf_counter() - start) / decisions * 1e6
+
+
+def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    limiter = InMemoryRateLimiter(max_keys=args.subjects)
+    subjects = [f"subject:user-{i}" for i in range(args.subjects)]
+    route = ("route:GET /appointments/{path}", ROUTE_LIMIT)
+    limiter.acquire_now([("subject:spent", EXHAUSTED)])
+    concurrency = AdaptiveConcurrencyLimit(100, 5, 200, latency_target=1.0)
+
+    def concurrency_slot(i: int) -> None:
+        concurrency.try_acquire()
+        concurrency.release(0.01)
+
+    cases = {
+        "subject bucket": lambda i: limiter.acquire_now([(subjects[i % args.subjects], SUBJECT_LIMIT)]),
+        "subject + route buckets": lambda i: limiter.acquire_now(
+            [(subjects[i % args.subjects], SUBJECT_LIMIT), route]
+        ),
+        "rejected (429)": lambda i: limiter.acquire_now([("subject:spent", EXHAUSTED)]),
+        "concurrency slot": concurrency_slot,
+    }
+    results = []
+    for name, decide in cases.items():
+        measure(args.decisions // 10, decide)  # warm-up: fill the LRU
+        results.append({"case": name, "us_per_decision": round(measure(args.decisions, decide), 3)})
+    return results
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--decisions", type=int, default=200000, help="decisions timed per case")
+    parser.add_argument("--subjects", type=int, default=10000, help="distinct JWT subjects")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'case':<25} {'us/decision':>12}")
+    for r in results:
+        print(f"{r['case']:<25} {r['us_per_decision']:>12}")
+
+
+if __name__ == "__main__":
+    main_cli()
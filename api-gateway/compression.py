@@ -0,0 +1,261 @@
+"""Negotiated response compression for the gateway: gzip, brotli (br) and zstd.
+
+The encoding is picked from the client's Accept-Encoding (highest q-value,
+ties broken by the configured preference order). Bodies are compressed as
+they stream: each chunk is flushed through the encoder, so a proxied export
+reaches the client progressively instead of after the last byte.
+
+Responses are left untouched when:
+- the upstream already encoded them (Content-Encoding set): never recompressed;
+- they are smaller than minimum_size, judged by Content-Length or, for streams
+  without one, by buffering up to minimum_size bytes;
+- the media type is not text-like, the status has no body, or Cache-Control
+  says no-transform.
+
+A compressed response gets Vary: Accept-Encoding, loses its Content-Length
+and has a strong ETag turned weak, since its bytes differ from the identity
+representation. appointment-service compares ETags weakly, so If-None-Match
+keeps working through the gateway.
+
+brotli and zstd need the brotli and zstandard packages; encodings whose
+package is missing are skipped.
+"""
+import functools
+import zlib
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+COMPRESSIBLE_TYPES = frozenset({
+    "application/json",
+    "application/x-ndjson",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+})
+# Statuses whose responses carry no body
+NO_BODY_STATUSES = frozenset({204, 304})
+
+
+class GzipEncoder:
+    def __init__(self, level: int) -> None:
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        # Z_SYNC_FLUSH ends each chunk on a byte boundary so the client can decode it now
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self, level: int) -> None:
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+class ZstdEncoder:
+    def __init__(self, level: int) -> None:
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self, data: bytes) -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush()
+
+
+ENCODERS: Dict[str, Callable[[int], object]] = {"gzip": GzipEncoder}
+if brotli is not None:
+    ENCODERS["br"] = BrotliEncoder
+if zstandard is not None:
+    ENCODERS["zstd"] = ZstdEncoder
+
+
+def available_encodings(requested: Iterable[str]) -> Tuple[str, ...]:
+    """requested, in order, without the encodings whose package is not installed"""
+    return tuple(name for name in requested if name in ENCODERS)
+
+
+@functools.lru_cache(maxsize=256)
+def negotiate(accept_encoding: str, encodings: Tuple[str, ...]) -> Optional[str]:
+    """Encoding to use for this Accept-Encoding (RFC 9110, section 12.5.3), or None for identity.
+
+    Cached: clients send a handful of distinct Accept-Encoding values.
+    """
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[name] = q
+    wildcard = weights.get("*", 0.0)
+    best, best_q = None, 0.0
+    for name in encodings:
+        q = weights.get(name, wildcard)
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    media_type = content_type.split(";", 1)[0].strip().lower()
+    return (
+        media_type.startswith("text/")
+        or media_type.endswith("+json")
+        or media_type in COMPRESSIBLE_TYPES
+    )
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing HTTP responses with the negotiated encoding.
+
+    levels maps an encoding to its level (gzip 1-9, br 0-11, zstd 1-22).
+    on_response(encoding, original_bytes, sent_bytes) is called once per
+    response body it handled, with encoding "identity" when it was left as is
+    and "passthrough" when the upstream had already encoded it.
+    """
+
+    def __init__(
+        self,
+        app,
+        encodings: Iterable[str] = ("br", "zstd", "gzip"),
+        minimum_size: int = 1024,
+        levels: Optional[Dict[str, int]] = None,
+        on_response: Optional[Callable[[str, int, int], None]] = None,
+    ) -> None:
+        self.app = app
+        self.encodings = available_encodings(encodings)
+        self.minimum_size = minimum_size
+        self.levels = {"gzip": 6, "br": 4, "zstd": 3, **(levels or {})}
+        self.on_response = on_response
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or not self.encodings or scope["method"] == "HEAD":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = Headers(scope=scope).get("accept-encoding")
+        encoding = negotiate(accept_encoding, self.encodings) if accept_encoding else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressingSend(send, encoding, self.levels[encoding], self.minimum_size, self.on_response)
+        await self.app(scope, receive, responder)
+
+
+class _CompressingSend:
+    """The send callable of one response; http.response.start waits for the first body chunk"""
+
+    PENDING, IDENTITY, COMPRESS = range(3)
+
+    def __init__(self, send, encoding: str, level: int, minimum_size: int, on_response) -> None:
+        self.send = send
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.on_response = on_response
+        self.state = self.PENDING
+        self.label = "identity"
+        self.start = None
+        self.buffer = b""
+        self.encoder = None
+        self.original = 0
+        self.sent = 0
+
+    async def __call__(self, message) -> None:
+        if message["type"] == "http.response.start":
+            # Relayed upstream headers keep their original case; Headers expects lowercase names
+            self.start = {**message, "headers": [(name.lower(), value) for name, value in message["headers"]]}
+            self._decide(Headers(raw=self.start["headers"]), message["status"])
+            return
+        if message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        self.original += len(body)
+        if self.state == self.PENDING:
+            # No Content-Length: buffer until the body proves large enough, or ends
+            self.buffer += body
+            if more_body and len(self.buffer) < self.minimum_size:
+                return
+            body, self.buffer = self.buffer, b""
+            if len(body) < self.minimum_size:
+                self.state = self.IDENTITY
+            else:
+                self._start_compressing()
+        if self.state == self.COMPRESS:
+            body = self.encoder.compress(body) if more_body else self.encoder.finish(body)
+        if self.start is not None:
+            await self._send_start(body, more_body)
+        if body or not more_body:
+            self.sent += len(body)
+            await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+        if not more_body and self.on_response is not None:
+            self.on_response(self.label, self.original, self.sent)
+
+    def _decide(self, headers: Headers, status: int) -> None:
+        if headers.get("content-encoding"):
+            self.state = self.IDENTITY
+            self.label = "passthrough"
+        elif (
+            status in NO_BODY_STATUSES
+            or status < 200
+            or not is_compressible(headers.get("content-type", ""))
+            or "no-transform" in headers.get("cache-control", "").lower()
+        ):
+            self.state = self.IDENTITY
+        elif headers.get("content-length") is not None:
+            # Size known up front: no need to buffer
+            if int(headers["content-length"]) < self.minimum_size:
+                self.state = self.IDENTITY
+            else:
+                self._start_compressing()
+
+    def _start_compressing(self) -> None:
+        self.state = self.COMPRESS
+        self.label = self.encoding
+        self.encoder = ENCODERS[self.encoding](self.level)
+
+    async def _send_start(self, body: bytes, more_body: bool) -> None:
+        start, self.start = self.start, None
+        if self.state == self.COMPRESS:
+            headers = MutableHeaders(raw=list(start["headers"]))
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("etag")
+            if etag is not None and not etag.startswith("W/"):
+                headers["ETag"] = "W/" + etag
+            if more_body:
+                del headers["Content-Length"]
+            else:
+                # The whole body fitted in the first chunk: its length is known
+                headers["Content-Length"] = str(len(body))
+            start = {**start, "headers": headers.raw}
+        await self.send(start)
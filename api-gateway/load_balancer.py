@@ -0,0 +1,205 @@
+"""Client-side load balancing across appointment-service instances.
+
+Each request goes to one instance picked among the available ones, that is
+healthy by the active checks, not ejected and with its circuit not open:
+
+- least_outstanding: the instance with the fewest requests waiting for an answer;
+- p2c (power of two choices): the better of two instances drawn at random,
+  nearly as even as least_outstanding without every request looking at
+  every instance, and without herding onto whichever instance is idle.
+
+Load is weighed as (outstanding + 1) / weight. An instance coming back (health
+check passing again, ejection over) starts with a low weight that grows
+linearly to 1 over slow_start seconds, so it warms its caches and pools before
+it gets a full share.
+
+Active health checks GET health_path on every instance each interval; it takes
+unhealthy_threshold failures in a row to take an instance out and
+healthy_threshold successes to put it back. Passive outlier ejection watches
+real traffic: consecutive_failures failed requests in a row (transport error
+or 5xx) eject the instance for ejection_seconds, times the number of recent
+ejections, up to max_ejection_seconds. At most max_ejection_percent of the
+instances are ejected at once.
+"""
+import asyncio
+import math
+import random
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+import httpx
+
+from resilience import ResilientUpstream
+
+POLICIES = ("least_outstanding", "p2c")
+# Weight of an instance when its slow start begins
+MIN_WEIGHT = 0.1
+
+
+class Instance:
+    """One upstream instance, as the balancer sees it"""
+
+    def __init__(self, url: str, upstream: ResilientUpstream) -> None:
+        self.url = url
+        self.upstream = upstream
+        # Optimistic: serve from the start, the first health checks correct it
+        self.healthy = True
+        self.check_successes = 0
+        self.check_failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = -math.inf
+        self.available_since = -math.inf
+
+    @property
+    def outstanding(self) -> int:
+        return self.upstream.outstanding
+
+    def ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def weight(self, now: float, slow_start: float) -> float:
+        elapsed = now - self.available_since
+        if slow_start <= 0 or elapsed >= slow_start:
+            return 1.0
+        return max(MIN_WEIGHT, elapsed / slow_start)
+
+
+class LoadBalancer:
+    """Picks an instance per request and keeps track of their health; on_eject(instance) is called on each ejection"""
+
+    def __init__(
+        self,
+        instances: Sequence[Instance],
+        policy: str = "p2c",
+        slow_start: float = 30.0,
+        health_path: str = "/health/ready",
+        healthy_threshold: int = 2,
+        unhealthy_threshold: int = 2,
+        consecutive_failures: int = 5,
+        ejection_seconds: float = 30.0,
+        max_ejection_seconds: float = 300.0,
+        max_ejection_percent: float = 50.0,
+        clock: Callable[[], float] = time.monotonic,
+        rng: Optional[random.Random] = None,
+        on_eject: Optional[Callable[[Instance], None]] = None,
+    ) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown load balancing policy {policy!r}; expected one of {', '.join(POLICIES)}")
+        self.instances = list(instances)
+        self.by_url: Dict[str, Instance] = {instance.url: instance for instance in self.instances}
+        self.policy = policy
+        self.slow_start = slow_start
+        self.health_path = health_path
+        self.healthy_threshold = healthy_threshold
+        self.unhealthy_threshold = unhealthy_threshold
+        self.consecutive_failures = consecutive_failures
+        self.ejection_seconds = ejection_seconds
+        self.max_ejection_seconds = max_ejection_seconds
+        self.max_ejection_percent = max_ejection_percent
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.on_eject = on_eject
+        self._next = 0
+
+    def available(self, instance: Instance, now: float) -> bool:
+        return instance.healthy and not instance.ejected(now) and instance.upstream.breaker.available()
+
+    def pick(self, exclude: Iterable[Instance] = ()) -> Optional[Instance]:
+        """Instance for the next request, or None when none is available"""
+        now = self.clock()
+        candidates = [i for i in self.instances if i not in exclude and self.available(i, now)]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+        if self.policy == "p2c":
+            candidates = self.rng.sample(candidates, 2)
+        else:
+            # Rotate the starting point so ties do not always go to the first instance
+            self._next = (self._next + 1) % len(candidates)
+            candidates = candidates[self._next:] + candidates[:self._next]
+        return min(candidates, key=lambda i: (i.outstanding + 1) / i.weight(now, self.slow_start))
+
+    def retry_after(self) -> Optional[float]:
+        """Seconds until the first ejected or open-circuit instance takes traffic again; None if none will by itself"""
+        now = self.clock()
+        waits = []
+        for instance in self.instances:
+            # Unhealthy instances come back when the health checks say so, not at a known time
+            if instance.healthy:
+                breaker = instance.upstream.breaker
+                circuit_wait = breaker.retry_after() if breaker.state == breaker.OPEN else 0.0
+                waits.append(max(instance.ejected_until - now, circuit_wait))
+        return min(waits) if waits else None
+
+    def record(self, url: str, ok: bool) -> None:
+        """Outcome of a request to an instance (passive outlier detection)"""
+        instance = self.by_url.get(url)
+        if instance is None:
+            return
+        if ok:
+            instance.consecutive_failures = 0
+            return
+        instance.consecutive_failures += 1
+        if instance.consecutive_failures >= self.consecutive_failures:
+            self._eject(instance)
+
+    def _eject(self, instance: Instance) -> None:
+        now = self.clock()
+        if instance.ejected(now):
+            return
+        ejected = sum(1 for i in self.instances if i.ejected(now))
+        if (ejected + 1) * 100 > self.max_ejection_percent * len(self.instances):
+            return
+        # An instance that behaved for a while starts over from the base ejection time
+        if now - instance.ejected_until > self.max_ejection_seconds:
+            instance.ejections = 0
+        instance.ejections += 1
+        instance.consecutive_failures = 0
+        instance.ejected_until = now + min(self.max_ejection_seconds, self.ejection_seconds * instance.ejections)
+        # Slow start once the ejection is over
+        instance.available_since = instance.ejected_until
+        if self.on_eject is not None:
+            self.on_eject(instance)
+
+    def record_check(self, instance: Instance, ok: bool) -> None:
+        """Result of one active health check"""
+        if ok:
+            instance.check_failures = 0
+            instance.check_successes += 1
+            if not instance.healthy and instance.check_successes >= self.healthy_threshold:
+                instance.healthy = True
+                instance.available_since = self.clock()
+        else:
+            instance.check_successes = 0
+            instance.check_failures += 1
+            if instance.healthy and instance.check_failures >= self.unhealthy_threshold:
+                instance.healthy = False
+
+    async def check(self, client: httpx.AsyncClient, timeout: float) -> None:
+        """One round of health checks, all instances at once"""
+
+        async def check_one(instance: Instance) -> None:
+            try:
+                response = await client.get(instance.url + self.health_path, timeout=timeout)
+                ok = response.is_success
+            except httpx.HTTPError:
+                ok = False
+            self.record_check(instance, ok)
+
+        await asyncio.gather(*(check_one(instance) for instance in self.instances))
+
+    async def run_health_checks(self, client: httpx.AsyncClient, interval: float, timeout: float) -> None:
+        """Check every interval seconds until cancelled"""
+        while True:
+            await self.check(client, timeout)
+            await asyncio.sleep(interval)
+
+
+def parse_urls(value: str) -> List[str]:
+    """Instance base URLs from a comma-separated list, without trailing slashes or duplicates"""
+    urls: List[str] = []
+    for url in value.split(","):
+        url = url.strip().rstrip("/")
+        if url and url not in urls:
+            urls.append(url)
+    return urls
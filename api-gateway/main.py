@@ -1,29 +1,413 @@
+import asyncio
+import math
 import os
+import time
 import httpx
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Tuple
 from fastapi import FastAPI, Depends, HTTPException, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import jwt, JWTError
 from datetime import datetime, timedelta, timezone
 from pydantic import BaseModel
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.background import BackgroundTask
+from compression import CompressionMiddleware
+from load_balancer import Instance, LoadBalancer, parse_urls
+from rate_limit import (
+    AdaptiveConcurrencyLimit,
+    InMemoryRateLimiter,
+    RedisRateLimiter,
+    parse_limit,
+    parse_route_limits,
+)
+from resilience import (
+    Alternate,
+    CircuitBreaker,
+    CircuitOpenError,
+    LatencyTracker,
+    ResilientUpstream,
+    RetryBudget,
+    clone_request,
+)
+from token_cache import RevokedTokens, VerifiedTokenCache
+from tracing import Tracing, create_exporter, end_proxy_span
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+APPOINTMENT_SERVICE_URL = os.getenv(
+    "APPOINTMENT_SERVICE_URL", "http://appointment-service:8001"
+)
+# Several appointment-service instances, comma-separated, balanced by the gateway (see load_balancer.py)
+APPOINTMENT_SERVICE_URLS = parse_urls(os.getenv("APPOINTMENT_SERVICE_URLS", APPOINTMENT_SERVICE_URL))
+LB_POLICY = os.getenv("LB_POLICY", "p2c")  # p2c or least_outstanding
+LB_SLOW_START_SECONDS = float(os.getenv("LB_SLOW_START_SECONDS", "30"))
+# Active health checks; only with two or more instances (0 disables them)
+# Readiness, not liveness: an instance draining or without its database stops getting traffic
+HEALTH_CHECK_PATH = os.getenv("HEALTH_CHECK_PATH", "/health/ready")
+HEALTH_CHECK_INTERVAL_SECONDS = float(os.getenv("HEALTH_CHECK_INTERVAL_SECONDS", "5"))
+HEALTH_CHECK_TIMEOUT_SECONDS = float(os.getenv("HEALTH_CHECK_TIMEOUT_SECONDS", "1"))
+HEALTH_CHECK_HEALTHY_THRESHOLD = int(os.getenv("HEALTH_CHECK_HEALTHY_THRESHOLD", "2"))
+HEALTH_CHECK_UNHEALTHY_THRESHOLD = int(os.getenv("HEALTH_CHECK_UNHEALTHY_THRESHOLD", "2"))
+# Passive outlier ejection
+OUTLIER_CONSECUTIVE_FAILURES = int(os.getenv("OUTLIER_CONSECUTIVE_FAILURES", "5"))
+OUTLIER_EJECTION_SECONDS = float(os.getenv("OUTLIER_EJECTION_SECONDS", "30"))
+OUTLIER_MAX_EJECTION_SECONDS = float(os.getenv("OUTLIER_MAX_EJECTION_SECONDS", "300"))
+OUTLIER_MAX_EJECTION_PERCENT = float(os.getenv("OUTLIER_MAX_EJECTION_PERCENT", "50"))
+
+# Upstream HTTP client: pool limits and per-phase timeouts (seconds)
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "3"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+UPSTREAM_WRITE_TIMEOUT = float(os.getenv("UPSTREAM_WRITE_TIMEOUT", "10"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5"))
+
+# Distributed tracing (see tracing.py); "none" disables it
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+OTLP_TRACES_ENDPOINT = os.getenv("OTLP_TRACES_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "0.01"))
+TRACE_EXPORT_QUEUE_SIZE = int(os.getenv("TRACE_EXPORT_QUEUE_SIZE", "2048"))
+TRACE_EXPORT_BATCH_SIZE = int(os.getenv("TRACE_EXPORT_BATCH_SIZE", "512"))
+TRACE_EXPORT_DELAY_MS = float(os.getenv("TRACE_EXPORT_DELAY_MS", "5000"))
+
+# Response compression (see compression.py): encodings in order of preference; empty disables it
+COMPRESSION_ENCODINGS = [
+    name.strip() for name in os.getenv("COMPRESSION_ENCODINGS", "br,zstd,gzip").split(",") if name.strip()
+]
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_LEVEL = int(os.getenv("COMPRESSION_BROTLI_LEVEL", "4"))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+
+# Rate limiting (see rate_limit.py): "memory" (per process), "redis" (shared by replicas) or "none"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory").lower()
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# "rate:burst" per JWT subject, and per "METHOD /route" (e.g. "POST /login=1:5"); empty or 0 disables.
+# Off by default: every client logs in as the same subject, so a per-subject limit caps the whole product.
+RATE_LIMIT_SUBJECT = parse_limit(os.getenv("RATE_LIMIT_SUBJECT", ""))
+RATE_LIMIT_ROUTES = parse_route_limits(os.getenv("RATE_LIMIT_ROUTES", ""))
+
+# Load shedding: adaptive limit on requests in flight to appointment-service
+CONCURRENCY_LIMIT_ENABLED = os.getenv("CONCURRENCY_LIMIT_ENABLED", "true").lower() == "true"
+CONCURRENCY_LIMIT_INITIAL = int(os.getenv("CONCURRENCY_LIMIT_INITIAL", str(UPSTREAM_MAX_CONNECTIONS)))
+CONCURRENCY_LIMIT_MIN = int(os.getenv("CONCURRENCY_LIMIT_MIN", "5"))
+# Above UPSTREAM_MAX_CONNECTIONS requests wait for a pooled connection: allow at most one pool's worth
+CONCURRENCY_LIMIT_MAX = int(os.getenv("CONCURRENCY_LIMIT_MAX", str(2 * UPSTREAM_MAX_CONNECTIONS)))
+CONCURRENCY_LATENCY_TARGET_MS = float(os.getenv("CONCURRENCY_LATENCY_TARGET_MS", "1000"))
+LOAD_SHED_RETRY_AFTER = int(os.getenv("LOAD_SHED_RETRY_AFTER", "1"))
+
+# Upstream resilience (see resilience.py): circuit breaker per upstream
+CIRCUIT_FAILURE_RATIO = float(os.getenv("CIRCUIT_FAILURE_RATIO", "0.5"))
+CIRCUIT_WINDOW = int(os.getenv("CIRCUIT_WINDOW", "20"))
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "5"))
+CIRCUIT_HALF_OPEN_CALLS = int(os.getenv("CIRCUIT_HALF_OPEN_CALLS", "3"))
+# GET retries with full-jitter backoff, and hedged GETs; both spend from one retry budget
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+RETRY_BACKOFF_BASE_MS = float(os.getenv("RETRY_BACKOFF_BASE_MS", "50"))
+RETRY_BACKOFF_MAX_MS = float(os.getenv("RETRY_BACKOFF_MAX_MS", "1000"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.2"))
+RETRY_BUDGET_MIN_PER_SECOND = float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "5"))
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "20"))
+# Path prefixes never hedged nor counted in the p95: heavy reads a second copy would make twice as heavy
+HEDGE_EXCLUDED_PATHS = tuple(
+    path.strip() for path in os.getenv("HEDGE_EXCLUDED_PATHS", "/appointments/export").split(",") if path.strip()
+)
+
+
+def create_tracing() -> Optional[Tracing]:
+    if TRACE_EXPORTER == "none":
+        return None
+    return Tracing(
+        "api-gateway",
+        create_exporter(TRACE_EXPORTER, OTLP_TRACES_ENDPOINT),
+        sample_ratio=TRACE_SAMPLE_RATIO,
+        queue_size=TRACE_EXPORT_QUEUE_SIZE,
+        batch_size=TRACE_EXPORT_BATCH_SIZE,
+        export_delay=TRACE_EXPORT_DELAY_MS / 1000,
+    )
+
+
+tracing = create_tracing()
+
+
+def create_rate_limiter():
+    if RATE_LIMIT_BACKEND == "redis":
+        return RedisRateLimiter.from_url(RATE_LIMIT_REDIS_URL)
+    if RATE_LIMIT_BACKEND == "memory":
+        return InMemoryRateLimiter(RATE_LIMIT_MAX_KEYS)
+    return None
+
+
+def create_concurrency_limit() -> Optional[AdaptiveConcurrencyLimit]:
+    if not CONCURRENCY_LIMIT_ENABLED:
+        return None
+    return AdaptiveConcurrencyLimit(
+        CONCURRENCY_LIMIT_INITIAL,
+        CONCURRENCY_LIMIT_MIN,
+        CONCURRENCY_LIMIT_MAX,
+        latency_target=CONCURRENCY_LATENCY_TARGET_MS / 1000,
+    )
+
+
+rate_limiter = create_rate_limiter()
+concurrency_limit = create_concurrency_limit()
+
+# One client per process, created in the app lifespan so keep-alive connections
+# to appointment-service are reused across requests
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def create_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            read=UPSTREAM_READ_TIMEOUT,
+            write=UPSTREAM_WRITE_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        ),
+        http2=UPSTREAM_HTTP2,
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client
+    http_client = create_http_client()
+    health_checks = None
+    # With a single instance there is nowhere else to route; its circuit breaker already fails fast
+    if HEALTH_CHECK_INTERVAL_SECONDS > 0 and len(balancer.instances) > 1:
+        health_checks = asyncio.create_task(
+            balancer.run_health_checks(http_client, HEALTH_CHECK_INTERVAL_SECONDS, HEALTH_CHECK_TIMEOUT_SECONDS)
+        )
+    yield
+    if health_checks is not None:
+        health_checks.cancel()
+        try:
+            await health_checks
+        except asyncio.CancelledError:
+            pass
+    await http_client.aclose()
+    http_client = None
+    if rate_limiter is not None:
+        await rate_limiter.close()
+    if tracing is not None:
+        tracing.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Change to your frontend URL in production
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
+)
+
+RESPONSE_BYTES = Counter(
+    "api_gateway_response_bytes_total",
+    "Body bytes of responses to clients that accept compression, before and after encoding",
+    ["encoding", "stage"],
+)
+
+
+def record_compression(encoding: str, original: int, sent: int) -> None:
+    RESPONSE_BYTES.labels(encoding=encoding, stage="original").inc(original)
+    RESPONSE_BYTES.labels(encoding=encoding, stage="sent").inc(sent)
+
+
+app.add_middleware(
+    CompressionMiddleware,
+    encodings=COMPRESSION_ENCODINGS,
+    minimum_size=COMPRESSION_MIN_SIZE,
+    levels={"gzip": COMPRESSION_GZIP_LEVEL, "br": COMPRESSION_BROTLI_LEVEL, "zstd": COMPRESSION_ZSTD_LEVEL},
+    on_response=record_compression,
 )
 security = HTTPBearer()
 SECRET_KEY = "your-secret-key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-APPOINTMENT_SERVICE_URL = os.getenv(
-    "APPOINTMENT_SERVICE_URL", "http://appointment-service:8001"
+# Verified tokens are cached until their exp so repeated requests skip jwt.decode
+JWT_CACHE_MAX_SIZE = int(os.getenv("JWT_CACHE_MAX_SIZE", "10000"))
+token_cache = VerifiedTokenCache(JWT_CACHE_MAX_SIZE)
+revoked_tokens = RevokedTokens()
+
+JWT_CACHE_REQUESTS = Counter(
+    "api_gateway_jwt_cache_requests_total",
+    "Verified-token cache lookups",
+    ["result"],
+)
+JWT_CACHE_HITS = JWT_CACHE_REQUESTS.labels(result="hit")
+JWT_CACHE_MISSES = JWT_CACHE_REQUESTS.labels(result="miss")
+JWT_CACHE_SIZE = Gauge(
+    "api_gateway_jwt_cache_entries", "Tokens currently held in the verified-token cache"
+)
+JWT_CACHE_SIZE.set_function(lambda: len(token_cache))
+
+REJECTED_REQUESTS = Counter(
+    "api_gateway_rejected_requests_total",
+    "Requests refused before reaching the upstream: rate limited (subject, route), shed (overload) "
+    "or with no instance available (unavailable)",
+    ["reason"],
 )
+REJECTED_BY_REASON = {
+    reason: REJECTED_REQUESTS.labels(reason=reason) for reason in ("subject", "route", "overload", "unavailable")
+}
+RATE_LIMIT_ERRORS = Counter(
+    "api_gateway_rate_limit_errors_total",
+    "Rate limit checks that failed (backend unreachable); those requests are let through",
+)
+CONCURRENCY_LIMIT = Gauge(
+    "api_gateway_concurrency_limit", "Current adaptive limit on requests in flight to the upstream"
+)
+CONCURRENCY_LIMIT.set_function(lambda: concurrency_limit.limit if concurrency_limit is not None else 0)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "api_gateway_upstream_in_flight", "Requests in flight to the upstream, counted by the concurrency limit"
+)
+UPSTREAM_IN_FLIGHT.set_function(lambda: concurrency_limit.in_flight if concurrency_limit is not None else 0)
+
+CIRCUIT_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+CIRCUIT_STATE = Gauge(
+    "api_gateway_circuit_state", "Circuit breaker state per upstream: 0 closed, 1 half-open, 2 open", ["upstream"]
+)
+CIRCUIT_TRANSITIONS = Counter(
+    "api_gateway_circuit_transitions_total", "Circuit breaker state changes per upstream", ["upstream", "state"]
+)
+UPSTREAM_EVENTS = {
+    "rejected": Counter(
+        "api_gateway_circuit_rejections_total", "Requests failed fast because the circuit was open", ["upstream"]
+    ),
+    "retry": Counter(
+        "api_gateway_upstream_retries_total", "Idempotent requests sent again after a failure", ["upstream"]
+    ),
+    "budget_exhausted": Counter(
+        "api_gateway_retry_budget_exhausted_total", "Retries and hedges skipped for lack of retry budget", ["upstream"]
+    ),
+    "hedge": Counter("api_gateway_upstream_hedges_total", "Hedged requests sent after the p95 latency", ["upstream"]),
+    "hedge_won": Counter(
+        "api_gateway_upstream_hedge_wins_total", "Hedged requests answered before the original", ["upstream"]
+    ),
+}
+
+UPSTREAM_REQUESTS = Counter(
+    "api_gateway_upstream_requests_total",
+    "Requests sent to each upstream instance (retries and hedges included), by outcome",
+    ["upstream", "outcome"],
+)
+UPSTREAM_LATENCY = Histogram(
+    "api_gateway_upstream_latency_seconds",
+    "Time to response headers from each upstream instance",
+    ["upstream"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+UPSTREAM_OUTSTANDING = Gauge(
+    "api_gateway_upstream_outstanding", "Requests waiting for response headers, per upstream instance", ["upstream"]
+)
+UPSTREAM_AVAILABLE = Gauge(
+    "api_gateway_upstream_available",
+    "1 when the instance takes traffic: healthy, not ejected and its circuit not open",
+    ["upstream"],
+)
+UPSTREAM_WEIGHT = Gauge(
+    "api_gateway_upstream_weight", "Balancing weight of each instance (below 1 during slow start)", ["upstream"]
+)
+OUTLIER_EJECTIONS = Counter(
+    "api_gateway_upstream_ejections_total", "Instances ejected after consecutive failures", ["upstream"]
+)
+
+# Shared by every upstream: retries and hedges are bounded across the whole gateway
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SECOND)
+upstreams: Dict[str, ResilientUpstream] = {}
+
+
+def record_circuit_state(upstream: str, state: str) -> None:
+    CIRCUIT_STATE.labels(upstream=upstream).set(CIRCUIT_STATES[state])
+    CIRCUIT_TRANSITIONS.labels(upstream=upstream, state=state).inc()
+
+
+def record_attempt(base_url: str, seconds: float, ok: bool) -> None:
+    UPSTREAM_REQUESTS.labels(upstream=base_url, outcome="ok" if ok else "error").inc()
+    UPSTREAM_LATENCY.labels(upstream=base_url).observe(seconds)
+    balancer.record(base_url, ok)
+
+
+def upstream_for(base_url: str) -> ResilientUpstream:
+    """Breaker, latency history and retry policy of one upstream, created on first use"""
+    upstream = upstreams.get(base_url)
+    if upstream is None:
+        breaker = CircuitBreaker(
+            CIRCUIT_FAILURE_RATIO,
+            CIRCUIT_WINDOW,
+            CIRCUIT_MIN_CALLS,
+            CIRCUIT_OPEN_SECONDS,
+            CIRCUIT_HALF_OPEN_CALLS,
+            on_state_change=lambda state: record_circuit_state(base_url, state),
+        )
+        events = {name: counter.labels(upstream=base_url) for name, counter in UPSTREAM_EVENTS.items()}
+        upstream = upstreams[base_url] = ResilientUpstream(
+            base_url,
+            breaker,
+            retry_budget,
+            max_retries=UPSTREAM_RETRIES,
+            backoff_base=RETRY_BACKOFF_BASE_MS / 1000,
+            backoff_max=RETRY_BACKOFF_MAX_MS / 1000,
+            hedging=HEDGE_ENABLED,
+            hedge_min_delay=HEDGE_MIN_DELAY_MS / 1000,
+            latency=LatencyTracker(HEDGE_PERCENTILE),
+            on_event=lambda event: events[event].inc(),
+            on_attempt=lambda seconds, ok: record_attempt(base_url, seconds, ok),
+        )
+        CIRCUIT_STATE.labels(upstream=base_url).set(0)
+    return upstream
+
+
+def instance_gauges(url: str) -> None:
+    """Per-instance gauges, read from the current balancer when /metrics is scraped"""
+
+    def read(value: Callable[[Instance, float], float]) -> Callable[[], float]:
+        def get() -> float:
+            instance = balancer.by_url.get(url)
+            return value(instance, balancer.clock()) if instance is not None else 0
+
+        return get
+
+    UPSTREAM_OUTSTANDING.labels(upstream=url).set_function(read(lambda i, now: i.outstanding))
+    UPSTREAM_AVAILABLE.labels(upstream=url).set_function(read(lambda i, now: float(balancer.available(i, now))))
+    UPSTREAM_WEIGHT.labels(upstream=url).set_function(read(lambda i, now: i.weight(now, balancer.slow_start)))
+
+
+def create_balancer(urls: List[str]) -> LoadBalancer:
+    for url in urls:
+        instance_gauges(url)
+    return LoadBalancer(
+        [Instance(url, upstream_for(url)) for url in urls],
+        policy=LB_POLICY,
+        slow_start=LB_SLOW_START_SECONDS,
+        health_path=HEALTH_CHECK_PATH,
+        healthy_threshold=HEALTH_CHECK_HEALTHY_THRESHOLD,
+        unhealthy_threshold=HEALTH_CHECK_UNHEALTHY_THRESHOLD,
+        consecutive_failures=OUTLIER_CONSECUTIVE_FAILURES,
+        ejection_seconds=OUTLIER_EJECTION_SECONDS,
+        max_ejection_seconds=OUTLIER_MAX_EJECTION_SECONDS,
+        max_ejection_percent=OUTLIER_MAX_EJECTION_PERCENT,
+        on_eject=lambda instance: OUTLIER_EJECTIONS.labels(upstream=instance.url).inc(),
+    )
+
+
+balancer = create_balancer(APPOINTMENT_SERVICE_URLS)
 
 
 # --- Auth ---
@@ -32,7 +416,40 @@ class LoginRequest(BaseModel):
     password: str
 
 
-@app.post("/login")
+async def enforce_rate_limit(request: Request, subject: Optional[str]) -> None:
+    """Take a token from the subject's bucket and the route's; 429 with Retry-After when one is empty"""
+    if rate_limiter is None:
+        return
+    buckets = []
+    if subject is not None and RATE_LIMIT_SUBJECT is not None:
+        buckets.append((f"subject:{subject}", RATE_LIMIT_SUBJECT))
+    if RATE_LIMIT_ROUTES:
+        route = f"{request.method} {request.scope['route'].path}"
+        route_limit = RATE_LIMIT_ROUTES.get(route)
+        if route_limit is not None:
+            buckets.append((f"route:{route}", route_limit))
+    if not buckets:
+        return
+    try:
+        denial = await rate_limiter.acquire(buckets)
+    except Exception:
+        # An unreachable shared backend must not take the gateway down with it
+        RATE_LIMIT_ERRORS.inc()
+        return
+    if denial is not None:
+        REJECTED_BY_REASON[denial.key.split(":", 1)[0]].inc()
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(max(1, math.ceil(denial.retry_after)))},
+        )
+
+
+async def rate_limit_route(request: Request) -> None:
+    await enforce_rate_limit(request, None)
+
+
+@app.post("/login", dependencies=[Depends(rate_limit_route)])
 def login(data: LoginRequest):
     if data.username == "admin" and data.password == "123456":
         expire = datetime.now(timezone.utc) + timedelta(
@@ -45,13 +462,41 @@ def login(data: LoginRequest):
 
 
 def verify_jwt(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        payload = jwt.decode(
-            credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM]
-        )
+    token = credentials.credentials
+    if token in revoked_tokens:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    payload = token_cache.get(token)
+    if payload is not None:
+        JWT_CACHE_HITS.inc()
         return payload
+    JWT_CACHE_MISSES.inc()
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    token_cache.put(token, payload)
+    return payload
+
+
+async def rate_limited_user(request: Request, user=Depends(verify_jwt)):  # type: ignore
+    """verify_jwt, then the rate limits of the token's subject and of the route"""
+    await enforce_rate_limit(request, user.get("sub"))
+    return user
+
+
+def revoke_token(token: str, expires_at: float) -> None:
+    """Invalidation hook: reject token from now on, even if it is cached"""
+    revoked_tokens.add(token, expires_at)
+    token_cache.invalidate(token)
+
+
+@app.post("/logout")
+def logout(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    user=Depends(rate_limited_user),  # type: ignore
+):
+    revoke_token(credentials.credentials, user["exp"])
+    return {"status": "logged out"}
 
 
 @app.get("/health")
@@ -59,39 +504,185 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/protected")
-def protected(user=Depends(verify_jwt)):  # type: ignore
+def protected(user=Depends(rate_limited_user)):  # type: ignore
     return {"user": user}
 
 
 # --- Proxy to appointment-service ---
-# Delete this commentary
+# Hop-by-hop headers (RFC 9110, section 7.6.1) only apply to a single connection
+HOP_BY_HOP_HEADERS = frozenset({
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+})
+
+
+def filter_headers(raw_headers, drop=frozenset()):
+    """Drop hop-by-hop headers, including any listed in the Connection header"""
+    excluded = set(HOP_BY_HOP_HEADERS) | set(drop)
+    for name, value in raw_headers:
+        if name.lower() == b"connection":
+            excluded.update(t.strip().lower() for t in value.decode("latin-1").split(","))
+    return [
+        (name, value)
+        for name, value in raw_headers
+        if name.decode("latin-1").lower() not in excluded
+    ]
+
+
+def acquire_upstream_slot() -> None:
+    """Take a concurrency slot for a proxied request; 503 when the adaptive limit is reached"""
+    # Shed load before the upstream queues it: requests over the adaptive limit never leave the gateway
+    if concurrency_limit is not None and not concurrency_limit.try_acquire():
+        REJECTED_BY_REASON["overload"].inc()
+        raise HTTPException(
+            status_code=503,
+            detail="Upstream overloaded",
+            headers={"Retry-After": str(LOAD_SHED_RETRY_AFTER)},
+        )
+
+
+def release_upstream_slot(latency: Optional[float]) -> None:
+    """Give back the concurrency slot of a proxied request; latency None when it failed"""
+    if concurrency_limit is not None:
+        concurrency_limit.release(latency)
+
+
+def cancel_upstream_slot() -> None:
+    """Give back the concurrency slot of a request that got no upstream answer"""
+    if concurrency_limit is not None:
+        concurrency_limit.cancel()
+
+
+async def close_upstream(resp: httpx.Response, span=None, latency: Optional[float] = None) -> None:
+    """Release the connection once the body was relayed, then the concurrency slot, and end the proxy span"""
+    await resp.aclose()
+    release_upstream_slot(latency)
+    if span is not None:
+        end_proxy_span(span, resp.status_code)
+
+
+async def stream_upstream(resp: httpx.Response):
+    """Relay the upstream body chunk by chunk; always release the connection"""
+    try:
+        async for chunk in resp.aiter_raw():
+            yield chunk
+    finally:
+        await resp.aclose()
+
+
+def pick_instance() -> Instance:
+    """Instance for the next proxied request; 503 when none can take it"""
+    instance = balancer.pick()
+    if instance is None:
+        # Every instance is down, ejected or has its circuit open: fail fast
+        cancel_upstream_slot()
+        REJECTED_BY_REASON["unavailable"].inc()
+        retry_after = balancer.retry_after()
+        raise HTTPException(
+            status_code=503,
+            detail="Upstream unavailable",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after or LOAD_SHED_RETRY_AFTER)))},
+        )
+    return instance
+
+
+def alternate_instances(
+    first: Instance, upstream_request: httpx.Request, path: str, params: List[Tuple[str, str]]
+) -> Alternate:
+    """Send retries and hedges to an instance this request has not tried yet, when there is one"""
+    tried = [first]
+
+    def alternate() -> Optional[Tuple[ResilientUpstream, httpx.Request]]:
+        other = balancer.pick(exclude=tried)
+        if other is None:
+            return None
+        tried.append(other)
+        return other.upstream, clone_request(upstream_request, httpx.URL(f"{other.url}/{path}", params=params))
+
+    return alternate
+
+
+def relay_upstream(resp: httpx.Response, span, started: float) -> StreamingResponse:
+    """Stream the upstream response to the client, closing it (and the span) once sent"""
+    # Time to response headers; errors and upstream overload count as failures for the limit
+    latency = None if resp.status_code >= 500 or resp.status_code == 429 else time.perf_counter() - started
+    # Raw (still encoded) bytes are relayed, so Content-Encoding/Content-Length stay valid;
+    # CompressionMiddleware leaves bodies the upstream already encoded as they are
+    response = StreamingResponse(
+        stream_upstream(resp),
+        status_code=resp.status_code,
+        # Runs after the last chunk, also when the client disconnects mid-stream
+        background=BackgroundTask(close_upstream, resp, span, latency),
+    )
+    response.raw_headers = filter_headers(resp.headers.raw)
+    return response
 
 
 @app.api_route(
     "/appointments/{path:path}",
-    methods=["GET", "POST", "PUT", "DELETE"],
+    methods=["GET", "POST", "PUT", "PATCH", "DELETE"],
     include_in_schema=False,
 )
-async def proxy_appointments(request: Request, path: str, user=Depends(verify_jwt)):  # type: ignore
-    url = f"{APPOINTMENT_SERVICE_URL}/{path}"
+async def proxy_appointments(request: Request, path: str, user=Depends(rate_limited_user)):  # type: ignore
+    acquire_upstream_slot()
+    instance = pick_instance()
+    url = f"{instance.url}/{path}"
+    params = request.query_params.multi_items()
     method = request.method
-    headers = dict(request.headers)
-    headers.pop("host", None)
-    headers.pop("content-length", None)
-    headers.pop("transfer-encoding", None)
-    async with httpx.AsyncClient() as client:
-        req_args = {  # type: ignore
-            "url": url,
-            "headers": headers,
-            "params": dict(request.query_params),
-            "timeout": 30.0,
-        }
-        if method in ["POST", "PUT"]:
-            body = await request.body()
-            if body:
-                req_args["content"] = body
-        resp = await client.request(method, **req_args)  # type: ignore
-    return Response(
-        content=resp.content, status_code=resp.status_code, headers=dict(resp.headers)
+    forward_body = method in ["POST", "PUT", "PATCH"]
+    # The client body is forwarded as it arrives, so its Content-Length still holds
+    drop = {"host"} if forward_body else {"host", "content-length"}
+    headers = filter_headers(request.headers.raw, drop)
+    span = None
+    if tracing is not None:
+        # Upstream continues this span's trace: its traceparent replaces the client's
+        span, headers = tracing.start_proxy_span(method, "/appointments/{path}", headers)
+    upstream_request = http_client.build_request(  # type: ignore
+        method,
+        url,
+        headers=headers,
+        params=params,
+        content=request.stream() if forward_body else None,
     )
+    alternate = alternate_instances(instance, upstream_request, path, params)
+    hedge = not request.url.path.startswith(HEDGE_EXCLUDED_PATHS)
+    started = time.perf_counter()
+    try:
+        resp = await instance.upstream.send(http_client, upstream_request, alternate, hedge)  # type: ignore
+    except CircuitOpenError as exc:
+        # Failing fast says nothing about upstream latency: no sample for the concurrency limit
+        cancel_upstream_slot()
+        if span is not None:
+            end_proxy_span(span, 503, "Circuit open")
+        raise HTTPException(
+            status_code=503,
+            detail="Upstream unavailable",
+            headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))},
+        )
+    except httpx.TimeoutException:
+        release_upstream_slot(None)
+        if span is not None:
+            end_proxy_span(span, 504, "Upstream timeout")
+        raise HTTPException(status_code=504, detail="Upstream timeout")
+    except httpx.TransportError:
+        release_upstream_slot(None)
+        if span is not None:
+            end_proxy_span(span, 502, "Upstream unavailable")
+        raise HTTPException(status_code=502, detail="Upstream unavailable")
+    except BaseException:
+        # e.g. cancelled because the client went away: the slot must not leak
+        cancel_upstream_slot()
+        raise
+    return relay_upstream(resp, span, started)
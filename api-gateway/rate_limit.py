@@ -0,0 +1,239 @@
+"""Rate limiting and load shedding in front of appointment-service.
+
+Rate limits are token buckets, one per JWT subject and one per route, kept in
+the GCRA form: a single "theoretical arrival time" (TAT) per bucket instead of
+a token count and a refill timestamp. A bucket with rate r and burst b allows b
+requests at once and then one every 1/r seconds, exactly like a token bucket of
+capacity b refilled at r tokens/s, but each decision is one read and one write.
+
+A request takes a token from all its buckets or from none, so a request
+rejected by its route bucket does not use up its subject's allowance.
+
+Backends:
+- InMemoryRateLimiter: per-process buckets in a bounded LRU. A bucket that has
+  refilled carries no information, so evicting one only resets it to full.
+- RedisRateLimiter: buckets shared by every gateway replica, updated by one Lua
+  script per request (a single round trip, atomic, on Redis's clock).
+
+AdaptiveConcurrencyLimit caps requests in flight to the upstream. The cap
+follows AIMD: it grows by one per window of fast responses and shrinks by a
+factor when a response is slower than the latency target or fails, so the
+gateway sheds load (503) before the upstream's own queues build up. Like TCP,
+it shrinks at most once per window: the other slow answers of a burst were
+sent under the old limit and say nothing about the new one.
+"""
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Sequence, Tuple
+
+
+class Limit(NamedTuple):
+    rate: float  # tokens per second
+    burst: int  # bucket capacity
+
+    @property
+    def interval(self) -> float:
+        return 1.0 / self.rate
+
+
+# (bucket key, its limit)
+Bucket = Tuple[str, Limit]
+
+
+class Denial(NamedTuple):
+    key: str  # the bucket that would have to wait longest
+    retry_after: float  # seconds until every bucket allows the request
+
+
+def parse_limit(value: str) -> Optional[Limit]:
+    """Limit from "rate:burst" (burst defaults to rate); None for an empty value or a rate of 0"""
+    if not value.strip():
+        return None
+    rate, _, burst = value.partition(":")
+    limit = Limit(float(rate), int(burst) if burst.strip() else max(1, int(float(rate))))
+    return limit if limit.rate > 0 else None
+
+
+def parse_route_limits(value: str) -> Dict[str, Limit]:
+    """{"METHOD /route/template": Limit} from "GET /appointments/{path}=100:200,POST /login=1:5" """
+    limits: Dict[str, Limit] = {}
+    for item in value.split(","):
+        route, _, limit = item.rpartition("=")
+        parsed = parse_limit(limit) if route.strip() else None
+        if parsed is not None:
+            method, _, path = route.strip().partition(" ")
+            limits[f"{method.upper()} {path.strip()}"] = parsed
+    return limits
+
+
+def gcra(tat: Optional[float], now: float, limit: Limit) -> Tuple[float, float]:
+    """(TAT after taking one token, seconds over the limit); the token is only available when the excess is <= 0"""
+    new_tat = max(tat or now, now) + limit.interval
+    return new_tat, new_tat - now - limit.burst * limit.interval
+
+
+class RateLimitBackend:
+    """Interface of the bucket stores"""
+
+    async def acquire(self, buckets: Sequence[Bucket]) -> Optional[Denial]:
+        """Take a token from every bucket, or from none; None when the request is allowed"""
+        raise NotImplementedError
+
+    def reset(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemoryRateLimiter(RateLimitBackend):
+    """Buckets of this process. Never awaits, so the event loop needs no lock."""
+
+    def __init__(self, max_keys: int = 100000, clock=time.monotonic) -> None:
+        self.max_keys = max_keys
+        self.clock = clock
+        self._tats: "OrderedDict[str, float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._tats)
+
+    async def acquire(self, buckets: Sequence[Bucket]) -> Optional[Denial]:
+        return self.acquire_now(buckets)
+
+    def acquire_now(self, buckets: Sequence[Bucket]) -> Optional[Denial]:
+        now = self.clock()
+        tats = self._tats
+        new_tats = []
+        denial = None
+        for key, limit in buckets:
+            new_tat, excess = gcra(tats.get(key), now, limit)
+            if excess > 0:
+                if denial is None or excess > denial.retry_after:
+                    denial = Denial(key, excess)
+            new_tats.append(new_tat)
+        if denial is not None:
+            return denial
+        for (key, _), new_tat in zip(buckets, new_tats):
+            tats[key] = new_tat
+            tats.move_to_end(key)
+        while len(tats) > self.max_keys:
+            tats.popitem(last=False)
+        return None
+
+    def reset(self) -> None:
+        self._tats.clear()
+
+
+# KEYS: bucket keys. ARGV: interval and burst window (burst * interval) of each bucket, in order.
+# Returns {0, "0"} when allowed, else {index of the denying bucket (1-based), retry_after}.
+# Floats go back as strings: Redis truncates Lua numbers to integers.
+GCRA_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local tats = {}
+local denied, retry = 0, 0
+for i, key in ipairs(KEYS) do
+  local interval = tonumber(ARGV[2 * i - 1])
+  local window = tonumber(ARGV[2 * i])
+  local tat = math.max(tonumber(redis.call('GET', key)) or now, now) + interval
+  local excess = tat - now - window
+  if excess > 0 and excess > retry then
+    denied, retry = i, excess
+  end
+  tats[i] = tat
+end
+if denied > 0 then
+  return {denied, tostring(retry)}
+end
+for i, key in ipairs(KEYS) do
+  redis.call('SET', key, tostring(tats[i]), 'PX', math.ceil((tats[i] - now) * 1000))
+end
+return {0, '0'}
+"""
+
+
+class RedisRateLimiter(RateLimitBackend):
+    """Buckets shared between replicas, over a redis.asyncio client (or a compatible one).
+
+    Keys expire once their bucket is full again, so Redis only holds active buckets.
+    """
+
+    def __init__(self, client, prefix: str = "ratelimit:") -> None:
+        self.client = client
+        self.prefix = prefix
+        # Sent once, then run by its SHA (EVALSHA)
+        self._script = client.register_script(GCRA_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url: str) -> "RedisRateLimiter":
+        # Optional dependency: only needed with RATE_LIMIT_BACKEND=redis
+        import redis.asyncio as redis
+
+        return cls(redis.from_url(url))
+
+    async def acquire(self, buckets: Sequence[Bucket]) -> Optional[Denial]:
+        keys = [self.prefix + key for key, _ in buckets]
+        args = []
+        for _, limit in buckets:
+            args += [limit.interval, limit.burst * limit.interval]
+        denied, retry_after = await self._script(keys=keys, args=args)
+        if int(denied) == 0:
+            return None
+        return Denial(buckets[int(denied) - 1][0], float(retry_after))
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+class AdaptiveConcurrencyLimit:
+    """AIMD limit on requests in flight; try_acquire and release are O(1) and never block.
+
+    Every acquired slot must be released, with the upstream latency in seconds,
+    or None when the request failed (timeout, connection error, 5xx). A failure
+    counts as a sample of latency_target for the once-per-window backoff.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        min_limit: int,
+        max_limit: int,
+        latency_target: float,
+        backoff: float = 0.9,
+        clock=time.monotonic,
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.clock = clock
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self.last_decrease = float("-inf")
+
+    def try_acquire(self) -> bool:
+        if self.in_flight >= int(self.limit):
+            return False
+        self.in_flight += 1
+        return True
+
+    def cancel(self) -> None:
+        """Give a slot back without a latency sample: the request never got an upstream answer"""
+        self.in_flight -= 1
+
+    def release(self, latency: Optional[float]) -> None:
+        in_flight = self.in_flight
+        self.in_flight -= 1
+        if latency is None or latency > self.latency_target:
+            self._decrease(self.latency_target if latency is None else latency)
+        elif in_flight * 2 >= self.limit:
+            # Only grow while the limit is actually in use: idle periods say nothing about capacity
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def _decrease(self, window: float) -> None:
+        # A request that took `window` seconds and ended now started after the last decrease
+        # only if that decrease is more than `window` ago; otherwise it was already counted
+        now = self.clock()
+        if now - self.last_decrease > window:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+            self.last_decrease = now
@@ -0,0 +1,388 @@
+"""Circuit breaking, retries and hedged reads for requests to an upstream.
+
+Every request to an upstream goes through its CircuitBreaker. After too many
+failures (transport errors or 5xx) in its rolling window the breaker opens and
+requests fail fast for open_seconds instead of waiting on a sick upstream.
+It then lets a few probe requests through (half-open): if they succeed it
+closes again, otherwise it re-opens.
+
+Idempotent requests (GET, HEAD) also get:
+- retries after connection errors and 502/503/504, with full-jitter
+  exponential backoff. Timeouts are not retried: the request already waited
+  the whole read timeout, and hedging is what covers slow responses;
+- a hedge: when the first attempt has no response headers after the observed
+  p95 latency, the same request is sent again and the first usable response
+  wins. The other one is cancelled.
+
+Heavy reads (e.g. an export that scans the table before its first byte) are
+sent with hedge=False: a second copy would double their cost on the upstream
+exactly when it is slow, and their latency would inflate the p95 that cheap
+reads are hedged against. They are still retried.
+
+With several instances (load_balancer.py), retries and hedges go to an
+instance the request has not tried yet.
+
+Retries and hedges are extra load on an upstream that may already be
+struggling, so both draw from one RetryBudget shared by the whole gateway:
+every request deposits `ratio` tokens and each retry or hedge spends one.
+"""
+import asyncio
+import collections
+import random
+import time
+from typing import Callable, List, Optional, Tuple
+
+import httpx
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD"})
+RETRY_STATUSES = frozenset({502, 503, 504})
+# Failures that happen before the upstream could act on the request
+RETRYABLE_ERRORS = (httpx.NetworkError, httpx.ConnectTimeout, httpx.RemoteProtocolError)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, upstream: str, retry_after: float) -> None:
+        super().__init__(f"Circuit open for {upstream}")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over the outcomes of the last `window` requests.
+
+    Opens when at least min_calls outcomes are known and failure_ratio of them
+    failed. on_state_change(state) is called on every transition.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(
+        self,
+        failure_ratio: float = 0.5,
+        window: int = 20,
+        min_calls: int = 10,
+        open_seconds: float = 5.0,
+        half_open_calls: int = 3,
+        clock: Callable[[], float] = time.monotonic,
+        on_state_change: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self.on_state_change = on_state_change
+        self.state = self.CLOSED
+        self._outcomes: "collections.deque[int]" = collections.deque(maxlen=window)  # 1 = failure
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+
+    def allow(self) -> bool:
+        """Whether a request may go to the upstream now; in half-open it takes a probe slot"""
+        if self.state == self.OPEN:
+            if self.clock() < self._opened_at + self.open_seconds:
+                return False
+            self._transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probes >= self.half_open_calls:
+                return False
+            self._probes += 1
+        return True
+
+    def available(self) -> bool:
+        """Whether allow() would let a request through now, without taking a probe slot"""
+        if self.state == self.OPEN:
+            return self.clock() >= self._opened_at + self.open_seconds
+        return self.state == self.CLOSED or self._probes < self.half_open_calls
+
+    def retry_after(self) -> float:
+        """Seconds until an open breaker lets probes through"""
+        return max(0.0, self._opened_at + self.open_seconds - self.clock())
+
+    def record(self, ok: bool) -> None:
+        """Outcome of a request that allow() let through"""
+        if self.state == self.OPEN:
+            return
+        if self.state == self.HALF_OPEN:
+            if not ok:
+                self._transition(self.OPEN)
+                return
+            self._probe_successes += 1
+            if self._probe_successes >= self.half_open_calls:
+                self._transition(self.CLOSED)
+            return
+        outcomes = self._outcomes
+        if len(outcomes) == outcomes.maxlen:
+            self._failures -= outcomes[0]
+        outcomes.append(0 if ok else 1)
+        self._failures += 0 if ok else 1
+        if len(outcomes) >= self.min_calls and self._failures >= self.failure_ratio * len(outcomes):
+            self._transition(self.OPEN)
+
+    def cancel(self) -> None:
+        """A request let through ended without an outcome (cancelled): free its probe slot"""
+        if self.state == self.HALF_OPEN and self._probes > self._probe_successes:
+            self._probes -= 1
+
+    def _transition(self, state: str) -> None:
+        self.state = state
+        self._probes = self._probe_successes = 0
+        if state == self.OPEN:
+            self._opened_at = self.clock()
+        elif state == self.CLOSED:
+            self._outcomes.clear()
+            self._failures = 0
+        if self.on_state_change is not None:
+            self.on_state_change(state)
+
+
+class RetryBudget:
+    """Retries allowed as a fraction of requests, plus a reserve of min_per_second for low traffic.
+
+    The reserve refills continuously up to one second's worth, and starts full.
+    """
+
+    def __init__(
+        self,
+        ratio: float = 0.2,
+        min_per_second: float = 5.0,
+        max_balance: float = 100.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self.clock = clock
+        self.balance = 0.0
+        self.reserve = min_per_second
+        self._updated_at = clock()
+
+    def deposit(self) -> None:
+        self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def try_withdraw(self) -> bool:
+        now = self.clock()
+        self.reserve = min(self.min_per_second, self.reserve + (now - self._updated_at) * self.min_per_second)
+        self._updated_at = now
+        if self.balance >= 1:
+            self.balance -= 1
+            return True
+        if self.reserve >= 1:
+            self.reserve -= 1
+            return True
+        return False
+
+
+class LatencyTracker:
+    """Percentile of the last `size` latencies, recomputed every `refresh` samples so reads are O(1)"""
+
+    def __init__(self, percentile: float = 0.95, size: int = 1000, min_samples: int = 100, refresh: int = 100) -> None:
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.refresh = refresh
+        self._samples: List[float] = [0.0] * size
+        self._count = 0
+        self._value: Optional[float] = None
+
+    def record(self, seconds: float) -> None:
+        self._samples[self._count % len(self._samples)] = seconds
+        self._count += 1
+        if self._count >= self.min_samples and self._count % self.refresh == 0:
+            recent = sorted(self._samples[:min(self._count, len(self._samples))])
+            self._value = recent[min(len(recent) - 1, int(len(recent) * self.percentile))]
+
+    def value(self) -> Optional[float]:
+        """The percentile, or None until min_samples latencies were recorded"""
+        return self._value
+
+
+def clone_request(request: httpx.Request, url: Optional[httpx.URL] = None) -> httpx.Request:
+    """Copy of a bodiless request, optionally to another URL: a retry or hedge shares no state with the original"""
+    if url is None:
+        return httpx.Request(request.method, request.url, headers=request.headers, extensions=dict(request.extensions))
+    # Host is derived from the new URL
+    headers = [(name, value) for name, value in request.headers.raw if name.lower() != b"host"]
+    return httpx.Request(request.method, url, headers=headers, extensions=dict(request.extensions))
+
+
+# Picks where a retry or hedge goes: another upstream and the request rewritten for it, or None to stay put
+Alternate = Callable[[], Optional[Tuple["ResilientUpstream", httpx.Request]]]
+
+
+class ResilientUpstream:
+    """Sends requests to one upstream through its breaker, with retries and hedging for idempotent ones.
+
+    on_event(event) is called with "retry", "budget_exhausted", "hedge",
+    "hedge_won" and "rejected" (failed fast, circuit open); on_attempt(seconds,
+    ok) after every attempt that got an answer or a transport error.
+    outstanding counts the attempts waiting for response headers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        breaker: CircuitBreaker,
+        budget: RetryBudget,
+        max_retries: int = 2,
+        backoff_base: float = 0.05,
+        backoff_max: float = 1.0,
+        hedging: bool = True,
+        hedge_min_delay: float = 0.02,
+        latency: Optional[LatencyTracker] = None,
+        on_event: Optional[Callable[[str], None]] = None,
+        on_attempt: Optional[Callable[[float, bool], None]] = None,
+    ) -> None:
+        self.name = name
+        self.breaker = breaker
+        self.budget = budget
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedging = hedging
+        self.hedge_min_delay = hedge_min_delay
+        self.latency = latency if latency is not None else LatencyTracker()
+        self.on_event = on_event or (lambda event: None)
+        self.on_attempt = on_attempt
+        self.outstanding = 0
+
+    def backoff(self, retry: int) -> float:
+        """Full jitter: uniform between 0 and the capped exponential delay of this retry"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (retry - 1)))
+
+    async def send(
+        self,
+        client: httpx.AsyncClient,
+        request: httpx.Request,
+        alternate: Optional[Alternate] = None,
+        hedge: bool = True,
+    ) -> httpx.Response:
+        """Streamed response of the last attempt; raises CircuitOpenError or the last transport error.
+
+        alternate, when given, picks the upstream of each retry and hedge; by default they come back here.
+        hedge=False: never hedged and left out of the p95.
+        """
+        self.budget.deposit()
+        idempotent = request.method in IDEMPOTENT_METHODS
+        upstream, retry = self, 0
+        while True:
+            if not upstream.breaker.allow():
+                upstream.on_event("rejected")
+                raise CircuitOpenError(upstream.name, upstream.breaker.retry_after())
+            response, error = None, None
+            try:
+                if idempotent and upstream.hedging and hedge:
+                    response = await upstream._send_hedged(client, request, alternate)
+                else:
+                    response = await upstream._send_once(client, request, record_latency=hedge)
+            except httpx.TransportError as exc:
+                error = exc
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                return response
+            retryable = idempotent and (error is None or isinstance(error, RETRYABLE_ERRORS))
+            if not retryable or retry >= self.max_retries or not upstream._spend("budget_exhausted"):
+                if error is not None:
+                    raise error
+                return response
+            if response is not None:
+                await response.aclose()
+            retry += 1
+            upstream.on_event("retry")
+            await asyncio.sleep(self.backoff(retry))
+            upstream, request = upstream._next_attempt(request, alternate)
+
+    def _next_attempt(
+        self, request: httpx.Request, alternate: Optional[Alternate]
+    ) -> Tuple["ResilientUpstream", httpx.Request]:
+        other = alternate() if alternate is not None else None
+        return other if other is not None else (self, clone_request(request))
+
+    def _spend(self, event_if_denied: str) -> bool:
+        if self.budget.try_withdraw():
+            return True
+        self.on_event(event_if_denied)
+        return False
+
+    async def _send_once(
+        self, client: httpx.AsyncClient, request: httpx.Request, record_latency: bool = True
+    ) -> httpx.Response:
+        started = time.perf_counter()
+        self.outstanding += 1
+        try:
+            response = await client.send(request, stream=True)
+        except httpx.TransportError:
+            self.breaker.record(False)
+            if self.on_attempt is not None:
+                self.on_attempt(time.perf_counter() - started, False)
+            raise
+        except BaseException:
+            self.breaker.cancel()
+            raise
+        finally:
+            self.outstanding -= 1
+        elapsed = time.perf_counter() - started
+        ok = response.status_code < 500
+        self.breaker.record(ok)
+        if ok and record_latency:
+            self.latency.record(elapsed)
+        if self.on_attempt is not None:
+            self.on_attempt(elapsed, ok)
+        return response
+
+    async def _send_hedged(
+        self, client: httpx.AsyncClient, request: httpx.Request, alternate: Optional[Alternate] = None
+    ) -> httpx.Response:
+        p95 = self.latency.value()
+        if p95 is None:
+            return await self._send_once(client, request)
+        primary = asyncio.ensure_future(self._send_once(client, request))
+        tasks = [primary]
+        winner = primary
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=max(self.hedge_min_delay, p95))
+            if done:
+                return await primary
+            target, hedge_request = self._next_attempt(request, alternate)
+            if not target.breaker.allow():
+                return await primary
+            if not self._spend("budget_exhausted"):
+                target.breaker.cancel()
+                return await primary
+            self.on_event("hedge")
+            hedge = asyncio.ensure_future(target._send_once(client, hedge_request))
+            tasks.append(hedge)
+            winner = await _first_usable(tasks)
+            if winner is hedge:
+                self.on_event("hedge_won")
+            return await winner
+        except BaseException:
+            winner = None  # e.g. the client went away: nothing is returned
+            raise
+        finally:
+            for task in tasks:
+                if task is not winner:
+                    await _discard(task)
+
+
+async def _first_usable(tasks: List["asyncio.Future[httpx.Response]"]) -> "asyncio.Future[httpx.Response]":
+    """The first attempt to get a usable (non-5xx) response; the first attempt when none does"""
+    pending = set(tasks)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        # A failed attempt waits for the other one
+        for task in tasks:
+            if task in done and not task.exception() and task.result().status_code < 500:
+                return task
+    return tasks[0]
+
+
+async def _discard(task: "asyncio.Future[httpx.Response]") -> None:
+    """Cancel a losing attempt, or close its response if it already arrived"""
+    if not task.done():
+        task.cancel()
+    try:
+        response = await task
+    except BaseException:
+        return
+    await response.aclose()
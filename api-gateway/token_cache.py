@@ -0,0 +1,80 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+def token_digest(token: str) -> bytes:
+    """Cache key for a bearer token; raw tokens are never kept in memory"""
+    return hashlib.sha256(token.encode()).digest()
+
+
+class VerifiedTokenCache:
+    """LRU cache of verified JWT payloads, each valid until the token's exp.
+
+    verify_jwt runs in the threadpool, so every operation takes a lock.
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._entries: "OrderedDict[bytes, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, token: str) -> Optional[Dict[str, Any]]:
+        key = token_digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def put(self, token: str, payload: Dict[str, Any]) -> None:
+        expires_at = payload.get("exp")
+        # Tokens without exp are not cached: there is no safe point to drop them
+        if self.max_size <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        key = token_digest(token)
+        with self._lock:
+            self._entries[key] = (float(expires_at), payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token: str) -> bool:
+        """Drop a token from the cache; returns whether it was cached"""
+        with self._lock:
+            return self._entries.pop(token_digest(token), None) is not None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class RevokedTokens:
+    """Digests of revoked tokens, remembered until they would have expired anyway"""
+
+    def __init__(self) -> None:
+        self._expiry: Dict[bytes, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, token: str, expires_at: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._expiry = {k: exp for k, exp in self._expiry.items() if exp > now}
+            self._expiry[token_digest(token)] = expires_at
+
+    def __contains__(self, token: str) -> bool:
+        # Lock-free fast path: the common case is an empty set
+        if not self._expiry:
+            return False
+        expires_at = self._expiry.get(token_digest(token))
+        return expires_at is not None and expires_at > time.time()
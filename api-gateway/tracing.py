@@ -0,0 +1,103 @@
+"""Distributed tracing for the gateway proxy: head sampling, W3C propagation, batched export.
+
+The gateway opens one SERVER span per proxied request and forwards its
+traceparent to appointment-service, which continues the trace with its
+endpoint and DB spans. Sampling is decided here by trace id (the same rule
+as appointment-service, so both pick the same traces) and honoured downstream
+through the sampled flag; an incoming sampled traceparent is always followed.
+Spans are exported from the BatchSpanProcessor thread through a bounded queue
+that drops spans rather than block a request.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from opentelemetry import trace
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SpanExporter
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+from opentelemetry.trace import SpanKind, Status, StatusCode
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+
+propagator = TraceContextTextMapPropagator()
+TRACE_HEADERS = frozenset(propagator.fields)
+
+
+def create_exporter(kind: str, endpoint: Optional[str] = None) -> SpanExporter:
+    if kind == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        return OTLPSpanExporter(endpoint=endpoint)
+    if kind == "console":
+        return ConsoleSpanExporter()
+    if kind == "memory":
+        return InMemorySpanExporter()
+    raise ValueError(f"Unknown trace exporter: {kind}")
+
+
+class Tracing:
+    """Provider and tracer of the gateway; exporter stays reachable for tests"""
+
+    def __init__(
+        self,
+        service_name: str,
+        exporter: SpanExporter,
+        sample_ratio: float,
+        queue_size: int = 2048,
+        batch_size: int = 512,
+        export_delay: float = 5.0,
+    ) -> None:
+        self.exporter = exporter
+        self.provider = TracerProvider(
+            sampler=ParentBased(TraceIdRatioBased(sample_ratio)),
+            resource=Resource.create({SERVICE_NAME: service_name}),
+        )
+        self.provider.add_span_processor(
+            BatchSpanProcessor(
+                exporter,
+                max_queue_size=queue_size,
+                max_export_batch_size=batch_size,
+                schedule_delay_millis=export_delay * 1000,
+            )
+        )
+        self.tracer = self.provider.get_tracer(service_name)
+
+    def start_proxy_span(
+        self, method: str, route: str, headers: List[Tuple[bytes, bytes]]
+    ) -> Tuple[trace.Span, List[Tuple[bytes, bytes]]]:
+        """SERVER span continuing the client's traceparent, plus the headers to send upstream.
+
+        The client's trace headers are replaced by ones naming this span as the parent.
+        """
+        incoming: Dict[str, str] = {
+            name.decode("latin-1").lower(): value.decode("latin-1")
+            for name, value in headers
+            if name.decode("latin-1").lower() in TRACE_HEADERS
+        }
+        span = self.tracer.start_span(
+            f"{method} {route}",
+            context=propagator.extract(incoming),
+            kind=SpanKind.SERVER,
+            attributes={"http.request.method": method, "http.route": route},
+        )
+        outgoing: Dict[str, str] = {}
+        propagator.inject(outgoing, context=trace.set_span_in_context(span))
+        forwarded = [
+            (name, value) for name, value in headers
+            if name.decode("latin-1").lower() not in TRACE_HEADERS
+        ]
+        forwarded.extend((name.encode("latin-1"), value.encode("latin-1")) for name, value in outgoing.items())
+        return span, forwarded
+
+    def shutdown(self) -> None:
+        self.provider.shutdown()
+
+
+def end_proxy_span(span: trace.Span, status_code: Optional[int] = None, error: Optional[str] = None) -> None:
+    """Record the outcome and end the span; 5xx and transport errors mark it as failed"""
+    if span.is_recording():
+        if status_code is not None:
+            span.set_attribute("http.response.status_code", status_code)
+        if error is not None or (status_code is not None and status_code >= 500):
+            span.set_status(Status(StatusCode.ERROR, error))
+    span.end()
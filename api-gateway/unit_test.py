@@ -1,16 +1,67 @@
 import pytest
-from unittest.mock import patch, AsyncMock, MagicMock
+from unittest.mock import patch
 from fastapi.testclient import TestClient
 from fastapi.security import HTTPAuthorizationCredentials
 from fastapi import HTTPException
 from jose import jwt
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Any
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Type
+import asyncio
+import gzip
+import json
+import random
+import time
+import zlib
+import brotli
+import zstandard
+import httpx
+import main
+from prometheus_client import REGISTRY
 from main import app, verify_jwt, SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from main import revoke_token, token_cache
+from token_cache import VerifiedTokenCache
+from compression import CompressionMiddleware, negotiate
+from rate_limit import (
+    GCRA_SCRIPT,
+    AdaptiveConcurrencyLimit,
+    InMemoryRateLimiter,
+    Limit,
+    RedisRateLimiter,
+    gcra,
+    parse_limit,
+    parse_route_limits,
+)
+from load_balancer import MIN_WEIGHT, Instance, LoadBalancer, parse_urls
+from resilience import CircuitBreaker, LatencyTracker, ResilientUpstream, RetryBudget
+from tracing import Tracing
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import SpanKind, StatusCode
+from main import (
+    create_http_client,
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_READ_TIMEOUT,
+    UPSTREAM_POOL_TIMEOUT,
+)
 
 client: TestClient = TestClient(app)
 
 
+def reset_upstreams() -> None:
+    """Rebuild breakers, retry policies and the balancer from main's current settings"""
+    main.upstreams.clear()
+    main.balancer = main.create_balancer(main.APPOINTMENT_SERVICE_URLS)
+
+
+@pytest.fixture(autouse=True)
+def reset_gateway_state() -> Iterator[None]:
+    """Every test starts with full buckets, no requests in flight, fresh upstreams and a fresh retry budget"""
+    main.rate_limiter.reset()
+    main.concurrency_limit = main.create_concurrency_limit()
+    main.retry_budget = RetryBudget(main.RETRY_BUDGET_RATIO, main.RETRY_BUDGET_MIN_PER_SECOND)
+    reset_upstreams()
+    yield
+
+
 class TestLogin:
     def test_login_success(self) -> None:
         """Test successful login with correct credentials"""
@@ -86,6 +137,94 @@ class TestJWTVerification:
         assert exc_info.value.detail == "Invalid token"
 
 
+def make_token(sub: str = "admin", minutes: int = ACCESS_TOKEN_EXPIRE_MINUTES) -> str:
+    expire: datetime = datetime.now(timezone.utc) + timedelta(minutes=minutes)
+    return jwt.encode({"sub": sub, "exp": expire}, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def bearer(token: str) -> HTTPAuthorizationCredentials:
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+
+class TestVerifiedTokenCache:
+    def setup_method(self) -> None:
+        token_cache.clear()
+
+    def test_verify_jwt_decodes_token_once(self) -> None:
+        """Test repeated verifications of the same token are served from the cache"""
+        token: str = make_token("cached-user")
+        with patch("main.jwt.decode", wraps=jwt.decode) as decode:
+            for _ in range(5):
+                assert verify_jwt(bearer(token))["sub"] == "cached-user"
+        assert decode.call_count == 1
+
+    def test_invalid_tokens_are_not_cached(self) -> None:
+        """Test a rejected token is decoded (and rejected) every time"""
+        with patch("main.jwt.decode", wraps=jwt.decode) as decode:
+            for _ in range(2):
+                with pytest.raises(HTTPException):
+                    verify_jwt(bearer("invalid-token"))
+        assert decode.call_count == 2
+        assert len(token_cache) == 0
+
+    def test_cached_entry_expires_with_token(self) -> None:
+        """Test a cached payload is dropped once the token's exp has passed"""
+        cache: VerifiedTokenCache = VerifiedTokenCache(max_size=10)
+        cache.put("token", {"sub": "admin", "exp": 1000})
+        with patch("token_cache.time.time", return_value=999):
+            assert cache.get("token") == {"sub": "admin", "exp": 1000}
+        with patch("token_cache.time.time", return_value=1000):
+            assert cache.get("token") is None
+        assert len(cache) == 0
+
+    def test_cache_evicts_least_recently_used(self) -> None:
+        """Test the cache never grows beyond max_size"""
+        cache: VerifiedTokenCache = VerifiedTokenCache(max_size=2)
+        exp: float = datetime.now(timezone.utc).timestamp() + 60
+        cache.put("a", {"exp": exp})
+        cache.put("b", {"exp": exp})
+        cache.get("a")
+        cache.put("c", {"exp": exp})
+        assert len(cache) == 2
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.get("c") is not None
+
+    def test_cache_disabled_with_zero_size(self) -> None:
+        """Test JWT_CACHE_MAX_SIZE=0 turns the cache off"""
+        cache: VerifiedTokenCache = VerifiedTokenCache(max_size=0)
+        cache.put("token", {"exp": datetime.now(timezone.utc).timestamp() + 60})
+        assert cache.get("token") is None
+
+    def test_revoked_token_is_rejected_even_if_cached(self) -> None:
+        """Test revoke_token invalidates the cached payload"""
+        token: str = make_token("revoked-user")
+        payload: Dict[str, Any] = verify_jwt(bearer(token))
+        revoke_token(token, payload["exp"])
+
+        with pytest.raises(HTTPException) as exc_info:
+            verify_jwt(bearer(token))
+        assert exc_info.value.status_code == 401
+        assert len(token_cache) == 0
+
+    def test_logout_revokes_token(self) -> None:
+        """Test /logout makes the token unusable"""
+        headers: Dict[str, str] = {"Authorization": f"Bearer {make_token('logout-user')}"}
+        assert client.get("/protected", headers=headers).status_code == 200
+        assert client.post("/logout", headers=headers).status_code == 200
+        assert client.get("/protected", headers=headers).status_code == 401
+
+    def test_cache_metrics_exposed(self) -> None:
+        """Test hit/miss counters are exported on /metrics"""
+        token: str = make_token("metrics-user")
+        verify_jwt(bearer(token))
+        verify_jwt(bearer(token))
+        body: str = client.get("/metrics").text
+        assert 'api_gateway_jwt_cache_requests_total{result="hit"}' in body
+        assert 'api_gateway_jwt_cache_requests_total{result="miss"}' in body
+        assert "api_gateway_jwt_cache_entries" in body
+
+
 class TestHealthEndpoint:
     def test_health_endpoint(self) -> None:
         """Test health endpoint returns ok status"""
@@ -124,65 +263,1318 @@ class TestProtectedEndpoint:
         assert response.status_code == 401
 
 
+def auth_headers() -> Dict[str, str]:
+    login_response = client.post(
+        "/login", json={"username": "admin", "password": "123456"}
+    )
+    return {"Authorization": f"Bearer {login_response.json()['access_token']}"}
+
+
+def upstream_response(
+    status_code: int, body: Any = None, headers: Optional[Dict[str, str]] = None
+) -> httpx.Response:
+    """Response with a streamed body, as a real upstream connection produces"""
+    content = body if isinstance(body, bytes) else json.dumps(body).encode()
+
+    async def stream() -> AsyncIterator[bytes]:
+        yield content
+
+    return httpx.Response(
+        status_code,
+        content=stream(),
+        headers={"Content-Type": "application/json", **(headers or {})},
+    )
+
+
+def mock_upstream(handler: Callable[[httpx.Request], Any]) -> httpx.AsyncClient:
+    """Shared upstream client whose requests are answered by handler"""
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
 class TestProxyAppointments:
-    @patch("httpx.AsyncClient")
-    @pytest.mark.asyncio
-    async def test_proxy_appointments_get(self, mock_client: MagicMock) -> None:
+    def test_proxy_appointments_get(self) -> None:
         """Test proxy GET request to appointments service"""
-        # Setup mock response
-        mock_response: MagicMock = MagicMock()
-        mock_response.content = b'{"appointments": []}'
-        mock_response.status_code = 200
-        mock_response.headers = {"Content-Type": "application/json"}
+        calls: List[httpx.Request] = []
 
-        mock_client_instance: AsyncMock = AsyncMock()
-        mock_client_instance.request.return_value = mock_response
-        mock_client.return_value.__aenter__.return_value = mock_client_instance
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            return upstream_response(200, {"appointments": []})
 
-        # Get valid token
-        login_response = client.post(
-            "/login", json={"username": "admin", "password": "123456"}
-        )
-        token: str = login_response.json()["access_token"]
-
-        # Make request to proxy endpoint
-        headers: Dict[str, str] = {"Authorization": f"Bearer {token}"}
-        response = client.get("/appointments/list", headers=headers)
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get("/appointments/list", headers=auth_headers())
 
         assert response.status_code == 200
-        mock_client_instance.request.assert_called_once()
+        assert response.json() == {"appointments": []}
+        assert len(calls) == 1
+        assert calls[0].url.path == "/list"
 
-    @patch("httpx.AsyncClient")
-    @pytest.mark.asyncio
-    async def test_proxy_appointments_post(self, mock_client: MagicMock) -> None:
+    def test_proxy_appointments_post(self) -> None:
         """Test proxy POST request to appointments service"""
-        # Setup mock response
-        mock_response: MagicMock = MagicMock()
-        mock_response.content = b'{"id": 1, "created": true}'
-        mock_response.status_code = 201
-        mock_response.headers = {"Content-Type": "application/json"}
+        calls: List[httpx.Request] = []
 
-        mock_client_instance: AsyncMock = AsyncMock()
-        mock_client_instance.request.return_value = mock_response
-        mock_client.return_value.__aenter__.return_value = mock_client_instance
-
-        # Get valid token
-        login_response = client.post(
-            "/login", json={"username": "admin", "password": "123456"}
-        )
-        token: str = login_response.json()["access_token"]
+        async def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            body = await request.aread()
+            return upstream_response(201, body)
 
-        # Make POST request to proxy endpoint
-        headers: Dict[str, str] = {"Authorization": f"Bearer {token}"}
         appointment_data: Dict[str, str] = {"patient": "John Doe", "date": "2024-01-01"}
-        response = client.post(
-            "/appointments/create", json=appointment_data, headers=headers
-        )
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.post(
+                    "/appointments/create", json=appointment_data, headers=auth_headers()
+                )
 
         assert response.status_code == 201
-        mock_client_instance.request.assert_called_once()
+        assert response.json() == appointment_data
+        assert len(calls) == 1
+
+    def test_proxy_appointments_patch_batch(self) -> None:
+        """Test PATCH (batch updates) is proxied with its body"""
+        calls: List[httpx.Request] = []
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            return upstream_response(207, json.loads(await request.aread()))
+
+        items: List[Dict[str, Any]] = [{"id": 1, "status": "cancelled"}]
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.patch(
+                    "/appointments/appointments/batch", json=items, headers=auth_headers()
+                )
+
+        assert response.status_code == 207
+        assert response.json() == items
+        assert calls[0].method == "PATCH"
+        assert calls[0].url.path == "/appointments/batch"
 
     def test_proxy_appointments_without_auth(self) -> None:
         """Test proxy endpoint without authentication"""
         response = client.get("/appointments/list")
         assert response.status_code == 403
+
+    def test_proxy_reuses_shared_client(self) -> None:
+        """Test all proxied requests go through the single lifespan client"""
+        upstream = mock_upstream(lambda request: upstream_response(200, []))
+        with patch("main.create_http_client", return_value=upstream) as factory:
+            with TestClient(app) as lifespan_client:
+                for _ in range(3):
+                    assert lifespan_client.get("/appointments/", headers=auth_headers()).status_code == 200
+
+        factory.assert_called_once()
+        assert upstream.is_closed
+
+    def test_proxy_forwards_query_params(self) -> None:
+        """Test repeated query params reach the upstream untouched"""
+        calls: List[httpx.Request] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            return upstream_response(200, [])
+
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                lifespan_client.get(
+                    "/appointments/appointments/?status=scheduled&fields=id&fields=status",
+                    headers=auth_headers(),
+                )
+
+        assert calls[0].url.params.get_list("fields") == ["id", "status"]
+        assert calls[0].url.params["status"] == "scheduled"
+
+    @pytest.mark.asyncio
+    async def test_proxy_streams_large_response(self) -> None:
+        """Test large upstream bodies are relayed chunk by chunk, not buffered"""
+        chunk = b"x" * 65536
+        chunks = 64
+        produced = 0
+
+        async def body() -> AsyncIterator[bytes]:
+            nonlocal produced
+            for _ in range(chunks):
+                produced += 1
+                yield chunk
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            return httpx.Response(200, content=body(), headers={"Content-Type": "application/json"})
+
+        sent: List[Dict[str, Any]] = []
+
+        async def receive() -> Dict[str, Any]:
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.body" and message.get("body"):
+                # Upstream chunks already pulled when this one goes out to the client
+                sent.append({"size": len(message["body"]), "produced": produced})
+
+        token = auth_headers()["Authorization"].encode()
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0", "spec_version": "2.4"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/appointments/",
+            "raw_path": b"/appointments/",
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"host", b"gateway"), (b"authorization", token)],
+            "client": ("127.0.0.1", 50000),
+            "server": ("gateway", 80),
+        }
+        with patch("main.http_client", mock_upstream(handler)):
+            await app(scope, receive, send)
+
+        assert len(sent) == chunks
+        assert sum(part["size"] for part in sent) == len(chunk) * chunks
+        assert all(part["produced"] <= i + 2 for i, part in enumerate(sent))
+
+    def test_proxy_streams_request_body(self) -> None:
+        """Test the client body is forwarded with its Content-Length"""
+        seen: Dict[str, Any] = {}
+
+        async def handler(request: httpx.Request) -> httpx.Response:
+            seen["body"] = await request.aread()
+            seen["content-length"] = request.headers.get("content-length")
+            return upstream_response(200, {"ok": True})
+
+        payload = b'{"notes": "' + b"A" * 100000 + b'"}'
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.put(
+                    "/appointments/appointments/1",
+                    content=payload,
+                    headers={**auth_headers(), "Content-Type": "application/json"},
+                )
+
+        assert response.status_code == 200
+        assert seen["body"] == payload
+        assert seen["content-length"] == str(len(payload))
+
+    def test_proxy_strips_hop_by_hop_headers(self) -> None:
+        """Test hop-by-hop headers are not forwarded in either direction"""
+        seen: Dict[str, Any] = {}
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            seen["headers"] = request.headers
+            return upstream_response(
+                200,
+                [],
+                headers={
+                    "Connection": "keep-alive, X-Upstream-Hop",
+                    "Keep-Alive": "timeout=5",
+                    "X-Upstream-Hop": "1",
+                    "X-Next-Cursor": "abc",
+                },
+            )
+
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get(
+                    "/appointments/",
+                    headers={
+                        **auth_headers(),
+                        "Connection": "keep-alive, X-Client-Hop",
+                        "X-Client-Hop": "1",
+                        "Proxy-Authorization": "Basic abc",
+                        "TE": "trailers",
+                    },
+                )
+
+        forwarded = seen["headers"]
+        assert "x-client-hop" not in forwarded
+        assert "proxy-authorization" not in forwarded
+        assert "te" not in forwarded
+        assert "authorization" in forwarded
+        assert "keep-alive" not in response.headers
+        assert "x-upstream-hop" not in response.headers
+        assert response.headers["x-next-cursor"] == "abc"
+
+    def test_proxy_passes_conditional_get_through(self) -> None:
+        """Test If-None-Match reaches the upstream and its 304 + ETag come back untouched"""
+        calls: List[httpx.Request] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            return upstream_response(304, b"", {"ETag": '"abc123"'})
+
+        headers: Dict[str, str] = {**auth_headers(), "If-None-Match": '"abc123"'}
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get("/appointments/appointments/1", headers=headers)
+
+        assert calls[0].headers["if-none-match"] == '"abc123"'
+        assert response.status_code == 304
+        assert response.headers["etag"] == '"abc123"'
+        assert response.content == b""
+
+    def test_proxy_export_keeps_stream_headers(self) -> None:
+        """Test NDJSON/CSV exports keep their media type and download name"""
+        lines = b'{"id": 1}\n{"id": 2}\n'
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            return upstream_response(200, lines, {
+                "Content-Type": "application/x-ndjson",
+                "Content-Disposition": 'attachment; filename="appointments.ndjson"',
+            })
+
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get(
+                    "/appointments/appointments/export?format=ndjson", headers=auth_headers()
+                )
+
+        assert response.content == lines
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert response.headers["content-disposition"] == 'attachment; filename="appointments.ndjson"'
+
+    def test_proxy_upstream_timeout(self) -> None:
+        """Test upstream timeouts are reported as 504"""
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            raise httpx.ReadTimeout("timed out", request=request)
+
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get("/appointments/", headers=auth_headers())
+        assert response.status_code == 504
+
+    def test_proxy_upstream_unavailable(self) -> None:
+        """Test connection errors to the upstream are reported as 502"""
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            raise httpx.ConnectError("refused", request=request)
+
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get("/appointments/", headers=auth_headers())
+        assert response.status_code == 502
+
+
+CLIENT_TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+CLIENT_SPAN_ID = "00f067aa0ba902b7"
+
+
+def in_memory_tracing(sample_ratio: float = 1.0) -> Tracing:
+    return Tracing("api-gateway", InMemorySpanExporter(), sample_ratio=sample_ratio, export_delay=0.01)
+
+
+def parse_traceparent(value: str) -> List[str]:
+    version, trace_id, span_id, flags = value.split("-")
+    return [trace_id, span_id, flags]
+
+
+class TestTracing:
+    def proxy_get(self, tracing: Tracing, headers: Dict[str, str]) -> httpx.Request:
+        calls: List[httpx.Request] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            return upstream_response(200, [])
+
+        with patch("main.tracing", tracing), patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get("/appointments/", headers={**auth_headers(), **headers})
+        assert response.status_code == 200
+        return calls[0]
+
+    def test_tracing_disabled_passes_traceparent_through(self) -> None:
+        """Test with TRACE_EXPORTER=none the client's traceparent reaches the upstream untouched"""
+        traceparent = f"00-{CLIENT_TRACE_ID}-{CLIENT_SPAN_ID}-01"
+        forwarded = self.proxy_get(None, {"traceparent": traceparent})  # type: ignore
+        assert forwarded.headers["traceparent"] == traceparent
+
+    def test_proxy_starts_trace_and_propagates_it(self) -> None:
+        """Test a sampled SERVER span is created and named as the upstream's parent"""
+        tracing = in_memory_tracing()
+        forwarded = self.proxy_get(tracing, {})
+
+        spans = tracing.exporter.get_finished_spans()
+        assert len(spans) == 1
+        span = spans[0]
+        assert span.kind is SpanKind.SERVER
+        assert span.name == "GET /appointments/{path}"
+        assert span.attributes["http.response.status_code"] == 200
+        trace_id, span_id, flags = parse_traceparent(forwarded.headers["traceparent"])
+        assert trace_id == format(span.context.trace_id, "032x")
+        assert span_id == format(span.context.span_id, "016x")
+        assert flags == "01"
+
+    def test_proxy_continues_client_trace(self) -> None:
+        """Test the client's traceparent is continued and replaced, not forwarded as is"""
+        tracing = in_memory_tracing(sample_ratio=0.0)
+        forwarded = self.proxy_get(
+            tracing, {"traceparent": f"00-{CLIENT_TRACE_ID}-{CLIENT_SPAN_ID}-01", "tracestate": "vendor=1"}
+        )
+
+        span = tracing.exporter.get_finished_spans()[0]
+        assert format(span.context.trace_id, "032x") == CLIENT_TRACE_ID
+        assert format(span.parent.span_id, "016x") == CLIENT_SPAN_ID
+        assert forwarded.headers.get_list("traceparent") == [
+            f"00-{CLIENT_TRACE_ID}-{format(span.context.span_id, '016x')}-01"
+        ]
+        assert forwarded.headers["tracestate"] == "vendor=1"
+
+    def test_unsampled_trace_is_propagated_but_not_exported(self) -> None:
+        """Test an unsampled request still tells the upstream not to sample it"""
+        tracing = in_memory_tracing(sample_ratio=0.0)
+        forwarded = self.proxy_get(tracing, {})
+
+        assert tracing.exporter.get_finished_spans() == ()
+        assert parse_traceparent(forwarded.headers["traceparent"])[2] == "00"
+
+    def test_upstream_failure_marks_span_as_error(self) -> None:
+        """Test transport errors end the span with an error status"""
+        tracing = in_memory_tracing()
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            raise httpx.ConnectError("refused", request=request)
+
+        with patch("main.tracing", tracing), patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get("/appointments/", headers=auth_headers())
+        assert response.status_code == 502
+        span = tracing.exporter.get_finished_spans()[0]
+        assert span.status.status_code is StatusCode.ERROR
+        assert span.attributes["http.response.status_code"] == 502
+
+
+class TestHttpClientConfig:
+    def test_create_http_client_limits_and_timeouts(self) -> None:
+        """Test the shared client is built with per-phase timeouts"""
+        http_client = create_http_client()
+        assert http_client.timeout.connect == UPSTREAM_CONNECT_TIMEOUT
+        assert http_client.timeout.read == UPSTREAM_READ_TIMEOUT
+        assert http_client.timeout.pool == UPSTREAM_POOL_TIMEOUT
+
+
+APPOINTMENTS_PAGE: List[Dict[str, Any]] = [
+    {
+        "id": i,
+        "patient_name": f"Patient {i}",
+        "patient_email": f"patient{i}@example.com",
+        "doctor_name": "Dr. Test",
+        "doctor_specialty": "General",
+        "appointment_time": "2030-07-01T09:00:00",
+        "status": "scheduled",
+        "notes": None,
+        "created_at": "2030-06-01T10:00:00",
+        "updated_at": "2030-06-01T10:00:00",
+    }
+    for i in range(50)
+]
+
+
+def decompress(encoding: str, data: bytes) -> bytes:
+    if encoding == "gzip":
+        return zlib.decompress(data, 31)
+    if encoding == "br":
+        return brotli.decompress(data)
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def http_scope(path: str, headers: List[Tuple[bytes, bytes]], method: str = "GET") -> Dict[str, Any]:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"gateway"), *headers],
+        "client": ("127.0.0.1", 50000),
+        "server": ("gateway", 80),
+    }
+
+
+async def run_asgi(asgi_app: Any, scope: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Messages the app sends for scope, in order"""
+    messages: List[Dict[str, Any]] = []
+
+    async def receive() -> Dict[str, Any]:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: Dict[str, Any]) -> None:
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+    return messages
+
+
+def chunked_app(
+    chunks: List[bytes], headers: Optional[List[Tuple[bytes, bytes]]] = None, status: int = 200
+) -> Callable[..., Any]:
+    """ASGI app streaming chunks, JSON by default"""
+
+    async def asgi_app(scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers if headers is not None else [(b"content-type", b"application/json")],
+        })
+        for i, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": i < len(chunks) - 1})
+
+    return asgi_app
+
+
+class TestCompression:
+    @pytest.mark.parametrize(
+        "accept_encoding, expected",
+        [
+            ("gzip, deflate, br, zstd", "br"),
+            ("gzip", "gzip"),
+            ("gzip;q=1.0, br;q=0.5", "gzip"),
+            ("br;q=0, gzip;q=0.1", "gzip"),
+            ("*", "br"),
+            ("*;q=0.5, br;q=0", "zstd"),
+            ("identity", None),
+            ("deflate, compress", None),
+            ("GZIP;Q=0.8", "gzip"),
+        ],
+    )
+    def test_negotiation(self, accept_encoding: str, expected: Optional[str]) -> None:
+        """Test the highest q-value wins and ties follow the configured preference"""
+        assert negotiate(accept_encoding, ("br", "zstd", "gzip")) == expected
+
+    @pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+    def test_proxy_compresses_large_json(self, encoding: str) -> None:
+        """Test a large upstream JSON body is encoded with the negotiated algorithm"""
+        with patch("main.create_http_client", return_value=mock_upstream(
+            lambda request: upstream_response(200, APPOINTMENTS_PAGE, {"ETag": '"v1"'})
+        )):
+            with TestClient(app) as lifespan_client:
+                with lifespan_client.stream(
+                    "GET", "/appointments/", headers={**auth_headers(), "Accept-Encoding": encoding}
+                ) as response:
+                    raw = b"".join(response.iter_raw())
+
+        assert response.headers["content-encoding"] == encoding
+        assert "accept-encoding" in response.headers["vary"].lower()
+        assert response.headers["etag"] == 'W/"v1"'
+        assert json.loads(decompress(encoding, raw)) == APPOINTMENTS_PAGE
+        assert len(raw) < len(json.dumps(APPOINTMENTS_PAGE)) / 4
+
+    def test_small_responses_are_not_compressed(self) -> None:
+        """Test bodies under COMPRESSION_MIN_SIZE go out as they are"""
+        with patch("main.create_http_client", return_value=mock_upstream(
+            lambda request: upstream_response(200, APPOINTMENTS_PAGE[:1], {"ETag": '"v1"'})
+        )):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get(
+                    "/appointments/1", headers={**auth_headers(), "Accept-Encoding": "br, gzip"}
+                )
+
+        assert "content-encoding" not in response.headers
+        assert response.headers["etag"] == '"v1"'
+        assert response.json() == APPOINTMENTS_PAGE[:1]
+
+    def test_already_encoded_upstream_body_passes_through(self) -> None:
+        """Test a gzip body from upstream is relayed byte for byte, even to a client preferring br"""
+        encoded = gzip.compress(json.dumps(APPOINTMENTS_PAGE).encode())
+        with patch("main.create_http_client", return_value=mock_upstream(
+            lambda request: upstream_response(
+                200, encoded, {"Content-Encoding": "gzip", "Content-Length": str(len(encoded))}
+            )
+        )):
+            with TestClient(app) as lifespan_client:
+                with lifespan_client.stream(
+                    "GET", "/appointments/", headers={**auth_headers(), "Accept-Encoding": "br, gzip"}
+                ) as response:
+                    raw = b"".join(response.iter_raw())
+
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["content-length"] == str(len(encoded))
+        assert raw == encoded
+
+    def test_uncompressible_media_type_is_left_alone(self) -> None:
+        """Test binary bodies are not compressed"""
+        middleware = CompressionMiddleware(
+            chunked_app([b"\x00" * 4096], [(b"content-type", b"application/octet-stream")])
+        )
+        messages = asyncio.run(run_asgi(middleware, http_scope("/", [(b"accept-encoding", b"gzip")])))
+        assert messages[0]["headers"] == [(b"content-type", b"application/octet-stream")]
+        assert messages[1]["body"] == b"\x00" * 4096
+
+    def test_known_length_single_chunk_keeps_content_length(self) -> None:
+        """Test a whole body sent at once gets the Content-Length of its encoded form"""
+        body = json.dumps(APPOINTMENTS_PAGE).encode()
+        headers = [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+        middleware = CompressionMiddleware(chunked_app([body], headers))
+        messages = asyncio.run(run_asgi(middleware, http_scope("/", [(b"accept-encoding", b"gzip")])))
+
+        sent = dict(messages[0]["headers"])
+        assert sent[b"content-encoding"] == b"gzip"
+        assert int(sent[b"content-length"]) == len(messages[1]["body"])
+        assert zlib.decompress(messages[1]["body"], 31) == body
+
+    def test_streamed_body_is_compressed_chunk_by_chunk(self) -> None:
+        """Test every upstream chunk reaches the client as soon as it is encoded"""
+        lines = [json.dumps(item).encode() + b"\n" for item in APPOINTMENTS_PAGE]
+        chunks = [b"".join(lines[i:i + 10]) for i in range(0, len(lines), 10)]
+        middleware = CompressionMiddleware(
+            chunked_app(chunks, [(b"content-type", b"application/x-ndjson")]), minimum_size=256
+        )
+        messages = asyncio.run(run_asgi(middleware, http_scope("/", [(b"accept-encoding", b"gzip")])))
+
+        bodies = [m["body"] for m in messages[1:]]
+        assert len(bodies) == len(chunks)
+        assert b"content-length" not in dict(messages[0]["headers"])
+        decoder = zlib.decompressobj(31)
+        # Each chunk decodes on its own, before the next one arrives
+        for chunk, body in zip(chunks, bodies):
+            assert decoder.decompress(body) == chunk
+
+    def test_stream_shorter_than_threshold_is_not_compressed(self) -> None:
+        """Test small streamed bodies are buffered and sent as they are"""
+        middleware = CompressionMiddleware(chunked_app([b'{"a": ', b"1}"]), minimum_size=1024)
+        messages = asyncio.run(run_asgi(middleware, http_scope("/", [(b"accept-encoding", b"gzip")])))
+
+        assert b"content-encoding" not in dict(messages[0]["headers"])
+        assert b"".join(m["body"] for m in messages[1:]) == b'{"a": 1}'
+
+    def test_not_modified_and_head_are_untouched(self) -> None:
+        """Test responses without a body keep their headers"""
+        headers = [(b"content-type", b"application/json"), (b"etag", b'"v1"')]
+        middleware = CompressionMiddleware(chunked_app([b""], headers, status=304))
+        messages = asyncio.run(run_asgi(middleware, http_scope("/", [(b"accept-encoding", b"gzip")])))
+        assert messages[0]["headers"] == headers
+
+        big = CompressionMiddleware(chunked_app([b"x" * 4096]))
+        head = asyncio.run(run_asgi(big, http_scope("/", [(b"accept-encoding", b"gzip")], method="HEAD")))
+        assert b"content-encoding" not in dict(head[0]["headers"])
+
+    def test_levels_and_byte_counts(self) -> None:
+        """Test the configured level is used and the bytes before/after are reported"""
+        body = json.dumps(APPOINTMENTS_PAGE).encode()
+        reported: List[Tuple[str, int, int]] = []
+        sizes: Dict[int, int] = {}
+        for level in (1, 9):
+            middleware = CompressionMiddleware(
+                chunked_app([body]), levels={"gzip": level},
+                on_response=lambda *args: reported.append(args),
+            )
+            messages = asyncio.run(run_asgi(middleware, http_scope("/", [(b"accept-encoding", b"gzip")])))
+            sizes[level] = len(messages[1]["body"])
+
+        assert sizes[9] <= sizes[1]
+        assert reported == [("gzip", len(body), sizes[1]), ("gzip", len(body), sizes[9])]
+
+    def test_disabled_without_encodings(self) -> None:
+        """Test COMPRESSION_ENCODINGS empty turns compression off"""
+        middleware = CompressionMiddleware(chunked_app([b"x" * 4096]), encodings=())
+        messages = asyncio.run(run_asgi(middleware, http_scope("/", [(b"accept-encoding", b"gzip")])))
+        assert b"content-encoding" not in dict(messages[0]["headers"])
+
+
+class FakeRedis:
+    """The subset of redis.asyncio RedisRateLimiter uses, with a clock the test moves.
+
+    The GCRA script runs as its Python equivalent, over the same keys and arguments.
+    """
+
+    def __init__(self) -> None:
+        self.now: float = 1000.0
+        self.values: Dict[str, Tuple[bytes, float]] = {}
+        self.closed: bool = False
+
+    def register_script(self, script: str) -> Callable[..., Any]:
+        assert script == GCRA_SCRIPT
+
+        async def run(keys: List[str], args: List[float]) -> List[Any]:
+            tats: List[float] = []
+            denied, retry = 0, 0.0
+            for i, key in enumerate(keys, start=1):
+                stored = self.values.get(key)
+                tat = float(stored[0]) if stored is not None and stored[1] > self.now else None
+                interval, window = args[2 * i - 2], args[2 * i - 1]
+                new_tat, _ = gcra(tat, self.now, Limit(1 / interval, 0))
+                excess = new_tat - self.now - window
+                if excess > retry:
+                    denied, retry = i, excess
+                tats.append(new_tat)
+            if denied:
+                return [denied, str(retry).encode()]
+            for key, tat in zip(keys, tats):
+                self.values[key] = (str(tat).encode(), tat)  # PX: gone once the bucket is full again
+            return [0, b"0"]
+
+        return run
+
+    async def aclose(self) -> None:
+        self.closed = True
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now: float = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestRateLimiting:
+    @pytest.mark.parametrize(
+        "value, expected",
+        [
+            ("10:20", Limit(10.0, 20)),
+            ("5", Limit(5.0, 5)),
+            ("0.5", Limit(0.5, 1)),
+            ("0:10", None),
+            ("", None),
+        ],
+    )
+    def test_parse_limit(self, value: str, expected: Optional[Limit]) -> None:
+        """Test "rate:burst" parsing; a rate of 0 or an empty value disables the bucket"""
+        assert parse_limit(value) == expected
+
+    def test_parse_route_limits(self) -> None:
+        """Test per-route limits are keyed by method and route template"""
+        limits = parse_route_limits("post /login=1:5, GET /appointments/{path}=100:200,,PUT /x=0")
+        assert limits == {"POST /login": Limit(1.0, 5), "GET /appointments/{path}": Limit(100.0, 200)}
+
+    def test_bucket_allows_burst_then_refills_at_rate(self) -> None:
+        """Test burst requests pass at once, then one per 1/rate seconds"""
+        clock = FakeClock()
+        limiter = InMemoryRateLimiter(clock=clock)
+        bucket = [("subject:a", Limit(rate=2, burst=3))]
+        assert [limiter.acquire_now(bucket) for _ in range(3)] == [None, None, None]
+
+        denial = limiter.acquire_now(bucket)
+        assert denial is not None
+        assert denial.key == "subject:a"
+        assert denial.retry_after == pytest.approx(0.5)
+
+        clock.now += 0.5
+        assert limiter.acquire_now(bucket) is None
+        assert limiter.acquire_now(bucket) is not None
+        clock.now += 10  # refills up to the burst, not beyond
+        assert [limiter.acquire_now(bucket) for _ in range(4)].count(None) == 3
+
+    def test_tokens_are_taken_from_all_buckets_or_none(self) -> None:
+        """Test a request denied by its route bucket keeps its subject's tokens"""
+        limiter = InMemoryRateLimiter(clock=FakeClock())
+        subject = ("subject:a", Limit(rate=1, burst=2))
+        route = ("route:POST /login", Limit(rate=1, burst=1))
+        assert limiter.acquire_now([subject, route]) is None
+        denial = limiter.acquire_now([subject, route])
+        assert denial is not None and denial.key == "route:POST /login"
+        # The subject still has the token the denied request did not take
+        assert limiter.acquire_now([subject]) is None
+        assert limiter.acquire_now([subject]) is not None
+
+    def test_in_memory_buckets_are_bounded(self) -> None:
+        """Test the least recently used buckets are evicted, which resets them to full"""
+        limiter = InMemoryRateLimiter(max_keys=2, clock=FakeClock())
+        limit = Limit(rate=1, burst=1)
+        for key in ("a", "b", "c"):
+            limiter.acquire_now([(key, limit)])
+        assert len(limiter) == 2
+        assert limiter.acquire_now([("a", limit)]) is None  # evicted: full again
+        assert limiter.acquire_now([("c", limit)]) is not None
+
+    def test_redis_buckets_are_shared_between_replicas(self) -> None:
+        """Test two gateways on the same Redis draw from the same buckets"""
+        redis = FakeRedis()
+        replica_a = RedisRateLimiter(redis)
+        replica_b = RedisRateLimiter(redis)
+        bucket = [("subject:a", Limit(rate=1, burst=2))]
+
+        async def scenario() -> None:
+            assert await replica_a.acquire(bucket) is None
+            assert await replica_b.acquire(bucket) is None
+            denial = await replica_a.acquire(bucket)
+            assert denial is not None
+            assert denial.key == "subject:a"
+            assert denial.retry_after == pytest.approx(1.0)
+            assert list(redis.values) == ["ratelimit:subject:a"]
+            redis.now += 1
+            assert await replica_b.acquire(bucket) is None
+            await replica_a.close()
+
+        asyncio.run(scenario())
+        assert redis.closed
+
+    def test_proxy_returns_429_once_subject_burst_is_spent(self) -> None:
+        """Test per-subject limit: 429 with Retry-After, other subjects unaffected"""
+        calls: List[httpx.Request] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            return upstream_response(200, [])
+
+        headers = {"Authorization": f"Bearer {make_token('busy-integration')}"}
+        other = {"Authorization": f"Bearer {make_token('someone-else')}"}
+        with patch("main.RATE_LIMIT_SUBJECT", Limit(rate=0.5, burst=2)):
+            with patch("main.create_http_client", return_value=mock_upstream(handler)):
+                with TestClient(app) as lifespan_client:
+                    statuses = [lifespan_client.get("/appointments/", headers=headers).status_code for _ in range(3)]
+                    limited = lifespan_client.get("/appointments/", headers=headers)
+                    assert lifespan_client.get("/appointments/", headers=other).status_code == 200
+
+        assert statuses == [200, 200, 429]
+        assert limited.status_code == 429
+        assert limited.headers["Retry-After"] == "2"
+        assert limited.json() == {"detail": "Too many requests"}
+        assert len(calls) == 3
+        assert 'api_gateway_rejected_requests_total{reason="subject"}' in client.get("/metrics").text
+
+    def test_route_limit_applies_to_login(self) -> None:
+        """Test per-route limits also cover unauthenticated routes"""
+        credentials = {"username": "admin", "password": "123456"}
+        with patch("main.RATE_LIMIT_ROUTES", parse_route_limits("POST /login=0.1:2")):
+            statuses = [client.post("/login", json=credentials).status_code for _ in range(3)]
+        assert statuses == [200, 200, 429]
+        assert 'api_gateway_rejected_requests_total{reason="route"}' in client.get("/metrics").text
+
+    def test_unreachable_backend_lets_requests_through(self) -> None:
+        """Test a failing shared backend fails open instead of rejecting traffic"""
+
+        class BrokenBackend(InMemoryRateLimiter):
+            async def acquire(self, buckets: Any) -> Any:
+                raise ConnectionError("redis down")
+
+        with patch("main.rate_limiter", BrokenBackend()), patch("main.RATE_LIMIT_SUBJECT", Limit(rate=1, burst=1)):
+            response = client.get("/protected", headers={"Authorization": f"Bearer {make_token()}"})
+        assert response.status_code == 200
+        assert "api_gateway_rate_limit_errors_total 1.0" in client.get("/metrics").text
+
+    def test_rate_limiting_disabled(self) -> None:
+        """Test RATE_LIMIT_BACKEND=none skips every bucket"""
+        headers = {"Authorization": f"Bearer {make_token('unlimited')}"}
+        with patch("main.rate_limiter", None), patch("main.RATE_LIMIT_SUBJECT", Limit(rate=0.1, burst=1)):
+            statuses = {client.get("/protected", headers=headers).status_code for _ in range(5)}
+        assert statuses == {200}
+
+
+class TestLoadShedding:
+    def test_limit_decreases_on_slow_or_failed_responses(self) -> None:
+        """Test multiplicative decrease, bounded by the minimum limit"""
+        clock = FakeClock()
+        limit = AdaptiveConcurrencyLimit(initial=10, min_limit=8, max_limit=20, latency_target=0.5, clock=clock)
+        assert limit.try_acquire()
+        limit.release(0.9)
+        assert limit.limit == pytest.approx(9.0)
+        for _ in range(2):
+            clock.now += 1  # a new window: requests sent after the last decrease
+            assert limit.try_acquire()
+            limit.release(None)
+        assert limit.limit == 8
+        assert limit.in_flight == 0
+
+    def test_burst_of_failures_decreases_once_per_window(self) -> None:
+        """Test failures that were all in flight together cut the limit only once"""
+        clock = FakeClock()
+        limit = AdaptiveConcurrencyLimit(initial=10, min_limit=1, max_limit=20, latency_target=0.5, clock=clock)
+        assert all(limit.try_acquire() for _ in range(10))
+        for _ in range(5):
+            limit.release(None)
+            clock.now += 0.01
+        for _ in range(5):
+            limit.release(2.0)  # slow, and started before the first cut
+        assert limit.limit == pytest.approx(9.0)
+
+        clock.now += 0.6  # past the window of a failure: a new failure is a new signal
+        assert limit.try_acquire()
+        limit.release(None)
+        assert limit.limit == pytest.approx(8.1)
+
+    def test_limit_grows_only_while_in_use(self) -> None:
+        """Test additive increase needs the limit to be at least half used"""
+        limit = AdaptiveConcurrencyLimit(initial=4, min_limit=1, max_limit=5, latency_target=0.5)
+        for _ in range(20):
+            assert limit.try_acquire()
+            limit.release(0.01)
+        assert limit.limit == 4  # one request at a time says nothing about capacity
+
+        for _ in range(50):
+            assert all(limit.try_acquire() for _ in range(int(limit.limit)))
+            for _ in range(int(limit.limit)):
+                limit.release(0.01)
+        assert limit.limit == 5
+
+    def test_requests_over_the_limit_are_rejected(self) -> None:
+        """Test try_acquire refuses once the limit is reached, without waiting"""
+        limit = AdaptiveConcurrencyLimit(initial=2, min_limit=1, max_limit=4, latency_target=0.5)
+        assert limit.try_acquire() and limit.try_acquire()
+        assert not limit.try_acquire()
+        limit.release(0.01)
+        assert limit.try_acquire()
+
+    def test_proxy_sheds_with_503_when_at_the_limit(self) -> None:
+        """Test requests over the concurrency limit get 503 + Retry-After without reaching upstream"""
+        calls: List[httpx.Request] = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            calls.append(request)
+            return upstream_response(200, [])
+
+        main.concurrency_limit.in_flight = int(main.concurrency_limit.limit)
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                response = lifespan_client.get("/appointments/", headers=auth_headers())
+
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(main.LOAD_SHED_RETRY_AFTER)
+        assert calls == []
+        assert 'api_gateway_rejected_requests_total{reason="overload"}' in client.get("/metrics").text
+
+    def test_proxy_releases_slot_and_feeds_latency(self) -> None:
+        """Test each proxied request gives its slot back; failures shrink the limit"""
+        statuses = iter([200, 500])
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            return upstream_response(next(statuses), [])
+
+        def timeout(request: httpx.Request) -> httpx.Response:
+            raise httpx.ReadTimeout("slow upstream", request=request)
+
+        initial = main.concurrency_limit.limit
+        with patch("main.create_http_client", return_value=mock_upstream(handler)):
+            with TestClient(app) as lifespan_client:
+                assert lifespan_client.get("/appointments/", headers=auth_headers()).status_code == 200
+                assert main.concurrency_limit.in_flight == 0
+                assert main.concurrency_limit.limit == initial
+                assert lifespan_client.get("/appointments/", headers=auth_headers()).status_code == 500
+        assert main.concurrency_limit.in_flight == 0
+        assert main.concurrency_limit.limit == pytest.approx(initial * 0.9)
+
+        main.concurrency_limit.last_decrease -= main.concurrency_limit.latency_target  # next window
+        with patch("main.create_http_client", return_value=mock_upstream(timeout)):
+            with TestClient(app) as lifespan_client:
+                assert lifespan_client.get("/appointments/", headers=auth_headers()).status_code == 504
+        assert main.concurrency_limit.in_flight == 0
+        assert main.concurrency_limit.limit == pytest.approx(initial * 0.81)
+        body = client.get("/metrics").text
+        assert "api_gateway_concurrency_limit" in body
+        assert "api_gateway_upstream_in_flight 0.0" in body
+
+
+class Fault(NamedTuple):
+    status: int = 200
+    delay: float = 0.0  # seconds before the response headers
+    error: Optional[Type[httpx.TransportError]] = None  # raised instead of answering
+    body: Any = None
+
+
+class FaultInjectingUpstream(httpx.AsyncBaseTransport):
+    """Local stub upstream: each request gets the next scripted fault, then `default`"""
+
+    def __init__(self, *faults: Fault, default: Fault = Fault()) -> None:
+        self.faults: List[Fault] = list(faults)
+        self.default = default
+        self.calls: List[httpx.Request] = []
+        self.cancelled: int = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.calls.append(request)
+        fault = self.faults.pop(0) if self.faults else self.default
+        try:
+            await asyncio.sleep(fault.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if fault.error is not None:
+            raise fault.error("injected fault", request=request)
+        body = fault.body if fault.body is not None else {"attempt": len(self.calls)}
+        return upstream_response(fault.status, body)
+
+
+def proxy_get(stub: FaultInjectingUpstream, path: str = "/appointments/") -> httpx.Response:
+    with patch("main.create_http_client", return_value=httpx.AsyncClient(transport=stub)):
+        with TestClient(app) as lifespan_client:
+            return lifespan_client.get(path, headers=auth_headers())
+
+
+class TestCircuitBreaker:
+    def test_opens_fails_fast_and_recovers_through_half_open(self) -> None:
+        """Test closed -> open -> half-open -> closed, with limited probes"""
+        clock = FakeClock()
+        states: List[str] = []
+        breaker = CircuitBreaker(
+            failure_ratio=0.5, window=4, min_calls=4, open_seconds=5, half_open_calls=2,
+            clock=clock, on_state_change=states.append,
+        )
+        for ok in (True, False, True):
+            assert breaker.allow()
+            breaker.record(ok)
+        assert breaker.state == CircuitBreaker.CLOSED  # under min_calls
+        breaker.record(False)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+        assert breaker.retry_after() == pytest.approx(5)
+
+        clock.now += 5
+        assert breaker.allow() and breaker.allow()
+        assert not breaker.allow()  # only half_open_calls probes
+        breaker.record(True)
+        breaker.record(True)
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert states == ["open", "half_open", "closed"]
+
+    def test_failed_probe_reopens(self) -> None:
+        """Test a failing probe sends the breaker back to open for another period"""
+        clock = FakeClock()
+        breaker = CircuitBreaker(window=2, min_calls=2, open_seconds=5, clock=clock)
+        breaker.record(False)
+        breaker.record(False)
+        clock.now += 5
+        assert breaker.allow()
+        breaker.record(False)
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+
+    def test_rolling_window_forgets_old_failures(self) -> None:
+        """Test only the last `window` outcomes count"""
+        breaker = CircuitBreaker(failure_ratio=0.6, window=5, min_calls=5)
+        for ok in (False, False, True, True, True, True, True, False, False):
+            breaker.record(ok)
+        assert breaker.state == CircuitBreaker.CLOSED  # 2 of the last 5 failed
+        breaker.record(False)
+        assert breaker.state == CircuitBreaker.OPEN
+
+    def test_cancelled_probe_frees_its_slot(self) -> None:
+        """Test a probe that ends without an outcome does not block the half-open state"""
+        clock = FakeClock()
+        breaker = CircuitBreaker(window=1, min_calls=1, open_seconds=1, half_open_calls=1, clock=clock)
+        breaker.record(False)
+        clock.now += 1
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.cancel()
+        assert breaker.allow()
+
+    def test_retry_budget(self) -> None:
+        """Test retries are a fraction of requests plus a per-second reserve"""
+        clock = FakeClock()
+        budget = RetryBudget(ratio=0.5, min_per_second=1, clock=clock)
+        assert budget.try_withdraw()  # the reserve starts full
+        assert not budget.try_withdraw()
+        budget.deposit()
+        budget.deposit()
+        assert budget.try_withdraw()
+        assert not budget.try_withdraw()
+        clock.now += 10  # the reserve holds at most one second's worth
+        assert budget.try_withdraw()
+        assert not budget.try_withdraw()
+
+    def test_latency_tracker_percentile(self) -> None:
+        """Test the percentile is only known after min_samples and follows recent latencies"""
+        tracker = LatencyTracker(percentile=0.95, size=100, min_samples=100, refresh=10)
+        for i in range(99):
+            tracker.record(i / 1000)
+        assert tracker.value() is None
+        tracker.record(0.099)
+        assert tracker.value() == pytest.approx(0.095)
+        for _ in range(100):
+            tracker.record(0.5)
+        assert tracker.value() == 0.5
+
+
+class TestUpstreamResilience:
+    def test_get_is_retried_after_connection_error_and_503(self) -> None:
+        """Test idempotent requests are retried until a usable response"""
+        labels = {"upstream": main.APPOINTMENT_SERVICE_URL}
+        retries_before = REGISTRY.get_sample_value("api_gateway_upstream_retries_total", labels) or 0
+        stub = FaultInjectingUpstream(Fault(error=httpx.ConnectError), Fault(status=503))
+        with patch("main.RETRY_BACKOFF_BASE_MS", 1):
+            reset_upstreams()
+            response = proxy_get(stub)
+        assert response.status_code == 200
+        assert response.json() == {"attempt": 3}
+        assert REGISTRY.get_sample_value("api_gateway_upstream_retries_total", labels) == retries_before + 2
+
+    def test_retries_stop_at_max_retries(self) -> None:
+        """Test the last upstream response is relayed once retries run out"""
+        stub = FaultInjectingUpstream(default=Fault(status=503))
+        with patch("main.RETRY_BACKOFF_BASE_MS", 1), patch("main.UPSTREAM_RETRIES", 1):
+            reset_upstreams()
+            response = proxy_get(stub)
+        assert response.status_code == 503
+        assert len(stub.calls) == 2
+
+    def test_post_and_timeouts_are_not_retried(self) -> None:
+        """Test non-idempotent requests and read timeouts get a single attempt"""
+        stub = FaultInjectingUpstream(Fault(status=503), Fault(error=httpx.ReadTimeout))
+        with patch("main.create_http_client", return_value=httpx.AsyncClient(transport=stub)):
+            with TestClient(app) as lifespan_client:
+                headers = auth_headers()
+                assert lifespan_client.post("/appointments/", json={}, headers=headers).status_code == 503
+                assert lifespan_client.get("/appointments/", headers=headers).status_code == 504
+        assert len(stub.calls) == 2
+
+    def test_exhausted_budget_skips_retries(self) -> None:
+        """Test retries stop when the shared retry budget is empty"""
+        main.retry_budget = RetryBudget(ratio=0, min_per_second=0)
+        reset_upstreams()
+        stub = FaultInjectingUpstream(Fault(status=502))
+        response = proxy_get(stub)
+        assert response.status_code == 502
+        assert len(stub.calls) == 1
+        assert "api_gateway_retry_budget_exhausted_total" in client.get("/metrics").text
+
+    def test_open_circuit_fails_fast(self) -> None:
+        """Test an open breaker answers 503 + Retry-After without calling the upstream"""
+        stub = FaultInjectingUpstream(default=Fault(error=httpx.ConnectError))
+        with patch("main.CIRCUIT_WINDOW", 2), patch("main.CIRCUIT_MIN_CALLS", 2), patch("main.UPSTREAM_RETRIES", 0):
+            reset_upstreams()
+            with patch("main.create_http_client", return_value=httpx.AsyncClient(transport=stub)):
+                with TestClient(app) as lifespan_client:
+                    headers = auth_headers()
+                    statuses = [lifespan_client.get("/appointments/", headers=headers).status_code for _ in range(2)]
+                    started = time.perf_counter()
+                    response = lifespan_client.get("/appointments/", headers=headers)
+                    elapsed = time.perf_counter() - started
+
+        assert statuses == [502, 502]
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(int(main.CIRCUIT_OPEN_SECONDS))
+        assert len(stub.calls) == 2
+        assert elapsed < 1
+        upstream = main.APPOINTMENT_SERVICE_URL
+        metrics = client.get("/metrics").text
+        assert f'api_gateway_circuit_state{{upstream="{upstream}"}} 2.0' in metrics
+        # The balancer skips instances whose circuit is open; with none left the gateway fails fast
+        assert f'api_gateway_upstream_available{{upstream="{upstream}"}} 0.0' in metrics
+        assert 'api_gateway_rejected_requests_total{reason="unavailable"} 1.0' in metrics
+        assert main.concurrency_limit.in_flight == 0
+
+    def test_slow_get_is_hedged(self) -> None:
+        """Test a GET slower than the observed p95 is sent again and the first answer wins"""
+        latency = main.upstream_for(main.APPOINTMENT_SERVICE_URL).latency
+        for _ in range(100):
+            latency.record(0.01)
+        stub = FaultInjectingUpstream(Fault(delay=5, body="primary"), Fault(body="hedge"))
+        started = time.perf_counter()
+        response = proxy_get(stub)
+        elapsed = time.perf_counter() - started
+
+        assert response.status_code == 200
+        assert response.json() == "hedge"
+        assert len(stub.calls) == 2
+        assert stub.cancelled == 1
+        assert elapsed < 5
+        upstream = main.APPOINTMENT_SERVICE_URL
+        metrics = client.get("/metrics").text
+        assert f'api_gateway_upstream_hedges_total{{upstream="{upstream}"}}' in metrics
+        assert f'api_gateway_upstream_hedge_wins_total{{upstream="{upstream}"}}' in metrics
+
+    def test_slow_export_is_not_hedged(self) -> None:
+        """Test a heavy read slower than the p95 gets no second copy of its scan"""
+        latency = main.upstream_for(main.APPOINTMENT_SERVICE_URL).latency
+        for _ in range(100):
+            latency.record(0.01)
+        stub = FaultInjectingUpstream(Fault(delay=0.3, body="export"), Fault(body="hedge"))
+        response = proxy_get(stub, "/appointments/export?format=csv")
+
+        assert response.status_code == 200
+        assert response.json() == "export"
+        assert len(stub.calls) == 1
+        assert stub.calls[0].url.path == "/export"
+
+    def test_fast_get_and_unknown_latency_are_not_hedged(self) -> None:
+        """Test no hedge fires for responses under the p95, nor before latencies are known"""
+        stub = FaultInjectingUpstream(Fault(delay=0.05))
+        assert proxy_get(stub).status_code == 200  # no p95 yet
+        latency = main.upstream_for(main.APPOINTMENT_SERVICE_URL).latency
+        for _ in range(100):
+            latency.record(0.5)
+        assert proxy_get(stub).status_code == 200
+        assert len(stub.calls) == 2
+
+
+INSTANCE_URLS = ["http://appointments-1:8001", "http://appointments-2:8001", "http://appointments-3:8001"]
+
+
+class UpstreamRouter(httpx.AsyncBaseTransport):
+    """Several local stub upstreams behind one client, routed by host"""
+
+    def __init__(self, stubs: Dict[str, httpx.AsyncBaseTransport]) -> None:
+        self.stubs = stubs
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.stubs[f"{request.url.scheme}://{request.url.host}:{request.url.port}"].handle_async_request(
+            request
+        )
+
+
+def instances(count: int, clock: Callable[[], float] = time.monotonic) -> List[Instance]:
+    return [
+        Instance(url, ResilientUpstream(url, CircuitBreaker(clock=clock), RetryBudget()))
+        for url in INSTANCE_URLS[:count]
+    ]
+
+
+def proxy_get_balanced(stubs: Dict[str, FaultInjectingUpstream], requests: int = 1) -> List[httpx.Response]:
+    """GET /appointments/ `requests` times through a gateway balancing over the stubs"""
+    with patch("main.APPOINTMENT_SERVICE_URLS", list(stubs)), patch("main.HEALTH_CHECK_INTERVAL_SECONDS", 0):
+        reset_upstreams()
+        with patch("main.create_http_client", return_value=httpx.AsyncClient(transport=UpstreamRouter(stubs))):
+            with TestClient(app) as lifespan_client:
+                headers = auth_headers()
+                return [lifespan_client.get("/appointments/", headers=headers) for _ in range(requests)]
+
+
+class TestLoadBalancing:
+    def test_parse_urls(self) -> None:
+        """Test instance URLs are trimmed and deduplicated"""
+        assert parse_urls(" http://a:1/, http://b:2,,http://a:1") == ["http://a:1", "http://b:2"]
+
+    def test_unknown_policy_is_rejected(self) -> None:
+        """Test a typo in LB_POLICY fails at startup"""
+        with pytest.raises(ValueError):
+            LoadBalancer(instances(2), policy="round_robin")
+
+    def test_least_outstanding_picks_the_least_loaded(self) -> None:
+        """Test the instance with the fewest requests in flight wins, ties rotating"""
+        pool = instances(3)
+        balancer = LoadBalancer(pool, policy="least_outstanding", slow_start=0)
+        pool[0].upstream.outstanding = 3
+        pool[1].upstream.outstanding = 1
+        pool[2].upstream.outstanding = 2
+        assert balancer.pick() is pool[1]
+        assert balancer.pick(exclude=[pool[1]]) is pool[2]
+        for instance in pool:
+            instance.upstream.outstanding = 0
+        assert {balancer.pick().url for _ in range(3)} == set(INSTANCE_URLS)  # type: ignore
+
+    def test_p2c_spreads_load_and_avoids_the_busiest(self) -> None:
+        """Test power of two choices uses every idle instance and never the most loaded one"""
+        pool = instances(3)
+        balancer = LoadBalancer(pool, policy="p2c", slow_start=0, rng=random.Random(7))
+        assert {balancer.pick().url for _ in range(50)} == set(INSTANCE_URLS)  # type: ignore
+        pool[0].upstream.outstanding = 10
+        assert all(balancer.pick() is not pool[0] for _ in range(50))
+
+    def test_health_checks_take_instances_out_and_back_with_slow_start(self) -> None:
+        """Test unhealthy_threshold failed checks remove an instance and healthy_threshold passes restore it"""
+        clock = FakeClock()
+        pool = instances(2, clock)
+        balancer = LoadBalancer(pool, slow_start=10, healthy_threshold=2, unhealthy_threshold=2, clock=clock)
+        sick = FaultInjectingUpstream(Fault(status=503), Fault(error=httpx.ConnectError))
+        stubs = {INSTANCE_URLS[0]: FaultInjectingUpstream(), INSTANCE_URLS[1]: sick}
+
+        async def check_rounds(rounds: int) -> None:
+            async with httpx.AsyncClient(transport=UpstreamRouter(stubs)) as http:
+                for _ in range(rounds):
+                    await balancer.check(http, timeout=1)
+
+        asyncio.run(check_rounds(1))
+        assert pool[1].healthy  # one failure is not enough
+        asyncio.run(check_rounds(1))
+        assert not pool[1].healthy
+        assert all(balancer.pick() is pool[0] for _ in range(10))
+        assert [call.url.path for call in sick.calls] == ["/health/ready", "/health/ready"]
+
+        asyncio.run(check_rounds(2))
+        assert pool[1].healthy
+        assert pool[1].weight(clock(), balancer.slow_start) == MIN_WEIGHT
+        clock.now += 5
+        assert pool[1].weight(clock(), balancer.slow_start) == pytest.approx(0.5)
+        clock.now += 5
+        assert pool[1].weight(clock(), balancer.slow_start) == 1.0
+
+    def test_health_checks_use_readiness(self) -> None:
+        """Test an instance that is alive but not ready (draining, database down) leaves rotation"""
+
+        class DrainingInstance(httpx.AsyncBaseTransport):
+            async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+                return upstream_response(503 if request.url.path == "/health/ready" else 200, {})
+
+        stubs = {INSTANCE_URLS[0]: FaultInjectingUpstream(), INSTANCE_URLS[1]: DrainingInstance()}
+
+        async def check_rounds(rounds: int) -> None:
+            async with httpx.AsyncClient(transport=UpstreamRouter(stubs)) as http:
+                for _ in range(rounds):
+                    await balancer.check(http, timeout=1)
+
+        with patch("main.APPOINTMENT_SERVICE_URLS", INSTANCE_URLS[:2]):
+            balancer = main.create_balancer(main.APPOINTMENT_SERVICE_URLS)
+        assert balancer.health_path == "/health/ready"
+        asyncio.run(check_rounds(main.HEALTH_CHECK_UNHEALTHY_THRESHOLD))
+        assert balancer.instances[0].healthy
+        assert not balancer.instances[1].healthy
+        assert all(balancer.pick() is balancer.instances[0] for _ in range(10))
+
+    def test_consecutive_failures_eject_with_growing_duration(self) -> None:
+        """Test outlier ejection, its backoff on repeat offenders and the slow start afterwards"""
+        clock = FakeClock()
+        pool = instances(3, clock)
+        ejected: List[str] = []
+        balancer = LoadBalancer(
+            pool, consecutive_failures=3, ejection_seconds=10, slow_start=10, clock=clock,
+            on_eject=lambda instance: ejected.append(instance.url),
+        )
+        for ok in (False, False, True, False, False):
+            balancer.record(pool[0].url, ok)
+        assert not pool[0].ejected(clock())  # a success resets the count
+        balancer.record(pool[0].url, False)
+        assert pool[0].ejected(clock())
+        assert balancer.retry_after() == 0  # the other instances are available
+        assert all(balancer.pick() is not pool[0] for _ in range(20))
+
+        clock.now += 10
+        assert balancer.available(pool[0], clock())
+        assert pool[0].weight(clock(), balancer.slow_start) == MIN_WEIGHT
+        for _ in range(3):
+            balancer.record(pool[0].url, False)
+        assert pool[0].ejected_until == clock() + 20
+        assert ejected == [pool[0].url, pool[0].url]
+
+    def test_ejections_are_capped(self) -> None:
+        """Test max_ejection_percent keeps part of the pool serving even if all of it fails"""
+        clock = FakeClock()
+        pool = instances(2, clock)
+        balancer = LoadBalancer(pool, consecutive_failures=1, max_ejection_percent=50, clock=clock)
+        balancer.record(pool[0].url, False)
+        balancer.record(pool[1].url, False)
+        assert pool[0].ejected(clock())
+        assert not pool[1].ejected(clock())
+        assert balancer.pick() is pool[1]
+
+    def test_proxy_spreads_requests_and_reports_each_instance(self) -> None:
+        """Test requests go to every instance and each gets its own load and latency metrics"""
+        stubs = {url: FaultInjectingUpstream() for url in INSTANCE_URLS}
+        with patch("main.LB_POLICY", "least_outstanding"):
+            responses = proxy_get_balanced(stubs, requests=6)
+        assert [r.status_code for r in responses] == [200] * 6
+        assert [len(stub.calls) for stub in stubs.values()] == [2, 2, 2]
+        metrics = client.get("/metrics").text
+        for url in INSTANCE_URLS:
+            assert f'api_gateway_upstream_requests_total{{outcome="ok",upstream="{url}"}}' in metrics
+            assert f'api_gateway_upstream_latency_seconds_count{{upstream="{url}"}}' in metrics
+            assert f'api_gateway_upstream_outstanding{{upstream="{url}"}} 0.0' in metrics
+            assert f'api_gateway_upstream_available{{upstream="{url}"}} 1.0' in metrics
+
+    def test_proxy_retries_on_another_instance(self) -> None:
+        """Test a failed GET is retried on an instance it has not tried yet"""
+        failing = FaultInjectingUpstream(default=Fault(status=503))
+        healthy = FaultInjectingUpstream()
+        stubs = {INSTANCE_URLS[0]: failing, INSTANCE_URLS[1]: healthy}
+        with patch("main.RETRY_BACKOFF_BASE_MS", 1), patch("main.LB_POLICY", "least_outstanding"):
+            responses = proxy_get_balanced(stubs, requests=2)
+        assert [r.status_code for r in responses] == [200, 200]
+        # One request lands on the failing instance and is retried on the other one
+        assert len(failing.calls) == 1
+        assert len(healthy.calls) == 2
+        assert all(call.url.host == "appointments-2" for call in healthy.calls)
+        assert all(call.headers["host"] == "appointments-2:8001" for call in healthy.calls)
+
+    def test_proxy_fails_fast_without_available_instance(self) -> None:
+        """Test 503 + Retry-After, without any upstream call, once every instance is ejected"""
+        stubs = {url: FaultInjectingUpstream(default=Fault(error=httpx.ConnectError)) for url in INSTANCE_URLS[:2]}
+        with patch("main.OUTLIER_CONSECUTIVE_FAILURES", 1), patch("main.OUTLIER_MAX_EJECTION_PERCENT", 100), \
+                patch("main.OUTLIER_EJECTION_SECONDS", 7), patch("main.UPSTREAM_RETRIES", 0):
+            responses = proxy_get_balanced(stubs, requests=3)
+        assert [r.status_code for r in responses] == [502, 502, 503]
+        assert responses[2].headers["Retry-After"] == "7"
+        assert [len(stub.calls) for stub in stubs.values()] == [1, 1]
+        assert main.concurrency_limit.in_flight == 0
+        metrics = client.get("/metrics").text
+        for url in INSTANCE_URLS[:2]:
+            assert f'api_gateway_upstream_ejections_total{{upstream="{url}"}} 1.0' in metrics
@@ -0,0 +1,194 @@
+"""Búsqueda de horarios libres por médico.
+
+Los horarios salen de una jornada configurable (días, franjas y duración del
+turno) y se cruzan con un índice en memoria de las citas de cada médico: una
+lista ordenada de horas de inicio por médico, consultada con bisect. Así una
+búsqueda de una semana es O(turnos · log n) y no toca la base de datos.
+
+El índice se construye al arrancar y se mantiene con cada escritura del
+proceso; una reconstrucción periódica incorpora las de otras réplicas.
+"""
+import bisect
+import datetime
+import heapq
+import itertools
+import threading
+
+# Las citas canceladas no ocupan turno
+INACTIVE_STATUSES = frozenset({"cancelled"})
+
+
+def parse_working_hours(spec):
+    """"08:00-12:00,14:00-18:00" -> [(time(8), time(12)), (time(14), time(18))]"""
+    windows = []
+    for window in spec.split(","):
+        start, end = (datetime.time.fromisoformat(part.strip()) for part in window.split("-"))
+        if start >= end:
+            raise ValueError(f"Invalid working hours window: {window!r}")
+        windows.append((start, end))
+    return sorted(windows)
+
+
+def parse_working_days(spec):
+    """"0-4" o "0,1,2,3,4" -> {0, 1, 2, 3, 4} (lunes = 0)"""
+    days = set()
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            days.update(range(int(first), int(last) + 1))
+        else:
+            days.add(int(part))
+    return days
+
+
+def _as_datetime(value):
+    return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
+
+
+class WorkingSchedule:
+    """Turnos de slot_minutes dentro de las franjas de los días hábiles"""
+
+    def __init__(self, days, windows, slot_minutes):
+        self.days = frozenset(days)
+        self.windows = windows
+        self.slot = datetime.timedelta(minutes=slot_minutes)
+
+    def slots(self, start, end):
+        """Inicios de turno en [start, end), en orden"""
+        day = start.date()
+        while day <= end.date():
+            if day.weekday() in self.days:
+                for window_start, window_end in self.windows:
+                    slot = datetime.datetime.combine(day, window_start)
+                    close = datetime.datetime.combine(day, window_end)
+                    while slot + self.slot <= close:
+                        if slot >= end:
+                            return
+                        if slot >= start:
+                            yield slot
+                        slot += self.slot
+            day += datetime.timedelta(days=1)
+
+
+class AvailabilityIndex:
+    """Horas de inicio de las citas activas de cada médico, ordenadas"""
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._reset()
+        self._journal = None
+
+    def _reset(self):
+        self._starts = {}  # doctor -> [appointment_time] ordenada
+        self._specialty_of = {}  # doctor -> specialty
+        self._by_id = {}  # id -> (doctor, appointment_time) de las citas activas
+
+    def __len__(self):
+        return len(self._by_id)
+
+    # --- Escrituras ---
+    def _remove_locked(self, appointment_id):
+        entry = self._by_id.pop(appointment_id, None)
+        if entry is None:
+            return
+        doctor, start = entry
+        starts = self._starts[doctor]
+        del starts[bisect.bisect_left(starts, start)]
+
+    def _upsert_locked(self, appointment_id, doctor, specialty, start, status):
+        self._remove_locked(appointment_id)
+        self._specialty_of[doctor] = specialty
+        if status in INACTIVE_STATUSES:
+            return
+        start = _as_datetime(start)
+        bisect.insort(self._starts.setdefault(doctor, []), start)
+        self._by_id[appointment_id] = (doctor, start)
+
+    def upsert(self, appointment_id, doctor, specialty, start, status):
+        with self._lock:
+            self._upsert_locked(appointment_id, doctor, specialty, start, status)
+            if self._journal is not None:
+                self._journal.append(("upsert", (appointment_id, doctor, specialty, start, status)))
+
+    def remove(self, appointment_id):
+        with self._lock:
+            self._remove_locked(appointment_id)
+            if self._journal is not None:
+                self._journal.append(("remove", (appointment_id,)))
+
+    # --- Reconstrucción ---
+    def start_rebuild(self):
+        """Desde aquí se registran las escrituras para reaplicarlas sobre la carga nueva"""
+        with self._lock:
+            self._journal = []
+
+    def abort_rebuild(self):
+        with self._lock:
+            self._journal = None
+
+    def finish_rebuild(self, doctors, appointments):
+        """doctors: [(doctor, specialty)]; appointments: [(id, doctor, specialty, time, status)]"""
+        with self._lock:
+            journal, self._journal = self._journal or [], None
+            self._reset()
+            for doctor, specialty in doctors:
+                self._specialty_of[doctor] = specialty
+            for appointment in appointments:
+                self._upsert_locked(*appointment)
+            # Escrituras que pudieron quedar fuera de la foto leída de la base de datos
+            for op, args in journal:
+                if op == "upsert":
+                    self._upsert_locked(*args)
+                else:
+                    self._remove_locked(*args)
+            self.loaded = True
+
+    # --- Consultas ---
+    def has_doctor(self, doctor):
+        return doctor in self._specialty_of
+
+    def doctors(self, specialty):
+        return sorted(d for d, s in self._specialty_of.items() if s == specialty)
+
+    def is_free(self, doctor, slot):
+        """Libre si ninguna cita [inicio, inicio + turno) se solapa con el turno"""
+        starts = self._starts.get(doctor)
+        if not starts:
+            return True
+        i = bisect.bisect_right(starts, slot - self.schedule.slot)
+        return i == len(starts) or starts[i] >= slot + self.schedule.slot
+
+    def is_booked(self, doctor, start):
+        """Hay una cita activa que empieza justo en start (lo que impide la clave única)"""
+        starts = self._starts.get(doctor, ())
+        i = bisect.bisect_left(starts, start)
+        return i < len(starts) and starts[i] == start
+
+    def nearest_free(self, doctor, around, not_before, horizon, limit):
+        """Turnos libres más cercanos a around, antes o después, nunca anteriores a not_before"""
+        start = max(around - horizon, not_before)
+        with self._lock:
+            free = [
+                s for s in self.schedule.slots(start, around + horizon)
+                if s != around and self.is_free(doctor, s)
+            ]
+        return heapq.nsmallest(limit, free, key=lambda s: (abs(s - around), s))
+
+    def free_slots(self, doctor, start, end, limit=None):
+        with self._lock:
+            free = (s for s in self.schedule.slots(start, end) if self.is_free(doctor, s))
+            return list(itertools.islice(free, limit))
+
+    def next_available(self, specialty, after, horizon, limit):
+        """Primer turno libre de cada médico de la especialidad, los más próximos primero"""
+        found = []
+        with self._lock:
+            for doctor in self.doctors(specialty):
+                free = (s for s in self.schedule.slots(after, after + horizon) if self.is_free(doctor, s))
+                slot = next(free, None)
+                if slot is not None:
+                    found.append((slot, doctor))
+        found.sort()
+        return found[:limit]
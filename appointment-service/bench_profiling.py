@@ -0,0 +1,177 @@
+"""Microbenchmark del desglose por fases y del perfilador por muestreo.
+
+Mide lo que añaden a cada petición mientras no hay un perfil en curso, y lo que
+cuesta un perfil activo:
+
+- los hooks solos (phase() dentro y fuera de una petición, la comprobación del perfilador),
+- una app ASGI vacía con y sin el middleware de métricas (request_metrics.py),
+- GET /appointments/{id} en proceso (ASGI, SQLite embebido, sin caché) con el
+  perfilador parado y muestreando.
+
+    python bench_profiling.py --iterations 200000 --requests 2000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import httpx
+
+import main
+from profiling import PHASES, end_request_phases, phase, start_request_phases
+from request_metrics import RateLimitedLog, RequestMetricsMiddleware
+from response_cache import ResponseCache
+from sqlite_repository import SQLiteRepository
+
+
+def per_call_ns(func: Callable[[], Any], iterations: int) -> float:
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter_ns() - start) / iterations
+
+
+def bench_hooks(iterations: int) -> Dict[str, float]:
+    def phase_outside_request() -> None:
+        with phase("query"):
+            pass
+
+    def phase_inside_request() -> None:
+        timings, token = start_request_phases()
+        with phase("query"):
+            pass
+        end_request_phases(token)
+
+    def open_and_close_request() -> None:
+        end_request_phases(start_request_phases()[1])
+
+    main.profiler.stop(wait=True)
+    results = {
+        "empty_loop_ns": per_call_ns(lambda: None, iterations),
+        "phase_outside_request_ns": per_call_ns(phase_outside_request, iterations),
+        "open_close_request_ns": per_call_ns(open_and_close_request, iterations),
+        "phase_inside_request_ns": per_call_ns(phase_inside_request, iterations),
+        "profiler_idle_check_ns": per_call_ns(main.profiler.request_finished, iterations),
+    }
+    return {name: round(value, 1) for name, value in results.items()}
+
+
+def bench_middleware(iterations: int) -> Dict[str, float]:
+    route = next(r for r in main.app.routes if getattr(r, "name", None) == "get_appointment")
+    scope = {"type": "http", "method": "GET", "path": "/appointments/1", "headers": []}
+
+    async def endpoint(scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        scope["route"] = route
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    instrumented = RequestMetricsMiddleware(
+        endpoint,
+        routes=main.app.routes,
+        count=main.REQUEST_COUNT,
+        latency=main.REQUEST_LATENCY,
+        phase_latency=main.REQUEST_PHASE_LATENCY,
+        phases=PHASES,
+        log=RateLimitedLog(main.logger, main.REQUEST_LOG_RATE),
+        on_request_end=main.profiler.request_finished,
+    )
+
+    async def receive() -> Dict[str, Any]:
+        return {"type": "http.request", "body": b""}
+
+    async def send(message: Dict[str, Any]) -> None:
+        pass
+
+    async def loop(app: Callable[..., Any]) -> float:
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            await app(dict(scope), receive, send)
+        return (time.perf_counter_ns() - start) / iterations
+
+    main.profiler.stop(wait=True)
+    bare = asyncio.run(loop(endpoint))
+    measured = asyncio.run(loop(instrumented))
+    return {"bare_asgi_app_ns": round(bare, 1), "metrics_middleware_ns": round(measured, 1)}
+
+
+async def bench_requests(requests: int, profile: bool) -> Dict[str, Any]:
+    transport = httpx.ASGITransport(app=main.app)
+    if profile:
+        main.profiler.start(requests * 2)
+    latencies: List[float] = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://service") as client:
+        for i in range(requests):
+            start = time.perf_counter()
+            response = await client.get(f"/appointments/{i % 100 + 1}")
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+    samples = main.profiler.status()["samples"]
+    main.profiler.stop(wait=True)
+    latencies.sort()
+    return {
+        "scenario": "profiler_sampling" if profile else "profiler_idle",
+        "requests": requests,
+        "mean_us": round(sum(latencies) / len(latencies) * 1e6, 1),
+        "p50_us": round(latencies[len(latencies) // 2] * 1e6, 1),
+        "samples": samples,
+    }
+
+
+async def seed(repository: SQLiteRepository, rows: int) -> None:
+    base = main.datetime.datetime(2030, 1, 7, 8, 0)
+    await repository.create_many([
+        (f"Patient {i}", f"patient{i}@example.com", f"Dr. {i % 10}", "General",
+         base + main.datetime.timedelta(minutes=30 * i), "scheduled", None)
+        for i in range(rows)
+    ])
+
+
+async def run_requests(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    repository = SQLiteRepository(os.path.join(workdir, "appointments.db"))
+    await repository.open()
+    main.repository = repository
+    # Sin caché: cada petición pasa por todas las fases
+    main.response_cache = ResponseCache(None, ttl=30, list_ttl=10)
+    try:
+        await seed(repository, 100)
+        await bench_requests(args.warmup, profile=False)
+        return [
+            await bench_requests(args.requests, profile=False),
+            await bench_requests(args.requests, profile=True),
+        ]
+    finally:
+        await repository.close()
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200000, help="calls per hook microbenchmark")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per in-process scenario")
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+    # El log de acceso va limitado por segundo; aquí interesa solo el coste de las métricas
+    logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory(prefix="salus-bench-") as workdir:
+        results = {
+            "hooks": bench_hooks(args.iterations),
+            "middleware": bench_middleware(args.iterations),
+            "requests": asyncio.run(run_requests(args, workdir)),
+        }
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, value in {**results["hooks"], **results["middleware"]}.items():
+        print(f"{name:<28} {value:>10} ns")
+    print(f"{'scenario':<20} {'mean us':>10} {'p50 us':>10} {'samples':>8}")
+    for r in results["requests"]:
+        print(f"{r['scenario']:<20} {r['mean_us']:>10} {r['p50_us']:>10} {r['samples']:>8}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,115 @@
+"""Microbenchmark de los dos caminos de serialización de los listados.
+
+Coste por fila de un listado de --rows citas (10 000 por defecto), por fase:
+
+- model (camino por defecto): filas como dicts, un AppointmentOut por fila,
+  jsonable_encoder y JSONResponse;
+- fast (FAST_JSON_ENDPOINTS): filas como tuplas, un dict por fila con las
+  columnas de la respuesta y ORJSONResponse (orjson).
+
+Las filas salen de un SQLite embebido con el mismo esquema que producción; la
+fase fetch incluye la conversión de las fechas, que en MySQL hace el driver.
+
+    python bench_serialization.py --rows 10000 --repeat 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import main
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from repository import APPOINTMENT_COLUMNS
+from sqlite_repository import SQLiteRepository
+
+COLUMNS = list(APPOINTMENT_COLUMNS)
+
+
+# Fases posteriores a la lectura de las filas, en orden
+STAGES: Dict[str, Dict[str, Callable[[Any], Any]]] = {
+    "model": {
+        "model": lambda rows: [main.AppointmentOut(**row) for row in rows],
+        "serialize": lambda items: JSONResponse(content=jsonable_encoder(items)).body,
+    },
+    "fast": {
+        "model": lambda rows: main._row_items(COLUMNS, main.APPOINTMENT_OUT_FIELDS, rows),
+        "serialize": lambda items: ORJSONResponse(items).body,
+    },
+}
+
+
+async def measure(repository: SQLiteRepository, path: str, rows: int) -> Dict[str, Any]:
+    """Segundos de cada fase para un listado de rows filas, y el cuerpo resultante"""
+    fetch = repository.list_rows if path == "fast" else repository.list
+    start = time.perf_counter()
+    value = await fetch(COLUMNS, {}, None, rows - 1)
+    timings = {"fetch": time.perf_counter() - start}
+    for name, stage in STAGES[path].items():
+        start = time.perf_counter()
+        value = stage(value)
+        timings[name] = time.perf_counter() - start
+    return {"timings": timings, "body": value}
+
+
+async def run(args: argparse.Namespace, workdir: str) -> List[Dict[str, Any]]:
+    repository = SQLiteRepository(os.path.join(workdir, "appointments.db"))
+    await repository.open()
+    try:
+        base = main.datetime.datetime(2030, 1, 7, 8, 0)
+        await repository.create_many([
+            (f"Patient {i}", f"patient{i}@example.com", f"Dr. {i % 50}", "General",
+             base + main.datetime.timedelta(minutes=30 * i), "scheduled", "Ayuno" if i % 3 else None)
+            for i in range(args.rows)
+        ])
+        bodies = {}
+        results = []
+        for path in ("model", "fast"):
+            await measure(repository, path, args.rows)
+            runs = [await measure(repository, path, args.rows) for _ in range(args.repeat)]
+            bodies[path] = runs[0]["body"]
+            phases = {
+                name: statistics.median(r["timings"][name] for r in runs) / args.rows * 1e6
+                for name in ("fetch", "model", "serialize")
+            }
+            results.append({
+                "path": path,
+                "rows": args.rows,
+                **{f"{name}_us_per_row": round(value, 3) for name, value in phases.items()},
+                "total_us_per_row": round(sum(phases.values()), 3),
+                "body_bytes": len(bodies[path]),
+            })
+        # Los dos caminos deben producir la misma respuesta
+        if json.loads(bodies["model"]) != json.loads(bodies["fast"]):
+            raise AssertionError("fast and model paths produced different responses")
+        results[1]["speedup"] = round(results[0]["total_us_per_row"] / results[1]["total_us_per_row"], 2)
+        return results
+    finally:
+        await repository.close()
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="rows per listing")
+    parser.add_argument("--repeat", type=int, default=5, help="measured listings per path (median)")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="salus-bench-") as workdir:
+        results = asyncio.run(run(args, workdir))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'path':<6} {'fetch us':>9} {'model us':>9} {'ser. us':>9} {'total us':>9} {'bytes':>9}  (per row)")
+    for r in results:
+        print(f"{r['path']:<6} {r['fetch_us_per_row']:>9} {r['model_us_per_row']:>9} "
+              f"{r['serialize_us_per_row']:>9} {r['total_us_per_row']:>9} {r['body_bytes']:>9}")
+    print(f"fast path: {results[1]['speedup']}x faster per row")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,143 @@
+"""Benchmark del coste de las trazas en el throughput de appointment-service.
+
+Cada escenario corre en su propio proceso (el estado de OpenTelemetry no se
+comparte): sin trazas (TRACE_EXPORTER=none) y
+con muestreo en cabeza del 0 %, 1 % y 100 %. Las peticiones son GET
+/appointments/{id} en proceso (ASGI, SQLite embebido, sin caché), con varios
+clientes concurrentes. El exportador serializa los spans a OTLP protobuf y los
+descarta: cuesta lo mismo que exportar, sin depender de un collector.
+
+    python bench_tracing.py --requests 5000 --concurrency 20
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+SCENARIOS = {
+    "off": None,
+    "sample_0": 0.0,
+    "sample_1": 0.01,
+    "sample_100": 1.0,
+}
+
+
+def encoding_exporter():
+    from opentelemetry.exporter.otlp.proto.common.trace_encoder import encode_spans
+    from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+    class EncodingExporter(SpanExporter):
+        """Serializa como OTLPSpanExporter y no envía nada"""
+
+        def __init__(self) -> None:
+            self.spans = 0
+
+        def export(self, spans):
+            encode_spans(spans).SerializeToString()
+            self.spans += len(spans)
+            return SpanExportResult.SUCCESS
+
+    return EncodingExporter()
+
+
+async def run_scenario(name: str, ratio: Optional[float], args: argparse.Namespace, workdir: str) -> Dict[str, Any]:
+    import httpx
+
+    import main
+    from response_cache import ResponseCache
+    from sqlite_repository import SQLiteRepository
+    from tracing import TracedRepository, Tracing
+
+    repository = SQLiteRepository(os.path.join(workdir, f"{name}.db"))
+    await repository.open()
+    main.repository = repository
+    # Sin caché: cada petición llega a la BD y crea su span de cliente
+    main.response_cache = ResponseCache(None, ttl=30, list_ttl=10)
+    tracing = None
+    if ratio is not None:
+        tracing = Tracing("appointment-service", encoding_exporter(), head_ratio=ratio)
+        main.tracer = tracing.tracer
+        main.repository = TracedRepository(repository, tracing.tracer, "sqlite")
+
+    base = main.datetime.datetime(2030, 1, 7, 8, 0)
+    await repository.create_many([
+        (f"Patient {i}", f"patient{i}@example.com", f"Dr. {i % 10}", "General",
+         base + main.datetime.timedelta(minutes=30 * i), "scheduled", None)
+        for i in range(100)
+    ])
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://service") as client:
+        async def worker(count: int) -> None:
+            for i in range(count):
+                response = await client.get(f"/appointments/{i % 100 + 1}")
+                response.raise_for_status()
+
+        await worker(args.warmup)
+        per_worker = args.requests // args.concurrency
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(per_worker) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    exported = 0
+    if tracing is not None:
+        tracing.shutdown()
+        exported = tracing.exporter.spans
+    await repository.close()
+    requests = per_worker * args.concurrency
+    return {
+        "scenario": name,
+        "requests": requests,
+        "rps": round(requests / elapsed, 1),
+        "mean_us": round(elapsed / requests * 1e6, 1),
+        "exported_spans": exported,
+    }
+
+
+def spawn(name: str, args: argparse.Namespace) -> Dict[str, Any]:
+    command = [
+        sys.executable, os.path.abspath(__file__), "--scenario", name,
+        "--requests", str(args.requests), "--concurrency", str(args.concurrency), "--warmup", str(args.warmup),
+    ]
+    env = {**os.environ, "TRACE_EXPORTER": "none", "CACHE_BACKEND": "none"}
+    output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def main_cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), help="run a single scenario in this process")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    if args.scenario:
+        # Los logs INFO por petición dominarían las cifras
+        logging.disable(logging.INFO)
+        with tempfile.TemporaryDirectory(prefix="salus-bench-") as workdir:
+            result = asyncio.run(run_scenario(args.scenario, SCENARIOS[args.scenario], args, workdir))
+        print(json.dumps(result))
+        return
+
+    results: List[Dict[str, Any]] = [spawn(name, args) for name in SCENARIOS]
+    baseline = results[0]["rps"]
+    for result in results:
+        result["rps_vs_off"] = round(result["rps"] / baseline, 3)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'scenario':<12} {'rps':>10} {'vs off':>8} {'mean us':>10} {'spans':>8}")
+    for r in results:
+        print(f"{r['scenario']:<12} {r['rps']:>10} {r['rps_vs_off']:>8} {r['mean_us']:>10} {r['exported_spans']:>8}")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,56 +1,72 @@
-import mysql.connector
-from fastapi import FastAPI, HTTPException, Path
-from pydantic import BaseModel, ConfigDict, EmailStr
+import asyncio
+from fastapi import Body, Depends, FastAPI, Header, HTTPException, Path, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ConfigDict, EmailStr, Field, ValidationError
+import base64
+import csv
 import datetime
+import hashlib
+import hmac
+import io
+import json
+import operator
 import os
-from typing import Optional, List
+from typing import Any, Dict, Optional, List
 import logging
-
-# OpenTelemetry imports - COMENTADOS para deshabilitar trazas
-# from opentelemetry import trace
-# from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-# from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-# from opentelemetry.sdk.trace import TracerProvider
-# from opentelemetry.sdk.trace.export import BatchSpanProcessor
-# from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-# from opentelemetry.sdk._logs import LoggingHandler, LoggerProvider
-# from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
-# from opentelemetry.exporter.otlp.proto.http._log_exporter import OTLPLogExporter
+from response_cache import InMemoryCache, RedisCache, ResponseCache
+from repository import APPOINTMENT_COLUMNS, BatchReadBackError, DoubleBookingError
+from mysql_repository import MySQLRepository
+from sqlite_repository import SQLiteRepository
+from profiling import PHASES, SamplingProfiler, phase
+from request_metrics import LiveGauges, RateLimitedLog, RequestMetricsMiddleware, mark_process_dead, metrics_registry
+from tracing import NoopTracer, TracedRepository, Tracing, TracingMiddleware, create_exporter
+from availability import (
+    INACTIVE_STATUSES, AvailabilityIndex, WorkingSchedule, parse_working_days, parse_working_hours,
+)
 
 # Prometheus imports - MANTENER ACTIVO
-from prometheus_fastapi_instrumentator import Instrumentator
-from prometheus_client import Counter, Histogram
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 import time
 import functools
+from contextlib import asynccontextmanager
 
 # Logger configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("appointment-service")
 
-# OpenTelemetry Tracing configuration - COMENTADO
-# resource = Resource(attributes={SERVICE_NAME: "appointment-service"})
-# trace.set_tracer_provider(TracerProvider(resource=resource))
-# tracer = trace.get_tracer(__name__)
-
-# otlp_exporter = OTLPSpanExporter(endpoint="http://localhost:4318/v1/traces")
-# span_processor = BatchSpanProcessor(otlp_exporter)
-# trace.get_tracer_provider().add_span_processor(span_processor)
+# Trazas (ver tracing.py): TRACE_EXPORTER=none las deshabilita sin coste
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+OTLP_TRACES_ENDPOINT = os.getenv("OTLP_TRACES_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "0.01"))  # muestreo en cabeza
+TRACE_TAIL_RATIO = float(os.getenv("TRACE_TAIL_RATIO", "0"))  # trazas registradas para decidir al final
+TRACE_TAIL_LATENCY_MS = float(os.getenv("TRACE_TAIL_LATENCY_MS", "500"))  # se exportan si tardan más
+TRACE_EXPORT_QUEUE_SIZE = int(os.getenv("TRACE_EXPORT_QUEUE_SIZE", "2048"))
+TRACE_EXPORT_BATCH_SIZE = int(os.getenv("TRACE_EXPORT_BATCH_SIZE", "512"))
+TRACE_EXPORT_DELAY_MS = float(os.getenv("TRACE_EXPORT_DELAY_MS", "5000"))
 
-# logger_provider = LoggerProvider(resource=resource)
-# log_exporter = OTLPLogExporter(endpoint="http://localhost:4318/v1/logs")
-# log_processor = BatchLogRecordProcessor(log_exporter)
-# logger_provider.add_log_record_processor(log_processor)
-# otel_handler = LoggingHandler(level=logging.INFO, logger_provider=logger_provider)
-# logging.getLogger().addHandler(otel_handler)
-
-# Mock tracer para reemplazar las llamadas a tracer cuando está deshabilitado
-class MockTracer:
-    def start_as_current_span(self, name):
-        from contextlib import nullcontext
-        return nullcontext()
+def create_tracing():
+    if TRACE_EXPORTER == "none":
+        logger.info("OpenTelemetry tracing disabled - using Prometheus metrics only")
+        return None
+    logger.info(
+        "OpenTelemetry tracing to %s (head %.2f%%, tail %.2f%%)",
+        TRACE_EXPORTER, TRACE_SAMPLE_RATIO * 100, TRACE_TAIL_RATIO * 100,
+    )
+    return Tracing(
+        "appointment-service",
+        create_exporter(TRACE_EXPORTER, OTLP_TRACES_ENDPOINT),
+        head_ratio=TRACE_SAMPLE_RATIO,
+        tail_ratio=TRACE_TAIL_RATIO,
+        tail_latency=TRACE_TAIL_LATENCY_MS / 1000,
+        queue_size=TRACE_EXPORT_QUEUE_SIZE,
+        batch_size=TRACE_EXPORT_BATCH_SIZE,
+        export_delay=TRACE_EXPORT_DELAY_MS / 1000,
+        on_tail_decision=lambda keep: TRACE_TAIL_DECISIONS.labels(decision="kept" if keep else "dropped").inc(),
+    )
 
-tracer = MockTracer()
-logger.info("OpenTelemetry tracing disabled - using Prometheus metrics only")
+tracing = create_tracing()
+tracer = tracing.tracer if tracing is not None else NoopTracer()
 
 # Database configuration
 DB_HOST = os.getenv("DB_HOST", "localhost")
@@ -59,22 +75,145 @@ DB_USER = os.getenv("DB_USER", "appuser")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "apppassword")
 DB_NAME = os.getenv("DB_NAME", "appointments_db")
 
-def get_connection():
-    return mysql.connector.connect(
-        host=DB_HOST,
-        port=int(DB_PORT),
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME,
-    )
+# Connection pool configuration
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "5"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # max lifetime in seconds
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # checkout timeout in seconds
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+
+# Almacenamiento: "mysql" (servidor) o "sqlite" (embebido, en SQLITE_PATH)
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "appointments.db")
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))  # espera por el bloqueo de escritura
+
+# Modo de acceso a MySQL: "sync" (mysql-connector en el threadpool) o "async" (aiomysql)
+DB_MODE = os.getenv("DB_MODE", "sync").lower()
+
+# Aplicar migraciones pendientes (migrations/) al arrancar
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "false").lower() == "true"
 
-app = FastAPI(title="Appointment Service", version="1.0.0")
+# Paginación de GET /appointments/
+LIST_DEFAULT_PAGE_SIZE = int(os.getenv("LIST_DEFAULT_PAGE_SIZE", "50"))
+LIST_MAX_PAGE_SIZE = int(os.getenv("LIST_MAX_PAGE_SIZE", "200"))
 
-# FastAPI OpenTelemetry instrumentation - COMENTADO
-# FastAPIInstrumentor.instrument_app(app)
+# Exportación: filas leídas del cursor del servidor por cada chunk de la respuesta
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "1000"))
 
-# Prometheus metrics integration - MANTENER ACTIVO
-Instrumentator().instrument(app).expose(app)
+# Endpoints por lotes: máximo de ítems por petición y filas por sentencia
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", "500"))
+
+# Camino rápido de serialización: estos endpoints responden con orjson desde las filas de la BD,
+# sin validar un AppointmentOut por fila (las filas ya se validaron al escribirse)
+FAST_JSON_SUPPORTED = ("list_appointments", "get_appointment", "create_appointment", "update_appointment")
+FAST_JSON_ENDPOINTS = frozenset(
+    name.strip() for name in os.getenv("FAST_JSON_ENDPOINTS", "").split(",") if name.strip()
+)
+for _name in sorted(FAST_JSON_ENDPOINTS.difference(FAST_JSON_SUPPORTED)):
+    logger.warning("FAST_JSON_ENDPOINTS: %s has no fast serialization path", _name)
+
+# Búsqueda de horarios libres: jornada, duración del turno y refresco del índice
+AVAILABILITY_WORKING_DAYS = os.getenv("AVAILABILITY_WORKING_DAYS", "0-4")  # lunes = 0
+AVAILABILITY_WORKING_HOURS = os.getenv("AVAILABILITY_WORKING_HOURS", "08:00-12:00,14:00-18:00")
+AVAILABILITY_SLOT_MINUTES = int(os.getenv("AVAILABILITY_SLOT_MINUTES", "30"))
+AVAILABILITY_MAX_DAYS = int(os.getenv("AVAILABILITY_MAX_DAYS", "31"))
+AVAILABILITY_REFRESH_SECONDS = float(os.getenv("AVAILABILITY_REFRESH_SECONDS", "300"))
+# Reserva de un turno ocupado (409): cuántos turnos libres proponer y a qué distancia buscarlos
+BOOKING_ALTERNATIVES = int(os.getenv("BOOKING_ALTERNATIVES", "3"))
+BOOKING_ALTERNATIVES_DAYS = int(os.getenv("BOOKING_ALTERNATIVES_DAYS", "7"))
+
+# Caché de lecturas: "memory" (LRU por proceso), "redis" (compartida) o "none"
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+CACHE_LIST_TTL_SECONDS = float(os.getenv("CACHE_LIST_TTL_SECONDS", "10"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# Endpoints /admin/*: deshabilitados (404) mientras ADMIN_TOKEN esté vacío
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+# Perfilador por muestreo: PROFILE_REQUESTS > 0 lo activa al arrancar para esas peticiones
+PROFILE_REQUESTS = int(os.getenv("PROFILE_REQUESTS", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_OUTPUT = os.getenv("PROFILE_OUTPUT", "")  # fichero de collapsed stacks; vacío = solo en memoria
+
+# Arranque y apagado de cada worker (serve.py arranca varios)
+DB_POOL_WARM_CONNECTIONS = int(os.getenv("DB_POOL_WARM_CONNECTIONS", str(DB_POOL_SIZE)))  # antes de la readiness
+STARTUP_WARMUP_TIMEOUT_SECONDS = float(os.getenv("STARTUP_WARMUP_TIMEOUT_SECONDS", "10"))
+READINESS_TIMEOUT_SECONDS = float(os.getenv("READINESS_TIMEOUT_SECONDS", "2"))  # para el ping a la BD
+DB_DRAIN_TIMEOUT_SECONDS = float(os.getenv("DB_DRAIN_TIMEOUT_SECONDS", "10"))  # espera a las operaciones en curso
+
+# Log de acceso: líneas por segundo como máximo (0 = sin log de acceso)
+REQUEST_LOG_RATE = int(os.getenv("REQUEST_LOG_RATE", "10"))
+# Modo multiproceso (PROMETHEUS_MULTIPROC_DIR): cada cuánto refresca cada worker sus gauges
+METRICS_REFRESH_SECONDS = float(os.getenv("METRICS_REFRESH_SECONDS", "5"))
+
+async def _refresh_availability_periodically():
+    """Carga el índice de horarios al arrancar y lo reconstruye cada AVAILABILITY_REFRESH_SECONDS"""
+    while True:
+        try:
+            await refresh_availability_index()
+        except Exception as e:
+            logger.warning("Availability index refresh failed: %s", str(e))
+        if AVAILABILITY_REFRESH_SECONDS <= 0:
+            return
+        await asyncio.sleep(AVAILABILITY_REFRESH_SECONDS)
+
+# "starting" hasta terminar el calentamiento, "ready", y "draining" desde que empieza el apagado
+service_status = "starting"
+
+async def warm_up():
+    """Abre las conexiones del pool antes de aceptar tráfico; la BD caída no impide arrancar"""
+    try:
+        await asyncio.wait_for(repository.warm_up(DB_POOL_WARM_CONNECTIONS), STARTUP_WARMUP_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.warning("Database pool warm-up timed out after %ss", STARTUP_WARMUP_TIMEOUT_SECONDS)
+    except Exception as e:
+        logger.warning("Database pool warm-up failed: %s", str(e))
+
+async def drain_connections(timeout):
+    """Espera a que vuelvan al pool las conexiones prestadas (transacciones en curso en el threadpool)"""
+    deadline = time.monotonic() + timeout
+    while repository.in_use() > 0:
+        if time.monotonic() >= deadline:
+            logger.warning("Closing the database pool with %d connection(s) still in use", repository.in_use())
+            return
+        await asyncio.sleep(0.05)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global service_status
+    service_status = "starting"
+    await repository.open()
+    await warm_up()
+    if PROFILE_REQUESTS > 0:
+        profiler.start(PROFILE_REQUESTS, PROFILE_INTERVAL_MS / 1000, PROFILE_OUTPUT or None)
+        logger.info("Profiling the next %d requests", PROFILE_REQUESTS)
+    availability_task = asyncio.create_task(_refresh_availability_periodically())
+    gauges_task = asyncio.create_task(live_gauges.run())
+    service_status = "ready"
+    yield
+    # uvicorn ya esperó a las peticiones en curso (hasta su timeout); quedan las del threadpool
+    service_status = "draining"
+    for task in (availability_task, gauges_task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await drain_connections(DB_DRAIN_TIMEOUT_SECONDS)
+    await repository.close()
+    await response_cache.close()
+    profiler.stop()
+    if tracing is not None:
+        tracing.shutdown()
+    mark_process_dead()
+
+app = FastAPI(title="Appointment Service", version="1.0.0", lifespan=lifespan)
+
+# Span de servidor por petición, continuando la traza del gateway (traceparent).
+# Lee main.tracer en cada petición: con NoopTracer no hace nada
+app.add_middleware(TracingMiddleware, get_tracer=lambda: tracer, excluded_prefixes=("/health", "/metrics", "/admin"))
 
 # Prometheus custom metrics - MANTENER ACTIVO
 REQUEST_COUNT = Counter(
@@ -89,6 +228,19 @@ REQUEST_LATENCY = Histogram(
     ['method', 'endpoint']
 )
 
+REQUEST_PHASE_LATENCY = Histogram(
+    'appointment_service_request_phase_seconds',
+    'Time spent in each phase of a request (connect, query, fetch, model, serialize)',
+    ['endpoint', 'phase'],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+TRACE_TAIL_DECISIONS = Counter(
+    'appointment_service_trace_tail_decisions_total',
+    'Traces recorded for tail sampling, by whether they were exported',
+    ['decision']
+)
+
 DB_OPERATIONS = Counter(
     'appointment_service_db_operations_total',
     'Total database operations',
@@ -101,33 +253,91 @@ APPOINTMENTS_CREATED = Counter(
     ['status']
 )
 
-def track_metrics(endpoint_func):
-    """Decorator para tracking de métricas personalizadas"""
-    @functools.wraps(endpoint_func)
-    def wrapper(*args, **kwargs):
-        method = "GET" if "get" in endpoint_func.__name__ else "POST" if "create" in endpoint_func.__name__ else "PUT" if "update" in endpoint_func.__name__ else "DELETE"
-        endpoint = endpoint_func.__name__
-        start_time = time.time()
-        status = "200"
-        
-        try:
-            response = endpoint_func(*args, **kwargs)
-            logger.info("Request to %s completed successfully", endpoint)
-            return response
-        except HTTPException as e:
-            status = str(e.status_code)
-            logger.warning("Request to %s failed with status %s", endpoint, status)
-            raise
-        except Exception as e:
-            status = "500"
-            logger.error("Request to %s failed with error: %s", endpoint, str(e))
-            raise
-        finally:
-            # Record Prometheus metrics
-            REQUEST_COUNT.labels(method=method, endpoint=endpoint, http_status=status).inc()
-            REQUEST_LATENCY.labels(method=method, endpoint=endpoint).observe(time.time() - start_time)
-    
-    return wrapper
+# Gauges calculados al leer /metrics (o refrescados por worker en modo multiproceso)
+live_gauges = LiveGauges(METRICS_REFRESH_SECONDS)
+
+DB_POOL_IN_USE = Gauge(
+    'appointment_service_db_pool_connections_in_use',
+    'Connections currently checked out of the pool',
+    multiprocess_mode='livesum'
+)
+
+live_gauges.add(DB_POOL_IN_USE, lambda: repository.in_use())
+
+DB_POOL_SATURATION = Gauge(
+    'appointment_service_db_pool_saturation_ratio',
+    'Checked-out connections over the pool capacity (size + max overflow)',
+    multiprocess_mode='livemax'
+)
+live_gauges.add(DB_POOL_SATURATION, lambda: repository.in_use() / (DB_POOL_SIZE + DB_POOL_MAX_OVERFLOW))
+
+DB_POOL_WAIT = Histogram(
+    'appointment_service_db_pool_wait_seconds',
+    'Time spent waiting to check out a connection from the pool',
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+
+DB_POOL_CHECKOUT_FAILURES = Counter(
+    'appointment_service_db_pool_checkout_failures_total',
+    'Failed connection checkouts',
+    ['reason']
+)
+
+CACHE_REQUESTS = Counter(
+    'appointment_service_cache_requests_total',
+    'Response cache lookups',
+    ['cache', 'result']
+)
+
+CACHE_HIT_RATIO = Gauge(
+    'appointment_service_cache_hit_ratio',
+    'Response cache hits over lookups since the process started',
+    multiprocess_mode='liveall'
+)
+
+def create_cache_backend():
+    if CACHE_BACKEND == "redis":
+        return RedisCache.from_url(CACHE_REDIS_URL)
+    if CACHE_BACKEND == "memory":
+        return InMemoryCache(CACHE_MAX_ENTRIES)
+    return None
+
+response_cache = ResponseCache(
+    create_cache_backend(),
+    ttl=CACHE_TTL_SECONDS,
+    list_ttl=CACHE_LIST_TTL_SECONDS,
+    on_lookup=lambda kind, result: CACHE_REQUESTS.labels(cache=kind, result=result).inc(),
+)
+live_gauges.add(CACHE_HIT_RATIO, lambda: response_cache.hit_ratio())
+
+availability_index = AvailabilityIndex(WorkingSchedule(
+    parse_working_days(AVAILABILITY_WORKING_DAYS),
+    parse_working_hours(AVAILABILITY_WORKING_HOURS),
+    AVAILABILITY_SLOT_MINUTES,
+))
+
+AVAILABILITY_INDEXED = Gauge(
+    'appointment_service_availability_indexed_appointments',
+    'Active appointments held in the in-memory availability index',
+    multiprocess_mode='livemax'
+)
+live_gauges.add(AVAILABILITY_INDEXED, lambda: len(availability_index))
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000)
+
+# Métricas, fases y log de acceso de cada petición (ver request_metrics.py).
+# /health, /metrics y /admin quedan fuera para no meter ruido
+app.add_middleware(
+    RequestMetricsMiddleware,
+    routes=app.routes,
+    count=REQUEST_COUNT,
+    latency=REQUEST_LATENCY,
+    phase_latency=REQUEST_PHASE_LATENCY,
+    phases=PHASES,
+    log=RateLimitedLog(logger, REQUEST_LOG_RATE),
+    on_request_end=lambda: profiler.request_finished(),
+    excluded_prefixes=("/health", "/metrics", "/admin"),
+)
 
 # Pydantic models
 class AppointmentBase(BaseModel):
@@ -157,104 +367,556 @@ class AppointmentOut(AppointmentBase):
     created_at: datetime.datetime
     updated_at: datetime.datetime
 
+# Orden de los campos en las respuestas, el mismo en los dos caminos de serialización
+APPOINTMENT_OUT_FIELDS = tuple(AppointmentOut.model_fields)
+
+class AppointmentBatchUpdate(AppointmentUpdate):
+    id: int = Field(..., gt=0)
+
+class BatchItemResult(BaseModel):
+    index: int
+    status: str  # created | updated | not_found | invalid | conflict
+    appointment: Optional[AppointmentOut] = None
+    errors: Optional[List[Dict[str, Any]]] = None
+
+class BatchResult(BaseModel):
+    succeeded: int
+    failed: int
+    results: List[BatchItemResult]
+
+def encode_cursor(row):
+    created_at = row["created_at"]
+    if isinstance(created_at, datetime.datetime):
+        created_at = created_at.isoformat()
+    raw = json.dumps([created_at, row["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, appointment_id = json.loads(raw)
+        return datetime.datetime.fromisoformat(created_at), int(appointment_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+# Validadores HTTP (ETag / If-None-Match)
+def _make_etag(*parts):
+    raw = ":".join(p.isoformat() if isinstance(p, datetime.datetime) else str(p) for p in parts)
+    return '"' + hashlib.sha1(raw.encode()).hexdigest()[:20] + '"'
+
+def appointment_etag(appointment_id, updated_at):
+    return _make_etag(appointment_id, updated_at)
+
+def list_etag(max_updated_at, row_count):
+    return _make_etag("list", "" if max_updated_at is None else max_updated_at, row_count)
+
+def etag_matches(if_none_match, etag):
+    """Comparación débil de If-None-Match (RFC 9110, sección 13.1.2)"""
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+
+def not_modified(etag):
+    return Response(status_code=304, headers={"ETag": etag})
+
+# Camino rápido (FAST_JSON_ENDPOINTS): de las filas de la BD a bytes con orjson, sin modelos
+def _row_items(columns, output, rows):
+    """Tuplas con los valores de columns a dicts con las columnas de output, en ese orden"""
+    if len(output) == 1:
+        position = columns.index(output[0])
+        return [{output[0]: row[position]} for row in rows]
+    values = operator.itemgetter(*(columns.index(column) for column in output))
+    return [dict(zip(output, values(row))) for row in rows]
+
+def _fast_appointment(row):
+    """La fila (dict) con los campos de AppointmentOut, sin validar"""
+    return {field: row[field] for field in APPOINTMENT_OUT_FIELDS}
+
+# Formatos de exportación: (media type, cabecera, codificador de un lote de filas)
+def _export_value(value):
+    return value.isoformat() if isinstance(value, (datetime.datetime, datetime.date)) else value
+
+def _ndjson_rows(columns, rows):
+    return "".join(
+        json.dumps(dict(zip(columns, map(_export_value, row))), ensure_ascii=False) + "\n"
+        for row in rows
+    ).encode()
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+def _csv_rows(columns, rows):
+    return _csv_lines([_export_value(value) for value in row] for row in rows)
+
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", lambda columns: b"", _ndjson_rows),
+    "csv": ("text/csv; charset=utf-8", lambda columns: _csv_lines([columns]), _csv_rows),
+}
+
+def create_repository():
+    if DB_BACKEND == "sqlite":
+        logger.info("Using embedded SQLite storage at %s", SQLITE_PATH)
+        storage = SQLiteRepository(
+            SQLITE_PATH,
+            pool_size=DB_POOL_SIZE,
+            busy_timeout=SQLITE_BUSY_TIMEOUT,
+            export_fetch_size=EXPORT_FETCH_SIZE,
+            pool_timeout=DB_POOL_TIMEOUT,
+        )
+    else:
+        storage = MySQLRepository(
+            DB_HOST, DB_PORT, DB_USER, DB_PASSWORD, DB_NAME,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_POOL_MAX_OVERFLOW,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pre_ping=DB_POOL_PRE_PING,
+            mode=DB_MODE,
+            migrate_on_startup=DB_MIGRATE_ON_STARTUP,
+            export_fetch_size=EXPORT_FETCH_SIZE,
+            batch_chunk_size=BATCH_CHUNK_SIZE,
+            on_checkout=DB_POOL_WAIT.observe,
+            on_checkout_failure=lambda reason: DB_POOL_CHECKOUT_FAILURES.labels(reason=reason).inc(),
+        )
+    if tracing is not None:
+        return TracedRepository(storage, tracer, DB_BACKEND)
+    return storage
+
+repository = create_repository()
+
+def _appointment_values(appointment):
+    return (
+        appointment.patient_name,
+        appointment.patient_email,
+        appointment.doctor_name,
+        appointment.doctor_specialty,
+        appointment.appointment_time,
+        appointment.status,
+        appointment.notes,
+    )
+
+def appointment_filters(
+    doctor_name: Optional[str] = None,
+    doctor_specialty: Optional[str] = None,
+    status: Optional[str] = None,
+    patient_email: Optional[str] = None,
+    appointment_time_from: Optional[datetime.datetime] = None,
+    appointment_time_to: Optional[datetime.datetime] = None,
+) -> Dict[str, Any]:
+    """Filtros comunes de GET /appointments/ y GET /appointments/export"""
+    return {
+        "doctor_name": doctor_name,
+        "doctor_specialty": doctor_specialty,
+        "status": status,
+        "patient_email": patient_email,
+        "appointment_time_from": appointment_time_from,
+        "appointment_time_to": appointment_time_to,
+    }
+
+def _parse_fields(fields):
+    """?fields=a,b -> lista de columnas pedidas (None = todas); 422 si hay desconocidas"""
+    if not fields:
+        return None
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = sorted(set(requested) - set(APPOINTMENT_COLUMNS))
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown fields: {', '.join(unknown)}")
+    return requested
+
+def _validate_batch(model, payload):
+    """Valida cada ítem por separado: los inválidos se reportan sin frenar el resto"""
+    if len(payload) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {BATCH_MAX_ITEMS} items")
+    valid = []
+    invalid = []
+    for index, item in enumerate(payload):
+        try:
+            valid.append((index, model.model_validate(item)))
+        except ValidationError as e:
+            errors = e.errors(include_url=False, include_context=False, include_input=False)
+            invalid.append(BatchItemResult(index=index, status="invalid", errors=errors))
+    return valid, invalid
+
+def _batch_response(results, succeeded_status):
+    """200 si todos los ítems se aplicaron; 207 si hubo fallos parciales"""
+    results.sort(key=lambda r: r.index)
+    succeeded = sum(1 for r in results if r.status == succeeded_status)
+    body = BatchResult(succeeded=succeeded, failed=len(results) - succeeded, results=results)
+    return JSONResponse(
+        status_code=200 if body.failed == 0 else 207,
+        content=body.model_dump(mode="json", exclude_none=True),
+    )
+
+_availability_refresh_lock = asyncio.Lock()
+
+async def refresh_availability_index():
+    """Reconstruye el índice; las escrituras concurrentes se reaplican sobre la carga nueva"""
+    async with _availability_refresh_lock:
+        availability_index.start_rebuild()
+        try:
+            since = datetime.datetime.combine(datetime.date.today(), datetime.time())
+            doctors, booked = await repository.load_availability(since)
+        except BaseException:
+            availability_index.abort_rebuild()
+            raise
+        availability_index.finish_rebuild(doctors, booked)
+        logger.info("Availability index loaded: %d doctors, %d appointments", len(doctors), len(booked))
+
+async def ensure_availability_index():
+    if availability_index.loaded:
+        return
+    try:
+        await refresh_availability_index()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Failed to load availability index: %s", str(e))
+        raise HTTPException(status_code=503, detail="Availability index unavailable")
+
+def _index_appointment(appointment):
+    availability_index.upsert(
+        appointment.id, appointment.doctor_name, appointment.doctor_specialty,
+        appointment.appointment_time, appointment.status,
+    )
+
+async def _booking_alternatives(doctor_name, appointment_time):
+    """Turnos libres del médico más próximos al pedido; sin índice no hay propuestas"""
+    try:
+        await ensure_availability_index()
+    except HTTPException:
+        return []
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    slots = availability_index.nearest_free(
+        doctor_name, appointment_time, now,
+        datetime.timedelta(days=BOOKING_ALTERNATIVES_DAYS), BOOKING_ALTERNATIVES,
+    )
+    return [slot.isoformat() for slot in slots]
+
+async def _double_booking_error(doctor_name, appointment_time):
+    return HTTPException(status_code=409, detail={
+        "message": "Doctor already has an appointment at that time",
+        "doctor_name": doctor_name,
+        "appointment_time": appointment_time.isoformat(),
+        "alternatives": await _booking_alternatives(doctor_name, appointment_time),
+    })
+
+def _batch_booking_conflicts(valid):
+    """Ítems que ya se sabe que chocan (entre sí o con el índice); la base de datos cubre el resto"""
+    conflicts, seen = {}, set()
+    for index, appointment in valid:
+        if appointment.status in INACTIVE_STATUSES:
+            continue
+        slot = (appointment.doctor_name, appointment.appointment_time)
+        if slot in seen or (availability_index.loaded and availability_index.is_booked(*slot)):
+            conflicts[index] = slot
+        seen.add(slot)
+    return conflicts
+
 # API Endpoints
 @app.post("/appointments/", response_model=AppointmentOut)
-@track_metrics
-def create_appointment(appointment: AppointmentCreate) -> AppointmentOut:
-    logger.info("Creating appointment for %s", appointment.patient_email)
+async def create_appointment(appointment: AppointmentCreate) -> AppointmentOut:
+    logger.debug("Creating appointment for %s", appointment.patient_email)
     
-    # OpenTelemetry span - COMENTADO pero manteniendo la estructura
-    # with tracer.start_as_current_span("create_appointment"):
-    with tracer.start_as_current_span("create_appointment"):  # Mock tracer - no hace nada
+    with tracer.start_as_current_span("create_appointment"):
+        values = _appointment_values(appointment)
         try:
-            conn = get_connection()
-            cursor = conn.cursor(dictionary=True)
-            
-            query = """
-                INSERT INTO appointments (
-                    patient_name, patient_email, doctor_name, doctor_specialty,
-                    appointment_time, status, notes, created_at, updated_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
-            """
-            values = (
-                appointment.patient_name,
-                appointment.patient_email,
-                appointment.doctor_name,
-                appointment.doctor_specialty,
-                appointment.appointment_time,
-                appointment.status,
-                appointment.notes,
-            )
-            
-            cursor.execute(query, values)
-            conn.commit()
-            appointment_id = cursor.lastrowid
-            
-            cursor.execute("SELECT * FROM appointments WHERE id = %s", (appointment_id,))
-            row = cursor.fetchone()
+            generated = await repository.create(values)
+            await response_cache.invalidate()
+            # La respuesta se arma con el payload más las columnas generadas por el servidor
+            row = {**appointment.model_dump(), **generated}
             
             # Prometheus metrics
             DB_OPERATIONS.labels(operation="insert", status="success").inc()
             APPOINTMENTS_CREATED.labels(status=appointment.status).inc()
             
-            logger.info("Created appointment with ID %s", appointment_id)
-            return AppointmentOut(**row)
+            logger.debug("Created appointment with ID %s", row["id"])
+            if "create_appointment" in FAST_JSON_ENDPOINTS:
+                # El payload ya se validó al entrar; el resto son columnas generadas por la BD
+                with phase("model"):
+                    created = AppointmentOut.model_construct(**row)
+                _index_appointment(created)
+                with phase("serialize"):
+                    return ORJSONResponse(_fast_appointment(row))
+            with phase("model"):
+                created = AppointmentOut(**row)
+            _index_appointment(created)
+            return created
             
+        except HTTPException:
+            raise
+        except DoubleBookingError:
+            DB_OPERATIONS.labels(operation="insert", status="conflict").inc()
+            logger.debug("Slot %s already booked for %s", appointment.appointment_time, appointment.doctor_name)
+            raise await _double_booking_error(appointment.doctor_name, appointment.appointment_time)
         except Exception as e:
             DB_OPERATIONS.labels(operation="insert", status="error").inc()
             logger.error("Failed to create appointment: %s", str(e))
             raise HTTPException(status_code=500, detail="Failed to create appointment")
-        finally:
-            cursor.close()
-            conn.close()
+
+async def _insert_batch(appointments):
+    """repository.create_many con los errores traducidos a respuestas HTTP"""
+    try:
+        return await repository.create_many([_appointment_values(appointment) for appointment in appointments])
+    except HTTPException:
+        raise
+    except DoubleBookingError:
+        # Otra réplica reservó alguno de los turnos; la transacción no escribió nada
+        DB_OPERATIONS.labels(operation="insert", status="conflict").inc()
+        raise HTTPException(status_code=409, detail="A slot in the batch is already booked; nothing was created")
+    except BatchReadBackError as e:
+        DB_OPERATIONS.labels(operation="insert", status="error").inc()
+        logger.error("Failed to read back the ids generated for a batch: %s", str(e))
+        raise HTTPException(
+            status_code=500, detail="Could not read back the ids generated for the batch; nothing was created"
+        )
+    except Exception as e:
+        DB_OPERATIONS.labels(operation="insert", status="error").inc()
+        logger.error("Failed to create appointment batch: %s", str(e))
+        raise HTTPException(status_code=500, detail="Failed to create appointments")
+
+@app.post("/appointments/batch", response_model=BatchResult)
+async def create_appointments_batch(payload: List[Dict[str, Any]] = Body(...)) -> JSONResponse:
+    """Crea varias citas en una transacción; devuelve un resultado por ítem"""
+    logger.debug("Creating batch of %d appointments", len(payload))
+
+    with tracer.start_as_current_span("create_appointments_batch"):
+        valid, results = _validate_batch(AppointmentCreate, payload)
+        conflicts = _batch_booking_conflicts(valid)
+        for index, (doctor_name, appointment_time) in conflicts.items():
+            results.append(BatchItemResult(index=index, status="conflict", errors=[{
+                "msg": "Doctor already has an appointment at that time",
+                "alternatives": await _booking_alternatives(doctor_name, appointment_time),
+            }]))
+        valid = [(index, appointment) for index, appointment in valid if index not in conflicts]
+        if valid:
+            generated = await _insert_batch([appointment for _, appointment in valid])
+            await response_cache.invalidate()
+
+            # Prometheus metrics: una vez por lote, no por fila
+            DB_OPERATIONS.labels(operation="insert", status="success").inc()
+            created_by_status = {}
+            for _, appointment in valid:
+                created_by_status[appointment.status] = created_by_status.get(appointment.status, 0) + 1
+            for status, count in created_by_status.items():
+                APPOINTMENTS_CREATED.labels(status=status).inc(count)
+
+            for (index, appointment), row in zip(valid, generated):
+                created = AppointmentOut(**appointment.model_dump(), **row)
+                _index_appointment(created)
+                results.append(BatchItemResult(index=index, status="created", appointment=created))
+        logger.debug("Created %d of %d appointments", len(valid), len(payload))
+        return _batch_response(results, "created")
+
+@app.patch("/appointments/batch", response_model=BatchResult)
+async def update_appointments_batch(payload: List[Dict[str, Any]] = Body(...)) -> JSONResponse:
+    """Actualiza (o cancela, con status) varias citas en una transacción"""
+    logger.debug("Updating batch of %d appointments", len(payload))
+
+    with tracer.start_as_current_span("update_appointments_batch"):
+        valid, results = _validate_batch(AppointmentBatchUpdate, payload)
+        if valid:
+            items = [
+                (update.id, update.model_dump(exclude_unset=True, exclude={"id"})) for _, update in valid
+            ]
+            try:
+                found, rows = await repository.update_many(items)
+            except HTTPException:
+                raise
+            except DoubleBookingError:
+                DB_OPERATIONS.labels(operation="update", status="conflict").inc()
+                raise HTTPException(
+                    status_code=409, detail="An update in the batch double-books a slot; nothing was updated"
+                )
+            except Exception as e:
+                DB_OPERATIONS.labels(operation="update", status="error").inc()
+                logger.error("Failed to update appointment batch: %s", str(e))
+                raise HTTPException(status_code=500, detail="Failed to update appointments")
+            await response_cache.invalidate(*(update.id for _, update in valid))
+
+            DB_OPERATIONS.labels(operation="update", status="success").inc()
+            for (index, update), was_found in zip(valid, found):
+                if was_found:
+                    updated = AppointmentOut(**rows[update.id])
+                    _index_appointment(updated)
+                    results.append(BatchItemResult(index=index, status="updated", appointment=updated))
+                else:
+                    results.append(BatchItemResult(index=index, status="not_found"))
+        return _batch_response(results, "updated")
 
 @app.get("/appointments/", response_model=List[AppointmentOut])
-@track_metrics
-def list_appointments() -> List[AppointmentOut]:
-    logger.info("Listing all appointments")
+async def list_appointments(
+    limit: int = Query(LIST_DEFAULT_PAGE_SIZE, ge=1, le=LIST_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    filters: Dict[str, Any] = Depends(appointment_filters),
+    fields: Optional[str] = Query(None, description="Comma-separated list of columns to return"),
+    if_none_match: Optional[str] = Header(None),
+) -> JSONResponse:
+    """Página de citas; el cursor de la siguiente página va en el header X-Next-Cursor"""
+    logger.debug("Listing appointments")
     
-    # OpenTelemetry span - COMENTADO pero manteniendo la estructura
-    with tracer.start_as_current_span("list_appointments"):  # Mock tracer
+    with tracer.start_as_current_span("list_appointments"):
+        fast = "list_appointments" in FAST_JSON_ENDPOINTS
+        requested = _parse_fields(fields)
+        columns = _list_columns(requested)
+        keyset = decode_cursor(cursor) if cursor else None
+        generation = await response_cache.generation()
+        cache_key = _list_cache_key(generation, limit, cursor, filters, requested)
+        cached = await response_cache.get("list", cache_key)
+        if cached is not None:
+            return _cached_list_response(cached, if_none_match)
         try:
-            conn = get_connection()
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM appointments ORDER BY created_at DESC")
-            rows = cursor.fetchall()
+            if if_none_match is not None:
+                version = await repository.list_version(filters, keyset, limit)
+                etag = list_etag(version["max_updated_at"], version["row_count"])
+                if etag_matches(if_none_match, etag):
+                    DB_OPERATIONS.labels(operation="select", status="not_modified").inc()
+                    return not_modified(etag)
+            if fast:
+                rows = await repository.list_rows(columns, filters, keyset, limit)
+            else:
+                rows = await repository.list(columns, filters, keyset, limit)
             
             # Prometheus metrics
             DB_OPERATIONS.labels(operation="select", status="success").inc()
-            logger.info("Retrieved %d appointments", len(rows))
-            
-            return [AppointmentOut(**row) for row in rows]
+            logger.debug("Retrieved %d appointments", len(rows))
             
+        except HTTPException:
+            raise
         except Exception as e:
             DB_OPERATIONS.labels(operation="select", status="error").inc()
             logger.error("Failed to list appointments: %s", str(e))
             raise HTTPException(status_code=500, detail="Failed to retrieve appointments")
-        finally:
-            cursor.close()
-            conn.close()
+
+        headers = {}
+        if fast:
+            return await _fast_list_response(columns, requested, rows, limit, headers, cache_key, generation)
+        return await _list_response(columns, requested, rows, limit, headers, cache_key, generation)
+
+async def _list_response(columns, requested, rows, limit, headers, cache_key, generation):
+    """Final de list_appointments con filas en diccionario, validadas con AppointmentOut"""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers["X-Next-Cursor"] = encode_cursor(rows[-1])
+    headers["ETag"] = list_etag(max((row["updated_at"] for row in rows), default=None), len(rows))
+    with phase("model"):
+        if requested is None:
+            items = [AppointmentOut(**row) for row in rows]
+        else:
+            items = [{c: row[c] for c in columns if c in requested} for row in rows]
+    with phase("serialize"):
+        content = jsonable_encoder(items)
+    await response_cache.set("list", cache_key, {"items": content, "headers": headers}, generation)
+    with phase("serialize"):
+        return JSONResponse(content=content, headers=headers)
+
+def _list_columns(requested):
+    """Columnas a leer: las pedidas más id y created_at, que forman el cursor, y updated_at, por el ETag"""
+    if requested is None:
+        return APPOINTMENT_COLUMNS
+    return [c for c in APPOINTMENT_COLUMNS if c in requested or c in ("id", "created_at", "updated_at")]
+
+def _list_cache_key(generation, limit, cursor, filters, requested):
+    if generation is None:
+        return None
+    shape = {"limit": limit, "cursor": cursor, "filters": filters,
+             "fields": sorted(requested) if requested is not None else None}
+    return response_cache.list_key(generation, shape)
+
+def _cached_list_response(cached, if_none_match):
+    """Página servida desde la caché: 304 si el cliente ya la tiene"""
+    if etag_matches(if_none_match, cached["headers"]["ETag"]):
+        return not_modified(cached["headers"]["ETag"])
+    with phase("serialize"):
+        if "body" in cached:
+            return Response(cached["body"], media_type="application/json", headers=cached["headers"])
+        return JSONResponse(content=cached["items"], headers=cached["headers"])
+
+async def _fast_list_response(columns, requested, rows, limit, headers, cache_key, generation):
+    """Final de list_appointments con filas en tupla; la caché guarda el cuerpo ya codificado"""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        headers["X-Next-Cursor"] = encode_cursor(
+            {"created_at": last[columns.index("created_at")], "id": last[columns.index("id")]}
+        )
+    updated_at = columns.index("updated_at")
+    headers["ETag"] = list_etag(max((row[updated_at] for row in rows), default=None), len(rows))
+    output = APPOINTMENT_OUT_FIELDS if requested is None else [c for c in columns if c in requested]
+    with phase("model"):
+        items = _row_items(columns, output, rows)
+    with phase("serialize"):
+        response = ORJSONResponse(items, headers=headers)
+    await response_cache.set("list", cache_key, {"body": response.body.decode(), "headers": headers}, generation)
+    return response
+
+@app.get("/appointments/export")
+async def export_appointments(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    filters: Dict[str, Any] = Depends(appointment_filters),
+    fields: Optional[str] = Query(None, description="Comma-separated list of columns to return"),
+) -> StreamingResponse:
+    """Todas las citas que cumplen los filtros, en streaming como NDJSON o CSV"""
+    logger.debug("Exporting appointments as %s", format)
+
+    with tracer.start_as_current_span("export_appointments"):
+        requested = _parse_fields(fields)
+        columns = [c for c in APPOINTMENT_COLUMNS if requested is None or c in requested]
+        media_type, encode_header, encode_rows = EXPORT_FORMATS[format]
+        header = encode_header(columns)
+        encode = functools.partial(encode_rows, columns)
+        try:
+            body = await repository.export(columns, filters, header, encode)
+            DB_OPERATIONS.labels(operation="select", status="success").inc()
+        except HTTPException:
+            raise
+        except Exception as e:
+            DB_OPERATIONS.labels(operation="select", status="error").inc()
+            logger.error("Failed to export appointments: %s", str(e))
+            raise HTTPException(status_code=500, detail="Failed to export appointments")
+
+        return StreamingResponse(
+            body,
+            media_type=media_type,
+            headers={"Content-Disposition": f'attachment; filename="appointments.{format}"'},
+        )
 
 @app.get("/appointments/{appointment_id}", response_model=AppointmentOut)
-@track_metrics
-def get_appointment(appointment_id: int = Path(..., gt=0)) -> AppointmentOut:
-    logger.info("Getting appointment with id %s", appointment_id)
+async def get_appointment(
+    appointment_id: int = Path(..., gt=0),
+    if_none_match: Optional[str] = Header(None),
+) -> AppointmentOut:
+    logger.debug("Getting appointment with id %s", appointment_id)
     
-    with tracer.start_as_current_span("get_appointment"):  # Mock tracer
+    with tracer.start_as_current_span("get_appointment"):
+        cache_key = response_cache.appointment_key(appointment_id)
+        cached = await response_cache.get("appointment", cache_key)
+        if cached is not None:
+            return _cached_appointment_response(cached, if_none_match)
+        # La generación se lee antes de la consulta: si hay una escritura en medio, no se guarda
+        generation = await response_cache.generation()
         try:
-            conn = get_connection()
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM appointments WHERE id = %s", (appointment_id,))
-            row = cursor.fetchone()
+            if if_none_match is not None:
+                version = await repository.get_version(appointment_id)
+                # Si la cita no existe sigue la consulta completa, que responde 404
+                if version is not None:
+                    etag = appointment_etag(appointment_id, version["updated_at"])
+                    if etag_matches(if_none_match, etag):
+                        DB_OPERATIONS.labels(operation="select", status="not_modified").inc()
+                        return not_modified(etag)
+            row = await repository.get(appointment_id)
             
             if not row:
                 DB_OPERATIONS.labels(operation="select", status="not_found").inc()
-                logger.warning("Appointment with id %s not found", appointment_id)
+                logger.debug("Appointment with id %s not found", appointment_id)
                 raise HTTPException(status_code=404, detail="Appointment not found")
             
             DB_OPERATIONS.labels(operation="select", status="success").inc()
-            logger.info("Retrieved appointment with id %s", appointment_id)
-            return AppointmentOut(**row)
+            logger.debug("Retrieved appointment with id %s", appointment_id)
+            return await _appointment_response(row, cache_key, generation)
             
         except HTTPException:
             raise
@@ -262,79 +924,102 @@ def get_appointment(appointment_id: int = Path(..., gt=0)) -> AppointmentOut:
             DB_OPERATIONS.labels(operation="select", status="error").inc()
             logger.error("Failed to get appointment: %s", str(e))
             raise HTTPException(status_code=500, detail="Failed to retrieve appointment")
-        finally:
-            cursor.close()
-            conn.close()
+
+def _cached_appointment_response(cached, if_none_match):
+    """Cita servida desde la caché: 304 si el cliente ya la tiene"""
+    etag = appointment_etag(cached["id"], cached["updated_at"])
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+    with phase("serialize"):
+        return JSONResponse(content=cached, headers={"ETag": etag})
+
+async def _appointment_response(row, cache_key, generation):
+    """Respuesta de get_appointment a partir de la fila leída, que también se guarda en la caché"""
+    if "get_appointment" in FAST_JSON_ENDPOINTS:
+        # La caché guarda valores JSON, como en el otro camino
+        with phase("serialize"):
+            content = {field: _export_value(row[field]) for field in APPOINTMENT_OUT_FIELDS}
+            response = ORJSONResponse(content, headers={"ETag": appointment_etag(row["id"], row["updated_at"])})
+        await response_cache.set("appointment", cache_key, content, generation)
+        return response
+    with phase("model"):
+        appointment = AppointmentOut(**row)
+    with phase("serialize"):
+        content = jsonable_encoder(appointment)
+    await response_cache.set("appointment", cache_key, content, generation)
+    with phase("serialize"):
+        return JSONResponse(
+            content=content, headers={"ETag": appointment_etag(appointment.id, appointment.updated_at)}
+        )
 
 @app.put("/appointments/{appointment_id}", response_model=AppointmentOut)
-@track_metrics
-def update_appointment(appointment_id: int, appointment: AppointmentUpdate) -> AppointmentOut:
-    logger.info("Updating appointment with id %s", appointment_id)
+async def update_appointment(appointment_id: int, appointment: AppointmentUpdate) -> AppointmentOut:
+    logger.debug("Updating appointment with id %s", appointment_id)
     
-    with tracer.start_as_current_span("update_appointment"):  # Mock tracer
+    with tracer.start_as_current_span("update_appointment"):
         try:
-            conn = get_connection()
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT * FROM appointments WHERE id = %s", (appointment_id,))
-            row = cursor.fetchone()
+            changes = appointment.model_dump(exclude_unset=True)
+            updated_row = await repository.update(appointment_id, changes)
+            await response_cache.invalidate(appointment_id)
             
-            if not row:
+            if not updated_row:
                 DB_OPERATIONS.labels(operation="update", status="not_found").inc()
-                logger.info("Appointment with id %s not found", appointment_id)
+                logger.debug("Appointment with id %s not found", appointment_id)
                 raise HTTPException(status_code=404, detail="Appointment not found")
             
-            fields = []
-            values = []
-            for field, value in appointment.model_dump(exclude_unset=True).items():
-                fields.append(f"{field} = %s")
-                values.append(value)
-            
-            if fields:
-                update_query = f"UPDATE appointments SET {', '.join(fields)}, updated_at = NOW() WHERE id = %s"
-                values.append(appointment_id)
-                cursor.execute(update_query, tuple(values))
-                conn.commit()
-            
-            cursor.execute("SELECT * FROM appointments WHERE id = %s", (appointment_id,))
-            updated_row = cursor.fetchone()
-            
             DB_OPERATIONS.labels(operation="update", status="success").inc()
-            logger.info("Appointment with id %s updated", appointment_id)
+            logger.debug("Appointment with id %s updated", appointment_id)
             
-            return AppointmentOut(**updated_row)
+            if "update_appointment" in FAST_JSON_ENDPOINTS:
+                with phase("model"):
+                    updated = AppointmentOut.model_construct(**updated_row)
+                _index_appointment(updated)
+                with phase("serialize"):
+                    return ORJSONResponse(_fast_appointment(updated_row))
+            with phase("model"):
+                updated = AppointmentOut(**updated_row)
+            _index_appointment(updated)
+            return updated
             
         except HTTPException:
             raise
+        except DoubleBookingError:
+            DB_OPERATIONS.labels(operation="update", status="conflict").inc()
+            raise await _update_conflict_error(appointment_id, changes)
         except Exception as e:
             DB_OPERATIONS.labels(operation="update", status="error").inc()
             logger.error("Failed to update appointment: %s", str(e))
             raise HTTPException(status_code=500, detail="Failed to update appointment")
-        finally:
-            cursor.close()
-            conn.close()
+
+async def _update_conflict_error(appointment_id, changes):
+    """409 de una actualización: médico y hora salen del cambio o, si no cambian, de la cita"""
+    doctor_name, appointment_time = changes.get("doctor_name"), changes.get("appointment_time")
+    if doctor_name is None or appointment_time is None:
+        current = await repository.get(appointment_id)
+        if current is None:
+            # Borrada entre el UPDATE rechazado y esta lectura
+            return HTTPException(status_code=404, detail="Appointment not found")
+        doctor_name = doctor_name or current["doctor_name"]
+        appointment_time = appointment_time or current["appointment_time"]
+    return await _double_booking_error(doctor_name, appointment_time)
 
 @app.delete("/appointments/{appointment_id}")
-@track_metrics
-def delete_appointment(appointment_id: int) -> dict[str, bool]:
-    logger.info("Deleting appointment with id %s", appointment_id)
+async def delete_appointment(appointment_id: int) -> dict[str, bool]:
+    logger.debug("Deleting appointment with id %s", appointment_id)
     
-    with tracer.start_as_current_span("delete_appointment"):  # Mock tracer
+    with tracer.start_as_current_span("delete_appointment"):
         try:
-            conn = get_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM appointments WHERE id = %s", (appointment_id,))
-            row = cursor.fetchone()
+            deleted = await repository.delete(appointment_id)
+            await response_cache.invalidate(appointment_id)
             
-            if not row:
+            if not deleted:
                 DB_OPERATIONS.labels(operation="delete", status="not_found").inc()
-                logger.warning("Appointment with id %s not found", appointment_id)
+                logger.debug("Appointment with id %s not found", appointment_id)
                 raise HTTPException(status_code=404, detail="Appointment not found")
             
-            cursor.execute("DELETE FROM appointments WHERE id = %s", (appointment_id,))
-            conn.commit()
-            
+            availability_index.remove(appointment_id)
             DB_OPERATIONS.labels(operation="delete", status="success").inc()
-            logger.info("Appointment with id %s deleted", appointment_id)
+            logger.debug("Appointment with id %s deleted", appointment_id)
             
             return {"ok": True}
             
@@ -344,11 +1029,116 @@ def delete_appointment(appointment_id: int) -> dict[str, bool]:
             DB_OPERATIONS.labels(operation="delete", status="error").inc()
             logger.error("Failed to delete appointment: %s", str(e))
             raise HTTPException(status_code=500, detail="Failed to delete appointment")
-        finally:
-            cursor.close()
-            conn.close()
+
+def _slot_window(start, end):
+    """Ventana de búsqueda: desde ahora como mínimo y de hasta AVAILABILITY_MAX_DAYS días"""
+    now = datetime.datetime.now().replace(second=0, microsecond=0)
+    start = max(start or now, now)
+    end = end or start + datetime.timedelta(days=7)
+    if end <= start:
+        raise HTTPException(status_code=422, detail="end must be after start")
+    if end - start > datetime.timedelta(days=AVAILABILITY_MAX_DAYS):
+        raise HTTPException(status_code=422, detail=f"Search window exceeds {AVAILABILITY_MAX_DAYS} days")
+    return start, end
+
+@app.get("/availability/slots")
+async def get_free_slots(
+    doctor_name: str,
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    limit: int = Query(100, ge=1, le=1000),
+) -> Dict[str, Any]:
+    """Turnos libres de un médico entre start y end (por defecto, los próximos 7 días)"""
+    await ensure_availability_index()
+    if not availability_index.has_doctor(doctor_name):
+        raise HTTPException(status_code=404, detail="Doctor not found")
+    start, end = _slot_window(start, end)
+    slots = availability_index.free_slots(doctor_name, start, end, limit)
+    return {
+        "doctor_name": doctor_name,
+        "slot_minutes": AVAILABILITY_SLOT_MINUTES,
+        "slots": [slot.isoformat() for slot in slots],
+    }
+
+@app.get("/availability/next")
+async def get_next_available(
+    doctor_specialty: str,
+    after: Optional[datetime.datetime] = None,
+    limit: int = Query(5, ge=1, le=100),
+) -> Dict[str, Any]:
+    """Primer turno libre de cada médico de la especialidad, ordenados por fecha"""
+    await ensure_availability_index()
+    start, _ = _slot_window(after, None)
+    found = availability_index.next_available(
+        doctor_specialty, start, datetime.timedelta(days=AVAILABILITY_MAX_DAYS), limit
+    )
+    return {
+        "doctor_specialty": doctor_specialty,
+        "slot_minutes": AVAILABILITY_SLOT_MINUTES,
+        "results": [{"doctor_name": doctor, "slot": slot.isoformat()} for slot, doctor in found],
+    }
+
+@app.get("/metrics", include_in_schema=False)
+def metrics() -> Response:
+    return Response(generate_latest(metrics_registry()), media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/health")
+@app.get("/health/live")
 def health_check() -> dict[str, str]:
-    """Health check endpoint - sin métricas personalizadas para evitar ruido"""
+    """Liveness: el proceso responde; no consulta la BD"""
     return {"status": "ok"}
+
+@app.get("/health/ready")
+async def readiness_check() -> JSONResponse:
+    """Readiness: calentamiento hecho, sin drenar, la BD responde y el índice de horarios está cargado"""
+    checks = {"lifecycle": service_status}
+    if service_status == "draining":
+        checks["database"] = "skipped"
+    else:
+        try:
+            await asyncio.wait_for(repository.ping(), READINESS_TIMEOUT_SECONDS)
+            checks["database"] = "ok"
+        except asyncio.TimeoutError:
+            checks["database"] = "timeout"
+        except Exception as e:
+            logger.debug("Readiness database check failed: %s", str(e))
+            checks["database"] = "unavailable"
+    checks["availability_index"] = "loaded" if availability_index.loaded else "loading"
+    ready = service_status == "ready" and checks["database"] == "ok" and availability_index.loaded
+    return JSONResponse(
+        {"status": "ready" if ready else "not_ready", "checks": checks, "db_connections_in_use": repository.in_use()},
+        status_code=200 if ready else 503,
+    )
+
+# Administración: perfilado bajo demanda. El gateway reenvía /appointments/* a este servicio,
+# así que estos endpoints exigen X-Admin-Token además de no estar en la red pública.
+def require_admin(x_admin_token: Optional[str] = Header(None)) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if x_admin_token is None or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+def start_profile(
+    requests: int = Query(100, ge=1, le=100000),
+    interval_ms: float = Query(PROFILE_INTERVAL_MS, ge=1, le=1000),
+) -> Dict[str, Any]:
+    """Muestrea las pilas durante las próximas `requests` peticiones; descarta el perfil anterior"""
+    if not profiler.start(requests, interval_ms / 1000, PROFILE_OUTPUT or None):
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    logger.info("Profiling the next %d requests every %sms", requests, interval_ms)
+    return profiler.status()
+
+@app.get("/admin/profile", dependencies=[Depends(require_admin)])
+def get_profile_status() -> Dict[str, Any]:
+    return profiler.status()
+
+@app.get("/admin/profile/stacks", dependencies=[Depends(require_admin)])
+def get_profile_stacks() -> Response:
+    """Collapsed stacks del perfil en curso o del último: flamegraph.pl, speedscope o inferno"""
+    return Response(content=profiler.collapsed(), media_type="text/plain")
+
+@app.delete("/admin/profile", dependencies=[Depends(require_admin)])
+def stop_profile() -> Dict[str, Any]:
+    profiler.stop(wait=True)
+    return profiler.status()
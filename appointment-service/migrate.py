@@ -0,0 +1,116 @@
+"""Migraciones de esquema versionadas para appointment-service.
+
+Cada archivo ``migrations/NNN_descripcion.sql`` es una versión. Las versiones
+aplicadas se registran en la tabla ``schema_migrations``. Se ejecutan al
+arrancar (DB_MIGRATE_ON_STARTUP=true) o a mano:
+
+    python migrate.py            # aplica las pendientes
+    python migrate.py --status   # lista aplicadas / pendientes
+"""
+import argparse
+import logging
+import os
+import re
+
+logger = logging.getLogger("appointment-service.migrations")
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_(\w+)\.sql$")
+# Evita que varios workers/réplicas apliquen la misma migración a la vez
+MIGRATION_LOCK_NAME = "appointment_service_migrations"
+MIGRATION_LOCK_TIMEOUT = 30
+
+CREATE_MIGRATIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def split_sql_statements(sql):
+    """Separa un script SQL en sentencias, ignorando comentarios ``--``"""
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [stmt.strip() for stmt in "\n".join(lines).split(";") if stmt.strip()]
+
+
+def load_migrations(directory=MIGRATIONS_DIR):
+    """Devuelve [(version, name, statements)] ordenado por versión"""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = MIGRATION_FILE_RE.match(filename)
+        if not match:
+            continue
+        with open(os.path.join(directory, filename), encoding="utf-8") as f:
+            statements = split_sql_statements(f.read())
+        migrations.append((int(match.group(1)), match.group(2), statements))
+    migrations.sort(key=lambda m: m[0])
+    versions = [m[0] for m in migrations]
+    if len(versions) != len(set(versions)):
+        raise ValueError(f"Duplicate migration versions in {directory}")
+    return migrations
+
+
+def applied_versions(cursor):
+    cursor.execute(CREATE_MIGRATIONS_TABLE_SQL)
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def apply_migrations(conn, directory=MIGRATIONS_DIR):
+    """Aplica las migraciones pendientes en orden y devuelve las versiones aplicadas"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK_NAME, MIGRATION_LOCK_TIMEOUT))
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError("Could not acquire the schema migration lock")
+        try:
+            done = applied_versions(cursor)
+            applied = []
+            for version, name, statements in load_migrations(directory):
+                if version in done:
+                    continue
+                logger.info("Applying migration %03d_%s", version, name)
+                # El DDL de MySQL hace commit implícito: se registra la versión al terminar
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name)
+                )
+                conn.commit()
+                applied.append(version)
+            return applied
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK_NAME,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply appointment-service schema migrations")
+    parser.add_argument("--status", action="store_true", help="show applied and pending migrations")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from main import _create_connection
+
+    conn = _create_connection()
+    try:
+        if args.status:
+            cursor = conn.cursor()
+            done = applied_versions(cursor)
+            cursor.close()
+            for version, name, _ in load_migrations():
+                state = "applied" if version in done else "pending"
+                print(f"{version:03d}_{name}: {state}")
+        else:
+            applied = apply_migrations(conn)
+            print(f"Applied {len(applied)} migration(s)")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
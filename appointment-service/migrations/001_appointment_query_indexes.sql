@@ -0,0 +1,8 @@
+-- Índices para los patrones de consulta de appointment-service:
+-- listados paginados por (created_at, id) y filtros por doctor, especialidad,
+-- paciente o estado acotados por appointment_time.
+CREATE INDEX idx_appointments_created_id ON appointments (created_at, id);
+CREATE INDEX idx_appointments_doctor_time ON appointments (doctor_name, appointment_time);
+CREATE INDEX idx_appointments_specialty_time ON appointments (doctor_specialty, appointment_time);
+CREATE INDEX idx_appointments_patient_time ON appointments (patient_email, appointment_time);
+CREATE INDEX idx_appointments_status_time ON appointments (status, appointment_time);
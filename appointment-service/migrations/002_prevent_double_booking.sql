@@ -0,0 +1,26 @@
+-- Un médico no puede tener dos citas activas a la misma hora.
+-- active_slot es NULL para las canceladas (y NULL no choca en un índice único),
+-- así que cancelar libera el turno. La comprobación la hace InnoDB al insertar
+-- o actualizar, bloqueando solo la entrada del índice de ese médico y hora:
+-- dos reservas simultáneas del mismo turno no pueden confirmarse ambas.
+
+-- Antes del índice, las dobles reservas que ya existan harían fallar el ALTER:
+-- de cada grupo se conserva la más antigua (menor id) y las demás se cancelan,
+-- marcadas en notes para poder encontrarlas y avisar a los pacientes.
+UPDATE appointments a
+    JOIN (
+        SELECT doctor_name, appointment_time, MIN(id) AS kept_id
+        FROM appointments
+        WHERE status IS NULL OR status <> 'cancelled'
+        GROUP BY doctor_name, appointment_time
+        HAVING COUNT(*) > 1
+    ) duplicates
+        ON duplicates.doctor_name = a.doctor_name AND duplicates.appointment_time = a.appointment_time
+SET a.status = 'cancelled',
+    a.notes = CONCAT_WS(' ', a.notes, '[cancelada por migración 002: doble reserva]')
+WHERE (a.status IS NULL OR a.status <> 'cancelled') AND a.id <> duplicates.kept_id;
+
+ALTER TABLE appointments
+    ADD COLUMN active_slot DATETIME
+        AS (IF(status = 'cancelled', NULL, appointment_time)) STORED,
+    ADD UNIQUE INDEX uq_appointments_doctor_active_slot (doctor_name, active_slot);
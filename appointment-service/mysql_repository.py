@@ -0,0 +1,741 @@
+"""Backend MySQL (DB_BACKEND=mysql, el de por defecto).
+
+- Dos drivers según mode (DB_MODE): "sync" usa mysql-connector sobre un QueuePool
+  de SQLAlchemy desde el threadpool; "async" usa aiomysql en el event loop. Las
+  sentencias SQL son las mismas para los dos.
+- Cada operación hace un único viaje al servidor: las escrituras usan lotes
+  multi-sentencia (INSERT/UPDATE más el SELECT de la fila resultante).
+- Pool acotado: pool_size conexiones persistentes más max_overflow bajo carga. Si
+  no queda ninguna libre en pool_timeout segundos, 503 en vez de dejar bloqueados
+  los hilos del threadpool.
+- on_checkout(segundos) y on_checkout_failure(motivo) reciben la espera y los
+  fallos de cada préstamo de conexión (las métricas del pool en main.py).
+"""
+import asyncio
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import aiomysql
+import mysql.connector
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from mysql.connector.constants import ClientFlag
+from pymysql.constants import CLIENT
+from sqlalchemy import event, exc as sa_exc
+from sqlalchemy.pool import QueuePool
+
+from migrate import apply_migrations
+from profiling import add_phase, phase
+from repository import (
+    DOUBLE_BOOKING_KEY, AppointmentRepository, BatchReadBackError, DoubleBookingError,
+    build_filtered_select, build_list_query, build_list_version_query,
+)
+
+logger = logging.getLogger("appointment-service.mysql")
+
+ER_DUP_ENTRY = 1062
+
+# SQL statements (compartidos por los drivers sync y async)
+# INSERT y lectura de las columnas generadas por el servidor en un solo lote
+CREATE_APPOINTMENT_SQL = """
+    INSERT INTO appointments (
+        patient_name, patient_email, doctor_name, doctor_specialty,
+        appointment_time, status, notes, created_at, updated_at)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, NOW(), NOW());
+    SELECT id, created_at, updated_at FROM appointments WHERE id = LAST_INSERT_ID()
+"""
+SELECT_APPOINTMENT_SQL = "SELECT * FROM appointments WHERE id = %s"
+# Carga del índice de horarios: todos los médicos y las citas activas desde hoy
+SELECT_DOCTORS_SQL = "SELECT DISTINCT doctor_name, doctor_specialty FROM appointments"
+SELECT_BOOKED_SQL = """
+    SELECT id, doctor_name, doctor_specialty, appointment_time, status FROM appointments
+    WHERE appointment_time >= %s AND (status IS NULL OR status <> 'cancelled')
+"""
+# Solo placeholders en VALUES: así ambos drivers convierten executemany en un INSERT multi-fila
+INSERT_APPOINTMENT_ROW_SQL = """
+    INSERT INTO appointments (
+        patient_name, patient_email, doctor_name, doctor_specialty,
+        appointment_time, status, notes)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+"""
+# InnoDB reserva un bloque de ids a un INSERT multi-fila, separados por auto_increment_increment
+# (1 salvo con varios primarios, p. ej. Galera); lastrowid es el primero. El paso se lee en la
+# misma consulta. Un INSERT cuyo número de filas no se conoce de antemano no tiene esa garantía
+SELECT_GENERATED_RANGE_SQL = """
+    SELECT id, created_at, updated_at FROM appointments
+    WHERE id BETWEEN %s AND %s + (%s - 1) * @@auto_increment_increment
+        AND MOD(id - %s, @@auto_increment_increment) = 0
+    ORDER BY id
+"""
+# Consulta barata para validar un ETag sin traer la fila completa
+SELECT_APPOINTMENT_VERSION_SQL = "SELECT updated_at FROM appointments WHERE id = %s"
+DELETE_APPOINTMENT_SQL = "DELETE FROM appointments WHERE id = %s"
+
+
+def _build_update_sql(changes):
+    """UPDATE + SELECT de la fila resultante en un solo lote"""
+    assignments = ", ".join(f"{field} = %s" for field in changes)
+    return (
+        f"UPDATE appointments SET {assignments}, updated_at = NOW() WHERE id = %s; "
+        + SELECT_APPOINTMENT_SQL
+    )
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _generated_range_params(first_id, count):
+    return first_id, first_id, count, first_id
+
+
+def _check_generated(chunk, generated):
+    if len(generated) != len(chunk):
+        raise BatchReadBackError(
+            f"Batch insert returned {len(generated)} generated rows for {len(chunk)} inserted"
+        )
+
+
+def _build_batch_update_sql(chunk):
+    """Un UPDATE por ítem más un SELECT de las filas resultantes, en un solo lote"""
+    statements = []
+    params = []
+    for appointment_id, changes in chunk:
+        if changes:
+            assignments = ", ".join(f"{field} = %s" for field in changes)
+            statements.append(f"UPDATE appointments SET {assignments}, updated_at = NOW() WHERE id = %s")
+        else:
+            # No modifica nada, pero con FOUND_ROWS el rowcount dice si la cita existe
+            statements.append("UPDATE appointments SET updated_at = updated_at WHERE id = %s")
+        params.extend([*changes.values(), appointment_id])
+    ids = [appointment_id for appointment_id, _ in chunk]
+    statements.append(f"SELECT * FROM appointments WHERE id IN ({', '.join(['%s'] * len(ids))})")
+    params.extend(ids)
+    return "; ".join(statements), tuple(params)
+
+
+def _is_double_booking(exc):
+    """IntegrityError de la clave de turnos, tanto de mysql-connector (errno) como de pymysql (args[0])"""
+    errno = getattr(exc, "errno", None)
+    if errno is None and exc.args and isinstance(exc.args[0], int):
+        errno = exc.args[0]
+    return errno == ER_DUP_ENTRY and DOUBLE_BOOKING_KEY in str(exc)
+
+
+@contextmanager
+def _double_booking_errors():
+    try:
+        yield
+    except Exception as e:
+        if _is_double_booking(e):
+            raise DoubleBookingError(str(e)) from e
+        raise
+
+
+async def _prepend_async(first, chunks):
+    yield first
+    async for chunk in chunks:
+        yield chunk
+
+
+def _reset_on_checkin(dbapi_connection, connection_record, reset_state):
+    # Las conexiones son autocommit: el ROLLBACK al devolverlas solo hace falta
+    # si quedó una transacción explícita abierta
+    if dbapi_connection.in_transaction:
+        dbapi_connection.rollback()
+
+
+def _ping_on_checkout(dbapi_connection, connection_record, connection_proxy):
+    """Pre-ping: descarta conexiones muertas antes de entregarlas al endpoint"""
+    try:
+        dbapi_connection.ping(reconnect=False)
+    except mysql.connector.Error as e:
+        logger.warning("Discarding stale pooled connection: %s", str(e))
+        # El pool invalida la conexión y reintenta con una nueva
+        raise sa_exc.DisconnectionError() from e
+
+
+class MySQLRepository(AppointmentRepository):
+    def __init__(
+        self, host, port, user, password, database, pool_size=10, max_overflow=5, pool_recycle=1800,
+        pool_timeout=5.0, pre_ping=True, mode="sync", migrate_on_startup=False, export_fetch_size=1000,
+        batch_chunk_size=500, on_checkout=None, on_checkout_failure=None,
+    ):
+        self.host = host
+        self.port = int(port)
+        self.user = user
+        self.password = password
+        self.database = database
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_recycle = pool_recycle
+        self.pool_timeout = pool_timeout
+        self.pre_ping = pre_ping
+        self.mode = mode
+        self.migrate_on_startup = migrate_on_startup
+        self.export_fetch_size = export_fetch_size
+        self.batch_chunk_size = batch_chunk_size
+        self.on_checkout = on_checkout
+        self.on_checkout_failure = on_checkout_failure
+        # Connections older than pool_recycle are replaced on checkout
+        self.pool = QueuePool(
+            self._connect,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            timeout=pool_timeout,
+            recycle=pool_recycle,
+            reset_on_return=None,  # ver _reset_on_checkin
+        )
+        event.listen(self.pool, "reset", _reset_on_checkin)
+        if pre_ping:
+            event.listen(self.pool, "checkout", _ping_on_checkout)
+        # Pool de aiomysql, creado en open() cuando mode == "async"
+        self.async_pool = None
+
+    def _connect(self):
+        return mysql.connector.connect(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            database=self.database,
+            # autocommit: las escrituras de una sola sentencia no pagan un COMMIT aparte.
+            # FOUND_ROWS: rowcount de UPDATE cuenta filas encontradas, no solo las modificadas.
+            autocommit=True,
+            client_flags=[ClientFlag.FOUND_ROWS],
+        )
+
+    async def _create_async_pool(self):
+        return await aiomysql.create_pool(
+            host=self.host,
+            port=self.port,
+            user=self.user,
+            password=self.password,
+            db=self.database,
+            minsize=0,
+            maxsize=self.pool_size + self.max_overflow,
+            pool_recycle=self.pool_recycle,
+            autocommit=True,
+            client_flag=CLIENT.FOUND_ROWS,
+        )
+
+    def _migrate_sync(self):
+        conn = self._connect()
+        try:
+            applied = apply_migrations(conn)
+            logger.info("Applied %d schema migration(s)", len(applied))
+        finally:
+            conn.close()
+
+    async def open(self):
+        if self.migrate_on_startup:
+            await run_in_threadpool(self._migrate_sync)
+        if self.mode == "async":
+            self.async_pool = await self._create_async_pool()
+            logger.info("Using async MySQL driver (aiomysql)")
+        else:
+            logger.info("Using sync MySQL driver (mysql-connector)")
+
+    async def close(self):
+        if self.async_pool is not None:
+            self.async_pool.close()
+            await self.async_pool.wait_closed()
+            self.async_pool = None
+        self.pool.dispose()
+
+    def in_use(self):
+        if self.async_pool is not None:
+            return self.async_pool.size - self.async_pool.freesize
+        return self.pool.checkedout()
+
+    def _checkout_failed(self, reason, error):
+        if self.on_checkout_failure is not None:
+            self.on_checkout_failure(reason)
+        if reason == "timeout":
+            logger.error("Timed out after %ss waiting for a database connection", self.pool_timeout)
+            return HTTPException(status_code=503, detail="Database busy, try again later")
+        logger.error("Failed to check out database connection: %s", str(error))
+        return HTTPException(status_code=503, detail="Database unavailable")
+
+    def _checked_out(self, start_time):
+        waited = time.perf_counter() - start_time
+        if self.on_checkout is not None:
+            self.on_checkout(waited)
+        add_phase("connect", waited)
+
+    def connection(self):
+        """Obtiene una conexión del pool; devuelve 503 si el pool está agotado"""
+        start_time = time.perf_counter()
+        try:
+            return self.pool.connect()
+        except sa_exc.TimeoutError as e:
+            raise self._checkout_failed("timeout", e)
+        except Exception as e:
+            raise self._checkout_failed("error", e)
+        finally:
+            self._checked_out(start_time)
+
+    async def _acquire_async(self):
+        if self.async_pool is None:
+            raise RuntimeError("async database pool is not initialized")
+        conn = await asyncio.wait_for(self.async_pool.acquire(), timeout=self.pool_timeout)
+        if self.pre_ping:
+            try:
+                await conn.ping(reconnect=False)
+            except Exception as e:
+                logger.warning("Discarding stale pooled connection: %s", str(e))
+                conn.close()
+                self.async_pool.release(conn)
+                conn = await asyncio.wait_for(self.async_pool.acquire(), timeout=self.pool_timeout)
+        return conn
+
+    @asynccontextmanager
+    async def async_connection(self):
+        """Equivalente async de connection() sobre el pool de aiomysql"""
+        start_time = time.perf_counter()
+        try:
+            conn = await self._acquire_async()
+        except asyncio.TimeoutError as e:
+            raise self._checkout_failed("timeout", e)
+        except Exception as e:
+            raise self._checkout_failed("error", e)
+        finally:
+            self._checked_out(start_time)
+        try:
+            yield conn
+        finally:
+            self.async_pool.release(conn)
+
+    async def _run(self, sync_op, async_op, *args):
+        """Ejecuta la operación con el driver de mode"""
+        if self.mode == "async":
+            return await async_op(*args)
+        return await run_in_threadpool(sync_op, *args)
+
+    # Data access - sync driver (mysql-connector, corre en el threadpool)
+    def _insert_appointment_sync(self, values):
+        conn = self.connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                generated = None
+                with phase("query"):
+                    for result in cursor.execute(CREATE_APPOINTMENT_SQL, values, multi=True):
+                        if result.with_rows:
+                            generated = result.fetchone()
+                return generated
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _insert_appointments_batch_sync(self, rows):
+        """Inserta rows en una transacción; devuelve las columnas generadas en el mismo orden"""
+        conn = self.connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                with phase("query"):
+                    conn.start_transaction()
+                    generated = []
+                    for chunk in _chunks(rows, self.batch_chunk_size):
+                        cursor.executemany(INSERT_APPOINTMENT_ROW_SQL, chunk)
+                        first_id = cursor.lastrowid
+                        cursor.execute(SELECT_GENERATED_RANGE_SQL, _generated_range_params(first_id, len(chunk)))
+                        chunk_generated = cursor.fetchall()
+                        _check_generated(chunk, chunk_generated)
+                        generated.extend(chunk_generated)
+                    conn.commit()
+                return generated
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _export_appointments_sync(self, query, params, header, encode_rows):
+        """Generador: cursor sin buffer, export_fetch_size filas por chunk (memoria constante).
+
+        El primer chunk (la cabecera) se entrega después de ejecutar la consulta, así
+        los errores de conexión o de SQL se reportan antes de enviar el status.
+        """
+        conn = self.connection()
+        cursor = None
+        unread = False
+        try:
+            cursor = conn.cursor()  # mysql-connector no bufferiza por defecto: lee del socket en cada fetch
+            cursor.execute(query, params)
+            unread = True
+            yield header
+            while True:
+                rows = cursor.fetchmany(self.export_fetch_size)
+                if not rows:
+                    break
+                yield encode_rows(rows)
+            unread = False
+        finally:
+            if unread:
+                # Cliente desconectado a mitad: se descarta la conexión en vez de drenar el resultado
+                conn.invalidate()
+            else:
+                try:
+                    if cursor is not None:
+                        cursor.close()
+                finally:
+                    conn.close()
+
+    def _update_appointments_batch_sync(self, items):
+        """Aplica [(id, cambios)] en una transacción; devuelve (encontrado por ítem, {id: fila})"""
+        conn = self.connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                with phase("query"):
+                    conn.start_transaction()
+                    found = []
+                    rows = {}
+                    for chunk in _chunks(items, self.batch_chunk_size):
+                        sql, params = _build_batch_update_sql(chunk)
+                        for result in cursor.execute(sql, params, multi=True):
+                            if result.with_rows:
+                                rows.update((row["id"], row) for row in result.fetchall())
+                            else:
+                                found.append(result.rowcount > 0)
+                    conn.commit()
+                return found, rows
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _load_availability_sync(self, since):
+        conn = self.connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(SELECT_DOCTORS_SQL)
+                doctors = cursor.fetchall()
+                cursor.execute(SELECT_BOOKED_SQL, (since,))
+                return doctors, cursor.fetchall()
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _list_appointments_sync(self, query, params, dictionary=True):
+        conn = self.connection()
+        try:
+            cursor = conn.cursor(dictionary=dictionary)
+            try:
+                with phase("query"):
+                    cursor.execute(query, params)
+                with phase("fetch"):
+                    return cursor.fetchall()
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _select_appointment_sync(self, appointment_id):
+        conn = self.connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                with phase("query"):
+                    cursor.execute(SELECT_APPOINTMENT_SQL, (appointment_id,))
+                with phase("fetch"):
+                    return cursor.fetchone()
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _select_appointment_version_sync(self, appointment_id):
+        conn = self.connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                with phase("query"):
+                    cursor.execute(SELECT_APPOINTMENT_VERSION_SQL, (appointment_id,))
+                with phase("fetch"):
+                    return cursor.fetchone()
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _update_appointment_sync(self, appointment_id, changes):
+        if not changes:
+            return self._select_appointment_sync(appointment_id)
+        conn = self.connection()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            try:
+                matched = 0
+                row = None
+                params = (*changes.values(), appointment_id, appointment_id)
+                with phase("query"):
+                    for result in cursor.execute(_build_update_sql(changes), params, multi=True):
+                        if result.with_rows:
+                            row = result.fetchone()
+                        else:
+                            matched = result.rowcount
+                return row if matched else None
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _delete_appointment_sync(self, appointment_id):
+        conn = self.connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                with phase("query"):
+                    cursor.execute(DELETE_APPOINTMENT_SQL, (appointment_id,))
+                return cursor.rowcount > 0
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _ping_sync(self):
+        conn = self.connection()
+        try:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            finally:
+                cursor.close()
+        finally:
+            conn.close()
+
+    def _warm_pool_sync(self, connections):
+        # Se toman todas a la vez (si no, el pool devolvería siempre la misma) y vuelven abiertas
+        checked_out = []
+        try:
+            for _ in range(connections):
+                checked_out.append(self.pool.connect())
+        finally:
+            for conn in checked_out:
+                conn.close()
+
+    # Data access - async driver (aiomysql)
+    async def _insert_appointment_async(self, values):
+        async with self.async_connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                with phase("query"):
+                    await cursor.execute(CREATE_APPOINTMENT_SQL, values)
+                    await cursor.nextset()
+                    return await cursor.fetchone()
+
+    async def _insert_appointments_batch_async(self, rows):
+        async with self.async_connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                with phase("query"):
+                    await conn.begin()
+                    try:
+                        generated = []
+                        for chunk in _chunks(rows, self.batch_chunk_size):
+                            await cursor.executemany(INSERT_APPOINTMENT_ROW_SQL, chunk)
+                            first_id = cursor.lastrowid
+                            await cursor.execute(
+                                SELECT_GENERATED_RANGE_SQL, _generated_range_params(first_id, len(chunk))
+                            )
+                            chunk_generated = await cursor.fetchall()
+                            _check_generated(chunk, chunk_generated)
+                            generated.extend(chunk_generated)
+                        await conn.commit()
+                        return generated
+                    except Exception:
+                        await conn.rollback()
+                        raise
+
+    async def _export_appointments_async(self, query, params, header, encode_rows):
+        """Equivalente async de _export_appointments_sync con un SSCursor de aiomysql"""
+        async with self.async_connection() as conn:
+            # Sin "async with": cerrar un SSCursor drena las filas pendientes
+            cursor = await conn.cursor(aiomysql.SSCursor)
+            unread = False
+            try:
+                await cursor.execute(query, params)
+                unread = True
+                yield header
+                while True:
+                    rows = await cursor.fetchmany(self.export_fetch_size)
+                    if not rows:
+                        break
+                    yield encode_rows(rows)
+                unread = False
+                await cursor.close()
+            finally:
+                if unread:
+                    conn.close()
+
+    async def _update_appointments_batch_async(self, items):
+        async with self.async_connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                with phase("query"):
+                    await conn.begin()
+                    try:
+                        found = []
+                        rows = {}
+                        for chunk in _chunks(items, self.batch_chunk_size):
+                            sql, params = _build_batch_update_sql(chunk)
+                            await cursor.execute(sql, params)
+                            found.append(cursor.rowcount > 0)
+                            for _ in range(len(chunk) - 1):
+                                await cursor.nextset()
+                                found.append(cursor.rowcount > 0)
+                            await cursor.nextset()
+                            rows.update((row["id"], row) for row in await cursor.fetchall())
+                        await conn.commit()
+                        return found, rows
+                    except Exception:
+                        await conn.rollback()
+                        raise
+
+    async def _load_availability_async(self, since):
+        async with self.async_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(SELECT_DOCTORS_SQL)
+                doctors = await cursor.fetchall()
+                await cursor.execute(SELECT_BOOKED_SQL, (since,))
+                return doctors, await cursor.fetchall()
+
+    async def _list_appointments_async(self, query, params, dictionary=True):
+        async with self.async_connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor if dictionary else aiomysql.Cursor) as cursor:
+                with phase("query"):
+                    await cursor.execute(query, params)
+                with phase("fetch"):
+                    return await cursor.fetchall()
+
+    async def _select_appointment_async(self, appointment_id):
+        async with self.async_connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                with phase("query"):
+                    await cursor.execute(SELECT_APPOINTMENT_SQL, (appointment_id,))
+                with phase("fetch"):
+                    return await cursor.fetchone()
+
+    async def _select_appointment_version_async(self, appointment_id):
+        async with self.async_connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                with phase("query"):
+                    await cursor.execute(SELECT_APPOINTMENT_VERSION_SQL, (appointment_id,))
+                with phase("fetch"):
+                    return await cursor.fetchone()
+
+    async def _update_appointment_async(self, appointment_id, changes):
+        if not changes:
+            return await self._select_appointment_async(appointment_id)
+        async with self.async_connection() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                params = (*changes.values(), appointment_id, appointment_id)
+                with phase("query"):
+                    await cursor.execute(_build_update_sql(changes), params)
+                    matched = cursor.rowcount
+                    await cursor.nextset()
+                    row = await cursor.fetchone()
+                return row if matched else None
+
+    async def _delete_appointment_async(self, appointment_id):
+        async with self.async_connection() as conn:
+            async with conn.cursor() as cursor:
+                with phase("query"):
+                    await cursor.execute(DELETE_APPOINTMENT_SQL, (appointment_id,))
+                return cursor.rowcount > 0
+
+    async def _ping_async(self):
+        async with self.async_connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT 1")
+                await cursor.fetchall()
+
+    async def _warm_pool_async(self, connections):
+        checked_out = []
+        try:
+            for _ in range(connections):
+                checked_out.append(await self.async_pool.acquire())
+        finally:
+            for conn in checked_out:
+                self.async_pool.release(conn)
+
+    # AppointmentRepository
+    async def warm_up(self, connections):
+        await self._run(self._warm_pool_sync, self._warm_pool_async, min(connections, self.pool_size))
+
+    async def ping(self):
+        await self._run(self._ping_sync, self._ping_async)
+
+    async def create(self, values):
+        with _double_booking_errors():
+            return await self._run(self._insert_appointment_sync, self._insert_appointment_async, values)
+
+    async def create_many(self, rows):
+        with _double_booking_errors():
+            return await self._run(
+                self._insert_appointments_batch_sync, self._insert_appointments_batch_async, rows
+            )
+
+    async def get(self, appointment_id):
+        return await self._run(self._select_appointment_sync, self._select_appointment_async, appointment_id)
+
+    async def get_version(self, appointment_id):
+        return await self._run(
+            self._select_appointment_version_sync, self._select_appointment_version_async, appointment_id
+        )
+
+    async def list(self, columns, filters, cursor, limit):
+        query, params = build_list_query(columns, filters, cursor, limit)
+        return await self._run(self._list_appointments_sync, self._list_appointments_async, query, params)
+
+    async def list_rows(self, columns, filters, cursor, limit):
+        query, params = build_list_query(columns, filters, cursor, limit)
+        return await self._run(
+            self._list_appointments_sync, self._list_appointments_async, query, params, False
+        )
+
+    async def list_version(self, filters, cursor, limit):
+        query, params = build_list_version_query(filters, cursor, limit)
+        rows = await self._run(self._list_appointments_sync, self._list_appointments_async, query, params)
+        return rows[0]
+
+    async def update(self, appointment_id, changes):
+        with _double_booking_errors():
+            return await self._run(
+                self._update_appointment_sync, self._update_appointment_async, appointment_id, changes
+            )
+
+    async def update_many(self, items):
+        with _double_booking_errors():
+            return await self._run(
+                self._update_appointments_batch_sync, self._update_appointments_batch_async, items
+            )
+
+    async def delete(self, appointment_id):
+        return await self._run(self._delete_appointment_sync, self._delete_appointment_async, appointment_id)
+
+    async def export(self, columns, filters, header, encode_rows):
+        query, params = build_filtered_select(columns, filters)
+        if self.mode == "async":
+            chunks = self._export_appointments_async(query, params, header, encode_rows)
+            first = await chunks.__anext__()
+            return _prepend_async(first, chunks)
+        chunks = self._export_appointments_sync(query, params, header, encode_rows)
+        first = await run_in_threadpool(next, chunks)
+        # Starlette itera los generadores sync en el threadpool, un chunk por vez
+        return itertools.chain([first], chunks)
+
+    async def load_availability(self, since):
+        return await self._run(self._load_availability_sync, self._load_availability_async, since)
@@ -0,0 +1,164 @@
+"""Desglose por fases de cada petición y perfilador por muestreo bajo demanda.
+
+Fases: el tiempo de una petición se reparte en
+- connect: esperar una conexión del pool,
+- query: ejecutar las sentencias (y, en las escrituras, leer su resultado),
+- fetch: leer las filas de una consulta,
+- model: construir los modelos Pydantic de la respuesta,
+- serialize: codificar la respuesta a JSON.
+
+El middleware de métricas (request_metrics.py) abre un acumulador por petición
+y, al terminar, publica cada fase en un histograma por endpoint. phase() fuera de una petición (tareas de fondo,
+tests) no mide nada. El acumulador viaja en un ContextVar, que run_in_threadpool
+copia al hilo del driver sync, así que las fases medidas allí también cuentan.
+
+Perfilador: SamplingProfiler toma muestras de la pila de todos los hilos cada
+pocos milisegundos durante las próximas N peticiones, y las agrega en formato
+"collapsed stacks" (una línea "raíz;...;hoja cuenta" por pila), que leen
+flamegraph.pl, speedscope e inferno. Desactivado solo cuesta una comparación
+por petición.
+"""
+import os
+import sys
+import threading
+import time
+from contextvars import ContextVar
+
+PHASES = ("connect", "query", "fetch", "model", "serialize")
+
+_request_phases = ContextVar("request_phases", default=None)
+
+
+def start_request_phases():
+    """Abre el acumulador {fase: segundos} de la petición en curso; devuelve (acumulador, token)"""
+    timings = {}
+    return timings, _request_phases.set(timings)
+
+
+def end_request_phases(token):
+    _request_phases.reset(token)
+
+
+def request_phases():
+    """Copia de las fases acumuladas hasta ahora por la petición en curso, o None fuera de una"""
+    timings = _request_phases.get()
+    return dict(timings) if timings is not None else None
+
+
+def add_phase(name, seconds):
+    """Suma seconds a la fase, para tiempos ya medidos (p. ej. la espera del pool)"""
+    timings = _request_phases.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+class phase:
+    """with phase("query"): ... suma la duración del bloque a la fase de la petición en curso"""
+
+    # Clase y no @contextmanager: sin generador por bloque, que es lo que más pesa fuera de una petición
+    __slots__ = ("name", "timings", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.timings = _request_phases.get()
+        if self.timings is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timings is not None:
+            self.timings[self.name] = self.timings.get(self.name, 0.0) + time.perf_counter() - self.start
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Muestrea las pilas de todos los hilos mientras quedan peticiones por perfilar"""
+
+    def __init__(self, interval=0.005, max_depth=128):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.output = None
+        self._remaining = 0
+        self._requests = 0
+        self._samples = 0
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, requests, interval=None, output=None):
+        """Empieza a muestrear hasta que terminen requests peticiones; False si ya estaba activo"""
+        with self._lock:
+            if self.active:
+                return False
+            if interval is not None:
+                self.interval = interval
+            self.output = output
+            self._requests = requests
+            self._remaining = requests
+            self._samples = 0
+            self._counts = {}
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def stop(self, wait=False):
+        self._remaining = 0
+        self._stop.set()
+        thread = self._thread
+        if wait and thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def request_finished(self):
+        """Llamado por cada petición medida; sin perfil activo es una sola comparación"""
+        if self._remaining:
+            with self._lock:
+                self._remaining -= 1
+                if self._remaining <= 0:
+                    self._stop.set()
+
+    def status(self):
+        return {
+            "active": self.active,
+            "requests": self._requests,
+            "remaining_requests": self._remaining,
+            "interval_ms": round(self.interval * 1000, 3),
+            "samples": self._samples,
+            "stacks": len(self._counts),
+        }
+
+    def collapsed(self):
+        """Pilas agregadas, una por línea: "hilo;raíz;...;hoja cuenta", de más a menos frecuente"""
+        counts = sorted(self._counts.items(), key=lambda item: (-item[1], item[0]))
+        return "".join(f"{stack} {count}\n" for stack, count in counts)
+
+    def _sample(self, own_ident):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, f"thread-{ident}"))
+            key = ";".join(reversed(stack))
+            self._counts[key] = self._counts.get(key, 0) + 1
+        self._samples += 1
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            self._sample(own_ident)
+        if self.output:
+            with open(self.output, "w", encoding="utf-8") as f:
+                f.write(self.collapsed())
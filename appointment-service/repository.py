@@ -0,0 +1,154 @@
+"""Acceso a datos de appointment-service detrás de una interfaz común.
+
+Los endpoints solo hablan con un AppointmentRepository. DB_BACKEND elige la
+implementación:
+
+- "mysql" (MySQLRepository, en mysql_repository.py): el servidor MySQL, con
+  mysql-connector en el threadpool o aiomysql según DB_MODE.
+- "sqlite" (SQLiteRepository, en sqlite_repository.py): SQLite embebido, sin
+  servidor; para tests rápidos, benchmarks y despliegues edge.
+
+Las filas se devuelven como dicts con las columnas de ``appointments`` y las
+fechas como datetime, igual en las dos implementaciones. list_rows devuelve
+tuplas, para el camino rápido de serialización (FAST_JSON_ENDPOINTS en main.py).
+"""
+
+# Columnas que se pueden pedir con ?fields= y filtros por igualdad de GET /appointments/
+APPOINTMENT_COLUMNS = (
+    "id", "patient_name", "patient_email", "doctor_name", "doctor_specialty",
+    "appointment_time", "status", "notes", "created_at", "updated_at",
+)
+LIST_EQUALITY_FILTERS = ("doctor_name", "doctor_specialty", "status", "patient_email")
+# Orden de los valores de create/create_many
+APPOINTMENT_WRITE_COLUMNS = (
+    "patient_name", "patient_email", "doctor_name", "doctor_specialty",
+    "appointment_time", "status", "notes",
+)
+
+# Clave única de migrations/002 (y su equivalente en SQLite): un médico, una cita activa por hora
+DOUBLE_BOOKING_KEY = "uq_appointments_doctor_active_slot"
+
+
+class DoubleBookingError(Exception):
+    """El médico ya tiene una cita activa que empieza a esa hora"""
+
+
+class BatchReadBackError(Exception):
+    """No se pudieron leer las filas creadas por un lote; la transacción se deshizo"""
+
+
+class AppointmentRepository:
+    """Operaciones sobre appointments; todas son corrutinas"""
+
+    async def open(self):
+        """Al arrancar el servicio: pools, esquema, migraciones"""
+
+    async def close(self):
+        pass
+
+    async def warm_up(self, connections):
+        """Antes de aceptar tráfico: deja abiertas hasta connections conexiones en el pool"""
+
+    async def ping(self):
+        """Toma una conexión y ejecuta una consulta trivial; lanza una excepción si no puede"""
+        raise NotImplementedError
+
+    def in_use(self):
+        """Conexiones prestadas ahora mismo; al apagar se espera a que vuelvan todas"""
+        return 0
+
+    async def create(self, values):
+        """values en el orden de APPOINTMENT_WRITE_COLUMNS; devuelve {id, created_at, updated_at}"""
+        raise NotImplementedError
+
+    async def create_many(self, rows):
+        """Inserta rows en una transacción; columnas generadas de cada una, en el mismo orden"""
+        raise NotImplementedError
+
+    async def get(self, appointment_id):
+        """La fila completa, o None"""
+        raise NotImplementedError
+
+    async def get_version(self, appointment_id):
+        """{updated_at} de la cita, o None; para validar un ETag sin leer la fila"""
+        raise NotImplementedError
+
+    async def list(self, columns, filters, cursor, limit):
+        """Página por keyset (ver build_list_query), con una fila de más si hay siguiente página"""
+        raise NotImplementedError
+
+    async def list_rows(self, columns, filters, cursor, limit):
+        """Como list, pero cada fila es una tupla con los valores de columns, en ese orden"""
+        rows = await self.list(columns, filters, cursor, limit)
+        return [tuple(row[c] for c in columns) for row in rows]
+
+    async def list_version(self, filters, cursor, limit):
+        """{max_updated_at, row_count} de la página, sin leer sus filas"""
+        raise NotImplementedError
+
+    async def update(self, appointment_id, changes):
+        """Aplica changes ({columna: valor}); devuelve la fila resultante, o None si no existe"""
+        raise NotImplementedError
+
+    async def update_many(self, items):
+        """Aplica [(id, cambios)] en una transacción; devuelve (encontrado por ítem, {id: fila})"""
+        raise NotImplementedError
+
+    async def delete(self, appointment_id):
+        """True si la cita existía"""
+        raise NotImplementedError
+
+    async def export(self, columns, filters, header, encode_rows):
+        """Iterable (sync o async) de chunks para un StreamingResponse.
+
+        La consulta ya se ejecutó cuando vuelve: los errores se reportan antes
+        de enviar el status. El primer chunk es header.
+        """
+        raise NotImplementedError
+
+    async def load_availability(self, since):
+        """([(doctor, specialty)], [(id, doctor, specialty, time, status)] activas desde since)"""
+        raise NotImplementedError
+
+
+# Consultas de listado, comunes a los backends (placeholders %s; SQLite los traduce)
+def build_filtered_select(columns, filters, cursor=None):
+    """SELECT filtrado y ordenado por (created_at, id), más reciente primero"""
+    conditions = []
+    params = []
+    for field in LIST_EQUALITY_FILTERS:
+        if filters.get(field) is not None:
+            conditions.append(f"{field} = %s")
+            params.append(filters[field])
+    if filters.get("appointment_time_from") is not None:
+        conditions.append("appointment_time >= %s")
+        params.append(filters["appointment_time_from"])
+    if filters.get("appointment_time_to") is not None:
+        conditions.append("appointment_time < %s")
+        params.append(filters["appointment_time_to"])
+    if cursor is not None:
+        created_at, appointment_id = cursor
+        conditions.append("(created_at < %s OR (created_at = %s AND id < %s))")
+        params.extend([created_at, created_at, appointment_id])
+
+    query = f"SELECT {', '.join(columns)} FROM appointments"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY created_at DESC, id DESC"
+    return query, params
+
+
+def build_list_query(columns, filters, cursor, limit, lookahead=1):
+    """Keyset pagination sobre (created_at, id), más reciente primero"""
+    query, params = build_filtered_select(columns, filters, cursor)
+    # Se pide una fila extra para saber si hay una página siguiente
+    return query + " LIMIT %s", (*params, limit + lookahead)
+
+
+def build_list_version_query(filters, cursor, limit):
+    """MAX(updated_at) y número de filas de una página, sin traer las filas"""
+    page_query, params = build_list_query(("updated_at",), filters, cursor, limit, lookahead=0)
+    return (
+        f"SELECT MAX(updated_at) AS max_updated_at, COUNT(*) AS row_count FROM ({page_query}) AS page",
+        params,
+    )
@@ -0,0 +1,212 @@
+"""Métricas y log de acceso de cada petición, en un solo middleware ASGI.
+
+Sustituye a prometheus-fastapi-instrumentator y al decorador track_metrics:
+el método y la ruta salen de la petición (scope) y no del nombre de la
+función, y los hijos de cada métrica (.labels()) se resuelven una vez por
+ruta al arrancar, no en cada petición. También abre el acumulador de fases
+(profiling.py), así que cubre la validación y la serialización de FastAPI.
+
+Log de acceso: una línea por petición ("GET /appointments/{id} 200 1.2ms"),
+limitada a rate líneas por segundo; las que no caben se cuentan y se resumen
+en una línea al empezar el segundo siguiente.
+
+Varios workers: con PROMETHEUS_MULTIPROC_DIR definido antes de arrancar,
+prometheus_client guarda los valores en ficheros de ese directorio y
+metrics_registry() los agrega en /metrics (modo multiproceso de
+prometheus_client). Los gauges calculados con una función no se guardan en
+esos ficheros: LiveGauges los refresca desde cada worker.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from prometheus_client import REGISTRY, CollectorRegistry
+from prometheus_client import multiprocess
+
+from profiling import end_request_phases, start_request_phases
+
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+# Métodos que se etiquetan tal cual; el resto cuenta como "other" (cardinalidad acotada)
+KNOWN_METHODS = frozenset({"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"})
+UNMATCHED_ENDPOINT = "unmatched"
+
+
+def metrics_registry():
+    """Registro para /metrics: el del proceso, o el agregado de todos los workers"""
+    if not MULTIPROCESS:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def mark_process_dead(pid=None):
+    """Al salir un worker (por defecto, este proceso): sus gauges "live*" dejan de contar"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+class LiveGauges:
+    """Gauges cuyo valor calcula una función (uso del pool, ratio de aciertos de caché...).
+
+    En un proceso usa Gauge.set_function: se evalúa al leer /metrics. En
+    multiproceso /metrics lee ficheros, así que refresh() los escribe cada
+    interval segundos desde el worker (run() en el lifespan).
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._gauges = []
+
+    def add(self, gauge, func):
+        if MULTIPROCESS:
+            self._gauges.append((gauge, func))
+        else:
+            gauge.set_function(func)
+
+    def refresh(self):
+        for gauge, func in self._gauges:
+            try:
+                gauge.set(func())
+            except Exception:
+                logging.getLogger(__name__).debug("Could not refresh gauge %s", gauge, exc_info=True)
+
+    async def run(self):
+        while self._gauges:
+            self.refresh()
+            await asyncio.sleep(self.interval)
+
+
+class RateLimitedLog:
+    """Como mucho rate líneas por segundo; las demás se cuentan y se resumen"""
+
+    def __init__(self, logger, rate):
+        self.logger = logger
+        self.rate = rate
+        self._window = 0
+        self._emitted = 0
+        self._suppressed = 0
+
+    def log(self, level, msg, *args):
+        if self.rate <= 0 or not self.logger.isEnabledFor(level):
+            return
+        window = int(time.monotonic())
+        if window != self._window:
+            if self._suppressed:
+                self.logger.info(
+                    "%d request log lines suppressed (limit %d/s)", self._suppressed, self.rate
+                )
+            self._window = window
+            self._emitted = 0
+            self._suppressed = 0
+        if self._emitted < self.rate:
+            self._emitted += 1
+            self.logger.log(level, msg, *args)
+        else:
+            self._suppressed += 1
+
+
+class _RouteMetrics:
+    """Hijos de las métricas de una (ruta, método), resueltos una sola vez"""
+
+    __slots__ = ("method", "endpoint", "route", "latency", "phases", "_count_metric", "_counts")
+
+    def __init__(self, method, endpoint, route, count, latency, phase_latency, phases):
+        self.method = method
+        self.endpoint = endpoint
+        self.route = route
+        self.latency = latency.labels(method=method, endpoint=endpoint)
+        self.phases = {name: phase_latency.labels(endpoint=endpoint, phase=name) for name in phases}
+        self._count_metric = count
+        self._counts = {}
+        self.count(200)
+
+    def count(self, status):
+        child = self._counts.get(status)
+        if child is None:
+            child = self._counts[status] = self._count_metric.labels(
+                method=self.method, endpoint=self.endpoint, http_status=str(status)
+            )
+        return child
+
+
+class RequestMetricsMiddleware:
+    """Cuenta, mide y registra cada petición HTTP fuera de excluded_prefixes.
+
+    count: Counter [method, endpoint, http_status]; latency: Histogram [method,
+    endpoint]; phase_latency: Histogram [endpoint, phase]. endpoint es el nombre
+    de la ruta (el de la función del endpoint en FastAPI). on_request_end se
+    llama al terminar cada petición medida (el perfilador cuenta peticiones).
+    """
+
+    def __init__(self, app, routes, count, latency, phase_latency, phases, log=None,
+                 on_request_end=None, excluded_prefixes=()):
+        self.app = app
+        self.log = log
+        self.on_request_end = on_request_end
+        self.excluded_prefixes = tuple(excluded_prefixes)
+        self._metrics = (count, latency, phase_latency, phases)
+        self._by_route = {}
+        for route in routes:
+            if getattr(route, "path", "").startswith(self.excluded_prefixes):
+                continue
+            for method in getattr(route, "methods", None) or ():
+                self._resolve(route, method)
+        self._unmatched = {}
+
+    def _resolve(self, route, method):
+        # Por identidad: las rutas de Starlette definen __eq__ y no son hashables
+        key = (id(route), method)
+        metrics = self._by_route.get(key)
+        if metrics is None:
+            name = getattr(route, "name", None) or UNMATCHED_ENDPOINT
+            path = getattr(route, "path", None) or name
+            metrics = self._by_route[key] = _RouteMetrics(method, name, path, *self._metrics)
+        return metrics
+
+    def _unmatched_metrics(self, method):
+        metrics = self._unmatched.get(method)
+        if metrics is None:
+            metrics = self._unmatched[method] = _RouteMetrics(
+                method, UNMATCHED_ENDPOINT, UNMATCHED_ENDPOINT, *self._metrics
+            )
+        return metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.excluded_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        timings, phases_token = start_request_phases()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            end_request_phases(phases_token)
+            method = scope["method"]
+            if method not in KNOWN_METHODS:
+                method = "other"
+            route = scope.get("route")
+            metrics = self._resolve(route, method) if route is not None else self._unmatched_metrics(method)
+            metrics.count(status).inc()
+            metrics.latency.observe(elapsed)
+            for name, seconds in timings.items():
+                child = metrics.phases.get(name)
+                if child is not None:
+                    child.observe(seconds)
+            if self.on_request_end is not None:
+                self.on_request_end()
+            if self.log is not None:
+                level = logging.ERROR if status >= 500 else logging.WARNING if status >= 400 else logging.INFO
+                self.log.log(level, "%s %s %d %.1fms", method, metrics.route, status, elapsed * 1000)
@@ -0,0 +1,194 @@
+"""Caché de lectura (read-through) para GET /appointments/ y GET /appointments/{id}.
+
+Dos tipos de entrada:
+
+- por id: ``appointments:id:<id>``; cada escritura borra la de su cita.
+- por forma de consulta: ``appointments:list:<generación>:<hash>``, donde el hash
+  cubre limit, cursor, filtros y fields. Cualquier escritura puede cambiar
+  cualquier listado, así que las escrituras cambian la generación y las
+  entradas anteriores dejan de leerse (las retira el TTL o el LRU).
+
+La generación también evita guardar datos viejos: una lectura que empezó antes
+de una escritura no se guarda si la generación cambió mientras tanto.
+
+El backend es enchufable: InMemoryCache (LRU en el proceso, por defecto) o
+RedisCache (compartido entre réplicas/workers).
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger("appointment-service.cache")
+
+
+class CacheBackend:
+    """Interfaz de los backends; los valores son JSON serializable"""
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    async def delete(self, key):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class InMemoryCache(CacheBackend):
+    """LRU acotado a max_entries con expiración por entrada"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    async def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    async def set(self, key, value, ttl=None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisCache(CacheBackend):
+    """Backend compartido sobre un cliente redis.asyncio (o uno compatible)"""
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        # Dependencia opcional: solo hace falta con CACHE_BACKEND=redis
+        import redis.asyncio as redis
+
+        return cls(redis.from_url(url))
+
+    async def get(self, key):
+        raw = await self.client.get(key)
+        return None if raw is None else json.loads(raw)
+
+    async def set(self, key, value, ttl=None):
+        px = None if ttl is None else max(1, int(ttl * 1000))
+        await self.client.set(key, json.dumps(value), px=px)
+
+    async def delete(self, key):
+        await self.client.delete(key)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class ResponseCache:
+    """Claves, generación e invalidación sobre un backend; backend=None la desactiva.
+
+    Un fallo del backend nunca hace fallar la petición: se registra y se trata
+    como un miss. ``on_lookup(kind, result)`` recibe cada consulta ("hit",
+    "miss" o "error") para exportarla como métrica.
+    """
+
+    def __init__(self, backend, ttl, list_ttl, namespace="appointments", on_lookup=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.list_ttl = list_ttl
+        self.namespace = namespace
+        self.on_lookup = on_lookup
+        self.hits = 0
+        self.lookups = 0
+        self._generation_key = f"{namespace}:list-generation"
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def hit_ratio(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def appointment_key(self, appointment_id):
+        return f"{self.namespace}:id:{appointment_id}"
+
+    def list_key(self, generation, shape):
+        raw = json.dumps(shape, sort_keys=True, default=str).encode()
+        return f"{self.namespace}:list:{generation}:{hashlib.sha1(raw).hexdigest()}"
+
+    async def generation(self):
+        """Generación actual de los listados; se crea si no existe (o fue desalojada)"""
+        if not self.enabled:
+            return None
+        try:
+            current = await self.backend.get(self._generation_key)
+            if current is None:
+                current = uuid.uuid4().hex
+                await self.backend.set(self._generation_key, current)
+            return current
+        except Exception as e:
+            logger.warning("Response cache unavailable: %s", str(e))
+            return None
+
+    async def get(self, kind, key):
+        if not self.enabled or key is None:
+            return None
+        try:
+            value = await self.backend.get(key)
+            result = "miss" if value is None else "hit"
+        except Exception as e:
+            logger.warning("Response cache read failed: %s", str(e))
+            value, result = None, "error"
+        self.lookups += 1
+        if result == "hit":
+            self.hits += 1
+        if self.on_lookup is not None:
+            self.on_lookup(kind, result)
+        return value
+
+    async def set(self, kind, key, value, generation):
+        """Guarda value salvo que una escritura haya cambiado la generación desde la lectura"""
+        if not self.enabled or key is None or generation is None:
+            return
+        try:
+            if await self.backend.get(self._generation_key) != generation:
+                return
+            await self.backend.set(key, value, self.list_ttl if kind == "list" else self.ttl)
+        except Exception as e:
+            logger.warning("Response cache write failed: %s", str(e))
+
+    async def invalidate(self, *appointment_ids):
+        """Tras una escritura: nueva generación de listados y fuera las entradas de las citas"""
+        if not self.enabled:
+            return
+        try:
+            await self.backend.set(self._generation_key, uuid.uuid4().hex)
+            for appointment_id in appointment_ids:
+                await self.backend.delete(self.appointment_key(appointment_id))
+        except Exception as e:
+            logger.warning("Response cache invalidation failed: %s", str(e))
+
+    async def close(self):
+        if self.enabled:
+            await self.backend.close()
@@ -0,0 +1,305 @@
+"""Servidor de producción: N workers de uvicorn sobre un mismo socket.
+
+    python serve.py
+
+El proceso maestro abre el socket, importa la aplicación (PRELOAD_APP: los
+workers heredan main ya importado y comparten sus páginas de memoria) y hace
+fork de WEB_CONCURRENCY workers, que aceptan conexiones del mismo socket. Si
+un worker muere, el maestro lo sustituye; si no llega a arrancar (falla el
+lifespan), el maestro para todo en vez de reintentar en bucle.
+
+Apagado (SIGTERM o SIGINT al maestro): cada worker recibe SIGTERM, deja de
+aceptar conexiones, espera hasta GRACEFUL_TIMEOUT a las peticiones en curso y
+ejecuta el lifespan de main, que espera a que vuelvan al pool las conexiones
+prestadas (DB_DRAIN_TIMEOUT_SECONDS) antes de cerrarlo. Pasado ese margen, el
+maestro mata a los que queden con SIGKILL.
+
+WEB_CONCURRENCY=auto usa las CPUs disponibles para el proceso: las de su
+afinidad, limitadas por la cuota de CPU del cgroup (contenedores con --cpus).
+HTTP_LOOP y HTTP_PARSER en auto eligen uvloop y httptools si están instalados.
+Con más de un worker y sin PROMETHEUS_MULTIPROC_DIR, las métricas van a un
+directorio temporal para que /metrics agregue las de todos los workers. La
+caché de lecturas en memoria es de cada proceso: con varios workers, un worker
+serviría datos viejos tras una escritura hecha en otro, así que CACHE_BACKEND
+memory (el valor por defecto) pasa a none; para cachear, CACHE_BACKEND=redis.
+El índice de horarios también es de cada proceso y no se puede desactivar (lo
+usan los endpoints /availability): con varios workers se reconstruye cada
+AVAILABILITY_WORKERS_REFRESH_SECONDS como mucho.
+"""
+import glob
+import importlib.util
+import logging
+import math
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+logger = logging.getLogger("appointment-service.serve")
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "80"))
+WEB_CONCURRENCY = os.getenv("WEB_CONCURRENCY", "auto")
+HTTP_LOOP = os.getenv("HTTP_LOOP", "auto")  # auto, uvloop o asyncio
+HTTP_PARSER = os.getenv("HTTP_PARSER", "auto")  # auto, httptools o h11
+PRELOAD_APP = os.getenv("PRELOAD_APP", "true").lower() == "true"
+GRACEFUL_TIMEOUT = float(os.getenv("GRACEFUL_TIMEOUT", "30"))  # peticiones en curso al apagar
+KEEPALIVE = int(os.getenv("KEEPALIVE", "5"))
+BACKLOG = int(os.getenv("BACKLOG", "2048"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
+# El middleware de métricas ya escribe un log de acceso limitado (REQUEST_LOG_RATE)
+ACCESS_LOG = os.getenv("ACCESS_LOG", "false").lower() == "true"
+# Tras GRACEFUL_TIMEOUT, el lifespan aún espera a las conexiones prestadas del pool
+KILL_TIMEOUT = float(os.getenv(
+    "KILL_TIMEOUT", str(GRACEFUL_TIMEOUT + float(os.getenv("DB_DRAIN_TIMEOUT_SECONDS", "10")) + 5)
+))
+# Con varios workers, tope del intervalo de reconstrucción del índice de horarios
+AVAILABILITY_WORKERS_REFRESH_SECONDS = float(os.getenv("AVAILABILITY_WORKERS_REFRESH_SECONDS", "5"))
+
+APP = "main:app"
+# Código de salida de un worker que no llegó a arrancar (el mismo que usa uvicorn.run)
+WORKER_BOOT_ERROR = 3
+
+
+def cgroup_cpu_limit(path="/sys/fs/cgroup/cpu.max"):
+    """CPUs que permite la cuota del cgroup v2 (redondeando hacia arriba), o None sin límite"""
+    try:
+        with open(path) as f:
+            quota, period = f.read().split()[:2]
+    except (OSError, ValueError):
+        return None
+    if quota == "max":
+        return None
+    return max(1, math.ceil(int(quota) / int(period)))
+
+
+def available_cpus():
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    return min(cpus, limit) if limit else cpus
+
+
+def worker_count(value=WEB_CONCURRENCY):
+    if value == "auto":
+        return available_cpus()
+    return max(1, int(value))
+
+
+def _installed(module):
+    return importlib.util.find_spec(module) is not None
+
+
+def resolve_loop(value=HTTP_LOOP):
+    if value != "auto":
+        return value
+    return "uvloop" if _installed("uvloop") else "asyncio"
+
+
+def resolve_http(value=HTTP_PARSER):
+    if value != "auto":
+        return value
+    return "httptools" if _installed("httptools") else "h11"
+
+
+def prepare_metrics_dir(workers):
+    """Directorio de métricas multiproceso limpio; devuelve el temporal creado (a borrar al salir), si lo hay.
+
+    Se fija antes de importar main: prometheus_client elige el modo al importarse.
+    """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        # Los ficheros de una ejecución anterior sumarían contadores de procesos que ya no existen
+        for stale in glob.glob(os.path.join(path, "*.db")):
+            os.remove(stale)
+        return None
+    if workers == 1:
+        return None
+    path = tempfile.mkdtemp(prefix="appointment-service-metrics-")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    return path
+
+
+def resolve_cache_backend(workers):
+    """Desactiva la caché en memoria si hay más de un worker; devuelve el backend que usará main.
+
+    Se fija antes de importar main, que lee CACHE_BACKEND al importarse.
+    """
+    backend = os.environ.get("CACHE_BACKEND", "memory").lower()
+    if workers > 1 and backend == "memory":
+        logger.warning(
+            "CACHE_BACKEND=memory is per process and %d workers would serve stale reads after writes "
+            "made by another worker; caching disabled (use CACHE_BACKEND=redis to cache)",
+            workers,
+        )
+        backend = os.environ["CACHE_BACKEND"] = "none"
+    return backend
+
+
+def resolve_availability_refresh(workers):
+    """Acorta la reconstrucción del índice de horarios si hay más de un worker; devuelve el intervalo de main.
+
+    Cada worker solo ve al momento sus propias reservas; las de los demás le llegan al
+    reconstruir. Se fija antes de importar main, que lee AVAILABILITY_REFRESH_SECONDS al importarse.
+    """
+    refresh = float(os.environ.get("AVAILABILITY_REFRESH_SECONDS", "300"))
+    if workers > 1 and not 0 < refresh <= AVAILABILITY_WORKERS_REFRESH_SECONDS:
+        logger.warning(
+            "The availability index is per process and %d workers would miss each other's bookings until "
+            "the next rebuild (AVAILABILITY_REFRESH_SECONDS=%g); rebuilding every %gs instead",
+            workers, refresh, AVAILABILITY_WORKERS_REFRESH_SECONDS,
+        )
+        refresh = AVAILABILITY_WORKERS_REFRESH_SECONDS
+        os.environ["AVAILABILITY_REFRESH_SECONDS"] = str(refresh)
+    return refresh
+
+
+def bind_socket(host=HOST, port=PORT):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock):
+    """Sirve app en el socket hasta recibir SIGTERM/SIGINT; devuelve el código de salida"""
+    import uvicorn
+
+    config = uvicorn.Config(
+        app,
+        loop=resolve_loop(),
+        http=resolve_http(),
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        timeout_keep_alive=KEEPALIVE,
+        log_level=LOG_LEVEL,
+        access_log=ACCESS_LOG,
+    )
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+    return 0 if server.started else WORKER_BOOT_ERROR
+
+
+class Supervisor:
+    """Arranca los workers con fork, sustituye a los que mueren y los apaga ordenadamente"""
+
+    def __init__(self, target, workers, kill_timeout=KILL_TIMEOUT, on_worker_exit=None):
+        self.target = target
+        self.workers = workers
+        self.kill_timeout = kill_timeout
+        self.on_worker_exit = on_worker_exit
+        self.pids = set()
+        self._stop_signal = None
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = WORKER_BOOT_ERROR
+            try:
+                for signum in (signal.SIGTERM, signal.SIGINT):
+                    signal.signal(signum, signal.SIG_DFL)
+                code = self.target()
+            except BaseException:
+                logger.exception("Worker %d crashed", os.getpid())
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.pids.add(pid)
+        logger.info("Started worker %d", pid)
+        return pid
+
+    def _handle_signal(self, signum, frame):
+        self._stop_signal = signum
+
+    def _reap(self):
+        """[(pid, código de salida)] de los workers que han terminado, sin bloquear"""
+        exited = []
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in self.pids:
+                self.pids.discard(pid)
+                exited.append((pid, os.waitstatus_to_exitcode(status)))
+                if self.on_worker_exit is not None:
+                    self.on_worker_exit(pid)
+        return exited
+
+    def run(self):
+        """Bucle del maestro; devuelve su código de salida"""
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._handle_signal)
+        for _ in range(self.workers):
+            self.spawn()
+        code = 0
+        while self._stop_signal is None:
+            for pid, exit_code in self._reap():
+                if exit_code == WORKER_BOOT_ERROR:
+                    logger.error("Worker %d failed to boot; shutting down", pid)
+                    code = WORKER_BOOT_ERROR
+                    self._stop_signal = signal.SIGTERM
+                    break
+                logger.warning("Worker %d exited with code %d; starting a new one", pid, exit_code)
+                self.spawn()
+            time.sleep(0.1)
+        logger.info("Stopping %d worker(s) (signal %d)", len(self.pids), self._stop_signal)
+        self.stop()
+        return code
+
+    def stop(self):
+        for pid in self.pids:
+            os.kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.kill_timeout
+        while self.pids and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        for pid in self.pids:
+            logger.warning("Worker %d did not stop within %ss; killing it", pid, self.kill_timeout)
+            os.kill(pid, signal.SIGKILL)
+        while self.pids:
+            pid, _ = os.waitpid(-1, 0)
+            self.pids.discard(pid)
+            if self.on_worker_exit is not None:
+                self.on_worker_exit(pid)
+
+
+def serve():
+    logging.basicConfig(level=logging.INFO)
+    workers = worker_count()
+    metrics_dir = prepare_metrics_dir(workers)
+    cache_backend = resolve_cache_backend(workers)
+    availability_refresh = resolve_availability_refresh(workers)
+    logger.info(
+        "Serving %s on %s:%d with %d worker(s), loop=%s, http=%s, preload=%s, cache=%s, availability refresh=%gs",
+        APP, HOST, PORT, workers, resolve_loop(), resolve_http(), PRELOAD_APP, cache_backend, availability_refresh,
+    )
+    app = APP
+    if PRELOAD_APP:
+        from uvicorn.importer import import_from_string
+
+        app = import_from_string(APP)
+    sock = bind_socket()
+    try:
+        if workers == 1:
+            return run_worker(app, sock)
+        from request_metrics import mark_process_dead
+
+        return Supervisor(lambda: run_worker(app, sock), workers, on_worker_exit=mark_process_dead).run()
+    finally:
+        sock.close()
+        if metrics_dir is not None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(serve())
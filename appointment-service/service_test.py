@@ -1,10 +1,247 @@
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from fastapi.testclient import TestClient
-from main import app, AppointmentCreate, AppointmentUpdate
+from main import app, AppointmentCreate, AppointmentUpdate, encode_cursor, decode_cursor
+import main
+import mysql_repository
+import asyncio
 import datetime
+import os
+import mysql.connector
+import migrate
+import functools
+import json
+import threading
+import time
+import pymysql
+from response_cache import InMemoryCache, RedisCache, ResponseCache
+from availability import AvailabilityIndex, WorkingSchedule, parse_working_days, parse_working_hours
+from repository import DoubleBookingError
+from mysql_repository import MySQLRepository
+from sqlite_repository import SQLiteRepository
+from prometheus_client import REGISTRY
+from profiling import PHASES, SamplingProfiler, phase, start_request_phases, end_request_phases
+from opentelemetry import trace
+from opentelemetry.sdk.trace.export import SpanExportResult
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.sampling import Decision
+from opentelemetry.trace import SpanKind, StatusCode
+from tracing import HeadTailSampler, TracedRepository, Tracing
+from request_metrics import RateLimitedLog
+import logging
+import subprocess
+import sys
+import signal
+import socket
+import sqlite3
+import serve
 
 client = TestClient(app)
+# El backend MySQL de la app (algunos tests reemplazan main.repository)
+mysql_repo = main.repository
+
+@pytest.fixture(autouse=True)
+def reset_pool():
+    # Cada test parchea mysql.connector.connect; evita reutilizar conexiones de otro test
+    mysql_repo.pool.dispose()
+    yield
+    mysql_repo.pool.dispose()
+
+@pytest.fixture(autouse=True)
+def reset_cache(monkeypatch):
+    # Caché vacía por test: las respuestas de un test no deben servirse en otro
+    cache = ResponseCache(
+        InMemoryCache(100), ttl=30, list_ttl=10, on_lookup=main.response_cache.on_lookup
+    )
+    monkeypatch.setattr(main, "response_cache", cache)
+    return cache
+
+@pytest.fixture(autouse=True)
+def reset_availability(monkeypatch):
+    # Índice sin cargar por test: un test no debe ver las citas indexadas por otro
+    monkeypatch.setattr(main, "availability_index", AvailabilityIndex(main.availability_index.schedule))
+
+@pytest.fixture
+def no_cache(monkeypatch):
+    # Para tests que necesitan que cada petición llegue a la BD
+    monkeypatch.setattr(main, "response_cache", ResponseCache(None, ttl=30, list_ttl=10))
+
+# -------------------
+# Harness: conexión MySQL falsa que registra cada viaje al servidor
+# -------------------
+class FakeCursor:
+    """Cursor falso: cada sentencia consume el siguiente resultado guionizado de la conexión"""
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = -1
+        self.lastrowid = None
+        self.with_rows = False
+        self._rows = []
+        self._pending = []
+
+    def _load(self, result):
+        self.with_rows = "rows" in result
+        self._rows = list(result.get("rows", []))
+        self.rowcount = result.get("rowcount", len(self._rows))
+        self.lastrowid = result.get("lastrowid")
+
+    def _run(self, sql, params):
+        self.conn.round_trips.append((sql, params))
+        statements = [stmt for stmt in sql.split(";") if stmt.strip()]
+        results = [self.conn.next_result() for _ in statements]
+        for result in results:
+            # {"error": exc}: el servidor rechaza la sentencia (p. ej. clave duplicada)
+            if "error" in result:
+                raise result["error"]
+        self._load(results[0])
+        self._pending = results[1:]
+        return results
+
+    def execute(self, sql, params=None, multi=False):
+        results = self._run(sql, params)
+        if multi:
+            return self._iter_results(results)
+
+    def executemany(self, sql, seq_params):
+        # Los drivers reescriben el INSERT como uno multi-fila: un solo viaje
+        self._run(sql, list(seq_params))
+
+    def _iter_results(self, results):
+        for result in results:
+            self._load(result)
+            yield self
+
+    def nextset(self):
+        if not self._pending:
+            return None
+        self._load(self._pending.pop(0))
+        return True
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+class FakeAsyncCursor(FakeCursor):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, sql, params=None):
+        self._run(sql, params)
+
+    async def executemany(self, sql, seq_params):
+        FakeCursor.executemany(self, sql, seq_params)
+
+    async def nextset(self):
+        return FakeCursor.nextset(self)
+
+    async def fetchone(self):
+        return FakeCursor.fetchone(self)
+
+    async def fetchall(self):
+        return FakeCursor.fetchall(self)
+
+    async def fetchmany(self, size):
+        return FakeCursor.fetchmany(self, size)
+
+    async def close(self):
+        pass
+
+    def __await__(self):
+        # aiomysql: "await conn.cursor(...)" además de "async with conn.cursor(...)"
+        async def cursor():
+            return self
+        return cursor().__await__()
+
+class FakeConnection:
+    """Cuenta viajes al servidor: cada execute (una sentencia o un lote) y cada COMMIT/ROLLBACK"""
+    in_transaction = False
+
+    def __init__(self, results=()):
+        self.results = list(results)
+        self.round_trips = []
+
+    def next_result(self):
+        return self.results.pop(0) if self.results else {}
+
+    def cursor(self, *args, **kwargs):
+        return FakeCursor(self)
+
+    def start_transaction(self):
+        self.round_trips.append(("START TRANSACTION", None))
+
+    def commit(self):
+        self.round_trips.append(("COMMIT", None))
+
+    def rollback(self):
+        self.round_trips.append(("ROLLBACK", None))
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+class FakeAsyncConnection(FakeConnection):
+    def cursor(self, *args, **kwargs):
+        return FakeAsyncCursor(self)
+
+    async def begin(self):
+        FakeConnection.start_transaction(self)
+
+    async def commit(self):
+        FakeConnection.commit(self)
+
+    async def rollback(self):
+        FakeConnection.rollback(self)
+
+    async def ping(self, reconnect=False):
+        pass
+
+@pytest.fixture
+def fake_db():
+    conn = FakeConnection()
+    with patch("mysql_repository.mysql.connector.connect", return_value=conn):
+        yield conn
+
+@pytest.fixture
+def fake_async_db(monkeypatch):
+    conn = FakeAsyncConnection()
+    mock_pool = MagicMock()
+    mock_pool.acquire = AsyncMock(return_value=conn)
+    mock_pool.size = 1
+    mock_pool.freesize = 1
+    monkeypatch.setattr(mysql_repo, "mode", "async")
+    monkeypatch.setattr(mysql_repo, "async_pool", mock_pool)
+    return conn
+
+FAKE_ROW = {
+    "id": 1,
+    "patient_name": "Test Patient",
+    "patient_email": "test@example.com",
+    "doctor_name": "Dr. Test",
+    "doctor_specialty": "Test",
+    "appointment_time": "2024-07-01T10:00:00",
+    "status": "scheduled",
+    "notes": None,
+    "created_at": "2024-06-13T10:00:00",
+    "updated_at": "2024-06-13T10:00:00"
+}
+
+def _generated(row):
+    return {"rows": [{k: row[k] for k in ("id", "created_at", "updated_at")}]}
 
 # -------------------
 # Model tests
@@ -60,7 +297,7 @@ def test_list_appointments():
             "updated_at": "2024-06-13T10:00:00"
         }
     ]
-    with patch("main.mysql.connector.connect") as mock_connect:
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_connect.return_value = mock_conn
@@ -71,7 +308,7 @@ def test_list_appointments():
         assert response.json() == fake_appointments
 
 def test_list_appointments_empty():
-    with patch("main.mysql.connector.connect") as mock_connect:
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_connect.return_value = mock_conn
@@ -94,7 +331,7 @@ def test_get_appointment():
         "created_at": "2024-06-13T10:00:00",
         "updated_at": "2024-06-13T10:00:00"
     }
-    with patch("main.mysql.connector.connect") as mock_connect:
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_connect.return_value = mock_conn
@@ -105,7 +342,7 @@ def test_get_appointment():
         assert response.json() == fake_row
 
 def test_get_appointment_not_found():
-    with patch("main.mysql.connector.connect") as mock_connect:
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
         mock_connect.return_value = mock_conn
@@ -115,7 +352,7 @@ def test_get_appointment_not_found():
         assert response.status_code == 404
         assert response.json()["detail"] == "Appointment not found"
 
-def test_create_appointment():
+def test_create_appointment(fake_db):
     appointment_data = {
         "patient_name": "María González",
         "patient_email": "maria@example.com",
@@ -135,16 +372,10 @@ def test_create_appointment():
         "created_at": "2024-06-13T10:00:00",
         "updated_at": "2024-06-13T10:00:00"
     }
-    with patch("main.mysql.connector.connect") as mock_connect:
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        mock_cursor.lastrowid = 1
-        mock_cursor.fetchone.return_value = fake_row
-        response = client.post("/appointments/", json=appointment_data)
-        assert response.status_code == 200
-        assert response.json() == fake_row
+    fake_db.results = [{"rowcount": 1, "lastrowid": 1}, _generated(fake_row)]
+    response = client.post("/appointments/", json=appointment_data)
+    assert response.status_code == 200
+    assert response.json() == fake_row
 
 def test_create_appointment_invalid_data():
     appointment_data = {
@@ -154,7 +385,7 @@ def test_create_appointment_invalid_data():
     response = client.post("/appointments/", json=appointment_data)
     assert response.status_code == 422
 
-def test_update_appointment():
+def test_update_appointment(fake_db):
     update_data = {"patient_name": "Updated Patient", "status": "completed"}
     fake_row = {
         "id": 1,
@@ -168,51 +399,32 @@ def test_update_appointment():
         "created_at": "2024-06-13T10:00:00",
         "updated_at": "2024-06-13T10:00:00"
     }
-    with patch("main.mysql.connector.connect") as mock_connect:
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        # Simula que existe el registro antes de actualizar
-        mock_cursor.fetchone.side_effect = [fake_row, fake_row]
-        response = client.put("/appointments/1", json=update_data)
-        assert response.status_code == 200
-        assert response.json() == fake_row
+    fake_db.results = [{"rowcount": 1}, {"rows": [fake_row]}]
+    response = client.put("/appointments/1", json=update_data)
+    assert response.status_code == 200
+    assert response.json() == fake_row
+    sql, params = fake_db.round_trips[0]
+    assert sql.startswith("UPDATE appointments SET patient_name = %s, status = %s")
+    assert params == ("Updated Patient", "completed", 1, 1)
 
-def test_update_appointment_not_found():
+def test_update_appointment_not_found(fake_db):
     update_data = {"status": "completed"}
-    with patch("main.mysql.connector.connect") as mock_connect:
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = None
-        response = client.put("/appointments/999", json=update_data)
-        assert response.status_code == 404
+    fake_db.results = [{"rowcount": 0}, {"rows": []}]
+    response = client.put("/appointments/999", json=update_data)
+    assert response.status_code == 404
 
-def test_delete_appointment():
-    with patch("main.mysql.connector.connect") as mock_connect:
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        # Simula que existe el registro antes de borrar
-        mock_cursor.fetchone.return_value = (1,)
-        response = client.delete("/appointments/1")
-        assert response.status_code == 200
-        assert response.json() == {"ok": True}
+def test_delete_appointment(fake_db):
+    fake_db.results = [{"rowcount": 1}]
+    response = client.delete("/appointments/1")
+    assert response.status_code == 200
+    assert response.json() == {"ok": True}
 
-def test_delete_appointment_not_found():
-    with patch("main.mysql.connector.connect") as mock_connect:
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = None
-        response = client.delete("/appointments/999")
-        assert response.status_code == 404
+def test_delete_appointment_not_found(fake_db):
+    fake_db.results = [{"rowcount": 0}]
+    response = client.delete("/appointments/999")
+    assert response.status_code == 404
 
-def test_special_characters():
+def test_special_characters(fake_db):
     appointment_data = {
         "patient_name": "José María Ñoño",
         "patient_email": "jose@example.com",
@@ -220,30 +432,12 @@ def test_special_characters():
         "doctor_specialty": "Médico General",
         "appointment_time": "2024-07-01T10:00:00",
     }
-    fake_row = {
-        "id": 1,
-        "patient_name": "José María Ñoño",
-        "patient_email": "jose@example.com",
-        "doctor_name": "Dr. García-López",
-        "doctor_specialty": "Médico General",
-        "appointment_time": "2024-07-01T10:00:00",
-        "status": "scheduled",
-        "notes": None,
-        "created_at": "2024-06-13T10:00:00",
-        "updated_at": "2024-06-13T10:00:00"
-    }
-    with patch("main.mysql.connector.connect") as mock_connect:
-        mock_conn = MagicMock()
-        mock_cursor = MagicMock()
-        mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        mock_cursor.lastrowid = 1
-        mock_cursor.fetchone.return_value = fake_row
-        response = client.post("/appointments/", json=appointment_data)
-        assert response.status_code == 200
-        assert response.json()["patient_name"] == "José María Ñoño"
+    fake_db.results = [{"rowcount": 1, "lastrowid": 1}, _generated(FAKE_ROW)]
+    response = client.post("/appointments/", json=appointment_data)
+    assert response.status_code == 200
+    assert response.json()["patient_name"] == "José María Ñoño"
 
-def test_long_notes():
+def test_long_notes(fake_db):
     appointment_data = {
         "patient_name": "Test Patient",
         "patient_email": "test@example.com",
@@ -252,36 +446,1942 @@ def test_long_notes():
         "appointment_time": "2024-07-01T10:00:00",
         "notes": "A" * 500,
     }
-    fake_row = {
-        "id": 1,
+    fake_db.results = [{"rowcount": 1, "lastrowid": 1}, _generated(FAKE_ROW)]
+    response = client.post("/appointments/", json=appointment_data)
+    assert response.status_code == 200
+    assert len(response.json()["notes"]) == 500
+
+def test_invalid_datetime():
+    appointment_data = {
         "patient_name": "Test Patient",
         "patient_email": "test@example.com",
         "doctor_name": "Dr. Test",
         "doctor_specialty": "Test",
-        "appointment_time": "2024-07-01T10:00:00",
-        "status": "scheduled",
-        "notes": "A" * 500,
-        "created_at": "2024-06-13T10:00:00",
-        "updated_at": "2024-06-13T10:00:00"
+        "appointment_time": "invalid-datetime",
     }
-    with patch("main.mysql.connector.connect") as mock_connect:
+    response = client.post("/appointments/", json=appointment_data)
+    assert response.status_code == 422
+
+# -------------------
+# Connection pool tests
+# -------------------
+def test_pool_reuses_connections(no_cache):
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
         mock_conn = MagicMock()
-        mock_cursor = MagicMock()
         mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        mock_cursor.lastrowid = 1
-        mock_cursor.fetchone.return_value = fake_row
-        response = client.post("/appointments/", json=appointment_data)
+        mock_conn.cursor.return_value.fetchall.return_value = []
+        for _ in range(3):
+            response = client.get("/appointments/")
+            assert response.status_code == 200
+        assert mock_connect.call_count == 1
+        assert mock_conn.ping.call_count == 3
+
+def test_pool_replaces_stale_connection(no_cache):
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
+        stale_conn = MagicMock()
+        fresh_conn = MagicMock()
+        mock_connect.side_effect = [stale_conn, fresh_conn]
+        stale_conn.cursor.return_value.fetchall.return_value = []
+        fresh_conn.cursor.return_value.fetchall.return_value = []
+        assert client.get("/appointments/").status_code == 200
+        stale_conn.ping.side_effect = mysql.connector.errors.InterfaceError("gone away")
+        response = client.get("/appointments/")
         assert response.status_code == 200
-        assert len(response.json()["notes"]) == 500
+        assert mock_connect.call_count == 2
+        fresh_conn.cursor.return_value.execute.assert_called_once()
 
-def test_invalid_datetime():
-    appointment_data = {
+def test_pool_exhausted_returns_503():
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect, \
+            patch.object(mysql_repo.pool, "_timeout", 0.01):
+        mock_connect.side_effect = lambda **kwargs: MagicMock()
+        held = [mysql_repo.pool.connect() for _ in range(main.DB_POOL_SIZE + main.DB_POOL_MAX_OVERFLOW)]
+        try:
+            response = client.get("/appointments/")
+            assert response.status_code == 503
+        finally:
+            for conn in held:
+                conn.close()
+
+def test_pool_connect_error_returns_503():
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
+        mock_connect.side_effect = mysql.connector.errors.InterfaceError("can't connect")
+        response = client.get("/appointments/1")
+        assert response.status_code == 503
+
+@pytest.mark.parametrize("call", [
+    lambda: mysql_repo._insert_appointment_sync(()),
+    lambda: mysql_repo._insert_appointments_batch_sync([()]),
+    lambda: list(mysql_repo._export_appointments_sync("SELECT 1", (), b"", bytes)),
+    lambda: mysql_repo._update_appointments_batch_sync([(1, {"status": "cancelled"})]),
+    lambda: mysql_repo._load_availability_sync(None),
+    lambda: mysql_repo._list_appointments_sync("SELECT 1", ()),
+    lambda: mysql_repo._select_appointment_sync(1),
+    lambda: mysql_repo._select_appointment_version_sync(1),
+    lambda: mysql_repo._update_appointment_sync(1, {"status": "cancelled"}),
+    lambda: mysql_repo._delete_appointment_sync(1),
+])
+def test_connection_returns_to_pool_when_cursor_fails(call, monkeypatch):
+    # Conexión muerta: falla al crear el cursor, y aun así vuelve al pool
+    conn = MagicMock()
+    conn.cursor.side_effect = mysql.connector.errors.OperationalError("MySQL Connection not available")
+    monkeypatch.setattr(mysql_repo, "connection", lambda: conn)
+    with pytest.raises(mysql.connector.errors.OperationalError):
+        call()
+    conn.close.assert_called_once()
+
+def test_pool_metrics_exposed():
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    body = response.text
+    assert "appointment_service_db_pool_connections_in_use" in body
+    assert "appointment_service_db_pool_saturation_ratio" in body
+    assert "appointment_service_db_pool_wait_seconds" in body
+
+# -------------------
+# Async driver tests (DB_MODE=async, aiomysql pool mockeado)
+# -------------------
+
+@pytest.fixture
+def async_pool(monkeypatch):
+    mock_cursor = AsyncMock()
+    mock_cursor.__aenter__.return_value = mock_cursor
+    mock_conn = MagicMock()
+    mock_conn.ping = AsyncMock()
+    mock_conn.commit = AsyncMock()
+    mock_conn.cursor.return_value = mock_cursor
+    mock_pool = MagicMock()
+    mock_pool.acquire = AsyncMock(return_value=mock_conn)
+    mock_pool.size = 1
+    mock_pool.freesize = 1
+    monkeypatch.setattr(mysql_repo, "mode", "async")
+    monkeypatch.setattr(mysql_repo, "async_pool", mock_pool)
+    return mock_pool, mock_conn, mock_cursor
+
+def test_async_list_appointments(async_pool):
+    mock_pool, mock_conn, mock_cursor = async_pool
+    mock_cursor.fetchall.return_value = [FAKE_ROW]
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
+        response = client.get("/appointments/")
+        mock_connect.assert_not_called()
+    assert response.status_code == 200
+    assert response.json() == [FAKE_ROW]
+    mock_pool.release.assert_called_once_with(mock_conn)
+
+def test_async_get_appointment_not_found(async_pool):
+    _, _, mock_cursor = async_pool
+    mock_cursor.fetchone.return_value = None
+    response = client.get("/appointments/999")
+    assert response.status_code == 404
+
+def test_async_create_appointment(fake_async_db):
+    fake_async_db.results = [{"rowcount": 1, "lastrowid": 1}, _generated(FAKE_ROW)]
+    response = client.post("/appointments/", json={
         "patient_name": "Test Patient",
         "patient_email": "test@example.com",
         "doctor_name": "Dr. Test",
         "doctor_specialty": "Test",
-        "appointment_time": "invalid-datetime",
+        "appointment_time": "2024-07-01T10:00:00",
+    })
+    assert response.status_code == 200
+    assert response.json() == FAKE_ROW
+
+def test_async_delete_appointment(fake_async_db):
+    fake_async_db.results = [{"rowcount": 1}]
+    response = client.delete("/appointments/1")
+    assert response.status_code == 200
+    assert response.json() == {"ok": True}
+
+def test_async_pool_timeout_returns_503(async_pool, monkeypatch):
+    mock_pool, _, _ = async_pool
+
+    async def slow_acquire():
+        await asyncio.sleep(1)
+
+    mock_pool.acquire = slow_acquire
+    monkeypatch.setattr(mysql_repo, "pool_timeout", 0.01)
+    response = client.get("/appointments/1")
+    assert response.status_code == 503
+
+def test_async_pool_created_on_startup(monkeypatch):
+    monkeypatch.setattr(mysql_repo, "mode", "async")
+    mock_pool = MagicMock()
+    mock_pool.wait_closed = AsyncMock()
+    # Sin conexiones prestadas: el apagado no tiene nada que drenar
+    mock_pool.size = mock_pool.freesize = 0
+    with patch("mysql_repository.aiomysql.create_pool", new=AsyncMock(return_value=mock_pool)) as mock_create:
+        with TestClient(app):
+            assert mysql_repo.async_pool is mock_pool
+        mock_create.assert_awaited_once()
+    mock_pool.close.assert_called_once()
+    assert mysql_repo.async_pool is None
+
+# -------------------
+# Pagination / filtering / projection tests
+# -------------------
+def _page_rows(n):
+    rows = []
+    for i in range(n, 0, -1):
+        row = dict(FAKE_ROW)
+        row["id"] = i
+        row["created_at"] = f"2024-06-13T10:00:{i:02d}"
+        rows.append(row)
+    return rows
+
+def test_list_appointments_next_cursor():
+    rows = _page_rows(3)
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
+        mock_cursor = mock_connect.return_value.cursor.return_value
+        mock_cursor.fetchall.return_value = rows
+        response = client.get("/appointments/?limit=2")
+        assert response.status_code == 200
+        assert [r["id"] for r in response.json()] == [3, 2]
+        assert decode_cursor(response.headers["X-Next-Cursor"]) == (
+            datetime.datetime(2024, 6, 13, 10, 0, 2), 2
+        )
+        query, params = mock_cursor.execute.call_args[0]
+        assert "ORDER BY created_at DESC, id DESC LIMIT %s" in query
+        assert params[-1] == 3
+
+def test_list_appointments_last_page_has_no_cursor():
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
+        mock_connect.return_value.cursor.return_value.fetchall.return_value = _page_rows(2)
+        response = client.get("/appointments/?limit=2")
+        assert response.status_code == 200
+        assert "X-Next-Cursor" not in response.headers
+
+def test_list_appointments_with_cursor_and_filters():
+    cursor = encode_cursor({"created_at": datetime.datetime(2024, 6, 13, 10, 0, 2), "id": 2})
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
+        mock_cursor = mock_connect.return_value.cursor.return_value
+        mock_cursor.fetchall.return_value = []
+        response = client.get("/appointments/", params={
+            "cursor": cursor,
+            "doctor_name": "Dr. Test",
+            "status": "scheduled",
+            "appointment_time_from": "2024-07-01T00:00:00",
+        })
+        assert response.status_code == 200
+        query, params = mock_cursor.execute.call_args[0]
+        assert "doctor_name = %s" in query
+        assert "status = %s" in query
+        assert "appointment_time >= %s" in query
+        assert "(created_at < %s OR (created_at = %s AND id < %s))" in query
+        assert params[:2] == ("Dr. Test", "scheduled")
+        assert params[-4:-1] == (
+            datetime.datetime(2024, 6, 13, 10, 0, 2), datetime.datetime(2024, 6, 13, 10, 0, 2), 2
+        )
+
+def test_list_appointments_fields_projection():
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
+        mock_cursor = mock_connect.return_value.cursor.return_value
+        mock_cursor.fetchall.return_value = [
+            {"id": 1, "patient_name": "Test Patient", "created_at": "2024-06-13T10:00:00",
+             "updated_at": "2024-06-13T10:00:00"}
+        ]
+        response = client.get("/appointments/?fields=id,patient_name")
+        assert response.status_code == 200
+        assert response.json() == [{"id": 1, "patient_name": "Test Patient"}]
+        query = mock_cursor.execute.call_args[0][0]
+        # updated_at se lee siempre para calcular el ETag de la página
+        assert query.startswith("SELECT id, patient_name, created_at, updated_at FROM appointments")
+
+def test_list_appointments_unknown_field():
+    response = client.get("/appointments/?fields=id,password")
+    assert response.status_code == 422
+
+def test_list_appointments_invalid_cursor():
+    response = client.get("/appointments/?cursor=not-a-cursor")
+    assert response.status_code == 400
+
+def test_list_appointments_page_size_cap():
+    response = client.get(f"/appointments/?limit={main.LIST_MAX_PAGE_SIZE + 1}")
+    assert response.status_code == 422
+
+# -------------------
+# Schema migration tests
+# -------------------
+def test_split_sql_statements():
+    sql = """
+        -- comentario
+        CREATE INDEX a ON t (x);
+        CREATE INDEX b
+            ON t (y);
+    """
+    assert migrate.split_sql_statements(sql) == [
+        "CREATE INDEX a ON t (x)",
+        "CREATE INDEX b\n            ON t (y)",
+    ]
+
+def test_load_migrations_ordered():
+    migrations = migrate.load_migrations()
+    versions = [version for version, _, _ in migrations]
+    assert versions == sorted(versions)
+    assert versions[0] == 1
+    assert any("idx_appointments_created_id" in stmt for stmt in migrations[0][2])
+
+def _migration_cursor(applied):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = (1,)
+    mock_cursor.fetchall.return_value = [(v,) for v in applied]
+    return mock_cursor
+
+def test_apply_migrations_runs_pending():
+    mock_conn = MagicMock()
+    mock_cursor = _migration_cursor(applied=[])
+    mock_conn.cursor.return_value = mock_cursor
+    applied = migrate.apply_migrations(mock_conn)
+    assert applied == [v for v, _, _ in migrate.load_migrations()]
+    executed = [c[0][0] for c in mock_cursor.execute.call_args_list]
+    assert any(stmt.startswith("CREATE INDEX idx_appointments_doctor_time") for stmt in executed)
+    assert any(stmt.startswith("INSERT INTO schema_migrations") for stmt in executed)
+    assert executed[-1].startswith("SELECT RELEASE_LOCK")
+    mock_conn.commit.assert_called()
+
+def test_double_booking_migration_cancels_duplicates_first():
+    statements = dict((v, s) for v, _, s in migrate.load_migrations())[2]
+    assert statements[0].startswith("UPDATE appointments")
+    assert "ADD UNIQUE INDEX uq_appointments_doctor_active_slot" in statements[-1]
+
+def test_apply_migrations_skips_applied():
+    mock_conn = MagicMock()
+    mock_cursor = _migration_cursor(applied=[v for v, _, _ in migrate.load_migrations()])
+    mock_conn.cursor.return_value = mock_cursor
+    assert migrate.apply_migrations(mock_conn) == []
+    executed = [c[0][0] for c in mock_cursor.execute.call_args_list]
+    assert not any(stmt.startswith("CREATE INDEX") for stmt in executed)
+
+def test_apply_migrations_lock_not_acquired():
+    mock_conn = MagicMock()
+    mock_cursor = MagicMock()
+    mock_cursor.fetchone.return_value = (0,)
+    mock_conn.cursor.return_value = mock_cursor
+    with pytest.raises(RuntimeError):
+        migrate.apply_migrations(mock_conn)
+
+# -------------------
+# EXPLAIN checks (requieren MySQL real: MYSQL_TEST_HOST)
+# -------------------
+HOT_QUERY_FILTERS = {
+    "list_first_page": {},
+    "list_by_doctor": {"doctor_name": "Dr. 7"},
+    "list_by_specialty": {"doctor_specialty": "Specialty 3"},
+    "list_by_patient": {"patient_email": "patient42@example.com"},
+    "list_by_status_in_range": {
+        "status": "cancelled",
+        "appointment_time_from": datetime.datetime(2024, 7, 10),
+        "appointment_time_to": datetime.datetime(2024, 7, 11),
+    },
+}
+
+@pytest.fixture(scope="module")
+def mysql_explain_conn():
+    if not os.getenv("MYSQL_TEST_HOST"):
+        pytest.skip("MYSQL_TEST_HOST not set")
+    conn = mysql.connector.connect(
+        host=os.environ["MYSQL_TEST_HOST"],
+        port=int(os.getenv("MYSQL_TEST_PORT", "3306")),
+        user=os.getenv("MYSQL_TEST_USER", "root"),
+        password=os.getenv("MYSQL_TEST_PASSWORD", "rootpassword"),
+    )
+    cursor = conn.cursor()
+    with open(os.path.join(os.path.dirname(__file__), "mysql-init", "init_db.sql"), encoding="utf-8") as f:
+        for statement in migrate.split_sql_statements(f.read()):
+            cursor.execute(statement)
+    statuses = ["scheduled", "cancelled", "completed", "rescheduled"]
+    rows = [
+        (
+            f"Patient {i}", f"patient{i % 1000}@example.com", f"Dr. {i % 50}", f"Specialty {i % 10}",
+            datetime.datetime(2024, 7, 1) + datetime.timedelta(minutes=30 * i), statuses[i % 4], None,
+        )
+        for i in range(5000)
+    ]
+    cursor.executemany(
+        "INSERT INTO appointments (patient_name, patient_email, doctor_name, doctor_specialty,"
+        " appointment_time, status, notes) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+        rows,
+    )
+    conn.commit()
+    migrate.apply_migrations(conn)
+    cursor.execute("ANALYZE TABLE appointments")
+    cursor.fetchall()
+    cursor.close()
+    yield conn
+    conn.close()
+
+def _explain(conn, query, params):
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("EXPLAIN " + query, params)
+    plan = cursor.fetchall()
+    cursor.close()
+    return plan
+
+@pytest.mark.parametrize("name", sorted(HOT_QUERY_FILTERS))
+def test_hot_list_queries_use_index(mysql_explain_conn, name):
+    query, params = main.build_list_query(main.APPOINTMENT_COLUMNS, HOT_QUERY_FILTERS[name], None, 50)
+    for step in _explain(mysql_explain_conn, query, params):
+        assert step["type"] != "ALL", f"{name} does a full table scan: {step}"
+        assert step["key"], f"{name} does not use an index: {step}"
+
+def test_keyset_next_page_uses_index(mysql_explain_conn):
+    cursor = (datetime.datetime(2030, 1, 1), 2500)
+    query, params = main.build_list_query(main.APPOINTMENT_COLUMNS, {}, cursor, 50)
+    for step in _explain(mysql_explain_conn, query, params):
+        assert step["type"] != "ALL"
+        assert step["key"]
+
+# -------------------
+# Round trips por request (no debe crecer)
+# -------------------
+CREATE_PAYLOAD = {
+    "patient_name": "Test Patient",
+    "patient_email": "test@example.com",
+    "doctor_name": "Dr. Test",
+    "doctor_specialty": "Test",
+    "appointment_time": "2024-07-01T10:00:00",
+}
+
+ROUND_TRIP_CASES = [
+    ("POST", "/appointments/", CREATE_PAYLOAD, [{"rowcount": 1, "lastrowid": 1}, _generated(FAKE_ROW)]),
+    ("GET", "/appointments/", None, [{"rows": [FAKE_ROW]}]),
+    ("GET", "/appointments/1", None, [{"rows": [FAKE_ROW]}]),
+    ("PUT", "/appointments/1", {"status": "completed"}, [{"rowcount": 1}, {"rows": [FAKE_ROW]}]),
+    ("PUT", "/appointments/999", {"status": "completed"}, [{"rowcount": 0}, {"rows": []}]),
+    ("DELETE", "/appointments/1", None, [{"rowcount": 1}]),
+    ("DELETE", "/appointments/999", None, [{"rowcount": 0}]),
+]
+
+@pytest.mark.parametrize("method,url,payload,results", ROUND_TRIP_CASES)
+def test_single_round_trip_per_request(fake_db, method, url, payload, results):
+    fake_db.results = list(results)
+    response = client.request(method, url, json=payload)
+    assert response.status_code in (200, 404)
+    assert len(fake_db.round_trips) == 1, fake_db.round_trips
+
+@pytest.mark.parametrize("method,url,payload,results", ROUND_TRIP_CASES)
+def test_single_round_trip_per_request_async(fake_async_db, method, url, payload, results):
+    fake_async_db.results = list(results)
+    response = client.request(method, url, json=payload)
+    assert response.status_code in (200, 404)
+    assert len(fake_async_db.round_trips) == 1, fake_async_db.round_trips
+
+# -------------------
+# Response cache tests
+# -------------------
+class FakeRedis:
+    """Fake en memoria de redis.asyncio: get/set(px)/delete, compartible entre 'réplicas'"""
+    def __init__(self):
+        self.data = {}
+        self.now = 0.0
+
+    async def get(self, key):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= self.now:
+            del self.data[key]
+            return None
+        return value
+
+    async def set(self, key, value, px=None):
+        self.data[key] = (value, None if px is None else self.now + px / 1000)
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+
+    async def aclose(self):
+        pass
+
+def test_get_appointment_served_from_cache(fake_db):
+    fake_db.results = [{"rows": [FAKE_ROW]}]
+    first = client.get("/appointments/1")
+    second = client.get("/appointments/1")
+    assert first.json() == second.json() == FAKE_ROW
+    assert len(fake_db.round_trips) == 1
+
+def test_get_appointment_not_found_is_not_cached(fake_db):
+    fake_db.results = [{"rows": []}, {"rows": [FAKE_ROW]}]
+    assert client.get("/appointments/1").status_code == 404
+    assert client.get("/appointments/1").status_code == 200
+
+def test_list_cached_per_query_shape(fake_db):
+    fake_db.results = [{"rows": [FAKE_ROW]}, {"rows": []}]
+    assert client.get("/appointments/?status=scheduled").json() == [FAKE_ROW]
+    assert client.get("/appointments/?status=scheduled").json() == [FAKE_ROW]
+    assert client.get("/appointments/?status=cancelled").json() == []
+    assert len(fake_db.round_trips) == 2
+
+def test_list_cache_keeps_next_cursor(fake_db):
+    fake_db.results = [{"rows": _page_rows(3)}]
+    first = client.get("/appointments/?limit=2")
+    second = client.get("/appointments/?limit=2")
+    assert second.headers["X-Next-Cursor"] == first.headers["X-Next-Cursor"]
+    assert len(fake_db.round_trips) == 1
+
+def test_update_invalidates_appointment_and_lists(fake_db):
+    updated = {**FAKE_ROW, "status": "completed", "updated_at": "2024-06-14T10:00:00"}
+    fake_db.results = [
+        {"rows": [FAKE_ROW]}, {"rows": [FAKE_ROW]},
+        {"rowcount": 1}, {"rows": [updated]},
+        {"rows": [updated]}, {"rows": [updated]},
+    ]
+    client.get("/appointments/1")
+    client.get("/appointments/")
+    assert client.put("/appointments/1", json={"status": "completed"}).status_code == 200
+    assert client.get("/appointments/1").json()["status"] == "completed"
+    assert client.get("/appointments/").json()[0]["status"] == "completed"
+    assert len(fake_db.round_trips) == 5
+
+def test_delete_invalidates_appointment(fake_db):
+    fake_db.results = [{"rows": [FAKE_ROW]}, {"rowcount": 1}, {"rows": []}]
+    client.get("/appointments/1")
+    client.delete("/appointments/1")
+    assert client.get("/appointments/1").status_code == 404
+
+def test_create_invalidates_lists(fake_db):
+    fake_db.results = [
+        {"rows": []},
+        {"rowcount": 1, "lastrowid": 1}, _generated(FAKE_ROW),
+        {"rows": [FAKE_ROW]},
+    ]
+    assert client.get("/appointments/").json() == []
+    client.post("/appointments/", json=CREATE_PAYLOAD)
+    assert client.get("/appointments/").json() == [FAKE_ROW]
+
+def test_cache_skips_store_after_concurrent_write(reset_cache):
+    async def scenario():
+        key = reset_cache.appointment_key(1)
+        generation = await reset_cache.generation()
+        await reset_cache.invalidate(1)  # escritura entre la lectura en BD y el set
+        await reset_cache.set("appointment", key, FAKE_ROW, generation)
+        return await reset_cache.get("appointment", key)
+    assert asyncio.run(scenario()) is None
+
+def test_in_memory_cache_ttl_and_lru():
+    cache = InMemoryCache(max_entries=2)
+    async def scenario():
+        with patch("response_cache.time.monotonic", return_value=100.0):
+            await cache.set("a", 1, ttl=5)
+            await cache.set("b", 2)
+            await cache.get("a")
+            await cache.set("c", 3)
+            assert await cache.get("b") is None  # desalojada por LRU
+        with patch("response_cache.time.monotonic", return_value=105.0):
+            assert await cache.get("a") is None  # expirada
+            assert await cache.get("c") == 3
+    asyncio.run(scenario())
+    assert len(cache) == 1
+
+def test_redis_backend_shared_between_replicas():
+    redis = FakeRedis()
+    replica_a = ResponseCache(RedisCache(redis), ttl=30, list_ttl=10)
+    replica_b = ResponseCache(RedisCache(redis), ttl=30, list_ttl=10)
+    async def scenario():
+        key = replica_a.appointment_key(1)
+        await replica_a.set("appointment", key, FAKE_ROW, await replica_a.generation())
+        assert await replica_b.get("appointment", key) == FAKE_ROW
+        await replica_b.invalidate(1)
+        assert await replica_a.get("appointment", key) is None
+        await replica_a.set("appointment", key, FAKE_ROW, await replica_a.generation())
+        redis.now += 31  # TTL
+        assert await replica_b.get("appointment", key) is None
+    asyncio.run(scenario())
+
+def test_cache_backend_failure_falls_back_to_db(fake_db, monkeypatch):
+    broken = MagicMock()
+    broken.get = AsyncMock(side_effect=ConnectionError("cache down"))
+    broken.set = AsyncMock(side_effect=ConnectionError("cache down"))
+    monkeypatch.setattr(main, "response_cache", ResponseCache(broken, ttl=30, list_ttl=10))
+    fake_db.results = [{"rows": [FAKE_ROW]}]
+    response = client.get("/appointments/1")
+    assert response.status_code == 200
+    assert response.json() == FAKE_ROW
+
+def test_cache_disabled_with_none_backend(fake_db, no_cache):
+    fake_db.results = [{"rows": [FAKE_ROW]}, {"rows": [FAKE_ROW]}]
+    client.get("/appointments/1")
+    client.get("/appointments/1")
+    assert len(fake_db.round_trips) == 2
+
+def test_cache_metrics_exposed(fake_db):
+    fake_db.results = [{"rows": [FAKE_ROW]}]
+    client.get("/appointments/1")
+    client.get("/appointments/1")
+    body = client.get("/metrics").text
+    assert 'appointment_service_cache_requests_total{cache="appointment",result="hit"}' in body
+    assert 'appointment_service_cache_requests_total{cache="appointment",result="miss"}' in body
+    assert "appointment_service_cache_hit_ratio 0.5" in body
+
+# -------------------
+# ETag / If-None-Match tests
+# -------------------
+def test_get_appointment_etag():
+    etag = main.appointment_etag(1, datetime.datetime(2024, 6, 13, 10, 0))
+    assert etag == main.appointment_etag(1, "2024-06-13T10:00:00")
+    assert etag != main.appointment_etag(1, "2024-06-13T10:00:01")
+    assert etag != main.appointment_etag(2, "2024-06-13T10:00:00")
+
+def test_etag_matches():
+    assert main.etag_matches('"a", W/"b"', '"b"')
+    assert main.etag_matches("*", '"b"')
+    assert not main.etag_matches('"a"', '"b"')
+    assert not main.etag_matches(None, '"b"')
+
+def test_get_appointment_emits_etag(fake_db):
+    fake_db.results = [{"rows": [FAKE_ROW]}]
+    response = client.get("/appointments/1")
+    assert response.headers["ETag"] == main.appointment_etag(1, FAKE_ROW["updated_at"])
+
+def test_get_appointment_not_modified_uses_version_query(fake_db, no_cache):
+    etag = main.appointment_etag(1, FAKE_ROW["updated_at"])
+    fake_db.results = [{"rows": [{"updated_at": FAKE_ROW["updated_at"]}]}]
+    response = client.get("/appointments/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+    assert fake_db.round_trips == [(mysql_repository.SELECT_APPOINTMENT_VERSION_SQL, (1,))]
+
+def test_get_appointment_modified_returns_body(fake_db, no_cache):
+    fake_db.results = [{"rows": [{"updated_at": FAKE_ROW["updated_at"]}]}, {"rows": [FAKE_ROW]}]
+    response = client.get("/appointments/1", headers={"If-None-Match": '"stale"'})
+    assert response.status_code == 200
+    assert response.json() == FAKE_ROW
+
+def test_get_appointment_not_modified_from_cache(fake_db):
+    fake_db.results = [{"rows": [FAKE_ROW]}]
+    etag = client.get("/appointments/1").headers["ETag"]
+    response = client.get("/appointments/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert len(fake_db.round_trips) == 1
+
+def test_list_appointments_etag_from_page(fake_db):
+    rows = _page_rows(3)
+    rows[1]["updated_at"] = "2024-06-20T08:00:00"
+    fake_db.results = [{"rows": rows}]
+    response = client.get("/appointments/?limit=2")
+    assert response.headers["ETag"] == main.list_etag("2024-06-20T08:00:00", 2)
+
+def test_list_appointments_not_modified_uses_version_query(fake_db, no_cache):
+    etag = main.list_etag("2024-06-13T10:00:00", 1)
+    fake_db.results = [{"rows": [{"max_updated_at": "2024-06-13T10:00:00", "row_count": 1}]}]
+    response = client.get("/appointments/?status=scheduled&limit=5", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    query, params = fake_db.round_trips[0]
+    assert len(fake_db.round_trips) == 1
+    assert query.startswith("SELECT MAX(updated_at) AS max_updated_at, COUNT(*) AS row_count FROM (")
+    # La subconsulta es la misma página, sin la fila extra del cursor
+    assert params == ("scheduled", 5)
+
+def test_list_appointments_changed_page_returns_body(fake_db, no_cache):
+    fake_db.results = [
+        {"rows": [{"max_updated_at": "2024-06-14T10:00:00", "row_count": 1}]},
+        {"rows": [FAKE_ROW]},
+    ]
+    response = client.get("/appointments/", headers={"If-None-Match": main.list_etag("2024-06-13T10:00:00", 1)})
+    assert response.status_code == 200
+    assert response.json() == [FAKE_ROW]
+
+def test_list_appointments_not_modified_from_cache(fake_db):
+    fake_db.results = [{"rows": [FAKE_ROW]}]
+    etag = client.get("/appointments/").headers["ETag"]
+    response = client.get("/appointments/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert len(fake_db.round_trips) == 1
+
+def test_async_get_appointment_not_modified(fake_async_db, no_cache):
+    etag = main.appointment_etag(1, FAKE_ROW["updated_at"])
+    fake_async_db.results = [{"rows": [{"updated_at": FAKE_ROW["updated_at"]}]}]
+    response = client.get("/appointments/1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert len(fake_async_db.round_trips) == 1
+
+# -------------------
+# Batch endpoint tests
+# -------------------
+def _batch_generated(first_id, n):
+    return {"rows": [
+        {"id": first_id + i, "created_at": "2024-06-13T10:00:00", "updated_at": "2024-06-13T10:00:00"}
+        for i in range(n)
+    ]}
+
+def _batch_payload(n):
+    # Una hora distinta por ítem: dos ítems en el mismo turno serían una doble reserva
+    return [dict(CREATE_PAYLOAD, appointment_time=f"2024-07-01T{10 + i:02d}:00:00") for i in range(n)]
+
+def test_create_batch_single_transaction(fake_db):
+    fake_db.results = [{"rowcount": 3, "lastrowid": 10}, _batch_generated(10, 3)]
+    payload = [dict(item, patient_name=f"Patient {i}") for i, item in enumerate(_batch_payload(3))]
+    response = client.post("/appointments/batch", json=payload)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["succeeded"] == 3 and body["failed"] == 0
+    assert [r["appointment"]["id"] for r in body["results"]] == [10, 11, 12]
+    assert body["results"][2]["appointment"]["patient_name"] == "Patient 2"
+    statements = [sql for sql, _ in fake_db.round_trips]
+    assert statements[0] == "START TRANSACTION"
+    assert statements[1] == mysql_repository.INSERT_APPOINTMENT_ROW_SQL
+    assert len(fake_db.round_trips[1][1]) == 3
+    assert statements[-1] == "COMMIT"
+    assert len(statements) == 4
+
+def test_create_batch_chunks(fake_db, monkeypatch):
+    monkeypatch.setattr(mysql_repo, "batch_chunk_size", 2)
+    fake_db.results = [
+        {"rowcount": 2, "lastrowid": 1}, _batch_generated(1, 2),
+        {"rowcount": 1, "lastrowid": 3}, _batch_generated(3, 1),
+    ]
+    response = client.post("/appointments/batch", json=_batch_payload(3))
+    assert response.json()["succeeded"] == 3
+    inserts = [params for sql, params in fake_db.round_trips if sql == mysql_repository.INSERT_APPOINTMENT_ROW_SQL]
+    assert [len(params) for params in inserts] == [2, 1]
+
+def test_create_batch_partial_failure(fake_db):
+    fake_db.results = [{"rowcount": 1, "lastrowid": 5}, _batch_generated(5, 1)]
+    payload = [dict(CREATE_PAYLOAD, patient_email="not-an-email"), CREATE_PAYLOAD]
+    response = client.post("/appointments/batch", json=payload)
+    assert response.status_code == 207
+    body = response.json()
+    assert body["succeeded"] == 1 and body["failed"] == 1
+    assert body["results"][0]["status"] == "invalid"
+    assert body["results"][0]["errors"][0]["loc"] == ["patient_email"]
+    assert body["results"][1] == {"index": 1, "status": "created", "appointment": body["results"][1]["appointment"]}
+    assert body["results"][1]["appointment"]["id"] == 5
+
+def test_create_batch_rolls_back_on_db_error(fake_db):
+    # Faltan filas generadas: se aborta la transacción completa
+    fake_db.results = [{"rowcount": 2, "lastrowid": 1}, _batch_generated(1, 1)]
+    response = client.post("/appointments/batch", json=_batch_payload(2))
+    assert response.status_code == 500
+    assert response.json()["detail"] == (
+        "Could not read back the ids generated for the batch; nothing was created"
+    )
+    assert fake_db.round_trips[-1] == ("ROLLBACK", None)
+
+def test_create_batch_reads_ids_with_auto_increment_step(fake_db):
+    # auto_increment_increment = 2 (varios primarios): ids 10, 12, 14
+    fake_db.results = [{"rowcount": 3, "lastrowid": 10}, {"rows": [
+        dict(row, id=10 + 2 * i) for i, row in enumerate(_batch_generated(0, 3)["rows"])
+    ]}]
+    response = client.post("/appointments/batch", json=_batch_payload(3))
+    assert response.status_code == 200
+    assert [r["appointment"]["id"] for r in response.json()["results"]] == [10, 12, 14]
+    sql, params = fake_db.round_trips[2]
+    assert sql == mysql_repository.SELECT_GENERATED_RANGE_SQL
+    assert "@@auto_increment_increment" in sql
+    assert params == (10, 10, 3, 10)
+
+def test_create_batch_too_large(monkeypatch):
+    monkeypatch.setattr(main, "BATCH_MAX_ITEMS", 2)
+    response = client.post("/appointments/batch", json=_batch_payload(3))
+    assert response.status_code == 413
+
+def test_create_batch_metrics_once_per_batch(fake_db):
+    fake_db.results = [{"rowcount": 4, "lastrowid": 1}, _batch_generated(1, 4)]
+    inserts = main.DB_OPERATIONS.labels(operation="insert", status="success")
+    created = main.APPOINTMENTS_CREATED.labels(status="scheduled")
+    inserts_before, created_before = inserts._value.get(), created._value.get()
+    client.post("/appointments/batch", json=_batch_payload(4))
+    assert inserts._value.get() - inserts_before == 1
+    assert created._value.get() - created_before == 4
+
+def test_update_batch_reports_not_found(fake_db):
+    updated = {**FAKE_ROW, "status": "cancelled"}
+    fake_db.results = [{"rowcount": 1}, {"rowcount": 0}, {"rows": [updated]}]
+    payload = [{"id": 1, "status": "cancelled"}, {"id": 999, "status": "cancelled"}, {"status": "cancelled"}]
+    response = client.patch("/appointments/batch", json=payload)
+    assert response.status_code == 207
+    results = response.json()["results"]
+    assert [r["status"] for r in results] == ["updated", "not_found", "invalid"]
+    assert results[0]["appointment"]["status"] == "cancelled"
+    # Un solo lote multi-sentencia dentro de la transacción
+    assert [sql for sql, _ in fake_db.round_trips][0::2] == ["START TRANSACTION", "COMMIT"]
+    sql, params = fake_db.round_trips[1]
+    assert sql.count("UPDATE appointments") == 2
+    assert params == ("cancelled", 1, "cancelled", 999, 1, 999)
+
+def test_update_batch_invalidates_cache(fake_db):
+    updated = {**FAKE_ROW, "status": "cancelled"}
+    fake_db.results = [{"rows": [FAKE_ROW]}, {"rowcount": 1}, {"rows": [updated]}, {"rows": [updated]}]
+    client.get("/appointments/1")
+    client.patch("/appointments/batch", json=[{"id": 1, "status": "cancelled"}])
+    assert client.get("/appointments/1").json()["status"] == "cancelled"
+
+def test_async_batch_create_and_update(fake_async_db):
+    fake_async_db.results = [{"rowcount": 2, "lastrowid": 7}, _batch_generated(7, 2)]
+    response = client.post("/appointments/batch", json=_batch_payload(2))
+    assert [r["appointment"]["id"] for r in response.json()["results"]] == [7, 8]
+    fake_async_db.results = [{"rowcount": 1}, {"rowcount": 0}, {"rows": [FAKE_ROW]}]
+    response = client.patch("/appointments/batch", json=[{"id": 1, "notes": "x"}, {"id": 2, "notes": "y"}])
+    assert [r["status"] for r in response.json()["results"]] == ["updated", "not_found"]
+    assert fake_async_db.round_trips[-1] == ("COMMIT", None)
+
+# -------------------
+# Export tests
+# -------------------
+def _export_row(i):
+    return (i, f"Patient {i}", "p@example.com", "Dr. Test", "Test",
+            datetime.datetime(2024, 7, 1, 10, 0), "scheduled", None,
+            datetime.datetime(2024, 6, 13, 10, 0), datetime.datetime(2024, 6, 13, 10, 0))
+
+def test_export_ndjson(fake_db):
+    fake_db.results = [{"rows": [_export_row(1), _export_row(2)]}]
+    response = client.get("/appointments/export?status=scheduled")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["id"] for line in lines] == [1, 2]
+    assert lines[0]["appointment_time"] == "2024-07-01T10:00:00"
+    query, params = fake_db.round_trips[0]
+    assert "WHERE status = %s" in query and "LIMIT" not in query
+    assert params == ["scheduled"]
+
+def test_export_csv_with_fields(fake_db):
+    fake_db.results = [{"rows": [(1, "Patient 1"), (2, "Patient, 2")]}]
+    response = client.get("/appointments/export?format=csv&fields=id,patient_name")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert 'filename="appointments.csv"' in response.headers["content-disposition"]
+    assert response.text.splitlines() == ["id,patient_name", "1,Patient 1", '2,"Patient, 2"']
+    assert fake_db.round_trips[0][0].startswith("SELECT id, patient_name FROM appointments")
+
+def test_export_csv_empty_has_header(fake_db):
+    fake_db.results = [{"rows": []}]
+    response = client.get("/appointments/export?format=csv&fields=id")
+    assert response.text.splitlines() == ["id"]
+
+def test_export_invalid_format():
+    assert client.get("/appointments/export?format=xml").status_code == 422
+
+def test_export_db_error_before_streaming():
+    with patch("mysql_repository.mysql.connector.connect") as mock_connect:
+        mock_connect.return_value.cursor.return_value.execute.side_effect = mysql.connector.Error("boom")
+        response = client.get("/appointments/export")
+    assert response.status_code == 500
+
+def test_export_reads_in_fetch_size_chunks(fake_db, monkeypatch):
+    monkeypatch.setattr(mysql_repo, "export_fetch_size", 2)
+    fake_db.results = [{"rows": [_export_row(i) for i in range(5)]}]
+    chunks = list(mysql_repo._export_appointments_sync("SELECT 1", (), b"header", lambda rows: len(rows)))
+    assert chunks == [b"header", 2, 2, 1]
+
+EXPORT_ROW = _export_row(1)
+
+class LazyExportCursor:
+    """Cursor sin buffer simulado: genera las filas a medida que se piden"""
+    def __init__(self, total):
+        self.remaining = total
+        self.closed = False
+
+    def execute(self, query, params):
+        pass
+
+    def fetchmany(self, size):
+        n = min(size, self.remaining)
+        self.remaining -= n
+        return [EXPORT_ROW] * n
+
+    def close(self):
+        self.closed = True
+
+def _export_peak_memory(total):
+    import tracemalloc
+    conn = MagicMock()
+    conn.cursor.return_value = LazyExportCursor(total)
+    encode = functools.partial(main._ndjson_rows, main.APPOINTMENT_COLUMNS)
+    with patch.object(mysql_repo, "connection", return_value=conn):
+        tracemalloc.start()
+        exported = sum(len(chunk) for chunk in mysql_repo._export_appointments_sync("SELECT 1", (), b"", encode))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return exported, peak
+
+def test_export_memory_is_constant(monkeypatch):
+    monkeypatch.setattr(mysql_repo, "export_fetch_size", 200)
+    small_bytes, small_peak = _export_peak_memory(1_000)
+    large_bytes, large_peak = _export_peak_memory(20_000)
+    assert large_bytes == 20 * small_bytes
+    # 20x más filas, mismo pico de memoria (un chunk de EXPORT_FETCH_SIZE filas)
+    assert large_peak < small_peak * 1.5
+
+def test_export_client_disconnect_discards_connection():
+    conn = MagicMock()
+    conn.cursor.return_value = LazyExportCursor(10_000)
+    with patch.object(mysql_repo, "connection", return_value=conn):
+        chunks = mysql_repo._export_appointments_sync("SELECT 1", (), b"", lambda rows: b"x")
+        next(chunks)
+        next(chunks)
+        chunks.close()
+    conn.invalidate.assert_called_once()
+    conn.close.assert_not_called()
+
+def test_async_export_ndjson(fake_async_db):
+    fake_async_db.results = [{"rows": [_export_row(1)]}]
+    response = client.get("/appointments/export")
+    assert response.status_code == 200
+    assert json.loads(response.text)["patient_name"] == "Patient 1"
+
+# -------------------
+# Availability / free-slot tests
+# -------------------
+MONDAY = datetime.datetime(2030, 1, 7)  # lunes, siempre en el futuro
+
+def _schedule():
+    return WorkingSchedule(parse_working_days("0-4"), parse_working_hours("08:00-12:00,14:00-18:00"), 30)
+
+@pytest.fixture
+def availability(monkeypatch):
+    index = AvailabilityIndex(_schedule())
+    monkeypatch.setattr(main, "availability_index", index)
+    return index
+
+def _at(hour, minute=0, day=MONDAY):
+    return day.replace(hour=hour, minute=minute)
+
+def test_parse_working_config():
+    assert parse_working_days("0-2,5") == {0, 1, 2, 5}
+    assert parse_working_hours("14:00-18:00,08:00-12:00")[0] == (datetime.time(8), datetime.time(12))
+    with pytest.raises(ValueError):
+        parse_working_hours("12:00-08:00")
+
+def test_schedule_slots_skip_breaks_and_weekends():
+    slots = list(_schedule().slots(_at(11), _at(15)))
+    assert slots == [_at(11), _at(11, 30), _at(14), _at(14, 30)]
+    saturday = MONDAY + datetime.timedelta(days=5)
+    assert list(_schedule().slots(saturday, saturday + datetime.timedelta(days=1))) == []
+
+def test_index_overlapping_appointment_blocks_both_slots():
+    index = AvailabilityIndex(_schedule())
+    index.finish_rebuild([], [(1, "Dr. A", "Cardio", _at(9, 15), "scheduled")])
+    assert not index.is_free("Dr. A", _at(9))
+    assert not index.is_free("Dr. A", _at(9, 30))
+    assert index.is_free("Dr. A", _at(10))
+    assert index.is_free("Dr. B", _at(9))
+
+def test_index_incremental_writes():
+    index = AvailabilityIndex(_schedule())
+    index.finish_rebuild([("Dr. A", "Cardio")], [])
+    index.upsert(1, "Dr. A", "Cardio", _at(8), "scheduled")
+    assert index.free_slots("Dr. A", _at(8), _at(9)) == [_at(8, 30)]
+    index.upsert(1, "Dr. A", "Cardio", _at(8, 30), "scheduled")  # reprogramada
+    assert index.free_slots("Dr. A", _at(8), _at(9)) == [_at(8)]
+    index.upsert(1, "Dr. A", "Cardio", _at(8, 30), "cancelled")
+    assert len(index) == 0
+    index.upsert(2, "Dr. A", "Cardio", _at(8), "scheduled")
+    index.remove(2)
+    assert index.free_slots("Dr. A", _at(8), _at(9)) == [_at(8), _at(8, 30)]
+
+def test_index_rebuild_replays_concurrent_writes():
+    index = AvailabilityIndex(_schedule())
+    index.start_rebuild()
+    index.upsert(7, "Dr. A", "Cardio", _at(10), "scheduled")  # escrita después de la foto
+    index.finish_rebuild([("Dr. A", "Cardio")], [(1, "Dr. A", "Cardio", _at(9), "scheduled")])
+    assert not index.is_free("Dr. A", _at(9))
+    assert not index.is_free("Dr. A", _at(10))
+    assert index.loaded
+
+def test_next_available_by_specialty():
+    index = AvailabilityIndex(_schedule())
+    index.finish_rebuild(
+        [("Dr. A", "Cardio"), ("Dr. B", "Cardio"), ("Dr. C", "Derma")],
+        [(1, "Dr. A", "Cardio", _at(8), "scheduled"), (2, "Dr. B", "Cardio", _at(8), "scheduled"),
+         (3, "Dr. B", "Cardio", _at(8, 30), "scheduled")],
+    )
+    found = index.next_available("Cardio", _at(8), datetime.timedelta(days=1), limit=5)
+    assert found == [(_at(8, 30), "Dr. A"), (_at(9), "Dr. B")]
+
+def test_free_slot_queries_are_sub_millisecond():
+    import random
+    import time
+    rng = random.Random(42)
+    index = AvailabilityIndex(_schedule())
+    starts = list(_schedule().slots(MONDAY, MONDAY + datetime.timedelta(days=60)))
+    booked = [
+        (i, f"Dr. {i % 50}", f"Specialty {i % 5}", rng.choice(starts), "scheduled") for i in range(20_000)
+    ]
+    index.finish_rebuild([], booked)
+    week = datetime.timedelta(days=7)
+    runs = 200
+    started = time.perf_counter()
+    for i in range(runs):
+        index.free_slots(f"Dr. {i % 50}", MONDAY, MONDAY + week)
+    assert (time.perf_counter() - started) / runs < 0.001
+    started = time.perf_counter()
+    for i in range(runs):
+        index.next_available(f"Specialty {i % 5}", MONDAY, week, limit=5)
+    assert (time.perf_counter() - started) / runs < 0.001
+
+def test_free_slots_endpoint(availability):
+    availability.finish_rebuild([("Dr. Test", "Test")], [(1, "Dr. Test", "Test", _at(8), "scheduled")])
+    response = client.get("/availability/slots", params={
+        "doctor_name": "Dr. Test", "start": _at(8).isoformat(), "end": _at(9, 30).isoformat(),
+    })
+    assert response.status_code == 200
+    assert response.json() == {
+        "doctor_name": "Dr. Test",
+        "slot_minutes": 30,
+        "slots": [_at(8, 30).isoformat(), _at(9).isoformat()],
     }
-    response = client.post("/appointments/", json=appointment_data)
+
+def test_free_slots_unknown_doctor_and_bad_window(availability):
+    availability.finish_rebuild([("Dr. Test", "Test")], [])
+    assert client.get("/availability/slots?doctor_name=Nobody").status_code == 404
+    response = client.get("/availability/slots", params={
+        "doctor_name": "Dr. Test", "start": _at(8).isoformat(),
+        "end": (_at(8) + datetime.timedelta(days=90)).isoformat(),
+    })
     assert response.status_code == 422
+
+def test_next_available_endpoint(availability):
+    availability.finish_rebuild([("Dr. Test", "Test")], [(1, "Dr. Test", "Test", _at(8), "scheduled")])
+    response = client.get("/availability/next", params={"doctor_specialty": "Test", "after": _at(8).isoformat()})
+    assert response.json()["results"] == [{"doctor_name": "Dr. Test", "slot": _at(8, 30).isoformat()}]
+
+def test_availability_index_loaded_on_first_query(fake_db, availability):
+    fake_db.results = [
+        {"rows": [("Dr. Test", "Test")]},
+        {"rows": [(1, "Dr. Test", "Test", _at(8), "scheduled")]},
+    ]
+    response = client.get("/availability/slots", params={
+        "doctor_name": "Dr. Test", "start": _at(8).isoformat(), "end": _at(9).isoformat(),
+    })
+    assert response.json()["slots"] == [_at(8, 30).isoformat()]
+    assert [sql for sql, _ in fake_db.round_trips] == [
+        mysql_repository.SELECT_DOCTORS_SQL, mysql_repository.SELECT_BOOKED_SQL,
+    ]
+
+def test_availability_index_unavailable_returns_503(availability):
+    with patch("mysql_repository.mysql.connector.connect", side_effect=mysql.connector.Error("down")):
+        assert client.get("/availability/slots?doctor_name=Dr.%20Test").status_code == 503
+    assert not availability.loaded
+
+def test_create_appointment_updates_index(fake_db, availability):
+    availability.finish_rebuild([], [])
+    booked = {**FAKE_ROW, "appointment_time": _at(10).isoformat()}
+    fake_db.results = [{"rowcount": 1, "lastrowid": 1}, _generated(booked)]
+    client.post("/appointments/", json={**CREATE_PAYLOAD, "appointment_time": _at(10).isoformat()})
+    assert not availability.is_free("Dr. Test", _at(10))
+    fake_db.results = [{"rowcount": 1}]
+    client.delete("/appointments/1")
+    assert availability.is_free("Dr. Test", _at(10))
+
+# -------------------
+# Doble reserva: clave única (doctor_name, active_slot)
+# -------------------
+DUPLICATE_SLOT_MSG = (
+    "Duplicate entry 'Dr. Test-2030-01-07 10:00:00' for key 'appointments.uq_appointments_doctor_active_slot'"
+)
+
+def _duplicate_slot():
+    return mysql.connector.errors.IntegrityError(msg=DUPLICATE_SLOT_MSG, errno=1062)
+
+def test_is_double_booking_both_drivers():
+    assert mysql_repository._is_double_booking(_duplicate_slot())
+    assert mysql_repository._is_double_booking(pymysql.err.IntegrityError(1062, DUPLICATE_SLOT_MSG))
+    # Otra clave única o una FK no son dobles reservas
+    primary_key = pymysql.err.IntegrityError(1062, "Duplicate entry '1' for key 'PRIMARY'")
+    assert not mysql_repository._is_double_booking(primary_key)
+    assert not mysql_repository._is_double_booking(mysql.connector.errors.IntegrityError(msg="fk", errno=1452))
+    assert not mysql_repository._is_double_booking(RuntimeError(DUPLICATE_SLOT_MSG))
+
+def test_nearest_free_slots_around_booked_one():
+    index = AvailabilityIndex(_schedule())
+    index.finish_rebuild([], [
+        (1, "Dr. Test", "Test", _at(10), "scheduled"),
+        (2, "Dr. Test", "Test", _at(10, 30), "scheduled"),
+    ])
+    assert index.is_booked("Dr. Test", _at(10)) and not index.is_booked("Dr. Test", _at(10, 15))
+    nearest = index.nearest_free("Dr. Test", _at(10), MONDAY, datetime.timedelta(days=1), 3)
+    assert nearest == [_at(9, 30), _at(9), _at(11)]
+    # Nunca propone turnos anteriores a not_before
+    assert index.nearest_free("Dr. Test", _at(10), _at(10), datetime.timedelta(days=1), 2) == [_at(11), _at(11, 30)]
+
+def test_create_double_booking_returns_409_with_alternatives(fake_db, availability):
+    availability.finish_rebuild([("Dr. Test", "Test")], [(1, "Dr. Test", "Test", _at(10), "scheduled")])
+    fake_db.results = [{"error": _duplicate_slot()}]
+    conflicts = main.DB_OPERATIONS.labels(operation="insert", status="conflict")
+    before = conflicts._value.get()
+    response = client.post("/appointments/", json={**CREATE_PAYLOAD, "appointment_time": _at(10).isoformat()})
+    assert response.status_code == 409
+    detail = response.json()["detail"]
+    assert detail["doctor_name"] == "Dr. Test"
+    assert detail["alternatives"] == [_at(9, 30).isoformat(), _at(10, 30).isoformat(), _at(9).isoformat()]
+    assert conflicts._value.get() == before + 1
+
+def test_create_double_booking_async_driver(fake_async_db, availability):
+    availability.finish_rebuild([("Dr. Test", "Test")], [])
+    fake_async_db.results = [{"error": pymysql.err.IntegrityError(1062, DUPLICATE_SLOT_MSG)}]
+    response = client.post("/appointments/", json={**CREATE_PAYLOAD, "appointment_time": _at(10).isoformat()})
+    assert response.status_code == 409
+    assert response.json()["detail"]["alternatives"][0] == _at(9, 30).isoformat()
+
+def test_update_double_booking_uses_current_slot(fake_db, availability):
+    # Reactivar una cita cancelada: médico y hora salen de la fila actual
+    availability.finish_rebuild([("Dr. Test", "Test")], [(2, "Dr. Test", "Test", _at(10), "scheduled")])
+    current = {**FAKE_ROW, "appointment_time": _at(10)}
+    fake_db.results = [{"error": _duplicate_slot()}, {}, {"rows": [current]}]
+    response = client.put("/appointments/1", json={"status": "scheduled"})
+    assert response.status_code == 409
+    assert response.json()["detail"]["appointment_time"] == _at(10).isoformat()
+    assert [sql for sql, _ in fake_db.round_trips][-1] == mysql_repository.SELECT_APPOINTMENT_SQL
+
+def test_update_double_booking_of_deleted_appointment_returns_404(fake_db, availability):
+    # La cita se borró entre el UPDATE rechazado y la lectura de su turno
+    fake_db.results = [{"error": _duplicate_slot()}, {}, {"rows": []}]
+    response = client.put("/appointments/1", json={"status": "scheduled"})
+    assert response.status_code == 404
+
+def test_create_batch_reports_known_conflicts_per_item(fake_db, availability):
+    availability.finish_rebuild([("Dr. Test", "Test")], [(1, "Dr. Test", "Test", _at(10), "scheduled")])
+    fake_db.results = [{"rowcount": 1, "lastrowid": 7}, _batch_generated(7, 1)]
+    payload = [
+        {**CREATE_PAYLOAD, "appointment_time": _at(10).isoformat()},
+        {**CREATE_PAYLOAD, "appointment_time": _at(11).isoformat()},
+        {**CREATE_PAYLOAD, "appointment_time": _at(11).isoformat()},
+    ]
+    response = client.post("/appointments/batch", json=payload)
+    assert response.status_code == 207
+    results = response.json()["results"]
+    assert [r["status"] for r in results] == ["conflict", "created", "conflict"]
+    assert results[0]["errors"][0]["alternatives"][0] == _at(9, 30).isoformat()
+    inserts = [params for sql, params in fake_db.round_trips if sql == mysql_repository.INSERT_APPOINTMENT_ROW_SQL]
+    assert [len(params) for params in inserts] == [1]
+
+def test_create_batch_db_double_booking_rolls_back(fake_db):
+    fake_db.results = [{"error": _duplicate_slot()}]
+    response = client.post("/appointments/batch", json=[CREATE_PAYLOAD])
+    assert response.status_code == 409
+    assert fake_db.round_trips[-1] == ("ROLLBACK", None)
+
+def test_update_batch_double_booking_returns_409(fake_db):
+    fake_db.results = [{"error": _duplicate_slot()}]
+    response = client.patch("/appointments/batch", json=[{"id": 1, "status": "scheduled"}])
+    assert response.status_code == 409
+    assert fake_db.round_trips[-1] == ("ROLLBACK", None)
+
+def _book(conn, patient, slot, status="scheduled"):
+    cursor = conn.cursor()
+    try:
+        cursor.execute(mysql_repository.INSERT_APPOINTMENT_ROW_SQL, (
+            patient, f"{patient}@example.com", "Dr. Stress", "Stress", slot, status, None,
+        ))
+        return True
+    except mysql.connector.Error as e:
+        if mysql_repository._is_double_booking(e):
+            return False
+        raise
+    finally:
+        cursor.close()
+
+def test_concurrent_bookings_same_slot_one_wins(mysql_explain_conn):
+    """Cientos de reservas simultáneas del mismo turno desde conexiones distintas: gana una"""
+    threads, attempts = 100, 3
+    slot = datetime.datetime(2031, 3, 3, 9, 0)
+    barrier = threading.Barrier(threads)
+    outcomes, errors = [], []
+
+    def worker(n):
+        conn = mysql.connector.connect(
+            host=os.environ["MYSQL_TEST_HOST"],
+            port=int(os.getenv("MYSQL_TEST_PORT", "3306")),
+            user=os.getenv("MYSQL_TEST_USER", "root"),
+            password=os.getenv("MYSQL_TEST_PASSWORD", "rootpassword"),
+            database="appointments_db",
+            autocommit=True,
+        )
+        try:
+            barrier.wait()
+            for attempt in range(attempts):
+                outcomes.append(_book(conn, f"stress{n}-{attempt}", slot))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    assert errors == []
+    assert len(outcomes) == threads * attempts
+    assert outcomes.count(True) == 1
+    cursor = mysql_explain_conn.cursor()
+    cursor.execute(
+        "SELECT COUNT(*) FROM appointments WHERE doctor_name = 'Dr. Stress' AND appointment_time = %s", (slot,)
+    )
+    assert cursor.fetchone()[0] == 1
+    # Una cita cancelada no ocupa el turno: se puede volver a reservar
+    cursor.execute(
+        "UPDATE appointments SET status = 'cancelled' WHERE doctor_name = 'Dr. Stress' AND appointment_time = %s",
+        (slot,),
+    )
+    mysql_explain_conn.commit()
+    cursor.close()
+    assert _book(mysql_explain_conn, "after-cancel", slot)
+    assert _book(mysql_explain_conn, "cancelled-twice", slot, status="cancelled")
+    mysql_explain_conn.commit()
+
+def test_generated_range_follows_auto_increment_step(mysql_explain_conn):
+    """Con auto_increment_increment = 3 el lote recibe ids de 3 en 3 y se leen todos"""
+    rows = [
+        ("Step", "step@example.com", "Dr. Step", "Step", datetime.datetime(2032, 1, 5, 9 + i), "scheduled", None)
+        for i in range(3)
+    ]
+    cursor = mysql_explain_conn.cursor(dictionary=True)
+    cursor.execute("SET SESSION auto_increment_increment = 3")
+    try:
+        cursor.executemany(mysql_repository.INSERT_APPOINTMENT_ROW_SQL, rows)
+        first_id = cursor.lastrowid
+        cursor.execute(
+            mysql_repository.SELECT_GENERATED_RANGE_SQL, mysql_repository._generated_range_params(first_id, 3)
+        )
+        assert [row["id"] for row in cursor.fetchall()] == [first_id, first_id + 3, first_id + 6]
+    finally:
+        cursor.execute("SET SESSION auto_increment_increment = 1")
+        cursor.execute("DELETE FROM appointments WHERE doctor_name = 'Dr. Step'")
+        mysql_explain_conn.commit()
+        cursor.close()
+
+# -------------------
+# Repositorio SQLite (DB_BACKEND=sqlite): los mismos endpoints sobre una BD real embebida
+# -------------------
+@pytest.fixture
+def sqlite_repo(tmp_path, monkeypatch):
+    repo = SQLiteRepository(str(tmp_path / "appointments.db"), pool_size=2)
+    asyncio.run(repo.open())
+    monkeypatch.setattr(main, "repository", repo)
+    yield repo
+    asyncio.run(repo.close())
+
+def _sqlite_payload(hour, **overrides):
+    return dict(CREATE_PAYLOAD, appointment_time=f"2030-07-01T{hour:02d}:00:00", **overrides)
+
+def test_create_repository_from_config(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "DB_BACKEND", "sqlite")
+    monkeypatch.setattr(main, "SQLITE_PATH", str(tmp_path / "a.db"))
+    assert isinstance(main.create_repository(), SQLiteRepository)
+    monkeypatch.setattr(main, "DB_BACKEND", "mysql")
+    assert isinstance(main.create_repository(), MySQLRepository)
+
+def test_sqlite_exhausted_pool_answers_503(tmp_path, monkeypatch):
+    repo = SQLiteRepository(str(tmp_path / "appointments.db"), pool_size=1, pool_timeout=0.05)
+    asyncio.run(repo.open())
+    monkeypatch.setattr(main, "repository", repo)
+    try:
+        with repo._connection():
+            response = client.get("/appointments/1")
+        assert response.status_code == 503
+        assert response.json()["detail"] == "Database busy, try again later"
+        assert client.post("/appointments/", json=_sqlite_payload(9)).status_code == 200
+    finally:
+        asyncio.run(repo.close())
+
+def test_sqlite_crud(sqlite_repo):
+    created = client.post("/appointments/", json=_sqlite_payload(9))
+    assert created.status_code == 200
+    appointment = created.json()
+    assert appointment["status"] == "scheduled"
+    assert appointment["appointment_time"] == "2030-07-01T09:00:00"
+
+    fetched = client.get(f"/appointments/{appointment['id']}")
+    assert fetched.json() == appointment
+    revalidated = client.get(f"/appointments/{appointment['id']}", headers={"If-None-Match": fetched.headers["ETag"]})
+    assert revalidated.status_code == 304
+
+    updated = client.put(f"/appointments/{appointment['id']}", json={"notes": "Ayuno", "status": "completed"})
+    assert updated.status_code == 200
+    assert (updated.json()["notes"], updated.json()["status"]) == ("Ayuno", "completed")
+    assert client.put("/appointments/999", json={"notes": "x"}).status_code == 404
+
+    assert client.delete(f"/appointments/{appointment['id']}").status_code == 200
+    assert client.get(f"/appointments/{appointment['id']}").status_code == 404
+    assert client.delete(f"/appointments/{appointment['id']}").status_code == 404
+
+def test_sqlite_list_pagination_filters_and_etag(sqlite_repo, no_cache):
+    for hour in range(8, 13):
+        doctor = "Dr. A" if hour % 2 else "Dr. B"
+        assert client.post("/appointments/", json=_sqlite_payload(hour, doctor_name=doctor)).status_code == 200
+
+    first = client.get("/appointments/?limit=3")
+    assert [a["id"] for a in first.json()] == [5, 4, 3]
+    second = client.get(f"/appointments/?limit=3&cursor={first.headers['X-Next-Cursor']}")
+    assert [a["id"] for a in second.json()] == [2, 1]
+    assert "X-Next-Cursor" not in second.headers
+
+    filtered = client.get("/appointments/?doctor_name=Dr. A&fields=doctor_name")
+    assert filtered.json() == [{"doctor_name": "Dr. A"}, {"doctor_name": "Dr. A"}]
+
+    # El ETag de la consulta de versión coincide con el de la página completa
+    etag = first.headers["ETag"]
+    assert client.get("/appointments/?limit=3", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/appointments/?limit=2", headers={"If-None-Match": etag}).status_code == 200
+
+@pytest.fixture
+def fast_json(monkeypatch):
+    monkeypatch.setattr(main, "FAST_JSON_ENDPOINTS", frozenset(main.FAST_JSON_SUPPORTED))
+
+def _seed_sqlite(count):
+    for i in range(count):
+        payload = _sqlite_payload(8 + i % 10, doctor_name=f"Dr. {i // 10}", notes=None if i % 2 else "Ayuno")
+        assert client.post("/appointments/", json=payload).status_code == 200
+
+def test_fast_json_responses_match_model_path(sqlite_repo, no_cache, monkeypatch):
+    _seed_sqlite(12)
+    requests = [
+        ("get", "/appointments/?limit=5", None),
+        ("get", "/appointments/?limit=50&doctor_name=Dr. 1", None),
+        ("get", "/appointments/?fields=patient_email,appointment_time", None),
+        ("get", "/appointments/?fields=notes", None),
+        ("get", "/appointments/3", None),
+    ]
+
+    def responses():
+        results = []
+        for method, url, body in requests:
+            response = client.request(method, url, json=body)
+            results.append((response.status_code, response.content, response.headers.get("ETag"),
+                            response.headers.get("X-Next-Cursor")))
+        return results
+
+    model = responses()
+    before_update = client.get("/appointments/4").json()
+    monkeypatch.setattr(main, "FAST_JSON_ENDPOINTS", frozenset(main.FAST_JSON_SUPPORTED))
+    # Mismos bytes: mismo orden de campos y mismo formato de fechas que Pydantic
+    assert responses() == model
+
+    cursor = model[0][3]
+    assert client.get(f"/appointments/?limit=5&cursor={cursor}").json()[0]["id"] == 7
+
+    updated = client.put("/appointments/4", json={"notes": "Control"})
+    assert updated.status_code == 200
+    assert list(updated.json()) == list(main.APPOINTMENT_OUT_FIELDS)
+    assert updated.json() == dict(before_update, notes="Control", updated_at=updated.json()["updated_at"])
+
+def test_fast_json_create_matches_model_path(sqlite_repo, monkeypatch, availability):
+    model = client.post("/appointments/", json=_sqlite_payload(9))
+    monkeypatch.setattr(main, "FAST_JSON_ENDPOINTS", frozenset({"create_appointment"}))
+    fast = client.post("/appointments/", json=_sqlite_payload(10))
+    assert fast.status_code == 200
+    expected = dict(model.json(), id=2, appointment_time="2030-07-01T10:00:00",
+                    created_at=fast.json()["created_at"], updated_at=fast.json()["updated_at"])
+    assert fast.json() == expected
+    assert list(fast.json()) == list(model.json())
+    # La cita creada por el camino rápido también entra en el índice de horarios
+    assert main.availability_index.is_booked("Dr. Test", datetime.datetime(2030, 7, 1, 10, 0))
+
+def test_fast_json_list_cache_stores_encoded_body(sqlite_repo, fast_json):
+    _seed_sqlite(3)
+    first = client.get("/appointments/")
+    with patch.object(sqlite_repo, "list_rows", side_effect=AssertionError("served from cache")):
+        cached = client.get("/appointments/")
+    assert cached.content == first.content
+    assert cached.headers["ETag"] == first.headers["ETag"]
+    assert cached.headers["content-type"] == "application/json"
+
+def test_list_cache_entries_are_readable_by_both_paths(sqlite_repo, monkeypatch):
+    # Réplicas con distinta configuración comparten la caché de Redis
+    _seed_sqlite(3)
+    model = client.get("/appointments/").json()
+    monkeypatch.setattr(main, "FAST_JSON_ENDPOINTS", frozenset({"list_appointments"}))
+    assert client.get("/appointments/").json() == model
+    main.response_cache.backend._entries.clear()
+    fast = client.get("/appointments/").json()
+    monkeypatch.setattr(main, "FAST_JSON_ENDPOINTS", frozenset())
+    assert client.get("/appointments/").json() == fast == model
+
+def test_sqlite_list_rows_are_tuples_in_column_order(sqlite_repo):
+    _seed_sqlite(2)
+    columns = ["id", "notes", "appointment_time", "updated_at"]
+    rows = asyncio.run(sqlite_repo.list_rows(columns, {}, None, 10))
+    dicts = asyncio.run(sqlite_repo.list(columns, {}, None, 10))
+    assert rows == [tuple(row[c] for c in columns) for row in dicts]
+    assert isinstance(rows[0][2], datetime.datetime)
+
+def test_mysql_list_rows_uses_tuple_cursor():
+    conn = MagicMock()
+    conn.cursor.return_value.fetchall.return_value = [(1, "Patient")]
+    with patch.object(mysql_repo, "connection", return_value=conn):
+        rows = asyncio.run(mysql_repo.list_rows(["id", "patient_name"], {}, None, 10))
+    assert rows == [(1, "Patient")]
+    conn.cursor.assert_called_once_with(dictionary=False)
+
+def test_unknown_fast_json_endpoint_is_reported(monkeypatch):
+    monkeypatch.setenv("FAST_JSON_ENDPOINTS", "list_appointments,delete_appointment")
+    service_dir = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run(
+        [sys.executable, "-c", "import main; print(sorted(main.FAST_JSON_ENDPOINTS))"],
+        cwd=service_dir, env=dict(os.environ, DB_BACKEND="sqlite", TRACE_EXPORTER="none"),
+        check=True, capture_output=True, text=True,
+    )
+    assert "['delete_appointment', 'list_appointments']" in output.stdout
+    assert "delete_appointment has no fast serialization path" in output.stderr
+
+def test_sqlite_double_booking(sqlite_repo):
+    assert client.post("/appointments/", json=_sqlite_payload(9)).status_code == 200
+    conflict = client.post("/appointments/", json=_sqlite_payload(9, patient_name="Other"))
+    assert conflict.status_code == 409
+    assert conflict.json()["detail"]["doctor_name"] == "Dr. Test"
+
+    other = client.post("/appointments/", json=_sqlite_payload(10)).json()
+    moved = client.put(f"/appointments/{other['id']}", json={"appointment_time": "2030-07-01T09:00:00"})
+    assert moved.status_code == 409
+
+    # Una cita cancelada libera el turno
+    assert client.put("/appointments/1", json={"status": "cancelled"}).status_code == 200
+    assert client.post("/appointments/", json=_sqlite_payload(9, patient_name="Other")).status_code == 200
+
+def test_sqlite_batch_is_atomic(sqlite_repo):
+    created = client.post("/appointments/batch", json=[_sqlite_payload(h) for h in (9, 10, 11)])
+    assert created.json()["succeeded"] == 3
+    ids = [r["appointment"]["id"] for r in created.json()["results"]]
+
+    updated = client.patch("/appointments/batch", json=[
+        {"id": ids[0], "notes": "a"},
+        {"id": 999, "notes": "b"},
+    ])
+    assert [r["status"] for r in updated.json()["results"]] == ["updated", "not_found"]
+    assert client.get(f"/appointments/{ids[0]}").json()["notes"] == "a"
+
+    # Un choque en la BD deshace el lote entero
+    conflict = client.patch("/appointments/batch", json=[
+        {"id": ids[0], "notes": "no aplicado"},
+        {"id": ids[1], "appointment_time": "2030-07-01T11:00:00"},
+    ])
+    assert conflict.status_code == 409
+    assert client.get(f"/appointments/{ids[0]}").json()["notes"] == "a"
+
+def test_sqlite_export(sqlite_repo, monkeypatch):
+    monkeypatch.setattr(sqlite_repo, "export_fetch_size", 2)
+    for hour in range(8, 13):
+        client.post("/appointments/", json=_sqlite_payload(hour))
+    response = client.get("/appointments/export?format=csv&fields=id,appointment_time")
+    assert response.text.splitlines() == ["id,appointment_time"] + [
+        f"{6 - i},2030-07-01T{7 + 6 - i:02d}:00:00" for i in range(1, 6)
+    ]
+
+def test_sqlite_availability_index_loads_from_repository(sqlite_repo, availability):
+    client.post("/appointments/", json=_sqlite_payload(9))
+    doctors, booked = asyncio.run(sqlite_repo.load_availability(datetime.datetime(2030, 1, 1)))
+    assert doctors == [("Dr. Test", "Test")]
+    assert booked == [(1, "Dr. Test", "Test", datetime.datetime(2030, 7, 1, 9, 0), "scheduled")]
+
+def test_sqlite_concurrent_bookings_same_slot_one_wins(sqlite_repo):
+    """Escrituras simultáneas desde varios hilos y conexiones: el índice único deja pasar una"""
+    threads = 20
+    barrier = threading.Barrier(threads)
+    outcomes, errors = [], []
+    values = ("P", "p@example.com", "Dr. Stress", "Stress", datetime.datetime(2031, 3, 3, 9), "scheduled", None)
+
+    def worker():
+        barrier.wait()
+        try:
+            sqlite_repo._create_sync(values)
+            outcomes.append(True)
+        except DoubleBookingError:
+            outcomes.append(False)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    assert errors == []
+    assert outcomes.count(True) == 1
+
+# -------------------
+# Desglose por fases y perfilador por muestreo
+# -------------------
+def _phase_count(endpoint, name):
+    value = REGISTRY.get_sample_value(
+        "appointment_service_request_phase_seconds_count", {"endpoint": endpoint, "phase": name}
+    )
+    return value or 0
+
+def _phase_counts(endpoint):
+    return {name: _phase_count(endpoint, name) for name in PHASES}
+
+def test_phase_breakdown_sync_driver(fake_db, no_cache):
+    # Las fases medidas en el hilo del driver sync llegan al acumulador de la petición
+    before = _phase_counts("get_appointment")
+    fake_db.results = [{"rows": [FAKE_ROW]}]
+    assert client.get("/appointments/1").status_code == 200
+    after = _phase_counts("get_appointment")
+    assert {name: after[name] - before[name] for name in after} == {
+        "connect": 1, "query": 1, "fetch": 1, "model": 1, "serialize": 1,
+    }
+
+def test_phase_breakdown_async_driver(fake_async_db, no_cache):
+    before = _phase_counts("list_appointments")
+    fake_async_db.results = [{"rows": [FAKE_ROW]}]
+    assert client.get("/appointments/").status_code == 200
+    after = _phase_counts("list_appointments")
+    assert all(after[name] == before[name] + 1 for name in after)
+
+def test_phase_breakdown_sqlite(sqlite_repo):
+    before = _phase_counts("create_appointment")
+    assert client.post("/appointments/", json=_sqlite_payload(9)).status_code == 200
+    after = _phase_counts("create_appointment")
+    assert [name for name in after if after[name] > before[name]] == ["connect", "query", "model"]
+
+def test_phase_outside_request_records_nothing():
+    with phase("query"):
+        pass
+    timings, token = start_request_phases()
+    with phase("query"):
+        pass
+    with phase("query"):
+        pass
+    end_request_phases(token)
+    assert list(timings) == ["query"] and timings["query"] >= 0
+    with phase("query"):
+        pass
+    assert list(timings) == ["query"]
+
+def test_idle_profiling_hooks_are_cheap():
+    """Sin perfil activo, lo que se añade a cada petición se mide en nanosegundos"""
+    profiler = SamplingProfiler()
+    iterations = 20000
+    start = time.perf_counter()
+    for _ in range(iterations):
+        profiler.request_finished()
+        with phase("query"):
+            pass
+    per_call = (time.perf_counter() - start) / iterations
+    assert per_call < 20e-6
+
+def test_profiler_collects_collapsed_stacks_for_n_requests(tmp_path):
+    output = tmp_path / "stacks.txt"
+    profiler = SamplingProfiler()
+    assert profiler.start(3, interval=0.001, output=str(output))
+    assert not profiler.start(3)
+    deadline = time.monotonic() + 5
+    while profiler.status()["samples"] < 5 and time.monotonic() < deadline:
+        time.sleep(0.005)
+    for _ in range(3):
+        profiler.request_finished()
+    profiler._thread.join(timeout=5)
+
+    status = profiler.status()
+    assert not status["active"] and status["remaining_requests"] == 0 and status["samples"] >= 5
+    lines = profiler.collapsed().splitlines()
+    assert lines and output.read_text().splitlines() == lines
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) >= 1
+    # La raíz es el nombre del hilo; el perfilador no se muestrea a sí mismo
+    assert any(line.startswith("MainThread;") for line in lines)
+    assert not any(line.startswith("sampling-profiler;") for line in lines)
+
+def test_admin_profile_disabled_without_token(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "")
+    assert client.post("/admin/profile").status_code == 404
+    assert client.get("/admin/profile/stacks").status_code == 404
+
+def test_admin_profile_endpoints(monkeypatch, sqlite_repo):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "s3cret")
+    monkeypatch.setattr(main, "profiler", SamplingProfiler())
+    headers = {"X-Admin-Token": "s3cret"}
+    assert client.post("/admin/profile", headers={"X-Admin-Token": "nope"}).status_code == 403
+
+    started = client.post("/admin/profile?requests=2&interval_ms=1", headers=headers)
+    assert started.status_code == 200
+    assert started.json()["active"] and started.json()["remaining_requests"] == 2
+    assert client.post("/admin/profile", headers=headers).status_code == 409
+
+    # Solo cuentan las peticiones a endpoints medidos, no las de administración
+    client.get("/appointments/1")
+    assert client.get("/admin/profile", headers=headers).json()["remaining_requests"] == 1
+    client.get("/appointments/2")
+    main.profiler._thread.join(timeout=5)
+    assert client.get("/admin/profile", headers=headers).json()["active"] is False
+
+    stacks = client.get("/admin/profile/stacks", headers=headers)
+    assert stacks.headers["content-type"].startswith("text/plain")
+
+    assert client.post("/admin/profile?requests=1000", headers=headers).status_code == 200
+    stopped = client.delete("/admin/profile", headers=headers)
+    assert stopped.json()["active"] is False
+
+# -------------------
+# Trazas: muestreo en cabeza/cola, propagación W3C y spans de BD
+# -------------------
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_SPAN_ID = "00f067aa0ba902b7"
+
+def _traceparent(sampled=True):
+    return f"00-{TRACE_ID}-{PARENT_SPAN_ID}-{'01' if sampled else '00'}"
+
+@pytest.fixture
+def make_tracing(monkeypatch, sqlite_repo):
+    """Trazas a un exportador en memoria mientras dura el test"""
+    created = []
+
+    def make(**kwargs):
+        options = dict(head_ratio=1.0, tail_latency=10.0)
+        options.update(kwargs)
+        tracing = Tracing("appointment-service", InMemorySpanExporter(), **options)
+        monkeypatch.setattr(main, "tracer", tracing.tracer)
+        monkeypatch.setattr(main, "repository", TracedRepository(sqlite_repo, tracing.tracer, "sqlite"))
+        created.append(tracing)
+        return tracing
+
+    yield make
+    for tracing in created:
+        tracing.shutdown()
+
+def _exported(tracing):
+    tracing.provider.force_flush()
+    return tracing.exporter.get_finished_spans()
+
+def test_sampler_head_and_tail_decisions():
+    trace_id = int(TRACE_ID, 16)
+    assert HeadTailSampler(0.0).should_sample(None, trace_id, "x").decision is Decision.DROP
+    assert HeadTailSampler(1.0).should_sample(None, trace_id, "x").decision is Decision.RECORD_AND_SAMPLE
+    assert HeadTailSampler(0.0, 1.0).should_sample(None, trace_id, "x").decision is Decision.RECORD_ONLY
+    # Decisión por trace id: el mismo id da lo mismo en cualquier servicio con la misma fracción
+    low = trace_id & ((1 << 64) - 1)
+    ratio = low / 2 ** 64
+    assert HeadTailSampler(ratio + 0.01).should_sample(None, trace_id, "x").decision is Decision.RECORD_AND_SAMPLE
+    assert HeadTailSampler(ratio - 0.01).should_sample(None, trace_id, "x").decision is Decision.DROP
+
+def test_sampler_follows_remote_parent():
+    sampler = HeadTailSampler(1.0)
+    def parent(flags):
+        context = trace.SpanContext(int(TRACE_ID, 16), int(PARENT_SPAN_ID, 16), True, trace.TraceFlags(flags))
+        return trace.set_span_in_context(trace.NonRecordingSpan(context))
+    assert sampler.should_sample(parent(1), int(TRACE_ID, 16), "x").decision is Decision.RECORD_AND_SAMPLE
+    # El gateway no la muestreó: sin cola no se registra aunque aquí la fracción sea 1
+    assert sampler.should_sample(parent(0), int(TRACE_ID, 16), "x").decision is Decision.DROP
+    assert HeadTailSampler(0.0, 1.0).should_sample(parent(0), int(TRACE_ID, 16), "x").decision is Decision.RECORD_ONLY
+
+def test_trace_continues_from_traceparent_with_db_spans(make_tracing):
+    tracing = make_tracing()
+    created = client.post("/appointments/", json=_sqlite_payload(9)).json()
+    _exported(tracing)
+    tracing.exporter.clear()
+
+    response = client.get(f"/appointments/{created['id']}", headers={"traceparent": _traceparent()})
+    assert response.status_code == 200
+    spans = {span.name: span for span in _exported(tracing)}
+    server = spans["GET /appointments/{appointment_id}"]
+    handler = spans["get_appointment"]
+    db = spans["SELECT appointments"]
+    assert {format(span.context.trace_id, "032x") for span in spans.values()} == {TRACE_ID}
+    assert server.kind is SpanKind.SERVER and server.parent.span_id == int(PARENT_SPAN_ID, 16)
+    assert handler.parent.span_id == server.context.span_id
+    assert db.parent.span_id == handler.context.span_id
+    assert db.kind is SpanKind.CLIENT
+    assert db.attributes["db.system"] == "sqlite" and db.attributes["code.function"] == "get"
+    assert db.attributes["db.query_ms"] >= 0 and "db.fetch_ms" in db.attributes
+
+def test_unsampled_traceparent_is_not_exported(make_tracing):
+    tracing = make_tracing(head_ratio=1.0)
+    client.get("/appointments/1", headers={"traceparent": _traceparent(sampled=False)})
+    assert _exported(tracing) == ()
+
+def test_head_ratio_zero_exports_nothing(make_tracing):
+    tracing = make_tracing(head_ratio=0.0)
+    client.post("/appointments/", json=_sqlite_payload(9))
+    client.get("/appointments/1")
+    assert _exported(tracing) == ()
+
+def test_tail_sampling_keeps_errors_and_slow_traces(make_tracing, monkeypatch):
+    decisions = []
+    tracing = make_tracing(head_ratio=0.0, tail_ratio=1.0, tail_latency=10.0, on_tail_decision=decisions.append)
+    assert client.post("/appointments/", json=_sqlite_payload(9)).status_code == 200
+    assert _exported(tracing) == ()
+
+    working_get = main.repository.inner.get
+
+    async def failing_get(appointment_id):
+        raise RuntimeError("db down")
+    monkeypatch.setattr(main.repository.inner, "get", failing_get)
+    assert client.get("/appointments/1").status_code == 500
+    exported = _exported(tracing)
+    assert decisions == [False, True]
+    assert {span.name for span in exported} >= {"get_appointment", "SELECT appointments"}
+    assert all(span.context.trace_flags.sampled for span in exported)
+    assert any(span.status.status_code is StatusCode.ERROR for span in exported)
+
+    # Con umbral 0 cualquier traza registrada cuenta como lenta
+    tracing.provider._active_span_processor._span_processors[0].latency_threshold_ns = 0
+    monkeypatch.setattr(main.repository.inner, "get", working_get)
+    tracing.exporter.clear()
+    assert client.get("/appointments/1").status_code == 200
+    assert decisions[-1] is True and len(_exported(tracing)) > 0
+
+def test_export_never_blocks_requests(make_tracing):
+    class SlowExporter(InMemorySpanExporter):
+        def export(self, spans):
+            time.sleep(0.5)
+            return SpanExportResult.SUCCESS
+
+    tracing = make_tracing(export_delay=0.001, queue_size=4, batch_size=1)
+    tracing.exporter = SlowExporter()
+    tracing.provider._active_span_processor._span_processors[0].processor._batch_processor._exporter = tracing.exporter
+    start = time.perf_counter()
+    for hour in range(8, 13):
+        assert client.post("/appointments/", json=_sqlite_payload(hour)).status_code == 200
+    # La exportación (0,5 s por lote) va en su hilo; la cola llena descarta spans
+    assert time.perf_counter() - start < 1.0
+
+# -------------------
+# Métricas por petición (request_metrics.py)
+# -------------------
+def _request_count(method, endpoint, status):
+    value = REGISTRY.get_sample_value(
+        "appointment_service_requests_total",
+        {"method": method, "endpoint": endpoint, "http_status": status},
+    )
+    return value or 0
+
+def test_request_metrics_use_the_request_method(sqlite_repo):
+    # Antes el método salía del nombre de la función: update_appointments_batch contaba como PUT
+    created = client.post("/appointments/", json=_sqlite_payload(9)).json()
+    before = _request_count("PATCH", "update_appointments_batch", "200")
+    response = client.patch("/appointments/batch", json=[{"id": created["id"], "notes": "x"}])
+    assert response.status_code == 200
+    assert _request_count("PATCH", "update_appointments_batch", "200") == before + 1
+    assert _request_count("PUT", "update_appointments_batch", "200") == 0
+
+def test_request_metrics_count_validation_errors_and_unmatched_routes():
+    before_invalid = _request_count("POST", "create_appointment", "422")
+    before_unmatched = _request_count("other", "unmatched", "404")
+    assert client.post("/appointments/", json={}).status_code == 422
+    assert client.request("PROPFIND", "/no-such-route").status_code == 404
+    assert _request_count("POST", "create_appointment", "422") == before_invalid + 1
+    assert _request_count("other", "unmatched", "404") == before_unmatched + 1
+
+def test_request_metrics_skip_health_and_metrics():
+    before = REGISTRY.get_sample_value(
+        "appointment_service_request_latency_seconds_count", {"method": "GET", "endpoint": "health_check"}
+    )
+    client.get("/health")
+    client.get("/metrics")
+    assert before is None
+    assert REGISTRY.get_sample_value(
+        "appointment_service_request_latency_seconds_count", {"method": "GET", "endpoint": "health_check"}
+    ) is None
+    assert _request_count("GET", "metrics", "200") == 0
+
+def test_access_log_is_rate_limited(monkeypatch, caplog):
+    now = [100.2]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    log = RateLimitedLog(logging.getLogger("access-test"), rate=2)
+    with caplog.at_level(logging.INFO, logger="access-test"):
+        for i in range(5):
+            log.log(logging.INFO, "request %d", i)
+        now[0] = 101.1
+        log.log(logging.INFO, "request %d", 5)
+    assert [r.getMessage() for r in caplog.records] == [
+        "request 0", "request 1", "3 request log lines suppressed (limit 2/s)", "request 5",
+    ]
+
+MULTIPROCESS_WORKER = """
+import sys
+from fastapi.testclient import TestClient
+import main
+with TestClient(main.app) as client:
+    for _ in range(int(sys.argv[1])):
+        assert client.get("/appointments/?limit=1").status_code == 200
+    if len(sys.argv) > 2:
+        print(client.get("/metrics").text)
+"""
+
+def test_metrics_aggregate_across_worker_processes(tmp_path):
+    # Cada proceso escribe sus métricas en PROMETHEUS_MULTIPROC_DIR; /metrics suma las de todos
+    metrics_dir = tmp_path / "metrics"
+    metrics_dir.mkdir()
+    env = dict(
+        os.environ,
+        PROMETHEUS_MULTIPROC_DIR=str(metrics_dir),
+        DB_BACKEND="sqlite",
+        SQLITE_PATH=str(tmp_path / "appointments.db"),
+        CACHE_BACKEND="none",
+        TRACE_EXPORTER="none",
+    )
+    service_dir = os.path.dirname(os.path.abspath(__file__))
+
+    def run(*args):
+        return subprocess.run(
+            [sys.executable, "-c", MULTIPROCESS_WORKER, *args],
+            cwd=service_dir, env=env, check=True, capture_output=True, text=True,
+        ).stdout
+
+    run("2")
+    run("3")
+    scraped = run("1", "scrape")
+    expected = 'appointment_service_requests_total{endpoint="list_appointments",http_status="200",method="GET"} 6.0'
+    assert expected in scraped
+    assert "appointment_service_db_pool_connections_in_use" in scraped
+
+def test_liveness_does_not_touch_the_database():
+    with patch("main.repository.ping", side_effect=AssertionError("liveness must not query the DB")):
+        assert client.get("/health/live").json() == {"status": "ok"}
+
+def test_readiness_requires_warm_up_and_loaded_index(sqlite_repo, monkeypatch):
+    monkeypatch.setattr(main, "service_status", "starting")
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"] == {"lifecycle": "starting", "database": "ok", "availability_index": "loading"}
+
+    monkeypatch.setattr(main, "service_status", "ready")
+    assert client.get("/health/ready").status_code == 503
+    asyncio.run(main.refresh_availability_index())
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    assert response.json() == {
+        "status": "ready",
+        "checks": {"lifecycle": "ready", "database": "ok", "availability_index": "loaded"},
+        "db_connections_in_use": 0,
+    }
+
+def test_readiness_fails_when_pool_cannot_reach_database(sqlite_repo, monkeypatch):
+    monkeypatch.setattr(main, "service_status", "ready")
+    asyncio.run(main.refresh_availability_index())
+    with patch.object(sqlite_repo, "ping", side_effect=sqlite3.OperationalError("disk I/O error")):
+        response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"]["database"] == "unavailable"
+
+def test_readiness_times_out_on_a_stuck_pool(sqlite_repo, monkeypatch):
+    async def stuck():
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(main, "service_status", "ready")
+    monkeypatch.setattr(main, "READINESS_TIMEOUT_SECONDS", 0.05)
+    with patch.object(sqlite_repo, "ping", side_effect=stuck):
+        assert client.get("/health/ready").json()["checks"]["database"] == "timeout"
+
+def test_readiness_fails_while_draining(sqlite_repo, monkeypatch):
+    monkeypatch.setattr(main, "service_status", "draining")
+    asyncio.run(main.refresh_availability_index())
+    response = client.get("/health/ready")
+    assert response.status_code == 503
+    assert response.json()["checks"]["database"] == "skipped"
+
+def test_lifespan_warms_pool_before_ready_and_drains_on_shutdown(tmp_path, monkeypatch):
+    repo = SQLiteRepository(str(tmp_path / "appointments.db"), pool_size=3)
+    monkeypatch.setattr(main, "repository", repo)
+    warm_up = repo.warm_up
+    calls = []
+
+    async def record_warm_up(connections):
+        calls.append((connections, main.service_status))
+        await warm_up(connections)
+
+    monkeypatch.setattr(repo, "warm_up", record_warm_up)
+    with TestClient(app) as lifespan_client:
+        assert calls == [(main.DB_POOL_WARM_CONNECTIONS, "starting")]
+        assert lifespan_client.get("/health/ready").status_code == 200
+    assert main.service_status == "draining"
+
+def test_drain_waits_for_connections_in_use(monkeypatch):
+    in_use = [2, 1, 0]
+    monkeypatch.setattr(main, "repository", MagicMock(in_use=lambda: in_use.pop(0) if len(in_use) > 1 else in_use[0]))
+    asyncio.run(main.drain_connections(1))
+    assert in_use == [0]
+
+def test_drain_gives_up_after_timeout(monkeypatch, caplog):
+    monkeypatch.setattr(main, "repository", MagicMock(in_use=lambda: 1))
+    with caplog.at_level(logging.WARNING, logger="appointment-service"):
+        asyncio.run(main.drain_connections(0.1))
+    assert "1 connection(s) still in use" in caplog.text
+
+def test_sqlite_connections_in_use(sqlite_repo):
+    with sqlite_repo._connection():
+        assert sqlite_repo.in_use() == 1
+    assert sqlite_repo.in_use() == 0
+
+def test_worker_count_from_cpus(tmp_path, monkeypatch):
+    cpu_max = tmp_path / "cpu.max"
+    cpu_max.write_text("max 100000\n")
+    assert serve.cgroup_cpu_limit(str(cpu_max)) is None
+    cpu_max.write_text("150000 100000\n")
+    assert serve.cgroup_cpu_limit(str(cpu_max)) == 2
+    assert serve.cgroup_cpu_limit(str(tmp_path / "missing")) is None
+
+    monkeypatch.setattr(serve, "cgroup_cpu_limit", lambda: 2)
+    monkeypatch.setattr(serve.os, "sched_getaffinity", lambda pid: {0, 1, 2, 3}, raising=False)
+    assert serve.worker_count("auto") == 2
+    assert serve.worker_count("3") == 3
+    assert serve.worker_count("0") == 1
+
+def test_memory_cache_is_disabled_with_several_workers(monkeypatch, caplog):
+    monkeypatch.delenv("CACHE_BACKEND", raising=False)
+    assert serve.resolve_cache_backend(1) == "memory"
+    assert "CACHE_BACKEND" not in os.environ
+    with caplog.at_level(logging.WARNING, logger="appointment-service.serve"):
+        assert serve.resolve_cache_backend(4) == "none"
+    assert os.environ["CACHE_BACKEND"] == "none"
+    assert "caching disabled" in caplog.text
+    monkeypatch.setenv("CACHE_BACKEND", "redis")
+    assert serve.resolve_cache_backend(4) == "redis"
+
+def test_availability_refresh_is_shortened_with_several_workers(monkeypatch, caplog):
+    monkeypatch.delenv("AVAILABILITY_REFRESH_SECONDS", raising=False)
+    assert serve.resolve_availability_refresh(1) == 300
+    assert "AVAILABILITY_REFRESH_SECONDS" not in os.environ
+    with caplog.at_level(logging.WARNING, logger="appointment-service.serve"):
+        assert serve.resolve_availability_refresh(4) == serve.AVAILABILITY_WORKERS_REFRESH_SECONDS
+    assert float(os.environ["AVAILABILITY_REFRESH_SECONDS"]) == serve.AVAILABILITY_WORKERS_REFRESH_SECONDS
+    assert "availability index is per process" in caplog.text
+    # 0 (solo al arrancar) no vale con varios workers; un intervalo más corto se respeta
+    monkeypatch.setenv("AVAILABILITY_REFRESH_SECONDS", "0")
+    assert serve.resolve_availability_refresh(4) == serve.AVAILABILITY_WORKERS_REFRESH_SECONDS
+    monkeypatch.setenv("AVAILABILITY_REFRESH_SECONDS", "2")
+    assert serve.resolve_availability_refresh(4) == 2
+
+def test_loop_and_parser_selection(monkeypatch):
+    monkeypatch.setattr(serve, "_installed", lambda module: False)
+    assert (serve.resolve_loop("auto"), serve.resolve_http("auto")) == ("asyncio", "h11")
+    monkeypatch.setattr(serve, "_installed", lambda module: True)
+    assert (serve.resolve_loop("auto"), serve.resolve_http("auto")) == ("uvloop", "httptools")
+    assert serve.resolve_loop("asyncio") == "asyncio"
+
+def test_serve_runs_workers_and_stops_gracefully(tmp_path):
+    import httpx
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    env = dict(
+        os.environ,
+        WEB_CONCURRENCY="2",
+        HOST="127.0.0.1",
+        PORT=str(port),
+        DB_BACKEND="sqlite",
+        SQLITE_PATH=str(tmp_path / "appointments.db"),
+        CACHE_BACKEND="none",
+        TRACE_EXPORTER="none",
+        GRACEFUL_TIMEOUT="5",
+    )
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    service_dir = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen(
+        [sys.executable, "serve.py"], cwd=service_dir, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            assert process.poll() is None, process.stdout.read()
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/health/ready", timeout=1).status_code == 200:
+                    break
+            except httpx.HTTPError:
+                pass
+            assert time.monotonic() < deadline, "serve.py did not become ready"
+            time.sleep(0.1)
+        assert httpx.post(f"http://127.0.0.1:{port}/appointments/", json=CREATE_PAYLOAD).status_code == 200
+        # /metrics suma los dos workers: el servidor activa el modo multiproceso por su cuenta
+        scraped = httpx.get(f"http://127.0.0.1:{port}/metrics").text
+        assert 'endpoint="create_appointment",http_status="200",method="POST"} 1.0' in scraped
+    finally:
+        process.send_signal(signal.SIGTERM)
+        output = process.communicate(timeout=30)[0]
+    assert process.returncode == 0, output
+    assert output.count("Application shutdown complete") == 2
@@ -0,0 +1,335 @@
+"""Backend SQLite embebido (DB_BACKEND=sqlite).
+
+- Modo WAL: las lecturas no esperan a la escritura en curso, y SQLite admite un
+  solo escritor a la vez (busy_timeout en vez de fallar al instante).
+- Sentencias preparadas: el SQL de cada operación es constante (o depende solo
+  de las columnas), así que el caché de sentencias de cada conexión lo compila
+  una vez y lo reutiliza.
+- Un pool fijo de conexiones, usadas desde el threadpool. Si no queda ninguna
+  libre en pool_timeout segundos, 503 como el pool de MySQL: esperar sin límite
+  dejaría todos los hilos del threadpool bloqueados.
+
+Fechas: se guardan como texto ISO ("YYYY-MM-DD HH:MM:SS"), que ordena igual que
+el DATETIME de MySQL, y se devuelven como datetime.
+"""
+import datetime
+import itertools
+import logging
+import queue
+import sqlite3
+from contextlib import contextmanager
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from profiling import phase
+from repository import (
+    APPOINTMENT_COLUMNS, APPOINTMENT_WRITE_COLUMNS, DOUBLE_BOOKING_KEY, AppointmentRepository, DoubleBookingError,
+    build_filtered_select, build_list_query, build_list_version_query,
+)
+
+logger = logging.getLogger("appointment-service.sqlite")
+
+DATETIME_COLUMNS = frozenset({"appointment_time", "created_at", "updated_at", "max_updated_at"})
+
+# Equivalente de mysql-init/init_db.sql y migrations/ (mismo nombre de índices)
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS appointments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_name TEXT NOT NULL,
+    patient_email TEXT NOT NULL,
+    doctor_name TEXT NOT NULL,
+    doctor_specialty TEXT NOT NULL,
+    appointment_time TEXT NOT NULL,
+    status TEXT DEFAULT 'scheduled'
+        CHECK (status IN ('scheduled', 'cancelled', 'completed', 'rescheduled')),
+    notes TEXT,
+    created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),
+    updated_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime'))
+);
+CREATE INDEX IF NOT EXISTS idx_appointments_created_id ON appointments (created_at, id);
+CREATE INDEX IF NOT EXISTS idx_appointments_doctor_time ON appointments (doctor_name, appointment_time);
+CREATE INDEX IF NOT EXISTS idx_appointments_specialty_time ON appointments (doctor_specialty, appointment_time);
+CREATE INDEX IF NOT EXISTS idx_appointments_patient_time ON appointments (patient_email, appointment_time);
+CREATE INDEX IF NOT EXISTS idx_appointments_status_time ON appointments (status, appointment_time);
+-- Doble reserva: como la columna active_slot de MySQL, las canceladas no cuentan
+CREATE UNIQUE INDEX IF NOT EXISTS {DOUBLE_BOOKING_KEY} ON appointments (doctor_name, appointment_time)
+    WHERE status IS NULL OR status <> 'cancelled';
+"""
+
+_COLUMNS = ", ".join(APPOINTMENT_COLUMNS)
+INSERT_SQL = (
+    f"INSERT INTO appointments ({', '.join(APPOINTMENT_WRITE_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    " RETURNING id, created_at, updated_at"
+)
+SELECT_SQL = f"SELECT {_COLUMNS} FROM appointments WHERE id = ?"
+SELECT_VERSION_SQL = "SELECT updated_at FROM appointments WHERE id = ?"
+DELETE_SQL = "DELETE FROM appointments WHERE id = ?"
+SELECT_DOCTORS_SQL = "SELECT DISTINCT doctor_name, doctor_specialty FROM appointments"
+SELECT_BOOKED_SQL = (
+    "SELECT id, doctor_name, doctor_specialty, appointment_time, status FROM appointments"
+    " WHERE appointment_time >= ? AND (status IS NULL OR status <> 'cancelled')"
+)
+
+
+def _update_sql(fields):
+    assignments = ", ".join(f"{field} = ?" for field in fields)
+    return (
+        f"UPDATE appointments SET {assignments}, updated_at = datetime('now', 'localtime')"
+        f" WHERE id = ? RETURNING {_COLUMNS}"
+    )
+
+
+def _qmark(query):
+    return query.replace("%s", "?")
+
+
+def _to_db(value):
+    if isinstance(value, datetime.datetime):
+        # Como mysql-connector: la zona horaria no se guarda
+        return value.replace(tzinfo=None).isoformat(" ")
+    return value
+
+
+def _params(values):
+    return tuple(_to_db(value) for value in values)
+
+
+def _from_db(name, value):
+    if name in DATETIME_COLUMNS and isinstance(value, str):
+        return datetime.datetime.fromisoformat(value)
+    return value
+
+
+def _dict_row(cursor, row):
+    return {column[0]: _from_db(column[0], value) for column, value in zip(cursor.description, row)}
+
+
+def _one(cursor):
+    """Primera fila, consumiendo el resultado: una sentencia a medio leer (p. ej. un
+    INSERT ... RETURNING) deja abierta su transacción implícita"""
+    rows = cursor.fetchall()
+    return rows[0] if rows else None
+
+
+@contextmanager
+def _double_booking_errors():
+    try:
+        yield
+    except sqlite3.IntegrityError as e:
+        if "appointments.doctor_name, appointments.appointment_time" in str(e):
+            raise DoubleBookingError(str(e)) from e
+        raise
+
+
+class SQLiteRepository(AppointmentRepository):
+    def __init__(self, path, pool_size=5, busy_timeout=5.0, export_fetch_size=1000, pool_timeout=5.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.busy_timeout = busy_timeout
+        self.export_fetch_size = export_fetch_size
+        self._pool = None
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            isolation_level=None,  # autocommit; las transacciones se abren explícitamente
+            check_same_thread=False,  # cada conexión la usa un hilo del threadpool a la vez
+            cached_statements=256,
+        )
+        conn.row_factory = _dict_row
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Con WAL, NORMAL solo arriesga la última transacción ante un corte de luz, no la integridad
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _open_sync(self):
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        pool = queue.Queue()
+        pool.put(conn)
+        for _ in range(self.pool_size - 1):
+            pool.put(self._connect())
+        self._pool = pool
+
+    async def open(self):
+        await run_in_threadpool(self._open_sync)
+
+    async def close(self):
+        pool, self._pool = self._pool, None
+        while pool is not None and not pool.empty():
+            pool.get_nowait().close()
+
+    def _ping_sync(self):
+        with self._connection() as conn:
+            conn.execute("SELECT 1").fetchone()
+
+    async def ping(self):
+        await self._run(self._ping_sync)
+
+    def in_use(self):
+        # Las conexiones se abren todas en open(): las que faltan en la cola están prestadas
+        pool = self._pool
+        return self.pool_size - pool.qsize() if pool is not None else 0
+
+    @contextmanager
+    def _connection(self):
+        if self._pool is None:
+            raise RuntimeError("SQLite repository is not open")
+        with phase("connect"):
+            try:
+                conn = self._pool.get(timeout=self.pool_timeout)
+            except queue.Empty:
+                logger.error("Timed out after %ss waiting for a database connection", self.pool_timeout)
+                raise HTTPException(status_code=503, detail="Database busy, try again later")
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection() as conn:
+            # IMMEDIATE toma el bloqueo de escritura al empezar: sin deadlocks al promover una lectura
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.commit()
+
+    def _run(self, func, *args):
+        return run_in_threadpool(func, *args)
+
+    # --- Escrituras ---
+    def _create_sync(self, values):
+        with _double_booking_errors(), self._connection() as conn, phase("query"):
+            return _one(conn.execute(INSERT_SQL, _params(values)))
+
+    async def create(self, values):
+        return await self._run(self._create_sync, values)
+
+    def _create_many_sync(self, rows):
+        with _double_booking_errors(), self._transaction() as conn, phase("query"):
+            return [_one(conn.execute(INSERT_SQL, _params(values))) for values in rows]
+
+    async def create_many(self, rows):
+        return await self._run(self._create_many_sync, rows)
+
+    def _update_one(self, conn, appointment_id, changes):
+        if not changes:
+            return _one(conn.execute(SELECT_SQL, (appointment_id,)))
+        params = _params((*changes.values(), appointment_id))
+        return _one(conn.execute(_update_sql(changes), params))
+
+    def _update_sync(self, appointment_id, changes):
+        with _double_booking_errors(), self._connection() as conn, phase("query"):
+            return self._update_one(conn, appointment_id, changes)
+
+    async def update(self, appointment_id, changes):
+        return await self._run(self._update_sync, appointment_id, changes)
+
+    def _update_many_sync(self, items):
+        found, rows = [], {}
+        with _double_booking_errors(), self._transaction() as conn, phase("query"):
+            for appointment_id, changes in items:
+                row = self._update_one(conn, appointment_id, changes)
+                found.append(row is not None)
+                if row is not None:
+                    rows[appointment_id] = row
+        return found, rows
+
+    async def update_many(self, items):
+        return await self._run(self._update_many_sync, items)
+
+    def _delete_sync(self, appointment_id):
+        with self._connection() as conn, phase("query"):
+            return conn.execute(DELETE_SQL, (appointment_id,)).rowcount > 0
+
+    async def delete(self, appointment_id):
+        return await self._run(self._delete_sync, appointment_id)
+
+    # --- Lecturas ---
+    def _fetchone(self, sql, params):
+        with self._connection() as conn:
+            with phase("query"):
+                cursor = conn.execute(sql, _params(params))
+            with phase("fetch"):
+                return _one(cursor)
+
+    def _fetchall(self, sql, params):
+        with self._connection() as conn:
+            with phase("query"):
+                cursor = conn.execute(sql, _params(params))
+            with phase("fetch"):
+                return cursor.fetchall()
+
+    def _fetchall_tuples(self, sql, params, columns):
+        dates = [i for i, column in enumerate(columns) if column in DATETIME_COLUMNS]
+        with self._connection() as conn:
+            with phase("query"):
+                cursor = conn.cursor()
+                cursor.row_factory = None
+                cursor.execute(sql, _params(params))
+            with phase("fetch"):
+                rows = cursor.fetchall()
+                if not dates:
+                    return rows
+                # SQLite guarda las fechas como texto; solo esas columnas se convierten
+                converted = []
+                for row in rows:
+                    row = list(row)
+                    for i in dates:
+                        if isinstance(row[i], str):
+                            row[i] = datetime.datetime.fromisoformat(row[i])
+                    converted.append(tuple(row))
+                return converted
+
+    async def get(self, appointment_id):
+        return await self._run(self._fetchone, SELECT_SQL, (appointment_id,))
+
+    async def get_version(self, appointment_id):
+        return await self._run(self._fetchone, SELECT_VERSION_SQL, (appointment_id,))
+
+    async def list(self, columns, filters, cursor, limit):
+        query, params = build_list_query(columns, filters, cursor, limit)
+        return await self._run(self._fetchall, _qmark(query), params)
+
+    async def list_rows(self, columns, filters, cursor, limit):
+        query, params = build_list_query(columns, filters, cursor, limit)
+        return await self._run(self._fetchall_tuples, _qmark(query), params, columns)
+
+    async def list_version(self, filters, cursor, limit):
+        query, params = build_list_version_query(filters, cursor, limit)
+        return await self._run(self._fetchone, _qmark(query), params)
+
+    def _load_availability_sync(self, since):
+        with self._connection() as conn:
+            doctors = [tuple(row.values()) for row in conn.execute(SELECT_DOCTORS_SQL)]
+            booked = [tuple(row.values()) for row in conn.execute(SELECT_BOOKED_SQL, (_to_db(since),))]
+        return doctors, booked
+
+    async def load_availability(self, since):
+        return await self._run(self._load_availability_sync, since)
+
+    def _export_sync(self, query, params, header, encode_rows):
+        """Generador: EXPORT_FETCH_SIZE filas por chunk; la conexión vuelve al pool al terminar"""
+        with self._connection() as conn:
+            cursor = conn.execute(query, _params(params))
+            try:
+                yield header
+                while True:
+                    rows = cursor.fetchmany(self.export_fetch_size)
+                    if not rows:
+                        break
+                    yield encode_rows([tuple(row.values()) for row in rows])
+            finally:
+                cursor.close()
+
+    async def export(self, columns, filters, header, encode_rows):
+        query, params = build_filtered_select(columns, filters)
+        chunks = self._export_sync(_qmark(query), params, header, encode_rows)
+        first = await run_in_threadpool(next, chunks)
+        # Starlette itera los generadores sync en el threadpool, un chunk por vez
+        return itertools.chain([first], chunks)
@@ -36,6 +36,7 @@ fi
 
 echo "Prometheus iniciado correctamente en puerto 9090"
 
-# Iniciar la aplicación FastAPI
+# Iniciar la aplicación FastAPI: un worker por CPU (WEB_CONCURRENCY para fijar otro número).
+# Con varios workers la caché en memoria se desactiva: CACHE_BACKEND=redis para cachear
 echo "Iniciando appointment-service en puerto 80"
-exec uvicorn main:app --host 0.0.0.0 --port 80
+exec python serve.py
@@ -0,0 +1,367 @@
+"""Trazas distribuidas con OpenTelemetry: muestreo en cabeza y en cola, exportación por lotes.
+
+TRACE_EXPORTER elige a dónde van: "none" (por defecto; sin instrumentación ni
+coste), "otlp" (OTLP/HTTP), "console" o "memory" (tests y benchmarks).
+
+Muestreo, decidido por trace id igual que TraceIdRatioBased, así el gateway y
+este servicio eligen las mismas trazas:
+- Cabeza (head_ratio): trazas que se registran y se exportan siempre. Si la
+  petición trae un traceparent (W3C) muestreado, se exporta también aquí.
+- Cola (tail_ratio): fracción de trazas que se registra para decidir al final.
+  Las que no entraron por cabeza solo se exportan si la petición tardó más de
+  tail_latency o terminó con error. Registrar tiene coste: con tail_ratio = 0,
+  las trazas no muestreadas no crean spans reales.
+
+Exportación: BatchSpanProcessor exporta desde su propio hilo, con una cola
+acotada; si se llena descarta spans en lugar de bloquear la petición.
+"""
+import threading
+from contextlib import nullcontext
+
+from opentelemetry import context as context_api
+from opentelemetry import trace
+from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.sdk.trace.sampling import Decision, Sampler, SamplingResult
+from opentelemetry.trace import SpanContext, SpanKind, Status, StatusCode, TraceFlags
+from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+
+from profiling import request_phases
+from repository import AppointmentRepository
+
+_TRACE_ID_LIMIT = (1 << 64) - 1
+_propagator = TraceContextTextMapPropagator()
+_TRACE_HEADERS = frozenset(name.encode("latin-1") for name in _propagator.fields)
+
+
+class NoopTracer:
+    """Tracer de TRACE_EXPORTER=none: no toca el contexto ni crea spans"""
+
+    def start_as_current_span(self, name, **kwargs):
+        return nullcontext()
+
+
+class ServiceTracer:
+    """Tracer del SDK que no crea spans hijos de una traza que no se registra.
+
+    El sampler los descartaría igual; así se ahorra crearlos (y su contexto)
+    en el 99 % de peticiones que no se muestrean.
+    """
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def start_span(self, name, context=None, **kwargs):
+        return self.tracer.start_span(name, context=context, **kwargs)
+
+    def start_as_current_span(self, name, **kwargs):
+        current = trace.get_current_span()
+        if current.get_span_context().is_valid and not current.is_recording():
+            return nullcontext(current)
+        return self.tracer.start_as_current_span(name, **kwargs)
+
+
+class TracingMiddleware:
+    """Middleware ASGI: un span de servidor por petición, que continúa el traceparent (W3C) del cliente.
+
+    get_tracer se consulta en cada petición, así las trazas se activan o se
+    sustituyen (tests) sin reconstruir la app. En las peticiones no registradas
+    solo se crea el span y se deja en el contexto, para que los hijos lo sigan.
+    """
+
+    def __init__(self, app, get_tracer, excluded_prefixes=()):
+        self.app = app
+        self.get_tracer = get_tracer
+        self.excluded_prefixes = tuple(excluded_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        tracer = self.get_tracer()
+        if (
+            scope["type"] != "http"
+            or isinstance(tracer, NoopTracer)
+            or scope["path"].startswith(self.excluded_prefixes)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        carrier = {
+            name.decode("latin-1"): value.decode("latin-1")
+            for name, value in scope["headers"]
+            if name in _TRACE_HEADERS
+        }
+        method = scope["method"]
+        span = tracer.start_span(
+            method, context=_propagator.extract(carrier) if carrier else None, kind=SpanKind.SERVER
+        )
+        token = context_api.attach(trace.set_span_in_context(span))
+        if not span.is_recording():
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                context_api.detach(token)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception as exc:
+            span.record_exception(exc)
+            raise
+        finally:
+            # El router deja la ruta en el scope: nombre de baja cardinalidad
+            route = getattr(scope.get("route"), "path", None)
+            if route is not None:
+                span.update_name(f"{method} {route}")
+                span.set_attribute("http.route", route)
+            span.set_attribute("http.request.method", method)
+            span.set_attribute("url.path", scope["path"])
+            span.set_attribute("http.response.status_code", status_code)
+            if status_code >= 500:
+                span.set_status(Status(StatusCode.ERROR))
+            span.end()
+            context_api.detach(token)
+
+
+class HeadTailSampler(Sampler):
+    def __init__(self, head_ratio, tail_ratio=0.0):
+        self.set_ratios(head_ratio, tail_ratio)
+
+    def set_ratios(self, head_ratio, tail_ratio=0.0):
+        """Cambia las fracciones en caliente (las trazas ya empezadas no cambian)"""
+        self.head_ratio = head_ratio
+        self.tail_ratio = tail_ratio
+        self._head_bound = round(head_ratio * (_TRACE_ID_LIMIT + 1))
+        self._tail_bound = round(tail_ratio * (_TRACE_ID_LIMIT + 1))
+
+    def _by_trace_id(self, trace_id):
+        low = trace_id & _TRACE_ID_LIMIT
+        if low < self._head_bound:
+            return Decision.RECORD_AND_SAMPLE
+        if low < self._tail_bound:
+            return Decision.RECORD_ONLY
+        return Decision.DROP
+
+    def should_sample(self, parent_context, trace_id, name, kind=None, attributes=None, links=None,
+                      trace_state=None):
+        parent_span = trace.get_current_span(parent_context)
+        parent = parent_span.get_span_context()
+        if not parent.is_valid:
+            return SamplingResult(self._by_trace_id(trace_id), attributes)
+        if parent.trace_flags.sampled:
+            decision = Decision.RECORD_AND_SAMPLE
+        elif not parent.is_remote:
+            # Hijo local: sigue al span padre (registrado para la cola o descartado)
+            decision = Decision.RECORD_ONLY if parent_span.is_recording() else Decision.DROP
+        else:
+            # El servicio anterior no la muestreó: aquí solo puede entrar por la cola
+            low = trace_id & _TRACE_ID_LIMIT
+            decision = Decision.RECORD_ONLY if low < self._tail_bound else Decision.DROP
+        # El SDK pone al span los atributos que devuelve el sampler, no los de start_span
+        return SamplingResult(decision, attributes, parent.trace_state)
+
+    def get_description(self):
+        return f"HeadTailSampler{{head={self.head_ratio}, tail={self.tail_ratio}}}"
+
+
+def _as_sampled(span):
+    """Copia de un span registrado sin muestrear, marcado como muestreado para el exportador"""
+    context = span.context
+    return ReadableSpan(
+        name=span.name,
+        context=SpanContext(
+            context.trace_id, context.span_id, context.is_remote, TraceFlags(TraceFlags.SAMPLED),
+            context.trace_state,
+        ),
+        parent=span.parent,
+        resource=span.resource,
+        attributes=span.attributes,
+        events=span.events,
+        links=span.links,
+        kind=span.kind,
+        status=span.status,
+        start_time=span.start_time,
+        end_time=span.end_time,
+        instrumentation_scope=span.instrumentation_scope,
+    )
+
+
+class TailSamplingProcessor(SpanProcessor):
+    """Retiene los spans registrados sin muestrear hasta que acaba su raíz local, y decide.
+
+    Cuenta como error que la raíz (el span de servidor, que lo marca en los 5xx)
+    o un span de cliente (la BD) terminen en ERROR; un 404 no lo es. Los
+    muestreados en cabeza pasan directamente a processor. Como mucho se
+    retienen max_traces trazas; si hay más, se descarta la más antigua.
+    """
+
+    def __init__(self, processor, latency_threshold, max_traces=1000, on_decision=None):
+        self.processor = processor
+        self.latency_threshold_ns = int(latency_threshold * 1e9)
+        self.max_traces = max_traces
+        self.on_decision = on_decision
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def on_start(self, span, parent_context=None):
+        pass
+
+    def on_end(self, span):
+        if span.context.trace_flags.sampled:
+            self.processor.on_end(span)
+            return
+        trace_id = span.context.trace_id
+        with self._lock:
+            spans = self._pending.get(trace_id)
+            if spans is None:
+                if len(self._pending) >= self.max_traces:
+                    del self._pending[next(iter(self._pending))]
+                spans = self._pending[trace_id] = []
+            spans.append(span)
+            if span.parent is not None and not span.parent.is_remote:
+                return
+            del self._pending[trace_id]
+        keep = (
+            span.end_time - span.start_time >= self.latency_threshold_ns
+            or any(
+                s.status.status_code is StatusCode.ERROR and (s is span or s.kind is SpanKind.CLIENT)
+                for s in spans
+            )
+        )
+        if self.on_decision is not None:
+            self.on_decision(keep)
+        if keep:
+            for pending in spans:
+                self.processor.on_end(_as_sampled(pending))
+
+    def shutdown(self):
+        self.processor.shutdown()
+
+    def force_flush(self, timeout_millis=30000):
+        return self.processor.force_flush(timeout_millis)
+
+
+def create_exporter(kind, endpoint=None):
+    if kind == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+
+        return OTLPSpanExporter(endpoint=endpoint)
+    if kind == "console":
+        return ConsoleSpanExporter()
+    if kind == "memory":
+        return InMemorySpanExporter()
+    raise ValueError(f"Unknown trace exporter: {kind}")
+
+
+class Tracing:
+    """Proveedor, tracer y sampler de un servicio; exporter queda accesible para los tests"""
+
+    def __init__(self, service_name, exporter, head_ratio, tail_ratio=0.0, tail_latency=0.5,
+                 queue_size=2048, batch_size=512, export_delay=5.0, on_tail_decision=None):
+        self.exporter = exporter
+        self.sampler = HeadTailSampler(head_ratio, tail_ratio)
+        self.provider = TracerProvider(
+            sampler=self.sampler, resource=Resource.create({SERVICE_NAME: service_name})
+        )
+        batch = BatchSpanProcessor(
+            exporter,
+            max_queue_size=queue_size,
+            max_export_batch_size=batch_size,
+            schedule_delay_millis=export_delay * 1000,
+        )
+        self.provider.add_span_processor(
+            TailSamplingProcessor(batch, tail_latency, on_decision=on_tail_decision)
+        )
+        self.tracer = ServiceTracer(self.provider.get_tracer(service_name))
+
+    def shutdown(self):
+        self.provider.shutdown()
+
+
+class TracedRepository(AppointmentRepository):
+    """Un span de cliente por operación de la BD, con la espera del pool y los tiempos de query/fetch"""
+
+    def __init__(self, inner, tracer, db_system):
+        self.inner = inner
+        self.tracer = tracer
+        self.db_system = db_system
+
+    async def _traced(self, method, operation, *args):
+        attributes = {
+            "db.system": self.db_system,
+            "db.operation.name": operation,
+            "db.collection.name": "appointments",
+            "code.function": method,
+        }
+        with self.tracer.start_as_current_span(
+            f"{operation} appointments", kind=SpanKind.CLIENT, attributes=attributes
+        ) as span:
+            before = request_phases() if span.is_recording() else None
+            result = await getattr(self.inner, method)(*args)
+            if before is not None:
+                after = request_phases() or {}
+                for name in ("connect", "query", "fetch"):
+                    elapsed = after.get(name, 0.0) - before.get(name, 0.0)
+                    if elapsed > 0:
+                        span.set_attribute(f"db.{name}_ms", round(elapsed * 1000, 3))
+            return result
+
+    async def open(self):
+        await self.inner.open()
+
+    async def close(self):
+        await self.inner.close()
+
+    # Sondas y arranque: sin spans
+    async def warm_up(self, connections):
+        await self.inner.warm_up(connections)
+
+    async def ping(self):
+        await self.inner.ping()
+
+    def in_use(self):
+        return self.inner.in_use()
+
+    async def create(self, values):
+        return await self._traced("create", "INSERT", values)
+
+    async def create_many(self, rows):
+        return await self._traced("create_many", "INSERT", rows)
+
+    async def get(self, appointment_id):
+        return await self._traced("get", "SELECT", appointment_id)
+
+    async def get_version(self, appointment_id):
+        return await self._traced("get_version", "SELECT", appointment_id)
+
+    async def list(self, columns, filters, cursor, limit):
+        return await self._traced("list", "SELECT", columns, filters, cursor, limit)
+
+    async def list_rows(self, columns, filters, cursor, limit):
+        return await self._traced("list_rows", "SELECT", columns, filters, cursor, limit)
+
+    async def list_version(self, filters, cursor, limit):
+        return await self._traced("list_version", "SELECT", filters, cursor, limit)
+
+    async def update(self, appointment_id, changes):
+        return await self._traced("update", "UPDATE", appointment_id, changes)
+
+    async def update_many(self, items):
+        return await self._traced("update_many", "UPDATE", items)
+
+    async def delete(self, appointment_id):
+        return await self._traced("delete", "DELETE", appointment_id)
+
+    async def export(self, columns, filters, header, encode_rows):
+        return await self._traced("export", "SELECT", columns, filters, header, encode_rows)
+
+    async def load_availability(self, since):
+        return await self._traced("load_availability", "SELECT", since)
@@ -0,0 +1,454 @@
+"""Load test of appointment-service and the API gateway, fully local.
+
+Starts appointment-service on its embedded SQLite backend (or on a real MySQL
+with --mysql) and the gateway in front of it, each in its own process, then
+drives mixed read/write workloads at fixed concurrency levels. With
+--in-process the service app is called directly through ASGI, without sockets
+or a separate process, to measure the service and its repository alone. Every scenario
+runs a fixed number of requests with a seeded operation mix, so two runs issue
+the same requests in the same proportions.
+
+    python loadtest.py --output results.json
+    python loadtest.py --in-process --workload mixed
+    python loadtest.py --save-baseline baseline.json
+    python loadtest.py --baseline baseline.json --threshold 0.15
+    python loadtest.py --compare results.json --baseline baseline.json
+
+Results are JSON: RPS, p50/p95/p99 latency and error rate per
+"<workload>@c<concurrency>" scenario. With --baseline the exit status is 1 when
+any scenario regressed by more than the threshold.
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+GATEWAY_DIR = os.path.join(BENCH_DIR, "..", "api-gateway")
+SERVICE_DIR = os.path.join(BENCH_DIR, "..", "appointment-service")
+
+# Operation weights of each workload
+WORKLOADS: Dict[str, Dict[str, int]] = {
+    "read_heavy": {"get": 50, "list": 30, "filter": 15, "create": 5},
+    "mixed": {"get": 30, "list": 20, "filter": 10, "availability": 5, "create": 20, "update": 15},
+    "write_heavy": {"create": 50, "update": 40, "get": 10},
+}
+DEFAULT_CONCURRENCY = (10, 50)
+DOCTORS = 20
+
+
+# --- Statistics and comparison ---
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(len(sorted_values) * fraction))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    total = len(latencies)
+    return {
+        "requests": total,
+        "rps": round(total / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "error_rate": round(errors / total, 4) if total else 0.0,
+    }
+
+
+def compare(
+    current: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float,
+    max_error_rate_increase: float = 0.01,
+) -> List[str]:
+    """Regressions of current against baseline, one message each; empty when none"""
+    regressions = []
+    for name, base in sorted(baseline.items()):
+        result = current.get(name)
+        if result is None:
+            regressions.append(f"{name}: missing from the current results")
+            continue
+        if result["rps"] < base["rps"] * (1 - threshold):
+            regressions.append(f"{name}: rps {result['rps']} < baseline {base['rps']}")
+        for metric in ("p95_ms", "p99_ms"):
+            if result[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{name}: {metric} {result[metric]} > baseline {base[metric]}")
+        if result["error_rate"] > base["error_rate"] + max_error_rate_increase:
+            regressions.append(f"{name}: error_rate {result['error_rate']} > baseline {base['error_rate']}")
+    return regressions
+
+
+# --- Workload ---
+class Workload:
+    """Builds the requests of each operation; new appointments never share a slot.
+
+    prefix is "/appointments" through the gateway, which proxies
+    /appointments/<path> to <path> on the service.
+    """
+
+    def __init__(self, prefix: str, seed_rows: int) -> None:
+        self.prefix = prefix
+        self.seed_rows = seed_rows
+        self._slots = itertools.count()
+        self._created: List[int] = []
+
+    def _new_slot(self) -> Tuple[str, str]:
+        n = next(self._slots)
+        start = datetime.datetime(2040, 1, 2, 8, 0) + datetime.timedelta(minutes=30 * (n // DOCTORS))
+        return f"Dr. Bench {n % DOCTORS}", start.isoformat()
+
+    def _known_id(self, rng: random.Random) -> int:
+        if self._created and (not self.seed_rows or rng.random() < 0.5):
+            return rng.choice(self._created)
+        return rng.randint(1, max(self.seed_rows, 1))
+
+    def request(self, op: str, rng: random.Random) -> Tuple[str, str, Dict[str, Any]]:
+        base = f"{self.prefix}/appointments"
+        if op == "get":
+            return "GET", f"{base}/{self._known_id(rng)}", {}
+        if op == "list":
+            return "GET", f"{base}/", {"params": {"limit": 20}}
+        if op == "filter":
+            return "GET", f"{base}/", {"params": {"doctor_name": f"Dr. {rng.randrange(DOCTORS)}", "limit": 20}}
+        if op == "availability":
+            params = {"doctor_name": f"Dr. {rng.randrange(DOCTORS)}"}
+            return "GET", f"{self.prefix}/availability/slots", {"params": params}
+        if op == "create":
+            doctor, start = self._new_slot()
+            n = rng.randrange(1_000_000)
+            return "POST", f"{base}/", {"json": {
+                "patient_name": f"Bench Patient {n}",
+                "patient_email": f"bench{n}@example.com",
+                "doctor_name": doctor,
+                "doctor_specialty": "Bench",
+                "appointment_time": start,
+            }}
+        if op == "update":
+            return "PUT", f"{base}/{self._known_id(rng)}", {"json": {"notes": f"bench note {rng.random()}"}}
+        raise ValueError(f"Unknown operation: {op}")
+
+    def record(self, op: str, response: httpx.Response) -> None:
+        if op == "create" and response.status_code == 200:
+            self._created.append(response.json()["id"])
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    workload: Workload,
+    weights: Dict[str, int],
+    concurrency: int,
+    requests: int,
+    seed: int,
+) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    ops = rng.choices(list(weights), weights=list(weights.values()), k=requests)
+    queue = iter(enumerate(ops))
+    latencies: List[float] = []
+    per_op: Dict[str, List[float]] = {op: [] for op in weights}
+    op_errors: Dict[str, int] = {op: 0 for op in weights}
+
+    async def worker(worker_rng: random.Random) -> None:
+        for _, op in queue:
+            method, url, kwargs = workload.request(op, worker_rng)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                # 404 on a get/update of a random id is part of the workload, not a failure
+                failed = response.status_code >= 500 or response.status_code in (401, 409, 422, 429)
+            except httpx.HTTPError:
+                response, failed = None, True
+            elapsed = time.perf_counter() - start
+            latencies.append(elapsed)
+            per_op[op].append(elapsed)
+            if failed:
+                op_errors[op] += 1
+            elif response is not None:
+                workload.record(op, response)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(random.Random(seed * 1000 + i)) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    result = summarize(latencies, sum(op_errors.values()), elapsed)
+    result["concurrency"] = concurrency
+    result["operations"] = {
+        op: {"requests": len(values), "errors": op_errors[op]} for op, values in per_op.items() if values
+    }
+    return result
+
+
+# --- Processes under test ---
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_healthy(url: str, process: subprocess.Popen, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            if httpx.get(f"{url}/health", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not become healthy in {timeout}s")
+
+
+def seed_database(path: str, seed_rows: int, doctors: int = DOCTORS) -> None:
+    """Creates the service's SQLite schema and seeds seed_rows appointments on distinct slots"""
+    sys.path.insert(0, os.path.abspath(SERVICE_DIR))
+    from sqlite_repository import SCHEMA
+
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        start = datetime.datetime(2030, 1, 7, 8, 0)
+        statuses = ("scheduled", "completed", "rescheduled", "cancelled")
+        db.execute("BEGIN")
+        db.executemany(
+            "INSERT INTO appointments (patient_name, patient_email, doctor_name, doctor_specialty,"
+            " appointment_time, status) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    f"Patient {i}", f"patient{i}@example.com", f"Dr. {i % doctors}", f"Specialty {i % 5}",
+                    (start + datetime.timedelta(minutes=30 * (i // doctors))).isoformat(" "),
+                    statuses[i % len(statuses)],
+                )
+                for i in range(seed_rows)
+            ),
+        )
+        db.execute("COMMIT")
+    finally:
+        db.close()
+
+
+class Stack:
+    """appointment-service (and optionally the gateway) as child processes, or the service app in-process"""
+
+    def __init__(self, args: argparse.Namespace, workdir: str) -> None:
+        self.args = args
+        self.workdir = workdir
+        self.processes: List[subprocess.Popen] = []
+        self.service_url = ""
+        self.gateway_url = ""
+        self.app: Any = None
+
+    def _spawn(self, name: str, cmd: List[str], cwd: str, env: Dict[str, str], url: str) -> None:
+        log = open(os.path.join(self.workdir, f"{name}.log"), "w")
+        process = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append(process)
+        wait_healthy(url, process)
+
+    def _service_env(self) -> Dict[str, str]:
+        env = dict(os.environ)
+        if not self.args.mysql:
+            db_path = os.path.join(self.workdir, "appointments.db")
+            seed_database(db_path, self.args.seed_rows)
+            env.update(DB_BACKEND="sqlite", SQLITE_PATH=db_path)
+        env.update(item.split("=", 1) for item in self.args.service_env)
+        return env
+
+    def start(self) -> None:
+        env = self._service_env()
+        if self.args.in_process:
+            # The service reads its settings at import time
+            os.environ.update(env)
+            sys.path.insert(0, os.path.abspath(SERVICE_DIR))
+            import main
+
+            self.app = main.app
+            return
+        port = free_port()
+        self.service_url = f"http://127.0.0.1:{port}"
+        if self.args.service_workers:
+            cmd = [sys.executable, "serve.py"]
+            env.update(WEB_CONCURRENCY=str(self.args.service_workers), HOST="127.0.0.1", PORT=str(port),
+                       LOG_LEVEL="warning")
+        else:
+            cmd = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                   "--log-level", "warning", "--no-access-log"]
+        self._spawn("appointment-service", cmd, SERVICE_DIR, env, self.service_url)
+        if self.args.target == "gateway":
+            port = free_port()
+            self.gateway_url = f"http://127.0.0.1:{port}"
+            cmd = [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+                   "--log-level", "warning", "--no-access-log"]
+            self._spawn("api-gateway", cmd, GATEWAY_DIR,
+                        dict(os.environ, APPOINTMENT_SERVICE_URL=self.service_url), self.gateway_url)
+
+    def lifespan(self) -> Any:
+        """Startup/shutdown of the in-process app (the subprocesses run their own)"""
+        if self.app is None:
+            return contextlib.nullcontext()
+        return self.app.router.lifespan_context(self.app)
+
+    def stop(self) -> None:
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def make_client(stack: Stack, target: str, concurrency: int) -> httpx.AsyncClient:
+    """Client for the target; through the gateway every request carries a JWT"""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    if stack.app is not None:
+        return httpx.AsyncClient(transport=httpx.ASGITransport(app=stack.app), base_url="http://service", timeout=30)
+    if target == "service":
+        return httpx.AsyncClient(base_url=stack.service_url, limits=limits, timeout=30)
+    client = httpx.AsyncClient(base_url=stack.gateway_url, limits=limits, timeout=30)
+    login = await client.post("/login", json={"username": "admin", "password": "123456"})
+    login.raise_for_status()
+    client.headers["Authorization"] = f"Bearer {login.json()['access_token']}"
+    return client
+
+
+async def run(args: argparse.Namespace, stack: Stack) -> Dict[str, Any]:
+    async with stack.lifespan():
+        return await run_scenarios(args, stack)
+
+
+async def run_scenarios(args: argparse.Namespace, stack: Stack) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    workload_seed = itertools.count(args.seed)
+    # One workload for the whole run: scenarios share the database, so new slots must not repeat
+    workload = Workload("/appointments" if args.target == "gateway" else "", args.seed_rows)
+    for name in args.workload:
+        for concurrency in args.concurrency:
+            client = await make_client(stack, args.target, concurrency)
+            try:
+                seed = next(workload_seed)
+                if args.warmup:
+                    await run_scenario(client, workload, WORKLOADS[name], concurrency, args.warmup, seed + 10_000)
+                results[f"{name}@c{concurrency}"] = await run_scenario(
+                    client, workload, WORKLOADS[name], concurrency, args.requests, seed
+                )
+            finally:
+                await client.aclose()
+            print(f"{name}@c{concurrency}: {json.dumps(results[f'{name}@c{concurrency}'])}", file=sys.stderr)
+    return results
+
+
+def load_results(path: str) -> Dict[str, Dict[str, float]]:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return data.get("results", data)
+
+
+def write_json(path: str, data: Dict[str, Any]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workload", action="append", choices=sorted(WORKLOADS),
+                        help="workload to run (repeatable; default: all)")
+    parser.add_argument("--concurrency", type=int, action="append",
+                        help=f"concurrent clients (repeatable; default: {DEFAULT_CONCURRENCY})")
+    parser.add_argument("--requests", type=int, default=2000, help="measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=200, help="unmeasured requests before each scenario")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--seed-rows", type=int, default=5000, help="appointments in the SQLite database")
+    parser.add_argument("--target", choices=("gateway", "service"), default="gateway")
+    parser.add_argument("--mysql", action="store_true",
+                        help="run the service on the MySQL configured by DB_* instead of SQLite")
+    parser.add_argument("--in-process", action="store_true",
+                        help="call the service app through ASGI in this process (implies --target service)")
+    parser.add_argument("--service-workers", type=int, default=0, metavar="N",
+                        help="run the service under serve.py with N workers (default: one uvicorn process)")
+    parser.add_argument("--service-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra environment for appointment-service (repeatable)")
+    parser.add_argument("--output", help="write the results JSON here (default: stdout)")
+    parser.add_argument("--save-baseline", metavar="PATH", help="also store the results as a baseline")
+    parser.add_argument("--baseline", metavar="PATH", help="fail on regressions against this baseline")
+    parser.add_argument("--compare", metavar="RESULTS",
+                        help="compare an existing results file with --baseline instead of running")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed relative drop in rps / rise in p95 and p99 (default: 0.10)")
+    args = parser.parse_args(argv)
+    args.workload = args.workload or list(WORKLOADS)
+    args.concurrency = args.concurrency or list(DEFAULT_CONCURRENCY)
+    if args.in_process:
+        args.target = "service"
+    if args.compare and not args.baseline:
+        parser.error("--compare needs --baseline")
+    return args
+
+
+def check_regressions(current: Dict[str, Dict[str, float]], baseline_path: str, threshold: float) -> int:
+    regressions = compare(current, load_results(baseline_path), threshold)
+    for line in regressions:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    if not regressions:
+        print(f"No regressions against {baseline_path} (threshold {threshold:.0%})", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    if args.compare:
+        return check_regressions(load_results(args.compare), args.baseline, args.threshold)
+
+    with tempfile.TemporaryDirectory(prefix="salus-loadtest-") as workdir:
+        stack = Stack(args, workdir)
+        try:
+            stack.start()
+            results = asyncio.run(run(args, stack))
+        finally:
+            stack.stop()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "target": args.target,
+            "database": "mysql" if args.mysql else "sqlite",
+            "in_process": args.in_process,
+            "service_workers": args.service_workers or 1,
+            "requests": args.requests,
+            "seed": args.seed,
+        },
+        "results": results,
+    }
+    if args.output:
+        write_json(args.output, report)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if args.save_baseline:
+        write_json(args.save_baseline, report)
+    if args.baseline:
+        return check_regressions(results, args.baseline, args.threshold)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
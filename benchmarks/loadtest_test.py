@@ -0,0 +1,89 @@
+import json
+import os
+import sqlite3
+
+import loadtest
+
+
+class TestStatistics:
+    """Percentiles and the per-scenario summary"""
+
+    def test_nearest_rank_percentile(self) -> None:
+        values = [float(v) for v in range(1, 101)]
+        assert loadtest.percentile(values, 0.50) == 50.0
+        assert loadtest.percentile(values, 0.95) == 95.0
+        assert loadtest.percentile(values, 0.99) == 99.0
+        assert loadtest.percentile([0.2], 0.99) == 0.2
+        assert loadtest.percentile([], 0.5) == 0.0
+
+    def test_summarize(self) -> None:
+        summary = loadtest.summarize([0.01] * 90 + [0.1] * 10, errors=5, elapsed=2.0)
+        assert summary == {
+            "requests": 100, "rps": 50.0, "p50_ms": 10.0, "p95_ms": 100.0, "p99_ms": 100.0, "error_rate": 0.05,
+        }
+
+
+BASE = {"mixed@c10": {"rps": 100.0, "p50_ms": 10.0, "p95_ms": 20.0, "p99_ms": 30.0, "error_rate": 0.0}}
+
+
+class TestCompare:
+    """Regression checks against a stored baseline"""
+
+    def test_within_threshold(self) -> None:
+        current = {"mixed@c10": dict(BASE["mixed@c10"], rps=95.0, p95_ms=21.0)}
+        assert loadtest.compare(current, BASE, threshold=0.10) == []
+
+    def test_throughput_and_latency_regressions(self) -> None:
+        current = {"mixed@c10": dict(BASE["mixed@c10"], rps=80.0, p99_ms=40.0)}
+        regressions = loadtest.compare(current, BASE, threshold=0.10)
+        assert len(regressions) == 2
+        assert regressions[0].startswith("mixed@c10: rps")
+        assert regressions[1].startswith("mixed@c10: p99_ms")
+
+    def test_error_rate_and_missing_scenario(self) -> None:
+        current = {"mixed@c10": dict(BASE["mixed@c10"], error_rate=0.05)}
+        baseline = dict(BASE, **{"write_heavy@c50": BASE["mixed@c10"]})
+        regressions = loadtest.compare(current, baseline, threshold=0.10)
+        assert regressions == [
+            "mixed@c10: error_rate 0.05 > baseline 0.0",
+            "write_heavy@c50: missing from the current results",
+        ]
+
+    def test_compare_mode_exit_status(self, tmp_path, capsys) -> None:
+        baseline, results = tmp_path / "baseline.json", tmp_path / "results.json"
+        baseline.write_text(json.dumps({"meta": {}, "results": BASE}))
+        results.write_text(json.dumps({"meta": {}, "results": {"mixed@c10": dict(BASE["mixed@c10"], rps=50.0)}}))
+        assert loadtest.main_cli(["--compare", str(results), "--baseline", str(baseline)]) == 1
+        assert "REGRESSION mixed@c10: rps" in capsys.readouterr().err
+        assert loadtest.main_cli(["--compare", str(baseline), "--baseline", str(baseline)]) == 0
+
+
+class TestWorkload:
+    """Generated requests"""
+
+    def test_new_appointments_never_share_a_slot(self) -> None:
+        workload = loadtest.Workload("/appointments", seed_rows=10)
+        rng = loadtest.random.Random(1)
+        slots = set()
+        for _ in range(200):
+            method, url, kwargs = workload.request("create", rng)
+            assert (method, url) == ("POST", "/appointments/appointments/")
+            slots.add((kwargs["json"]["doctor_name"], kwargs["json"]["appointment_time"]))
+        assert len(slots) == 200
+
+
+class TestSeedDatabase:
+    """The SQLite database the service runs on during load tests"""
+
+    def test_seeded_rows_have_distinct_active_slots(self, tmp_path) -> None:
+        path = os.path.join(tmp_path, "appointments.db")
+        loadtest.seed_database(path, seed_rows=60, doctors=5)
+        db = sqlite3.connect(path)
+        try:
+            assert db.execute("SELECT COUNT(*) FROM appointments").fetchone() == (60,)
+            assert db.execute("SELECT COUNT(DISTINCT doctor_name) FROM appointments").fetchone() == (5,)
+            assert db.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+            first = db.execute("SELECT appointment_time FROM appointments ORDER BY id LIMIT 1").fetchone()
+            assert first == ("2030-01-07 08:00:00",)
+        finally:
+            db.close()